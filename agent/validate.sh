@@ -32,7 +32,7 @@ run_command "~/bin/mypy --pretty --show-error-context --strict src/agent_server.
 run_command "~/bin/mypy --pretty --show-error-context --strict src/telegram_adapter.py"
 
 #,_workflow
-for file in src/test_{async_confirmation_manager,code_specs{,_agent,_commands,_marker_implementation,_path_and_validator,_tests_skeleton,_validator},command_registry,list_files,validate_command_input,write_file_command,agent_loop,read_file_command,search_file_command,shell_command_command}.py; do
+for file in src/test_{async_confirmation_manager,code_specs{,_agent,_commands,_marker_implementation,_path_and_validator,_tests_skeleton,_validator},command_registry,conversation_search,list_files,message,message_bus{,_memory},prompt_cache,swarm_{commands,scheduler,session_pool,workflow},telegram_adapter,trigram_index,validate_command_input,write_file_command,workflow_workers,agent_loop,read_file_command,search_file_command,shell_command_command}.py; do
   run_command "${VALIDATE_PYTHON} -m pytest $file"
 done
 
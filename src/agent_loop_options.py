@@ -31,6 +31,15 @@ class BaseAgentLoop(abc.ABC):
   async def run(self) -> VariableMap:
     pass
 
+  @abc.abstractmethod
+  def set_next_message(self, message: Message) -> None:
+    """Sets the message that the next call to `run` sends first.
+
+    Allows running the loop again (continuing its conversation) after `run`
+    returns.
+    """
+    pass
+
 
 class BaseAgentLoopFactory(abc.ABC):
 
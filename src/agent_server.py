@@ -41,6 +41,20 @@ def parse_arguments() -> argparse.Namespace:
   parser = CreateCommonParser()
   parser.add_argument(
       '--port', type=int, default=5000, help="Port to run the web server on.")
+  parser.add_argument(
+      '--workflow-workers',
+      dest='workflow_workers',
+      type=int,
+      default=0,
+      help="If positive, workflows (from --workflow or created in the web UI) run in this many worker processes, rather than in the web server's process."
+  )
+  parser.add_argument(
+      '--workflow-workers-socket',
+      dest='workflow_workers_socket',
+      type=str,
+      default='/tmp/duende-workers.sock',
+      help="Unix socket through which workflow workers stream their conversations to the web server."
+  )
   return parser.parse_args()
 
 
@@ -49,17 +63,23 @@ async def read_root() -> FileResponse:
   return FileResponse(current_script_dir / "static/index.html")
 
 
-async def send_update(server_state: WebServerState, data: dict[str,
-                                                               Any]) -> None:
+async def send_update(server_state: WebServerState, sid: str,
+                      data: dict[str, Any]) -> None:
   message_count = data.get('message_count', 0)
+  limit = data.get('limit')
   conversation_id = data.get('conversation_id')
   if conversation_id is None:
     logging.error("SendUpdate: conversation_id is missing")
     return
 
-  logging.info(f"Received: request_update, message_count: {message_count}")
+  logging.info(f"Received: request_update, message_count: {message_count}, "
+               f"limit: {limit}")
   await server_state.send_update(
-      conversation_id, message_count, confirmation_required=None)
+      conversation_id,
+      message_count,
+      confirmation_required=None,
+      limit=limit,
+      to=sid)
 
 
 async def main() -> None:
@@ -82,11 +102,11 @@ async def main() -> None:
       logging.error("handle_confirmation: conversation_id is missing")
       return
     server_state.ReceiveConfirmation(confirmation, conversation_id)
-    await send_update(server_state, data)
+    await send_update(server_state, sid, data)
 
   @sio.on('request_update')  # type: ignore[misc]
   async def start_update(sid: str, data: dict[str, Any]) -> None:
-    await send_update(server_state, data)
+    await send_update(server_state, sid, data)
 
   @sio.on('list_conversations')  # type: ignore[misc]
   async def list_conversations(sid: str, data: dict[str, Any]) -> None:
@@ -96,6 +116,15 @@ async def main() -> None:
     limit = data.get('limit', MAX_CONVERSATIONS_PER_LIST_UPDATE)
     await server_state.list_conversations(start_id=start_id)
 
+  @sio.on('search_conversations')  # type: ignore[misc]
+  async def search_conversations(sid: str, data: dict[str, Any]) -> None:
+    query = data.get('query')
+    if not query:
+      logging.error("search_conversations: query is missing")
+      return
+    logging.info(f"Received: search_conversations: {query}")
+    await server_state.search_conversations(sid, query)
+
   @sio.on('create_agent_workflow')  # type:ignore[misc]
   async def create_agent_workflow(sid: str, data: dict[str, Any]) -> None:
     logging.info("Received: create_agent_workflow request")
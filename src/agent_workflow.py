@@ -36,6 +36,14 @@ class AgentWorkflowFactory(ABC):
                 args: dict[str, str]) -> AgentWorkflow:
     pass
 
+  def sharded(self) -> bool:
+    """Whether the workflow can be split across workflow workers.
+
+    If true, `--workflow-workers` runs an instance in every worker; each one
+    receives `shard_index` and `shard_count` in its `args`.
+    """
+    return False
+
 
 class AgentWorkflowFactoryContainer:
 
@@ -15,6 +15,7 @@ from command_registry_factory import CommandRegistryConfig, CommandRegistryWrite
 from confirmation import ConfirmationState, ConfirmationManager
 from file_access_policy import create_file_access_policy, load_file_access_policy, FileAccessPolicy, RegexFileAccessPolicy, CurrentDirectoryFileAccessPolicy, CompositeFileAccessPolicy
 from list_files import list_all_files
+from trigram_index import shared_trigram_index
 from validation import CreateValidationManager, ValidationManager
 from workflow_registry import StandardWorkflowFactoryContainer
 from chatgpt import ChatGPT
@@ -201,6 +202,8 @@ async def CreateAgentWorkflowOptions(
           "Initial validation failed, aborting further operations.")
 
   cwd = PathBox()
+  trigram_index = await shared_trigram_index(
+      pathlib.Path('.'), file_access_policy, repr(file_access_policy_config))
 
   registry = await create_command_registry(
       CommandRegistryConfig(
@@ -213,7 +216,8 @@ async def CreateAgentWorkflowOptions(
       validation_manager,
       start_new_task=lambda task_info: CommandOutput(
           command_name="task", output="", errors="", summary="Not implemented"),
-      git_dirty_accept=args.git_dirty_accept)
+      git_dirty_accept=args.git_dirty_accept,
+      trigram_index=trigram_index)
 
   if args.plugins:
     try:
@@ -230,7 +234,8 @@ async def CreateAgentWorkflowOptions(
       confirmation_manager=confirmation_manager,
       confirm_every=args.confirm_every)
 
-  ask_registry = create_ask_command_registry(cwd, file_access_policy)
+  ask_registry = create_ask_command_registry(cwd, file_access_policy,
+                                             trigram_index)
   registry.Register(
       AskCommand(
           conversation_factory=conversation_factory,
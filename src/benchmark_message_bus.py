@@ -0,0 +1,354 @@
+"""Benchmarks for `MessageBus`.
+
+Usage:
+
+    python3 src/benchmark_message_bus.py [queries|writes|concurrency|pipeline] [flags]
+
+Not part of the tests (it takes a while): run it manually after changes to the
+schema or the queries of the message bus.
+
+`queries` builds a bus with `--rows` messages (almost all already processed and
+sent, as in a long-running swarm) and measures the latency of the queries the
+swarm and the Telegram adapter run constantly, first without the indexes
+(`_MIGRATIONS[1]`) and then with them.
+
+`writes` measures the throughput of writing `--messages` messages: one
+transaction per message, batches (`write_new_messages`) and concurrent writers
+with and without a write-behind window.
+
+`concurrency` measures the latency of lookups (`read_message` and
+`find_message_by_telegram_id`) in a bus with `--rows` messages while
+`--concurrency` writers write continuously, with all the reads in the writer
+thread (`readers=0`) and with a pool of readers.
+
+`pipeline` drives `--messages` messages from synthetic producers (writing
+batches) to consumers (claiming batches and marking them as processed) through
+`SqliteMessageBus` and `InMemoryMessageBus`, for different batch sizes, and
+reports the throughput and the end-to-end latency (from the write to the claim)
+percentiles. Each producer writes its next batch once the previous one has been
+consumed.
+"""
+
+import argparse
+import asyncio
+import datetime
+import logging
+import pathlib
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+from message_bus_memory import InMemoryMessageBus
+from message_bus import END_USER_AGENT, Message, MessageBus, MessageContent, MessageId, SqliteMessageBus, TelegramChatId, TelegramMessageId, WorkerId, _MIGRATIONS
+from swarm_types import AgentName
+
+_AGENT_COUNT = 10
+_CHAT_COUNT = 100
+# Out of every `_BACKLOG_PERIOD` messages, one incoming and one outgoing message
+# are still pending.
+_BACKLOG_PERIOD = 1000
+# For `pipeline`.
+_PRODUCERS = 4
+_CONSUMERS = 4
+_BATCH_SIZES = [1, 10, 100]
+
+
+def _agent(index: int) -> str:
+  return f"agent-{index % _AGENT_COUNT}"
+
+
+def _populate(path: pathlib.Path, rows: int) -> None:
+  """Inserts `rows` messages directly (much faster than `write_new_message`).
+
+  Even rows are from the user to an agent; odd rows are replies to the user.
+  Every row has a Telegram message id except for the pending outgoing ones.
+  """
+  now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+  def _rows() -> list[tuple[object, ...]]:
+    values: list[tuple[object, ...]] = []
+    for i in range(rows):
+      pending = i % _BACKLOG_PERIOD < 2
+      incoming = i % 2 == 0
+      values.append((
+          END_USER_AGENT if incoming else _agent(i),
+          _agent(i) if incoming else END_USER_AGENT,
+          i % _CHAT_COUNT,
+          None if pending and not incoming else i,
+          f"Message {i}",
+          now,
+          None if pending and incoming else now,
+      ))
+    return values
+
+  connection = sqlite3.connect(str(path), isolation_level=None)
+  connection.execute("BEGIN")
+  connection.executemany(
+      """
+      INSERT INTO message_bus (source_agent, target_agent, telegram_chat_id,
+          telegram_message_id, content, queued_at, processed_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?)
+      """, _rows())
+  connection.execute("COMMIT")
+  connection.close()
+
+
+def _execute(path: pathlib.Path, statements: list[str]) -> None:
+  connection = sqlite3.connect(str(path), isolation_level=None)
+  for statement in statements:
+    connection.execute(statement)
+  connection.close()
+
+
+async def _measure(name: str, repetitions: int,
+                   func: Callable[[], Awaitable[object]]) -> None:
+  latencies: list[float] = []
+  for _ in range(repetitions):
+    start = time.perf_counter()
+    await func()
+    latencies.append((time.perf_counter() - start) * 1000)
+  latencies.sort()
+  print(f"  {name:<28} median {statistics.median(latencies):9.3f} ms   "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1]:9.3f} ms")
+
+
+async def _measure_queries(bus: MessageBus, rows: int,
+                           repetitions: int) -> None:
+  agents = [AgentName(_agent(i)) for i in range(_AGENT_COUNT)]
+  await _measure("wait_for_incoming_messages", repetitions,
+                 lambda: bus.wait_for_incoming_messages(agents))
+  await _measure("wait_for_outgoing_messages", repetitions,
+                 bus.wait_for_outgoing_messages)
+
+  def _lookup() -> Awaitable[object]:
+    i = random.randrange(0, rows, _BACKLOG_PERIOD) + 5
+    return bus.find_message_by_telegram_id(
+        TelegramChatId(i % _CHAT_COUNT), TelegramMessageId(i))
+
+  await _measure("find_message_by_telegram_id", repetitions, _lookup)
+
+
+async def benchmark_queries(rows: int, repetitions: int) -> None:
+  with tempfile.TemporaryDirectory() as directory:
+    path = pathlib.Path(directory) / "bus.db"
+    bus = SqliteMessageBus(path)
+    await bus.open()
+    print(f"Populating {rows} rows...")
+    _populate(path, rows)
+
+    _execute(path, [
+        "DROP INDEX message_bus_incoming", "DROP INDEX message_bus_outgoing",
+        "DROP INDEX message_bus_telegram"
+    ])
+    print("Without indexes:")
+    await _measure_queries(bus, rows, repetitions)
+
+    _execute(path, _MIGRATIONS[1])
+    print("With indexes:")
+    await _measure_queries(bus, rows, repetitions)
+    await bus.close()
+
+
+def _new_message(index: int) -> Message:
+  return Message(
+      message_id=MessageId(0),
+      source_agent=END_USER_AGENT,
+      target_agent=AgentName(_agent(index)),
+      local_directory=None,
+      conversation_id=None,
+      telegram_chat_id=TelegramChatId(index % _CHAT_COUNT),
+      telegram_message_id=None,
+      telegram_reply_to_id=None,
+      content=MessageContent(f"Message {index}"),
+      queued_at=datetime.datetime.now(datetime.timezone.utc),
+      processed_at=None)
+
+
+async def _measure_writes(name: str, messages: int,
+                          write_behind: datetime.timedelta | None,
+                          write: Callable[[MessageBus], Awaitable[object]],
+                          directory: pathlib.Path) -> None:
+  bus = SqliteMessageBus(directory / f"{name}.db", write_behind=write_behind)
+  await bus.open()
+  start = time.perf_counter()
+  await write(bus)
+  elapsed = time.perf_counter() - start
+  await bus.close()
+  print(f"  {name:<36} {messages / elapsed:10.0f} messages/s")
+
+
+async def benchmark_writes(messages: int, concurrency: int) -> None:
+
+  async def _one_by_one(bus: MessageBus) -> None:
+    for i in range(messages):
+      await bus.write_new_message(_new_message(i))
+
+  async def _batches(bus: MessageBus) -> None:
+    for start in range(0, messages, 100):
+      await bus.write_new_messages(
+          [_new_message(i) for i in range(start, min(start + 100, messages))])
+
+  async def _concurrent(bus: MessageBus) -> None:
+
+    async def _writer(first: int) -> None:
+      for i in range(first, messages, concurrency):
+        await bus.write_new_message(_new_message(i))
+
+    await asyncio.gather(*(_writer(i) for i in range(concurrency)))
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = pathlib.Path(directory)
+    print(f"Writing {messages} messages:")
+    await _measure_writes("one transaction per message", messages, None,
+                          _one_by_one, path)
+    await _measure_writes("write_new_messages (batches of 100)", messages, None,
+                          _batches, path)
+    await _measure_writes(f"{concurrency} concurrent writers", messages, None,
+                          _concurrent, path)
+    await _measure_writes(f"{concurrency} concurrent writers, write-behind",
+                          messages, datetime.timedelta(milliseconds=1),
+                          _concurrent, path)
+
+
+async def benchmark_concurrency(rows: int, repetitions: int,
+                                concurrency: int) -> None:
+  with tempfile.TemporaryDirectory() as directory:
+    for readers in [0, 4]:
+      path = pathlib.Path(directory) / f"readers-{readers}.db"
+      bus = SqliteMessageBus(path, readers=readers)
+      await bus.open()
+      _populate(path, rows)
+      stop = asyncio.Event()
+      written = 0
+
+      async def _writer(first: int) -> None:
+        nonlocal written
+        i = rows + first
+        while not stop.is_set():
+          await bus.write_new_message(_new_message(i))
+          written += 1
+          i += concurrency
+
+      def _read() -> Awaitable[object]:
+        return bus.read_message(MessageId(random.randrange(1, rows)))
+
+      def _lookup() -> Awaitable[object]:
+        i = random.randrange(0, rows, _BACKLOG_PERIOD) + 5
+        return bus.find_message_by_telegram_id(
+            TelegramChatId(i % _CHAT_COUNT), TelegramMessageId(i))
+
+      print(f"{readers} readers, {concurrency} concurrent writers:")
+      writers = [asyncio.create_task(_writer(i)) for i in range(concurrency)]
+      start = time.perf_counter()
+      await _measure("read_message", repetitions, _read)
+      await _measure("find_message_by_telegram_id", repetitions, _lookup)
+      elapsed = time.perf_counter() - start
+      stop.set()
+      await asyncio.gather(*writers)
+      print(f"  {'writes':<28} {written / elapsed:9.0f} messages/s")
+      await bus.close()
+
+
+def _percentile(values: list[float], percentile: int) -> float:
+  """`values` must be sorted."""
+  return values[min(len(values) - 1, len(values) * percentile // 100)]
+
+
+async def _measure_pipeline(name: str, bus: MessageBus, messages: int,
+                            batch_size: int) -> None:
+  agents = [AgentName(_agent(i)) for i in range(_AGENT_COUNT)]
+  # Keyed by content (known before the message is written).
+  written_at: dict[str, float] = {}
+  latencies: list[float] = []
+  # Each producer waits until its previous batch is consumed (so the latency
+  # doesn't include an ever-growing backlog).
+  outstanding: dict[str, asyncio.Event] = {}
+  done = asyncio.Event()
+
+  async def _producer(first: int) -> None:
+    indices = list(range(first, messages, _PRODUCERS))
+    for start in range(0, len(indices), batch_size):
+      batch = [_new_message(i) for i in indices[start:start + batch_size]]
+      consumed = [asyncio.Event() for _ in batch]
+      now = time.perf_counter()
+      for message, event in zip(batch, consumed):
+        written_at[message.content] = now
+        outstanding[message.content] = event
+      await bus.write_new_messages(batch)
+      for event in consumed:
+        await event.wait()
+
+  async def _consumer(index: int) -> None:
+    worker_id = WorkerId(f"consumer-{index}")
+    while True:
+      claimed = await bus.wait_for_claimed_messages(
+          agents, worker_id, datetime.timedelta(minutes=1), limit=batch_size)
+      now = time.perf_counter()
+      latencies.extend((now - written_at[m.content]) * 1000 for m in claimed)
+      await bus.mark_processed_many([m.message_id for m in claimed])
+      for message in claimed:
+        outstanding.pop(message.content).set()
+      if len(latencies) >= messages:
+        done.set()
+
+  await bus.open()
+  consumers = [asyncio.create_task(_consumer(i)) for i in range(_CONSUMERS)]
+  start = time.perf_counter()
+  await asyncio.gather(*(_producer(i) for i in range(_PRODUCERS)))
+  await done.wait()
+  elapsed = time.perf_counter() - start
+  for consumer in consumers:
+    consumer.cancel()
+  await asyncio.gather(*consumers, return_exceptions=True)
+  await bus.close()
+  latencies.sort()
+  print(f"  {name:<24} {messages / elapsed:9.0f} messages/s   latency "
+        f"p50 {_percentile(latencies, 50):8.3f} ms   "
+        f"p95 {_percentile(latencies, 95):8.3f} ms   "
+        f"p99 {_percentile(latencies, 99):8.3f} ms")
+
+
+async def benchmark_pipeline(messages: int) -> None:
+  print(f"{messages} messages, {_PRODUCERS} producers, "
+        f"{_CONSUMERS} consumers:")
+  with tempfile.TemporaryDirectory() as directory:
+    for batch_size in _BATCH_SIZES:
+      await _measure_pipeline(
+          f"sqlite, batches of {batch_size}",
+          SqliteMessageBus(pathlib.Path(directory) / f"{batch_size}.db"),
+          messages, batch_size)
+      await _measure_pipeline(f"memory, batches of {batch_size}",
+                              InMemoryMessageBus(), messages, batch_size)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      'benchmark',
+      nargs='?',
+      default='queries',
+      choices=['queries', 'writes', 'concurrency', 'pipeline'])
+  parser.add_argument('--rows', type=int, default=1_000_000)
+  parser.add_argument('--repetitions', type=int, default=20)
+  parser.add_argument('--messages', type=int, default=5000)
+  parser.add_argument('--concurrency', type=int, default=20)
+  args = parser.parse_args()
+  # The bus logs every message read.
+  logging.basicConfig(level=logging.WARNING)
+  match args.benchmark:
+    case 'queries':
+      asyncio.run(benchmark_queries(args.rows, args.repetitions))
+    case 'writes':
+      asyncio.run(benchmark_writes(args.messages, args.concurrency))
+    case 'concurrency':
+      asyncio.run(
+          benchmark_concurrency(args.rows, args.repetitions, args.concurrency))
+    case 'pipeline':
+      asyncio.run(benchmark_pipeline(args.messages))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,147 @@
+"""Benchmarks for `SearchFileCommand`.
+
+Usage:
+
+    python3 src/benchmark_search_file.py [flags]
+
+Not part of the tests (it takes a while): run it manually after changes to
+`file_search`.
+
+Builds a tree with `--files` text files (of `--lines` lines each, in
+directories of 100 files) and a few binary files, and measures the latency of
+searching the whole tree for a rare term, a frequent term (past the display
+limit) and a regular expression, with the previous implementation (reading
+each file sequentially through `aiofiles` and lowercasing every line) and with
+`SearchFileCommand`, without and with a `TrigramIndex` (also reporting the time
+to build it).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+import aiofiles
+
+from agent_command import VariableMap, VariableName, VariableValueBool, VariableValueStr
+from file_access_policy import CurrentDirectoryFileAccessPolicy, FileAccessPolicy
+from list_files import list_all_files
+from pathbox import PathBox
+from search_file_command import SearchFileCommand
+from trigram_index import TrigramIndex
+
+_WORDS = ["alpha", "beta", "gamma", "delta", "message", "return", "self"]
+_RARE_TERM = "needle_in_haystack"
+_FREQUENT_TERM = "message"
+_REGEX = r"def \w+_needle\("
+_BINARY_FILES = 50
+
+
+def _populate(base: pathlib.Path, files: int, lines: int) -> None:
+  rng = random.Random(0)
+  for i in range(files):
+    directory = base / f"dir_{i // 100}"
+    directory.mkdir(exist_ok=True)
+    contents = [
+        " ".join(rng.choice(_WORDS) for _ in range(8)) for _ in range(lines)
+    ]
+    if i % 1000 == 0:
+      contents[lines // 2] = f"def find_needle(): {_RARE_TERM}"
+    (directory / f"file_{i}.py").write_text("\n".join(contents) + "\n")
+  for i in range(_BINARY_FILES):
+    (base / f"dir_0/blob_{i}.bin").write_bytes(
+        bytes(rng.randrange(256) for _ in range(64 * 1024)))
+
+
+async def _baseline_search(base: pathlib.Path, policy: FileAccessPolicy,
+                           term: str) -> int:
+  """The previous implementation (without the output): returns the matches."""
+  match_count = 0
+  async for path in list_all_files(base, policy):
+    try:
+      async with aiofiles.open(path, mode='r', encoding='utf-8') as file:
+        lines = await file.readlines()
+      match_count += sum(1 for line in lines if term.lower() in line.lower())
+    except Exception:
+      pass
+  return match_count
+
+
+async def _measure(name: str, repetitions: int,
+                   func: Callable[[], Awaitable[object]]) -> None:
+  latencies: list[float] = []
+  for _ in range(repetitions):
+    start = time.perf_counter()
+    await func()
+    latencies.append((time.perf_counter() - start) * 1000)
+  latencies.sort()
+  print(f"  {name:<28} median {statistics.median(latencies):9.3f} ms   "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1]:9.3f} ms")
+
+
+async def _run(files: int, lines: int, repetitions: int) -> None:
+  original_cwd = os.getcwd()
+  with (tempfile.TemporaryDirectory() as
+        directory, tempfile.TemporaryDirectory() as index_directory):
+    # `CurrentDirectoryFileAccessPolicy` only allows files under the cwd.
+    os.chdir(directory)
+    base = pathlib.Path('.')
+    _populate(base, files, lines)
+    policy = CurrentDirectoryFileAccessPolicy()
+    command = SearchFileCommand(PathBox(), policy)
+
+    def _search(term: str,
+                regex: bool = False,
+                command: SearchFileCommand = command) -> Awaitable[object]:
+      return command.run(
+          VariableMap({
+              VariableName('content'): VariableValueStr(term),
+              VariableName('regex'): VariableValueBool(regex),
+          }))
+
+    print(f"{files} files of {lines} lines:")
+    await _measure("baseline (rare)", repetitions,
+                   lambda: _baseline_search(base, policy, _RARE_TERM))
+    await _measure("baseline (frequent)", repetitions,
+                   lambda: _baseline_search(base, policy, _FREQUENT_TERM))
+    await _measure("search_file (rare)", repetitions,
+                   lambda: _search(_RARE_TERM))
+    await _measure("search_file (frequent)", repetitions,
+                   lambda: _search(_FREQUENT_TERM))
+    await _measure("search_file (regex)", repetitions,
+                   lambda: _search(_REGEX, regex=True))
+
+    index = TrigramIndex(base, policy,
+                         pathlib.Path(index_directory) / "index.sqlite")
+    start = time.perf_counter()
+    await index.open()
+    await index.refresh()
+    print(f"  trigram index built in {time.perf_counter() - start:.3f} s")
+    indexed_command = SearchFileCommand(PathBox(), policy, index)
+    await _measure("indexed (rare)", repetitions,
+                   lambda: _search(_RARE_TERM, command=indexed_command))
+    await _measure("indexed (frequent)", repetitions,
+                   lambda: _search(_FREQUENT_TERM, command=indexed_command))
+    await index.close()
+    os.chdir(original_cwd)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--files', type=int, default=10_000)
+  parser.add_argument('--lines', type=int, default=200)
+  parser.add_argument('--repetitions', type=int, default=5)
+  args = parser.parse_args()
+  # `SearchFileCommand` logs every search.
+  logging.basicConfig(level=logging.WARNING)
+  asyncio.run(_run(args.files, args.lines, args.repetitions))
+
+
+if __name__ == '__main__':
+  main()
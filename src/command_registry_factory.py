@@ -23,29 +23,34 @@ from selection_manager import SelectionManager
 from select_python import SelectPythonCommand
 import shell_command_command
 from swarm_commands import DelegateRequestConfig, PublishMessageConfig
-from swarm_types import AgentName
+from swarm_types import AgentName, Topic
 from task_command import TaskInformation
 from validate_command import ValidateCommand
 from validation import ValidationManager
 from pathbox import PathBox
+from trigram_index import TrigramIndex
 from write_file_command import WriteFileCommand
 
 
 def _create_base_registry(
-    cwd: PathBox, file_access_policy: FileAccessPolicy) -> CommandRegistry:
+    cwd: PathBox,
+    file_access_policy: FileAccessPolicy,
+    trigram_index: TrigramIndex | None = None) -> CommandRegistry:
   registry = CommandRegistry()
   registry.Register(ReadFileCommand(cwd))
   registry.Register(ListFilesCommand(cwd, file_access_policy))
-  registry.Register(SearchFileCommand(cwd, file_access_policy))
+  registry.Register(SearchFileCommand(cwd, file_access_policy, trigram_index))
   return registry
 
 
 def create_ask_command_registry(
-    cwd: PathBox, file_access_policy: FileAccessPolicy) -> CommandRegistry:
+    cwd: PathBox,
+    file_access_policy: FileAccessPolicy,
+    trigram_index: TrigramIndex | None = None) -> CommandRegistry:
   registry = CommandRegistry()
   registry.Register(ReadFileCommand(cwd))
   registry.Register(ListFilesCommand(cwd, file_access_policy))
-  registry.Register(SearchFileCommand(cwd, file_access_policy))
+  registry.Register(SearchFileCommand(cwd, file_access_policy, trigram_index))
   registry.Register(AnswerCommand())
   return registry
 
@@ -71,6 +76,8 @@ class CommandRegistryConfig:
   # `delegate_request` should be enabled.
   delegate_request: DelegateRequestConfig | None = None
 
+  # If present and its `allow_list` (or `topics`) is non-empty, signifies that
+  # `publish_message` (or `publish_to_topic`) should be enabled.
   publish_message: PublishMessageConfig | None = None
 
   allow_shell: bool = False
@@ -159,7 +166,7 @@ def create_command_registry_config(
           f"Expected dictionary for 'publish_message', but got {type(publish_message_data)}"
       )
 
-    allowed_publish_message_keys = {'allow_list'}
+    allowed_publish_message_keys = {'allow_list', 'topics'}
     for key in publish_message_data:
       if key not in allowed_publish_message_keys:
         raise ValueError(
@@ -178,8 +185,15 @@ def create_command_registry_config(
               f"Expected string in 'publish_message.allow_list', but got {type(item)}"
           )
         publish_message_allow_list.append(AgentName(item))
+    publish_message_topics_data = publish_message_data.get('topics', [])
+    if not isinstance(publish_message_topics_data, list) or not all(
+        isinstance(item, str) and item for item in publish_message_topics_data):
+      raise ValueError(
+          f"Expected list of non-empty strings for 'publish_message.topics', but got {publish_message_topics_data!r}"
+      )
     publish_message = PublishMessageConfig(
-        allow_list=frozenset(publish_message_allow_list))
+        allow_list=frozenset(publish_message_allow_list),
+        topics=frozenset(Topic(item) for item in publish_message_topics_data))
 
   shell_templates = shell_command_command.ShellCommandTemplatesConfig(
       commands={})
@@ -231,11 +245,15 @@ async def create_command_registry(
     validation_manager: ValidationManager | None,
     start_new_task: Callable[[TaskInformation], CommandOutput],
     git_dirty_accept: bool = False,
-    can_start_tasks: bool = True) -> CommandRegistry:
+    can_start_tasks: bool = True,
+    trigram_index: TrigramIndex | None = None) -> CommandRegistry:
+  """Returns the registry for the main agent.
 
+  If `trigram_index` is given, searches use it and writes update it.
+  """
   assert config.file_access_policy
   file_access_policy = create_file_access_policy(config.file_access_policy)
-  registry = _create_base_registry(cwd, file_access_policy)
+  registry = _create_base_registry(cwd, file_access_policy, trigram_index)
 
   registry.Register(DoneCommand(arguments=[]))
 
@@ -267,7 +285,8 @@ async def create_command_registry(
           create_file_access_policy(config.writes.file_access_policy))
     registry.Register(
         WriteFileCommand(cwd, CompositeFileAccessPolicy(policies),
-                         validation_manager, selection_manager, None))
+                         validation_manager, selection_manager, None,
+                         trigram_index))
 
   if enable_select:
     for use_regex in [True, False]:
@@ -276,13 +295,15 @@ async def create_command_registry(
 
     if config.writes:
       registry.Register(
-          SelectOverwriteCommand(selection_manager, validation_manager))
+          SelectOverwriteCommand(selection_manager, validation_manager,
+                                 trigram_index))
 
     registry.Register(
         SelectPythonCommand(file_access_policy, selection_manager))
     if config.writes:
       registry.Register(
-          ReplacePythonCommand(file_access_policy, validation_manager))
+          ReplacePythonCommand(file_access_policy, validation_manager,
+                               trigram_index))
 
   #if can_start_tasks:
   #  registry.Register(TaskCommand(start_new_task))
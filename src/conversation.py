@@ -6,6 +6,7 @@ from datetime import datetime, timezone
 import aiofiles
 import asyncio
 
+from conversation_search import ConversationSearchIndex
 from conversation_state import ConversationState
 from agent_command import CommandInput, CommandOutput
 from message import Message, ContentSection
@@ -19,26 +20,28 @@ class ConversationFactoryOptions(NamedTuple):
                                       Coroutine[Any, Any, None]] | None = None
   on_state_changed_callback: Callable[[ConversationId],
                                       Coroutine[Any, Any, None]] | None = None
+  search_index: ConversationSearchIndex | None = None
 
 
 class Conversation:
 
-  def __init__(
-      self,
-      unique_id: int,
-      name: str,
-      command_registry: CommandRegistry,
-      on_message_added_callback: Callable[[int], Coroutine[Any, Any, None]]
-      | None = None,
-      on_state_changed_callback: Callable[[ConversationId], Coroutine[Any, Any,
-                                                                      None]]
-      | None = None
-  ) -> None:
+  def __init__(self,
+               unique_id: int,
+               name: str,
+               command_registry: CommandRegistry,
+               on_message_added_callback: Callable[[int], Coroutine[Any, Any,
+                                                                    None]]
+               | None = None,
+               on_state_changed_callback: Callable[[ConversationId],
+                                                   Coroutine[Any, Any, None]]
+               | None = None,
+               search_index: ConversationSearchIndex | None = None) -> None:
     self._unique_id = unique_id
     self._name = name
     self.messages: list[Message] = []
     self._on_message_added_callback = on_message_added_callback
     self._on_state_changed_callback = on_state_changed_callback
+    self._search_index = search_index
     self._state: ConversationState = ConversationState.STARTING
     self.last_state_change_time: datetime = datetime.now(timezone.utc)
     self.command_registry = command_registry
@@ -75,6 +78,9 @@ class Conversation:
     message = await self._derive_args(message)
     logging.info(self._DebugString(message))
     self.messages.append(message)
+    if self._search_index:
+      self._search_index.index_message(self._unique_id,
+                                       len(self.messages) - 1, message)
     if self._on_message_added_callback:
       await self._on_message_added_callback(self._unique_id)
 
@@ -119,6 +125,7 @@ class ConversationFactory:
     self._conversations: dict[ConversationId, Conversation] = {}
     self.on_message_added_callback = options.on_message_added_callback
     self.on_state_changed_callback = options.on_state_changed_callback
+    self._search_index = options.search_index
 
   def New(self, name: str, command_registry: CommandRegistry) -> Conversation:
     with self._lock:
@@ -126,7 +133,7 @@ class ConversationFactory:
       self._next_id += 1
     output = Conversation(reserved_id, name, command_registry,
                           self.on_message_added_callback,
-                          self.on_state_changed_callback)
+                          self.on_state_changed_callback, self._search_index)
     self._conversations[reserved_id] = output
     return output
 
@@ -135,3 +142,12 @@ class ConversationFactory:
 
   def GetAll(self) -> list[Conversation]:
     return list(self._conversations.values())
+
+  def Remove(self, id: ConversationId) -> None:
+    """Forgets a conversation (e.g., once it's no longer needed).
+
+    Also removes its messages from the search index.
+    """
+    self._conversations.pop(id, None)
+    if self._search_index:
+      self._search_index.remove_conversation(id)
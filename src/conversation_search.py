@@ -0,0 +1,158 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import sqlite3
+from typing import NamedTuple
+
+from message import Message
+
+# Stores conversation ids as plain integers (rather than importing
+# `conversation.ConversationId`) to avoid a circular import: `conversation`
+# feeds this index from `Conversation.AddMessage`.
+
+
+class SearchHit(NamedTuple):
+  conversation_id: int
+  message_index: int
+  role: str
+  # Fragment of the matching text, with matches wrapped in `[` and `]`.
+  snippet: str
+  # BM25 score as returned by FTS5; lower values are better matches.
+  rank: float
+
+
+def _message_columns(message: Message) -> tuple[str, str, str]:
+  """Returns the (content, commands, outputs) texts to index for `message`."""
+  content: list[str] = []
+  commands: list[str] = []
+  outputs: list[str] = []
+  for section in message.GetContentSections():
+    content.append(section.content)
+    if section.summary:
+      content.append(section.summary)
+    if section.command:
+      commands.append(section.command.command_name)
+      commands.extend(str(v) for v in section.command.args.values())
+    if section.command_output:
+      outputs.extend([
+          section.command_output.command_name,
+          str(section.command_output.output),
+          str(section.command_output.errors), section.command_output.summary
+      ])
+  return "\n".join(content), "\n".join(commands), "\n".join(outputs)
+
+
+def _fts_query(query: str) -> str:
+  """Turns free-form user input into a safe FTS5 query.
+
+  Each whitespace-separated term becomes a quoted phrase (so that characters
+  such as `.` or `-` in `message_bus.py` don't trigger FTS5 syntax errors); all
+  terms must match.
+  """
+  terms = query.split()
+  return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+class ConversationSearchIndex:
+  """Full-text index (SQLite FTS5) over the messages of all conversations.
+
+  Writes are queued to a dedicated thread: `index_message` returns immediately,
+  so indexing never adds latency to the agent loop. Searches are served by the
+  same thread, after any writes queued before them.
+  """
+
+  def __init__(self, path: str = ":memory:") -> None:
+    self._path = path
+    self._executor = ThreadPoolExecutor(max_workers=1)
+    # _connection is only accessed by threads running in _executor.
+    self._connection: sqlite3.Connection | None = None
+    self._executor.submit(self._open)
+
+  def _open(self) -> None:
+    self._connection = sqlite3.connect(self._path, isolation_level=None)
+    self._connection.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+            conversation_id UNINDEXED,
+            message_index UNINDEXED,
+            role UNINDEXED,
+            content,
+            commands,
+            outputs
+        )
+        """)
+
+  def _insert(self, conversation_id: int, message_index: int,
+              message: Message) -> None:
+    if self._connection is None:
+      raise ValueError("Search index is not open.")
+    content, commands, outputs = _message_columns(message)
+    self._connection.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                             (conversation_id, message_index, message.role,
+                              content, commands, outputs))
+
+  def index_message(self, conversation_id: int, message_index: int,
+                    message: Message) -> None:
+    """Queues `message` for indexing; doesn't block."""
+    future = self._executor.submit(self._insert, conversation_id, message_index,
+                                   message)
+    future.add_done_callback(self._on_insert_done)
+
+  def _on_insert_done(self, future: Future[None]) -> None:
+    exception = future.exception()
+    if exception:
+      logging.error(f"Failed to index message: {exception}")
+
+  def _delete(self, conversation_id: int) -> None:
+    if self._connection is None:
+      raise ValueError("Search index is not open.")
+    self._connection.execute("DELETE FROM messages WHERE conversation_id = ?",
+                             (conversation_id,))
+
+  def remove_conversation(self, conversation_id: int) -> None:
+    """Queues the removal of all messages of a conversation; doesn't block."""
+    future = self._executor.submit(self._delete, conversation_id)
+    future.add_done_callback(self._on_delete_done)
+
+  def _on_delete_done(self, future: Future[None]) -> None:
+    exception = future.exception()
+    if exception:
+      logging.error(f"Failed to remove conversation from index: {exception}")
+
+  async def flush(self) -> None:
+    """Waits until all messages queued so far have been indexed."""
+    await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                     lambda: None)
+
+  async def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+    """Returns the best `limit` matches for `query`, best first."""
+    fts_query = _fts_query(query)
+    if not fts_query:
+      return []
+
+    def _search() -> list[SearchHit]:
+      if self._connection is None:
+        raise ValueError("Search index is not open.")
+      cursor = self._connection.execute(
+          """
+          SELECT
+              conversation_id,
+              message_index,
+              role,
+              snippet(messages, -1, '[', ']', '…', 16),
+              rank
+          FROM messages
+          WHERE messages MATCH ?
+          ORDER BY rank
+          LIMIT ?
+          """, (fts_query, limit))
+      return [
+          SearchHit(
+              conversation_id=int(row[0]),
+              message_index=int(row[1]),
+              role=row[2],
+              snippet=row[3],
+              rank=row[4]) for row in cursor.fetchall()
+      ]
+
+    return await asyncio.get_running_loop().run_in_executor(
+        self._executor, _search)
@@ -0,0 +1,249 @@
+"""Searches files for lines matching a pattern (see `SearchFileCommand`).
+
+Files are memory-mapped and scanned (in batches) in worker threads. Binary
+files (with a NUL byte in their first `_BINARY_PROBE_BYTES` bytes) are skipped.
+"""
+
+import asyncio
+import dataclasses
+import mmap
+import os
+import pathlib
+import re
+import threading
+from typing import Any, Iterable
+
+# Files scanned by each worker thread task.
+_BATCH_SIZE = 64
+
+_BINARY_PROBE_BYTES = 8192
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchPattern:
+  """A pattern matched against each line of a file.
+
+  `term` is a substring or (if `regex`) a regular expression. Files are
+  searched as raw bytes, except for non-ASCII case-insensitive patterns (which
+  search the decoded UTF-8 contents).
+  """
+  term: str
+  case_sensitive: bool = False
+  regex: bool = False
+
+  def compile(self) -> re.Pattern[bytes] | re.Pattern[str]:
+    """Raises `re.error` if `term` isn't a valid regular expression."""
+    flags = re.MULTILINE | (0 if self.case_sensitive else re.IGNORECASE)
+    if self.case_sensitive or self.term.isascii():
+      return re.compile(self.term.encode('utf-8'), flags)
+    return re.compile(self.term, flags)
+
+
+@dataclasses.dataclass(frozen=True)
+class FileMatches:
+  path: pathlib.Path
+  line_count: int = 0
+  match_count: int = 0
+  # Line number (starting at 1) and contents (stripped) of matching lines.
+  # Left empty once the search has more matches than it displays.
+  lines: list[tuple[int, str]] = dataclasses.field(default_factory=list)
+  error: str | None = None
+
+
+class _MatchBudget:
+  """Counts the matches found (across threads), up to which details are kept."""
+
+  def __init__(self, limit: int) -> None:
+    self._limit = limit
+    self._matches = 0
+    self._lock = threading.Lock()
+
+  def remaining(self) -> int:
+    with self._lock:
+      return self._limit - self._matches
+
+  def add(self, matches: int) -> None:
+    with self._lock:
+      self._matches += matches
+
+
+# Either the memory-mapped contents of a file or (for `re.Pattern[str]`) its
+# decoded contents.
+_Contents = mmap.mmap | str
+
+# Bytes counted at a time (in memory-mapped files).
+_COUNT_CHUNK_BYTES = 1 << 20
+
+
+def _newline(contents: _Contents | bytes) -> Any:
+  return '\n' if isinstance(contents, str) else b'\n'
+
+
+def _count_newlines(contents: _Contents, start: int, end: int) -> int:
+  if isinstance(contents, str):
+    return contents.count('\n', start, end)
+  return sum(contents[i:min(i + _COUNT_CHUNK_BYTES, end)].count(b'\n')
+             for i in range(start, end, _COUNT_CHUNK_BYTES))
+
+
+def _line_end(contents: _Contents, start: int) -> int:
+  end = contents.find(_newline(contents), start)
+  return len(contents) if end == -1 else end
+
+
+def _scan_substring(contents: _Contents | bytes, needle: Any,
+                    max_lines: int) -> tuple[int, list[int]]:
+  """Returns the number of lines containing `needle` and (up to `max_lines`)
+  their starts."""
+  newline = _newline(contents)
+  match_count = 0
+  starts: list[int] = []
+  position = contents.find(needle)
+  while position != -1:
+    match_count += 1
+    if len(starts) < max_lines:
+      starts.append(contents.rfind(newline, 0, position) + 1)
+    end = contents.find(newline, position + len(needle))
+    if end == -1:
+      break
+    position = contents.find(needle, end + 1)
+  return match_count, starts
+
+
+def _scan_lowered_lines(contents: str, needle: str,
+                        max_lines: int) -> tuple[int, list[int]]:
+  """Like `_scan_substring`, but matching each line lowercased."""
+  match_count = 0
+  starts: list[int] = []
+  start = 0
+  for line in contents.split('\n'):
+    if needle in line.lower() and start < len(contents):
+      match_count += 1
+      if len(starts) < max_lines:
+        starts.append(start)
+    start += len(line) + 1
+  return match_count, starts
+
+
+def _scan_regex(pattern: re.Pattern[Any], contents: _Contents,
+                max_lines: int) -> tuple[int, list[int]]:
+  """Like `_scan_substring`, for lines matching `pattern`.
+
+  Like matching each line separately: matches spanning several lines are
+  ignored.
+  """
+  newline = _newline(contents)
+  match_count = 0
+  starts: list[int] = []
+  position = 0
+  while position < len(contents):
+    match = pattern.search(contents, position)
+    if match is None:
+      break
+    start = contents.rfind(newline, 0, match.start()) + 1
+    end = _line_end(contents, match.start())
+    if match.end() <= end or pattern.search(contents, start, end):
+      match_count += 1
+      if len(starts) < max_lines:
+        starts.append(start)
+    position = end + 1
+  return match_count, starts
+
+
+def _scan_contents(mapped: mmap.mmap, pattern: SearchPattern,
+                   compiled: re.Pattern[Any] | None,
+                   max_lines: int) -> tuple[_Contents, int, list[int]]:
+  """Returns the contents searched, the matching lines and their starts."""
+  if compiled is not None:
+    if isinstance(compiled.pattern, bytes):
+      return mapped, *_scan_regex(compiled, mapped, max_lines)
+    contents = mapped[:].decode('utf-8')
+    return contents, *_scan_regex(compiled, contents, max_lines)
+  if pattern.case_sensitive:
+    return mapped, *_scan_substring(mapped, pattern.term.encode('utf-8'),
+                                    max_lines)
+  if pattern.term.isascii():
+    # Lowercasing ASCII doesn't move the lines.
+    return mapped, *_scan_substring(mapped[:].lower(),
+                                    pattern.term.lower().encode('utf-8'),
+                                    max_lines)
+  contents = mapped[:].decode('utf-8')
+  return contents, *_scan_lowered_lines(contents, pattern.term.lower(),
+                                        max_lines)
+
+
+def _matching_lines(contents: _Contents,
+                    starts: list[int]) -> list[tuple[int, str]]:
+  """Returns the number and contents (stripped) of the lines at `starts`."""
+  lines: list[tuple[int, str]] = []
+  line_number = 1
+  previous = 0
+  for start in starts:
+    line_number += _count_newlines(contents, previous, start)
+    previous = start
+    line = contents[start:_line_end(contents, start)]
+    if isinstance(line, bytes):
+      line = line.decode('utf-8', errors='replace')
+    lines.append((line_number, line.strip()))
+  return lines
+
+
+def _line_count(contents: _Contents) -> int:
+  """Returns the number of lines (as in `readlines`)."""
+  newlines = _count_newlines(contents, 0, len(contents))
+  last = contents[-1:]
+  return newlines + (0 if last in ('\n', b'\n') else 1)
+
+
+def _scan_file(path: pathlib.Path, pattern: SearchPattern,
+               compiled: re.Pattern[Any] | None,
+               budget: _MatchBudget) -> FileMatches:
+  try:
+    with open(path, 'rb') as file:
+      if file.seek(0, os.SEEK_END) == 0:
+        return FileMatches(path)
+      with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped.find(b'\0', 0, _BINARY_PROBE_BYTES) != -1:
+          return FileMatches(path)
+        max_lines = max(0, budget.remaining())
+        contents, match_count, starts = _scan_contents(mapped, pattern,
+                                                       compiled, max_lines)
+        budget.add(match_count)
+        if match_count > max_lines:
+          starts = []
+        return FileMatches(
+            path,
+            line_count=_line_count(contents),
+            match_count=match_count,
+            lines=_matching_lines(contents, starts))
+  except Exception as e:
+    return FileMatches(path, error=str(e))
+
+
+def _scan_batch(paths: list[pathlib.Path], pattern: SearchPattern,
+                compiled: re.Pattern[Any] | None,
+                budget: _MatchBudget) -> list[FileMatches]:
+  return [_scan_file(path, pattern, compiled, budget) for path in paths]
+
+
+async def search_files(paths: Iterable[pathlib.Path], pattern: SearchPattern,
+                       max_lines: int) -> list[FileMatches]:
+  """Returns the matches in each file (in the order of `paths`).
+
+  Once more than `max_lines` lines have matched (in total), the remaining
+  files only count their matches (and may or may not include `lines`).
+
+  Raises `re.error` if `pattern` is an invalid regular expression.
+  """
+  compiled = pattern.compile() if pattern.regex else None
+  budget = _MatchBudget(max_lines)
+  all_paths = list(paths)
+  batches = [
+      all_paths[i:i + _BATCH_SIZE]
+      for i in range(0, len(all_paths), _BATCH_SIZE)
+  ]
+  results = await asyncio.gather(*[
+      asyncio.to_thread(_scan_batch, batch, pattern, compiled, budget)
+      for batch in batches
+  ])
+  return [matches for batch_results in results for matches in batch_results]
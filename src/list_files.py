@@ -1,8 +1,9 @@
 import os
-from typing import AsyncIterator
+from typing import AsyncIterator, NamedTuple
 from file_access_policy import FileAccessPolicy
 import asyncio
 import pathlib
+import time
 from enum import Enum, auto
 
 
@@ -11,6 +12,105 @@ class DirectoryBehavior(Enum):
   NO_RECURSE = auto()
 
 
+# Directories modified less than this before being listed are listed again
+# (rather than trusting their mtime), since they may have changed within the
+# granularity of the file system's timestamps.
+_RACY_MTIME_NS = 2_000_000_000
+
+
+class _Entry(NamedTuple):
+  name: str
+  is_file: bool  # Follows symlinks.
+  is_directory: bool  # Doesn't follow symlinks (like `Path.rglob`).
+
+
+class _Listing(NamedTuple):
+  mtime_ns: int
+  listed_at_ns: int
+  entries: list[_Entry]  # Sorted by name.
+
+
+class FileTree:
+  """Cache of directory listings, revalidated lazily through their mtimes.
+
+  Listing a tree stats each of its (cached) directories, but only lists again
+  those whose mtime changed.
+  """
+
+  def __init__(self) -> None:
+    # By absolute path.
+    self._listings: dict[str, _Listing] = {}
+    # The last output of `paths` for each base (and whether it recursed), with
+    # the names it was built from. Building paths is slow; most calls list the
+    # same names as the previous one.
+    self._paths: dict[tuple[str, bool], tuple[list[str],
+                                              list[pathlib.Path]]] = {}
+
+  def _entries(self, directory: str) -> list[_Entry]:
+    try:
+      mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+      self._listings.pop(directory, None)
+      return []
+    listing = self._listings.get(directory)
+    if (listing is not None and listing.mtime_ns == mtime_ns and
+        listing.listed_at_ns - mtime_ns > _RACY_MTIME_NS):
+      return listing.entries
+    listed_at_ns = time.time_ns()
+    try:
+      with os.scandir(directory) as scanner:
+        entries = sorted(
+            _Entry(entry.name, entry.is_file(),
+                   entry.is_dir(follow_symlinks=False)) for entry in scanner)
+    except OSError:
+      entries = []
+    self._listings[directory] = _Listing(mtime_ns, listed_at_ns, entries)
+    return entries
+
+  def files(self, base: pathlib.Path) -> list[str]:
+    """Returns all files under `base` (relative to it), sorted like `rglob`."""
+    output: list[str] = []
+
+    def walk(directory: str, prefix: str) -> None:
+      for entry in self._entries(directory):
+        if entry.is_file:
+          output.append(prefix + entry.name)
+        if entry.is_directory:
+          walk(
+              os.path.join(directory, entry.name),
+              f"{prefix}{entry.name}{os.sep}")
+
+    walk(os.path.abspath(base), "")
+    return output
+
+  def children(self, base: pathlib.Path) -> list[str]:
+    """Returns all entries in `base` (files, directories...), sorted."""
+    return [entry.name for entry in self._entries(os.path.abspath(base))]
+
+  def paths(self, base: pathlib.Path, recursive: bool) -> list[pathlib.Path]:
+    """Returns `files` (or `children`) as paths (`base / name`)."""
+    names = self.files(base) if recursive else self.children(base)
+    key = (str(base), recursive)
+    cached = self._paths.get(key)
+    if cached is not None and cached[0] == names:
+      return cached[1]
+    paths = [base / name for name in names]
+    self._paths[key] = (names, paths)
+    return paths
+
+  def invalidate(self, path: pathlib.Path) -> None:
+    """Forgets the listing of the directory containing `path`.
+
+    Called after creating files (e.g., by `WriteFileCommand`), so that they
+    are listed regardless of the granularity of the directory's mtime.
+    """
+    self._listings.pop(os.path.dirname(os.path.abspath(path)), None)
+
+
+# Shared by all callers of `list_all_files` in the process.
+file_tree = FileTree()
+
+
 async def list_all_files(
     base_path: pathlib.Path,
     file_access_policy: FileAccessPolicy,
@@ -21,17 +121,11 @@ async def list_all_files(
   if not base_path.is_dir():
     raise NotADirectoryError(f"{base_path} is not a valid directory.")
 
-  # Use rglob to get all files and directories recursively
-  # Run in a separate thread to avoid blocking the event loop
-  match directory_behavior:
-    case DirectoryBehavior.RECURSE:
-      all_paths = await asyncio.to_thread(lambda: sorted(base_path.rglob("*")))
-    case DirectoryBehavior.NO_RECURSE:
-      all_paths = await asyncio.to_thread(lambda: sorted(base_path.glob("*")))
-
-  # Sort paths for consistent output
-  for file_path_obj in all_paths:
-    if file_path_obj.is_file(
-    ) or directory_behavior == DirectoryBehavior.NO_RECURSE:
-      if file_access_policy.allow_access(str(file_path_obj)):
-        yield base_path / file_path_obj.relative_to(base_path)
+  # List (through `file_tree`) in a separate thread to avoid blocking the
+  # event loop.
+  paths = await asyncio.to_thread(
+      file_tree.paths, base_path,
+      directory_behavior == DirectoryBehavior.RECURSE)
+  for path in paths:
+    if file_access_policy.allow_access(str(path)):
+      yield path
@@ -1,7 +1,7 @@
 from typing import Any, NamedTuple
 from datetime import datetime, timezone
 
-from agent_command import CommandInput, CommandOutput, VariableName
+from agent_command import CommandInput, CommandOutput, VariableMap, VariableName, VariableValueStr
 
 
 class ContentSection(NamedTuple):
@@ -102,6 +102,44 @@ class Message:
         content_sections=content_sections,
         creation_time=datetime.fromisoformat(data['creation_time']))
 
+  @staticmethod
+  def FromPropertiesDict(data: dict[str, Any]) -> 'Message':
+    """Inverse of `ToPropertiesDict`.
+
+    Argument values (and derived arguments) are restored as strings, so the
+    result's `ToPropertiesDict` matches `data`.
+    """
+    content_sections: list[ContentSection] = []
+    for section_data in data.get('content_sections', []):
+      command: CommandInput | None = None
+      if 'command' in section_data:
+        command = CommandInput(
+            command_name=section_data['command']['command_name'],
+            args=VariableMap({
+                VariableName(key): VariableValueStr(value)
+                for key, value in section_data['command'].items()
+                if key != 'command_name'
+            }))
+      command_output: CommandOutput | None = None
+      if 'command_output' in section_data:
+        output_data = section_data['command_output']
+        command_output = CommandOutput(
+            command_name=output_data['command_name'],
+            output=output_data['output'],
+            errors=output_data['errors'],
+            summary=output_data['summary'],
+            task_done=output_data['task_done'] == str(True))
+      content_sections.append(
+          ContentSection(
+              content=section_data['content'],
+              command=command,
+              command_output=command_output,
+              summary=section_data.get('summary')))
+    return Message(
+        role=data['role'],
+        content_sections=content_sections,
+        creation_time=datetime.fromisoformat(data['creation_time']))
+
   def GetContentSections(self) -> list[ContentSection]:
     return self._content_sections
 
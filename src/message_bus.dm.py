@@ -1,20 +1,28 @@
+from abc import ABC, abstractmethod
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import datetime
 import dataclasses
+from enum import Enum
+import hashlib
 import logging
 import pathlib
 import sqlite3
-from typing import Callable, NewType, ParamSpec, TypeVar, cast
+import threading
+import time
+import zlib
+from typing import Any, Awaitable, Callable, NamedTuple, NewType, ParamSpec, TypeVar, cast
 
 from conversation import ConversationId
-from swarm_types import AgentName
+from message_bus_notifier import MessageBusNotifier
+from swarm_types import AgentName, Topic
 
 # MessageId is meant for the IDs of messages in the SQL database. It is NOT
 # meant for the IDs of Telegram messages (use TelegramMessageId for those).
 MessageId = NewType("MessageId", int)  # Unique ID across the bus.
 TelegramChatId = NewType("TelegramChatId", int)
 TelegramMessageId = NewType("TelegramMessageId", int)
+TelegramUpdateId = NewType("TelegramUpdateId", int)
 
 # Wrapper for the `content` fields in the message bus.
 MessageContent = NewType("MessageContent", str)
@@ -22,26 +30,812 @@ MessageContent = NewType("MessageContent", str)
 # Fake agent name reserved to represent the end user.
 END_USER_AGENT = AgentName("duende-internal:end-user")
 
+# Identifies a consumer of incoming messages (see
+# `MessageBus.claim_incoming_messages`). Must be unique across processes.
+WorkerId = NewType("WorkerId", str)
+
+# Unique ID of a message published to a topic (see `MessageBus.publish`).
+TopicMessageId = NewType("TopicMessageId", int)
+
+
+class MessagePriority(Enum):
+  """Order in which incoming messages are claimed (lower values first).
+
+  Messages are promoted one level for each `aging` they wait (see
+  `claim_incoming_messages`), so that lower priorities don't starve.
+  """
+  # Messages from the end user (END_USER_AGENT).
+  HIGH = 0
+  # Requests between agents (e.g., `delegate_request`).
+  MEDIUM = 1
+  # Background traffic between agents (e.g., `publish_message` and topics).
+  LOW = 2
+
+  def aged(self, waited_secs: float, aging: datetime.timedelta) -> int:
+    """Returns the value to order by after waiting `waited_secs`."""
+    return max(0, self.value - int(waited_secs / aging.total_seconds()))
+
+
+# Default `aging` for `MessageBus.claim_incoming_messages`.
+PRIORITY_AGING = datetime.timedelta(minutes=1)
+
 
 @dataclasses.dataclass(frozen=True)
 class Message:
   # The fields map directly to the rows of the `message_bus` SQL table.
   #
-  # Paths use `pathlib.Path`.
+  # Paths use `pathlib.Path`. `priority` (last) defaults to
+  # `MessagePriority.MEDIUM`.
   pass  # {{🍄 message fields}}
 
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
+# Schema migrations, applied in order. `PRAGMA user_version` holds the number of
+# migrations already applied to a database. Never edit a migration that has
+# been released (existing databases won't see the change); append a new one.
+#
+# The first migration uses `IF NOT EXISTS` so that databases created before
+# migrations existed (with version 0) are adopted.
+_MIGRATIONS: list[list[str]] = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS message_bus (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+            source_agent TEXT NOT NULL,
+            target_agent TEXT NOT NULL,
+
+            local_directory TEXT,
+
+            conversation_id INTEGER,
+
+            telegram_chat_id INTEGER NOT NULL,
+
+            telegram_message_id INTEGER,
+            telegram_reply_to_id INTEGER,
+
+            content TEXT NOT NULL,
+
+            queued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            processed_at DATETIME
+        )
+        """,
+    ],
+    [
+        # wait_for_incoming_messages.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_incoming
+        ON message_bus (target_agent, message_id)
+        WHERE processed_at IS NULL
+        """,
+        # wait_for_outgoing_messages.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_outgoing
+        ON message_bus (target_agent, message_id)
+        WHERE telegram_message_id IS NULL
+        """,
+        # find_message_by_telegram_id.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_telegram
+        ON message_bus (telegram_chat_id, telegram_message_id)
+        WHERE telegram_message_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.claim_incoming_messages`. `lease_expires_at` is in
+        # seconds since the epoch.
+        "ALTER TABLE message_bus ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE message_bus ADD COLUMN lease_expires_at REAL",
+    ],
+    [
+        # See `MessageBus.save_cursor`.
+        """
+        CREATE TABLE message_bus_cursors (
+            name TEXT PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        )
+        """,
+    ],
+    [
+        # See `MessageBus.archive_messages`. `content` is compressed (through
+        # the `zlib_compress` function registered by `_connect`).
+        """
+        CREATE TABLE message_bus_archive (
+            message_id INTEGER PRIMARY KEY,
+            source_agent TEXT NOT NULL,
+            target_agent TEXT NOT NULL,
+            local_directory TEXT,
+            conversation_id INTEGER,
+            telegram_chat_id INTEGER NOT NULL,
+            telegram_message_id INTEGER,
+            telegram_reply_to_id INTEGER,
+            content BLOB NOT NULL,
+            queued_at DATETIME,
+            processed_at DATETIME
+        )
+        """,
+        """
+        CREATE INDEX message_bus_archive_telegram
+        ON message_bus_archive (telegram_chat_id, telegram_message_id)
+        WHERE telegram_message_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.fail_message`. `retry_at` is in seconds since the
+        # epoch.
+        "ALTER TABLE message_bus ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE message_bus ADD COLUMN retry_at REAL",
+        """
+        CREATE TABLE message_bus_dead_letters (
+            message_id INTEGER PRIMARY KEY,
+            attempts INTEGER NOT NULL,
+            error TEXT NOT NULL,
+            failed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    [
+        # See `MessageBus.start_session`.
+        """
+        CREATE TABLE message_bus_sessions (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent TEXT NOT NULL,
+            telegram_chat_id INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Conversation ids written before this migration (by each process,
+        # starting from 0) must not be reused.
+        """
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'message_bus_sessions', COALESCE(MAX(conversation_id), 0)
+        FROM (
+            SELECT conversation_id FROM message_bus
+            UNION ALL SELECT conversation_id FROM message_bus_archive
+        )
+        """,
+        # read_conversation.
+        """
+        CREATE INDEX message_bus_conversation
+        ON message_bus (conversation_id, message_id)
+        WHERE conversation_id IS NOT NULL
+        """,
+        """
+        CREATE INDEX message_bus_archive_conversation
+        ON message_bus_archive (conversation_id, message_id)
+        WHERE conversation_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.publish`.
+        """
+        CREATE TABLE message_bus_topic_messages (
+            topic_message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            source_agent TEXT NOT NULL,
+            local_directory TEXT,
+            telegram_chat_id INTEGER NOT NULL,
+            telegram_reply_to_id INTEGER,
+            content TEXT NOT NULL,
+            published_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX message_bus_topic_messages_topic
+        ON message_bus_topic_messages (topic, topic_message_id)
+        """,
+        # See `MessageBus.set_subscriptions`. `topic_message_id` is the last
+        # message delivered to the subscriber.
+        """
+        CREATE TABLE message_bus_subscriptions (
+            agent TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            topic_message_id INTEGER NOT NULL,
+            PRIMARY KEY (agent, topic)
+        )
+        """,
+    ],
+    [
+        # See `MessagePriority`. `enqueued_at` (`time.time()` when the message
+        # was written or published) is used to age priorities and to measure
+        # claim latency; it's NULL for messages written before this migration.
+        """
+        ALTER TABLE message_bus
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 1
+        """,
+        "ALTER TABLE message_bus ADD COLUMN enqueued_at REAL",
+        """
+        ALTER TABLE message_bus_archive
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 1
+        """,
+        f"""
+        UPDATE message_bus SET priority = 0
+        WHERE source_agent = '{END_USER_AGENT}'
+        """,
+        "ALTER TABLE message_bus_topic_messages ADD COLUMN enqueued_at REAL",
+    ],
+    [
+        # See `_offload_content`.
+        """
+        CREATE TABLE message_bus_blobs (
+            digest TEXT PRIMARY KEY,
+            content TEXT NOT NULL
+        )
+        """,
+        "ALTER TABLE message_bus ADD COLUMN content_digest TEXT",
+        """
+        CREATE INDEX message_bus_content_digest
+        ON message_bus (content_digest)
+        WHERE content_digest IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.write_telegram_updates`.
+        """
+        CREATE TABLE message_bus_telegram_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+]
+
+# Contents (of messages in `message_bus`) longer than this (in UTF-8 bytes) are
+# stored in `message_bus_blobs` (see `_offload_content`).
+_BLOB_THRESHOLD = 4096
+
+# The columns of `message_bus` read into `Message` fields.
+_MESSAGE_FIELDS = """
+    message_id,
+    source_agent,
+    target_agent,
+    local_directory,
+    conversation_id,
+    telegram_chat_id,
+    telegram_message_id,
+    telegram_reply_to_id,
+    content,
+    queued_at,
+    processed_at,
+    priority
+"""
+# The `content` of a row in `message_bus`, loaded from `message_bus_blobs` if it
+# was offloaded. Only evaluated for the rows a query returns.
+_CONTENT = """COALESCE(
+    (SELECT b.content FROM message_bus_blobs b
+     WHERE b.digest = message_bus.content_digest),
+    message_bus.content)"""
+# Selects `_MESSAGE_FIELDS` (as read by `_message_from_row`) from `message_bus`.
+_MESSAGE_COLUMNS = _MESSAGE_FIELDS.replace("content", f"{_CONTENT} AS content")
+# Like `_MESSAGE_COLUMNS`, for `message_bus_archive`.
+_ARCHIVE_COLUMNS = _MESSAGE_FIELDS.replace(
+    "content", "zlib_decompress(content) AS content")
+
+
+def _apply_migrations(connection: sqlite3.Connection) -> None:
+  """Applies the entries in `_MIGRATIONS` that `connection` lacks.
+
+  Each migration runs in its own `BEGIN IMMEDIATE` transaction (together with
+  the update to `user_version`), so concurrent processes opening the same bus
+  apply each migration exactly once.
+
+  Raises RuntimeError if the database has a version newer than
+  `len(_MIGRATIONS)` (i.e., it was created by a newer version of this code).
+  """
+  raise NotImplementedError()  # {{🍄 apply migrations}}
+
+
+class BusStats(NamedTuple):
+  # Rows in the `message_bus` table.
+  rows: int
+  # Rows neither processed nor sent to Telegram.
+  pending_rows: int
+  # Rows in the `message_bus_archive` table.
+  archived_rows: int
+  # Size of the database file.
+  database_bytes: int
+  # Space in the database file not used by any table (see `compact`).
+  free_bytes: int
+  # Rows in the `message_bus_topic_messages` table.
+  topic_rows: int
+  # Rows in the `message_bus_blobs` table.
+  blob_rows: int
+  # Average and maximum time that messages claimed through this bus object
+  # (not other processes) waited for their first claim, per priority.
+  average_claim_latency: dict[MessagePriority, datetime.timedelta]
+  max_claim_latency: dict[MessagePriority, datetime.timedelta]
+
+
+class ClaimLatency:
+  """Tracks how long messages wait (since written) for their first claim."""
+
+  def __init__(self) -> None:
+    self._claims: dict[MessagePriority, int] = {}
+    self._total_secs: dict[MessagePriority, float] = {}
+    self._max_secs: dict[MessagePriority, float] = {}
+
+  def record(self, priority: MessagePriority, waited_secs: float) -> None:
+    self._claims[priority] = self._claims.get(priority, 0) + 1
+    self._total_secs[priority] = (
+        self._total_secs.get(priority, 0.0) + waited_secs)
+    self._max_secs[priority] = max(
+        self._max_secs.get(priority, 0.0), waited_secs)
+
+  def average(self) -> dict[MessagePriority, datetime.timedelta]:
+    return {
+        priority: datetime.timedelta(seconds=self._total_secs[priority] / count)
+        for priority, count in sorted(
+            self._claims.items(), key=lambda item: item[0].value)
+    }
+
+  def max(self) -> dict[MessagePriority, datetime.timedelta]:
+    return {
+        priority: datetime.timedelta(seconds=self._max_secs[priority])
+        for priority in sorted(self._max_secs, key=lambda p: p.value)
+    }
+
+
+class RetryPolicy(NamedTuple):
+  """How `MessageBus.fail_message` retries messages."""
+  # Attempts (including the first) before a message becomes a dead letter.
+  max_attempts: int
+  # Delay before the first retry; doubles with each retry (up to
+  # `max_backoff`).
+  backoff: datetime.timedelta
+  max_backoff: datetime.timedelta
+
+  def delay(self, attempts: int) -> datetime.timedelta:
+    """Returns how long to wait after `attempts` failed attempts."""
+    return min(self.backoff * 2.0**(attempts - 1), self.max_backoff)
+
+
+class DeadLetter(NamedTuple):
+  """A message that failed `RetryPolicy.max_attempts` times."""
+  message: Message
+  attempts: int
+  # The error (e.g., an exception trace) of the last attempt.
+  error: str
+  failed_at: datetime.datetime
+
+
+@dataclasses.dataclass(frozen=True)
+class TopicMessage:
+  """A message published to a topic (see `MessageBus.publish`).
+
+  Each subscriber receives it as a `Message` with the same fields.
+  """
+  topic_message_id: TopicMessageId
+  topic: Topic
+  source_agent: AgentName
+  local_directory: pathlib.Path | None
+  telegram_chat_id: TelegramChatId
+  telegram_reply_to_id: TelegramMessageId | None
+  content: MessageContent
+  published_at: datetime.datetime
+
+
+class BusSession(NamedTuple):
+  """A session (conversation) started by `MessageBus.start_session`."""
+  conversation_id: ConversationId
+  agent: AgentName
+  telegram_chat_id: TelegramChatId
+  created_at: datetime.datetime
+
+
+def _message_from_row(row: sqlite3.Row) -> Message:
+  """Converts a row with (at least) the `_MESSAGE_COLUMNS`."""
+  raise NotImplementedError()  # {{🍄 message from row}}
+
+
+def _session_from_row(row: sqlite3.Row) -> BusSession:
+  return BusSession(
+      conversation_id=ConversationId(row['conversation_id']),
+      agent=AgentName(row['agent']),
+      telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
+      created_at=datetime.datetime.fromisoformat(row['created_at']))
+
+
+def _connect(path: pathlib.Path, read_only: bool) -> sqlite3.Connection:
+  """Returns a new connection to the bus in `path`.
+
+  Passes timeout=20.0 and isolation_level=None when connecting. Read-only
+  connections can be used from any thread (but only one at a time).
+
+  Sets `row_factory` to `sqlite3.Row` and registers SQL functions
+  `zlib_compress` and `zlib_decompress` (used for the archive).
+  """
+  raise NotImplementedError()  # {{🍄 connect}}
+
+
+def _offload_content(connection: sqlite3.Connection,
+                     content: MessageContent) -> tuple[str, str | None]:
+  """Returns the values for the `content` and `content_digest` columns.
+
+  Contents longer than `_BLOB_THRESHOLD` are stored in `message_bus_blobs`,
+  keyed by their SHA-256 digest (so messages with the same content share a
+  row), and their `content` column is empty. Must run in the transaction that
+  writes the message.
+  """
+  raise NotImplementedError()  # {{🍄 offload content}}
+
+
+class MessageBus(ABC):
+  """Queue of messages between agents (and the end user, through Telegram).
+
+  Messages get increasing ids. Messages to agents are pending until they're
+  marked as processed; messages to `END_USER_AGENT`, until they get a
+  `telegram_message_id`.
+
+  Implementations: `SqliteMessageBus` (shared across processes) and
+  `InMemoryMessageBus` (in message_bus_memory.py; for tests and benchmarks).
+  """
+
+  @abstractmethod
+  async def open(self) -> None:
+    """Connects to the bus (creating it if needed)."""
+    pass
+
+  @abstractmethod
+  async def close(self) -> None:
+    """Disconnects from the bus."""
+    pass
 
-class MessageBus:
+  @abstractmethod
+  async def wait_for_incoming_messages(self,
+                                       agents: list[AgentName],
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+    """Polls until new incoming messages arrive for the agents listed.
+
+    A new incoming message is one without `processed_at` (and not waiting for
+    a retry; see `fail_message`) and with a `message_id` greater than `after`.
+    Returns at most `limit` messages, sorted by `message_id`.
+
+    Consumers should pass as `after` the id of the last message they've already
+    seen (e.g., a cursor obtained from `read_cursor`), so that a backlog is read
+    only once.
+    """
+    pass
+
+  @abstractmethod
+  async def wait_for_outgoing_messages(self,
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+    """Polls until new outgoing messages arrive.
+
+    A new outgoing message is one without `telegram_message_id`, with
+    `target_agent` set to `END_USER_AGENT` and with a `message_id` greater than
+    `after`. Returns at most `limit` messages, sorted by `message_id`.
+    """
+    pass
+
+  @abstractmethod
+  async def read_cursor(self, name: str) -> MessageId:
+    """Returns the value last stored for cursor `name` (or 0).
+
+    Cursors let consumers remember (across restarts) the last message they've
+    consumed; see `wait_for_incoming_messages`.
+    """
+    pass
+
+  @abstractmethod
+  async def save_cursor(self, name: str, message_id: MessageId) -> None:
+    """Stores `message_id` as the value of cursor `name`.
+
+    Cursors only move forward: if the stored value is greater than
+    `message_id`, it is kept.
+    """
+    pass
+
+  @abstractmethod
+  async def claim_incoming_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    """Claims (for `worker_id`) up to `limit` incoming messages for `agents`.
+
+    Only claims messages that aren't claimed by another worker (or whose lease
+    has expired) and aren't waiting for a retry (see `fail_message`). The claim
+    expires after `lease` (unless extended through `extend_leases`), after
+    which the messages can be claimed by others.
+    Claiming is atomic: concurrent callers (even in different processes) never
+    get the same message (unless its lease expires).
+
+    Claims messages in order of `MessagePriority`, promoting each message one
+    level for each `aging` (which must be positive) it has waited since it was
+    written; ties are broken by `message_id`. Returns them in that order. Keeps
+    the time that messages waited for their first claim (see `BusStats`).
+
+    Before claiming, delivers the topic messages (see `publish`) that `agents`
+    haven't received yet: each becomes an incoming message for each subscribed
+    agent (in `agents`), with priority `MessagePriority.LOW`, and the
+    subscription moves past it, atomically.
+
+    Returns immediately, possibly an empty list. The worker is expected to call
+    `mark_as_processed` for each message returned.
+    """
+    pass
+
+  @abstractmethod
+  async def wait_for_claimed_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    """Like `claim_incoming_messages`, but waits until it claims messages."""
+    pass
+
+  @abstractmethod
+  async def extend_leases(self, worker_id: WorkerId,
+                          lease: datetime.timedelta) -> int:
+    """Extends the leases of unprocessed messages claimed by `worker_id`.
+
+    Their leases will expire `lease` from now. Workers should call this
+    periodically while they process claimed messages. Returns the number of
+    messages whose leases were extended.
+    """
+    pass
+
+  @abstractmethod
+  async def release_claims(self, worker_id: WorkerId) -> None:
+    """Releases the unprocessed messages claimed by `worker_id`.
+
+    Other workers can claim them immediately.
+    """
+    pass
+
+  @abstractmethod
+  async def set_subscriptions(self, agent: AgentName,
+                              topics: frozenset[Topic]) -> None:
+    """Subscribes `agent` to `topics` (and unsubscribes it from all others).
+
+    A new subscription starts after the last message already published to its
+    topic; existing subscriptions keep their position.
+    """
+    pass
+
+  @abstractmethod
+  async def publish(self, message: TopicMessage) -> TopicMessage:
+    """Publishes `message` to the agents subscribed to `message.topic`.
+
+    Writes the message once, regardless of the number of subscribers; they
+    receive it when they claim their incoming messages (see
+    `claim_incoming_messages`). The `topic_message_id` will be overwritten (with
+    a new unique id, greater than all previous ones) and the resulting message
+    returned.
+    """
+    pass
+
+  async def set_conversation_id(self, message_id: MessageId,
+                                conversation_id: ConversationId) -> None:
+    await self.set_conversation_ids([(message_id, conversation_id)])
+
+  @abstractmethod
+  async def set_conversation_ids(
+      self, updates: list[tuple[MessageId, ConversationId]]) -> None:
+    """Sets the conversation_id of several messages, atomically.
+
+    It is an error to update a message that already has a conversation_id; if
+    any update fails, none is applied.
+    """
+    pass
+
+  async def write_new_message(self, message: Message) -> Message:
+    """Adds a new message to the bus.
+
+    The MessageId will be overwritten (with a new unique id, greater than all
+    previous ones) and the resulting message returned.
+    """
+    return (await self.write_new_messages([message]))[0]
+
+  @abstractmethod
+  async def write_new_messages(self, messages: list[Message]) -> list[Message]:
+    """Adds several messages to the bus, atomically.
 
-  def __init__(self, path: pathlib.Path) -> None:
+    Returns the messages written (in the same order), with their MessageId.
+    """
+    pass
+
+  @abstractmethod
+  async def write_telegram_updates(
+      self, updates: list[tuple[TelegramUpdateId, Message]]) -> list[Message]:
+    """Like `write_new_messages`, for the messages of Telegram updates.
+
+    Records each update id; messages whose update was already written (e.g.,
+    Telegram retried a webhook delivery) are skipped. Returns the messages
+    written. The records are deleted by `archive_messages`.
+    """
+    pass
+
+  async def mark_as_processed(self, message_id: MessageId) -> None:
+    """Sets processed_at to the current time."""
+    await self.mark_processed_many([message_id])
+
+  @abstractmethod
+  async def mark_processed_many(self, message_ids: list[MessageId]) -> None:
+    """Sets processed_at of several messages, atomically.
+
+    It is an error to mark a message that was already processed; if any update
+    fails, none is applied.
+    """
+    pass
+
+  async def set_telegram_message_id(
+      self, message_id: MessageId,
+      telegram_message_id: TelegramMessageId) -> None:
+    """Updates the telegram_message_id of a given row.
+
+    It is an error to update a message whose telegram_message_id already has a
+    value.
+    """
+    await self.set_telegram_message_ids([(message_id, telegram_message_id)])
+
+  @abstractmethod
+  async def set_telegram_message_ids(
+      self, updates: list[tuple[MessageId, TelegramMessageId]]) -> None:
+    """Like `set_telegram_message_id` for several messages, atomically.
+
+    If any update fails, none is applied.
+    """
+    pass
+
+  @abstractmethod
+  async def read_message(self, message_id: MessageId) -> Message:
+    """Returns a message from the bus or raises ValueError.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def find_message_by_telegram_id(
+      self, telegram_chat_id: TelegramChatId,
+      telegram_message_id: TelegramMessageId) -> Message:
+    """Returns a message from the bus or raises ValueError.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def fail_message(self, message_id: MessageId, error: str,
+                         policy: RetryPolicy) -> bool:
+    """Records a failed attempt at processing an incoming message.
+
+    Releases any claim on the message. If the message has failed fewer than
+    `policy.max_attempts` times, schedules a retry: it becomes incoming again
+    (without `processed_at` and `conversation_id`) after `policy.delay`.
+    Otherwise, it becomes a dead letter (with `error`), marked as processed,
+    until `requeue_dead_letters` is called.
+
+    Returns True if the message will be retried. Raises ValueError if the
+    message doesn't exist.
+    """
+    pass
+
+  @abstractmethod
+  async def list_dead_letters(self) -> list[DeadLetter]:
+    """Returns all dead letters (see `fail_message`), sorted by message id."""
+    pass
+
+  @abstractmethod
+  async def requeue_dead_letters(self,
+                                 message_ids: list[MessageId] | None = None
+                                ) -> list[MessageId]:
+    """Makes dead letters incoming again (as new, with no failed attempts).
+
+    Requeues the messages in `message_ids` (or all dead letters, if None).
+    Raises ValueError (requeueing none) if any of them isn't a dead letter.
+    Returns the messages requeued.
+    """
+    pass
+
+  @abstractmethod
+  async def start_session(self, message_id: MessageId) -> BusSession:
+    """Starts a new session to process an incoming message.
+
+    Assigns a new conversation id (unique across the bus, greater than 0) and
+    records it (with the message's `target_agent` and `telegram_chat_id`) so
+    that `read_session` can find the session after the process that started it
+    is gone. Sets the message's `conversation_id` (atomically).
+
+    Raises ValueError if the message doesn't exist or already has a
+    `conversation_id`.
+    """
+    pass
+
+  @abstractmethod
+  async def read_session(self, conversation_id: ConversationId) -> BusSession:
+    """Returns a session (see `start_session`) or raises ValueError."""
+    pass
+
+  @abstractmethod
+  async def read_conversation(self,
+                              conversation_id: ConversationId) -> list[Message]:
+    """Returns the messages with `conversation_id`, sorted by message id.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def archive_messages(self,
+                             older_than: datetime.timedelta,
+                             batch_size: int = 1000) -> int:
+    """Archives old messages that are done; returns how many.
+
+    A message is done if it was processed or, for messages to `END_USER_AGENT`,
+    sent to Telegram. It is old if it was processed (or, for messages without
+    `processed_at`, queued) more than `older_than` ago. Dead letters are never
+    archived. Archived messages are no longer pending anywhere, but
+    `read_message` and `find_message_by_telegram_id` still find them.
+
+    Also deletes topic messages published more than `older_than` ago that were
+    delivered to all their subscribers, and the records of Telegram updates
+    (see `write_telegram_updates`) received more than `older_than` ago.
+    """
+    pass
+
+  @abstractmethod
+  async def compact(self, pages: int = 1000) -> None:
+    """Releases space no longer used (e.g., after `archive_messages`)."""
+    pass
+
+  @abstractmethod
+  async def stats(self) -> BusStats:
+    """Returns statistics about the size of the bus."""
+    pass
+
+
+class SqliteMessageBus(MessageBus):
+  """A `MessageBus` in SQLite, shared by the swarm and the Telegram adapter.
+
+  All writes run in `_executor`, through a single connection. Reads run in
+  `_read_executor`, with a pool of read-only connections (so they don't wait
+  behind writes).
+
+  Consistency: a write is visible to all reads (in any process) that start
+  after the coroutine that issued the write returns; in particular, a task
+  always sees its own writes. Reads that start while a write is in progress
+  (e.g., waiting in the `write_behind` window) may not see it.
+  """
+
+  def __init__(self,
+               path: pathlib.Path,
+               write_behind: datetime.timedelta | None = None,
+               readers: int = 2) -> None:
+    """If `readers` is 0, reads run in `_executor` (with the writer)."""
     self._path = path
+    # If set, writes are delayed by up to this long, to group them into fewer
+    # transactions (see `_write`).
+    self._write_behind = write_behind
+    self._pending_writes: list[tuple[Callable[[], Any],
+                                     asyncio.Future[Any]]] = []
+    # Set while `_pending_writes` waits for the `write_behind` window to end.
+    self._flush_timer: asyncio.TimerHandle | None = None
+    # `_flush_writes` tasks running (see `_start_flush`).
+    self._flushers: set[asyncio.Task[None]] = set()
     self._executor = ThreadPoolExecutor(max_workers=1)
     # _connection is only accessed by threads running in _executor.
     self._connection: sqlite3.Connection | None = None
+    # Wakes up `_poll` when the bus changes (even in other processes).
+    self._notifier = MessageBusNotifier(path.with_name(path.name + ".notify"))
+    self._read_executor = ThreadPoolExecutor(
+        max_workers=readers) if readers else None
+    # Each thread in _read_executor has its own connection (in
+    # `_thread_local.connection`); they're all in `_read_connections`.
+    self._thread_local = threading.local()
+    self._read_connections: list[sqlite3.Connection] = []
+    self._read_connections_lock = threading.Lock()
+    # Updated (in `_executor`) by `_claim_messages_in_thread`.
+    self._claim_latency = ClaimLatency()
 
   async def _run_in_thread(self, func: Callable[P, T], *args: P.args,
                            **kwargs: P.kwargs) -> T:
@@ -49,83 +843,302 @@ class MessageBus:
     return await loop.run_in_executor(self._executor,
                                       lambda: func(*args, **kwargs))
 
-  async def _poll_in_thread(self,
-                            func: Callable[[], list[Message]]) -> list[Message]:
-    """Runs `func` once per second until it returns values."""
-    raise NotImplementedError()  # {{🍄 poll in thread}}
+  async def _run_read(self, func: Callable[[sqlite3.Connection], T]) -> T:
+    """Runs `func` in `_read_executor`, with a read-only connection."""
+    raise NotImplementedError()  # {{🍄 run read}}
+
+  async def _poll(
+      self, load: Callable[[], Awaitable[list[Message]]]) -> list[Message]:
+    """Runs `load` until it returns values.
+
+    Runs `load` again whenever `_notifier` signals a change and, as a fallback
+    (in case a notification is lost), every few seconds.
+    """
+    raise NotImplementedError()  # {{🍄 poll}}
 
   async def open(self) -> None:
     """Connects to the bus, potentially initializing it.
 
-    If the database is empty (or does not exist), creates the expected tables
-    (see message_bus.sql for details).
-
-    Passes timeout=20.0 and isolation_level=None when connecting.
+    Applies any pending `_MIGRATIONS` (creating the tables if the database is
+    empty or does not exist; see message_bus.sql for details). New databases
+    are created with `auto_vacuum = INCREMENTAL` (see `compact`).
     """
 
     def _open() -> None:
       raise NotImplementedError()  # {{🍄 init db}}
 
     await self._run_in_thread(_open)
+    self._notifier.open()
 
-  async def wait_for_incoming_messages(
-      self, agents: list[AgentName]) -> list[Message]:
-    """Polls until new incoming messages arrive for the agents listed.
+  async def close(self) -> None:
+    """Runs the pending writes (see `write_behind`) and disconnects."""
+    if self._flush_timer is not None:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+      await self._flush_writes()
+    await asyncio.gather(*self._flushers, return_exceptions=True)
+    self._notifier.close()
 
-    A new incoming message is one with `processed_at` set to NULL.
-    """
+    def _close() -> None:
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
+
+    await self._run_in_thread(_close)
+    if self._read_executor is not None:
+      self._read_executor.shutdown()
+      for connection in self._read_connections:
+        connection.close()
+
+  async def wait_for_incoming_messages(self,
+                                       agents: list[AgentName],
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
 
-    def _load_messages() -> list[Message]:
+    def _load_messages(connection: sqlite3.Connection) -> list[Message]:
       """May return empty list."""
       raise NotImplementedError()  # {{🍄 load incoming messages}}
 
-    return await self._poll_in_thread(_load_messages)
+    return await self._poll(lambda: self._run_read(_load_messages))
 
-  async def wait_for_outgoing_messages(self) -> list[Message]:
-    """Polls until new outgoing messages arrive.
+  async def wait_for_outgoing_messages(self,
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+
+    def _load_messages(connection: sqlite3.Connection) -> list[Message]:
+      raise NotImplementedError()  # {{🍄 load outgoing messages}}
+
+    return await self._poll(lambda: self._run_read(_load_messages))
+
+  async def read_cursor(self, name: str) -> MessageId:
+    raise NotImplementedError()  # {{🍄 read cursor}}
+
+  async def save_cursor(self, name: str, message_id: MessageId) -> None:
+    raise NotImplementedError()  # {{🍄 save cursor}}
+
+  async def claim_incoming_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    return await self._run_in_thread(self._claim_messages_in_thread, agents,
+                                     worker_id, lease, limit, aging)
 
-    A new outgoing message is one with `telegram_message_id` set to `NULL` and
-    `agent` set to the value in `END_USER_AGENT`.
+  async def wait_for_claimed_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    return await self._poll(lambda: self._run_in_thread(
+        self._claim_messages_in_thread, agents, worker_id, lease, limit, aging))
+
+  def _claim_messages_in_thread(self, agents: list[AgentName],
+                                worker_id: WorkerId, lease: datetime.timedelta,
+                                limit: int,
+                                aging: datetime.timedelta) -> list[Message]:
+    """Runs in `_executor`; returns the messages in the order claimed.
+
+    Delivers topic messages through `_deliver_topic_messages_in_thread` and then
+    claims with a single `UPDATE … RETURNING` statement.
     """
+    raise NotImplementedError()  # {{🍄 claim messages}}
 
-    def _load_messages() -> list[Message]:
-      raise NotImplementedError()  # {{🍄 load outgoing messages}}
+  async def extend_leases(self, worker_id: WorkerId,
+                          lease: datetime.timedelta) -> int:
+    raise NotImplementedError()  # {{🍄 extend leases}}
 
-    return await self._poll_in_thread(_load_messages)
+  async def release_claims(self, worker_id: WorkerId) -> None:
+    raise NotImplementedError()  # {{🍄 release claims}}
 
-  async def set_conversation_id(self, message_id: MessageId,
-                                conversation_id: ConversationId) -> None:
-    raise NotImplementedError()  # {{🍄 set message conversation}}
+  async def set_subscriptions(self, agent: AgentName,
+                              topics: frozenset[Topic]) -> None:
+    raise NotImplementedError()  # {{🍄 set subscriptions}}
 
-  async def write_new_message(self, message: Message) -> Message:
-    """Adds a new message to the database.
+  async def publish(self, message: TopicMessage) -> TopicMessage:
+    raise NotImplementedError()  # {{🍄 publish}}
+
+  def _deliver_topic_messages_in_thread(self, agents: list[AgentName],
+                                        limit: int) -> int:
+    """Runs in `_executor`; see `claim_incoming_messages`.
 
-    The MessageId will be overwritten (based on database state) and the
-    resulting message returned.
+    Delivers up to `limit` topic messages in a single transaction. Checks for
+    pending topic messages first (outside of the transaction), so that it
+    doesn't lock the bus when there are none. Returns the number of messages
+    delivered.
     """
+    raise NotImplementedError()  # {{🍄 deliver topic messages}}
+
+  async def set_conversation_ids(
+      self, updates: list[tuple[MessageId, ConversationId]]) -> None:
+
+    def _write_all() -> None:
+      for u in updates:
+        self._set_conversation_id_in_thread(*u)
+
+    if updates:
+      await self._write(_write_all)
+
+  async def write_new_messages(self, messages: list[Message]) -> list[Message]:
+    if not messages:
+      return []
+    return await self._write(
+        lambda: [self._insert_message_in_thread(m) for m in messages])
+
+  async def write_telegram_updates(
+      self, updates: list[tuple[TelegramUpdateId, Message]]) -> list[Message]:
+
+    def _write_all() -> list[Message]:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      written: list[Message] = []
+      for update_id, message in updates:
+        if self._connection.execute(
+            "INSERT OR IGNORE INTO message_bus_telegram_updates (update_id) "
+            "VALUES (?)", (update_id,)).rowcount:
+          written.append(self._insert_message_in_thread(message))
+      return written
+
+    if not updates:
+      return []
+    return await self._write(_write_all)
+
+  async def mark_processed_many(self, message_ids: list[MessageId]) -> None:
+
+    def _write_all() -> None:
+      for i in message_ids:
+        self._mark_as_processed_in_thread(i)
+
+    if message_ids:
+      await self._write(_write_all)
+
+  async def set_telegram_message_ids(
+      self, updates: list[tuple[MessageId, TelegramMessageId]]) -> None:
+
+    def _write_all() -> None:
+      for u in updates:
+        self._set_telegram_message_id_in_thread(*u)
+
+    if updates:
+      await self._write(_write_all)
+
+  async def _write(self, func: Callable[[], T]) -> T:
+    """Runs `func` (in `_executor`) in a write transaction; returns its result.
+
+    Without `write_behind`, runs `func` in its own transaction. Otherwise,
+    queues it in `_pending_writes`, to be run by `_flush_writes` (together with
+    all other writes queued during the `write_behind` window), through
+    `_flush_timer` and `_start_flush`.
+
+    Notifies waiters (through `_notifier`) after the transaction commits.
+    """
+    raise NotImplementedError()  # {{🍄 write}}
+
+  def _start_flush(self) -> None:
+    """Starts `_flush_writes` (at the end of the `write_behind` window)."""
+    self._flush_timer = None
+    task = asyncio.create_task(self._flush_writes())
+    self._flushers.add(task)
+    task.add_done_callback(self._flush_done)
+
+  def _flush_done(self, task: asyncio.Task[None]) -> None:
+    self._flushers.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      logging.error(
+          "Message bus: flushing writes failed.", exc_info=task.exception())
+
+  async def _flush_writes(self) -> None:
+    """Runs all `_pending_writes` in a single transaction.
+
+    Each write runs in its own savepoint: a write that fails (its exception is
+    given to its caller) doesn't affect the others.
+    """
+    raise NotImplementedError()  # {{🍄 flush writes}}
+
+  def _run_writes_in_thread(
+      self, funcs: list[Callable[[],
+                                 Any]]) -> list[tuple[Any, Exception | None]]:
+    """Runs `funcs` (in `_executor`) in a single transaction.
+
+    Returns the result (or exception) of each function, in order.
+    """
+    raise NotImplementedError()  # {{🍄 run writes in thread}}
+
+  def _set_conversation_id_in_thread(self, message_id: MessageId,
+                                     conversation_id: ConversationId) -> None:
+    raise NotImplementedError()  # {{🍄 set message conversation}}
+
+  def _insert_message_in_thread(self, message: Message) -> Message:
     raise NotImplementedError()  # {{🍄 write new message}}
 
-  async def mark_as_processed(self, message_id: MessageId) -> None:
-    """Sets processed_at to the current time."""
+  def _mark_as_processed_in_thread(self, message_id: MessageId) -> None:
     raise NotImplementedError()  # {{🍄 set processed at}}
 
-  async def set_telegram_message_id(
+  def _set_telegram_message_id_in_thread(
       self, message_id: MessageId,
       telegram_message_id: TelegramMessageId) -> None:
-    """Updates the telegram_message_id of a given row.
-
-    It is an error to try to update a message_id where the telegram_message_id
-    already has a value (we use a conditional update and validate that exactly
-    1 row was updated).
-    """
     raise NotImplementedError()  # {{🍄 set telegram message id}}
 
   async def read_message(self, message_id: MessageId) -> Message:
-    """Returns a message from the database or raises ValueError."""
     raise NotImplementedError()  # {{🍄 read message}}
 
   async def find_message_by_telegram_id(
       self, telegram_chat_id: TelegramChatId,
       telegram_message_id: TelegramMessageId) -> Message:
-    """Returns a message from the database or raises ValueError."""
     raise NotImplementedError()  # {{🍄 find message by telegram id}}
+
+  async def fail_message(self, message_id: MessageId, error: str,
+                         policy: RetryPolicy) -> bool:
+    raise NotImplementedError()  # {{🍄 fail message}}
+
+  async def list_dead_letters(self) -> list[DeadLetter]:
+    raise NotImplementedError()  # {{🍄 list dead letters}}
+
+  async def requeue_dead_letters(self,
+                                 message_ids: list[MessageId] | None = None
+                                ) -> list[MessageId]:
+    raise NotImplementedError()  # {{🍄 requeue dead letters}}
+
+  async def start_session(self, message_id: MessageId) -> BusSession:
+    raise NotImplementedError()  # {{🍄 start session}}
+
+  async def read_session(self, conversation_id: ConversationId) -> BusSession:
+    raise NotImplementedError()  # {{🍄 read session}}
+
+  async def read_conversation(self,
+                              conversation_id: ConversationId) -> list[Message]:
+    raise NotImplementedError()  # {{🍄 read conversation}}
+
+  async def archive_messages(self,
+                             older_than: datetime.timedelta,
+                             batch_size: int = 1000) -> int:
+    """Moves old messages that are done to `message_bus_archive`.
+
+    A message is done if it was processed or, for messages to `END_USER_AGENT`,
+    sent to Telegram. It is old if it was processed (or, for messages without
+    `processed_at`, queued) more than `older_than` ago.
+
+    The archive keeps all the columns (with `content` compressed and inline,
+    even if it was offloaded), so `read_message` and
+    `find_message_by_telegram_id` (for replies to old messages) keep working.
+    Afterwards, deletes the blobs no longer referenced by `message_bus`.
+
+    Moves `batch_size` messages per transaction (to avoid blocking writers for
+    long). Returns the number of messages archived.
+    """
+    raise NotImplementedError()  # {{🍄 archive messages}}
+
+  async def compact(self, pages: int = 1000) -> None:
+    """Returns free pages to the file system and checkpoints the WAL.
+
+    Runs `PRAGMA incremental_vacuum(pages)` and
+    `PRAGMA wal_checkpoint(TRUNCATE)`. Databases created before incremental
+    vacuum was enabled are converted (through a full `VACUUM`) the first time.
+    """
+    raise NotImplementedError()  # {{🍄 compact}}
+
+  async def stats(self) -> BusStats:
+    raise NotImplementedError()  # {{🍄 stats}}
@@ -1,21 +1,29 @@
 # DO NOT EDIT. This file is automatically generated by Duende.
+from abc import ABC, abstractmethod
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import datetime
 import dataclasses
+from enum import Enum
+import hashlib
 import logging
 import pathlib
 import sqlite3
-from typing import Callable, NewType, ParamSpec, TypeVar, cast
+import threading
+import time
+import zlib
+from typing import Any, Awaitable, Callable, NamedTuple, NewType, ParamSpec, TypeVar, cast
 
 from conversation import ConversationId
-from swarm_types import AgentName
+from message_bus_notifier import MessageBusNotifier
+from swarm_types import AgentName, Topic
 
 # MessageId is meant for the IDs of messages in the SQL database. It is NOT
 # meant for the IDs of Telegram messages (use TelegramMessageId for those).
 MessageId = NewType("MessageId", int)  # Unique ID across the bus.
 TelegramChatId = NewType("TelegramChatId", int)
 TelegramMessageId = NewType("TelegramMessageId", int)
+TelegramUpdateId = NewType("TelegramUpdateId", int)
 
 # Wrapper for the `content` fields in the message bus.
 MessageContent = NewType("MessageContent", str)
@@ -23,12 +31,42 @@ MessageContent = NewType("MessageContent", str)
 # Fake agent name reserved to represent the end user.
 END_USER_AGENT = AgentName("duende-internal:end-user")
 
+# Identifies a consumer of incoming messages (see
+# `MessageBus.claim_incoming_messages`). Must be unique across processes.
+WorkerId = NewType("WorkerId", str)
+
+# Unique ID of a message published to a topic (see `MessageBus.publish`).
+TopicMessageId = NewType("TopicMessageId", int)
+
+
+class MessagePriority(Enum):
+  """Order in which incoming messages are claimed (lower values first).
+
+  Messages are promoted one level for each `aging` they wait (see
+  `claim_incoming_messages`), so that lower priorities don't starve.
+  """
+  # Messages from the end user (END_USER_AGENT).
+  HIGH = 0
+  # Requests between agents (e.g., `delegate_request`).
+  MEDIUM = 1
+  # Background traffic between agents (e.g., `publish_message` and topics).
+  LOW = 2
+
+  def aged(self, waited_secs: float, aging: datetime.timedelta) -> int:
+    """Returns the value to order by after waiting `waited_secs`."""
+    return max(0, self.value - int(waited_secs / aging.total_seconds()))
+
+
+# Default `aging` for `MessageBus.claim_incoming_messages`.
+PRIORITY_AGING = datetime.timedelta(minutes=1)
+
 
 @dataclasses.dataclass(frozen=True)
 class Message:
   # The fields map directly to the rows of the `message_bus` SQL table.
   #
-  # Paths use `pathlib.Path`.
+  # Paths use `pathlib.Path`. `priority` (last) defaults to
+  # `MessagePriority.MEDIUM`.
   # ✨ message fields
   message_id: MessageId
   source_agent: AgentName
@@ -41,20 +79,848 @@ class Message:
   content: MessageContent
   queued_at: datetime.datetime
   processed_at: datetime.datetime | None
+  priority: MessagePriority = MessagePriority.MEDIUM
   # ✨
 
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
+# Schema migrations, applied in order. `PRAGMA user_version` holds the number of
+# migrations already applied to a database. Never edit a migration that has
+# been released (existing databases won't see the change); append a new one.
+#
+# The first migration uses `IF NOT EXISTS` so that databases created before
+# migrations existed (with version 0) are adopted.
+_MIGRATIONS: list[list[str]] = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS message_bus (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+            source_agent TEXT NOT NULL,
+            target_agent TEXT NOT NULL,
+
+            local_directory TEXT,
+
+            conversation_id INTEGER,
+
+            telegram_chat_id INTEGER NOT NULL,
+
+            telegram_message_id INTEGER,
+            telegram_reply_to_id INTEGER,
+
+            content TEXT NOT NULL,
+
+            queued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            processed_at DATETIME
+        )
+        """,
+    ],
+    [
+        # wait_for_incoming_messages.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_incoming
+        ON message_bus (target_agent, message_id)
+        WHERE processed_at IS NULL
+        """,
+        # wait_for_outgoing_messages.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_outgoing
+        ON message_bus (target_agent, message_id)
+        WHERE telegram_message_id IS NULL
+        """,
+        # find_message_by_telegram_id.
+        """
+        CREATE INDEX IF NOT EXISTS message_bus_telegram
+        ON message_bus (telegram_chat_id, telegram_message_id)
+        WHERE telegram_message_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.claim_incoming_messages`. `lease_expires_at` is in
+        # seconds since the epoch.
+        "ALTER TABLE message_bus ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE message_bus ADD COLUMN lease_expires_at REAL",
+    ],
+    [
+        # See `MessageBus.save_cursor`.
+        """
+        CREATE TABLE message_bus_cursors (
+            name TEXT PRIMARY KEY,
+            message_id INTEGER NOT NULL
+        )
+        """,
+    ],
+    [
+        # See `MessageBus.archive_messages`. `content` is compressed (through
+        # the `zlib_compress` function registered by `_connect`).
+        """
+        CREATE TABLE message_bus_archive (
+            message_id INTEGER PRIMARY KEY,
+            source_agent TEXT NOT NULL,
+            target_agent TEXT NOT NULL,
+            local_directory TEXT,
+            conversation_id INTEGER,
+            telegram_chat_id INTEGER NOT NULL,
+            telegram_message_id INTEGER,
+            telegram_reply_to_id INTEGER,
+            content BLOB NOT NULL,
+            queued_at DATETIME,
+            processed_at DATETIME
+        )
+        """,
+        """
+        CREATE INDEX message_bus_archive_telegram
+        ON message_bus_archive (telegram_chat_id, telegram_message_id)
+        WHERE telegram_message_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.fail_message`. `retry_at` is in seconds since the
+        # epoch.
+        "ALTER TABLE message_bus ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE message_bus ADD COLUMN retry_at REAL",
+        """
+        CREATE TABLE message_bus_dead_letters (
+            message_id INTEGER PRIMARY KEY,
+            attempts INTEGER NOT NULL,
+            error TEXT NOT NULL,
+            failed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    [
+        # See `MessageBus.start_session`.
+        """
+        CREATE TABLE message_bus_sessions (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent TEXT NOT NULL,
+            telegram_chat_id INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Conversation ids written before this migration (by each process,
+        # starting from 0) must not be reused.
+        """
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'message_bus_sessions', COALESCE(MAX(conversation_id), 0)
+        FROM (
+            SELECT conversation_id FROM message_bus
+            UNION ALL SELECT conversation_id FROM message_bus_archive
+        )
+        """,
+        # read_conversation.
+        """
+        CREATE INDEX message_bus_conversation
+        ON message_bus (conversation_id, message_id)
+        WHERE conversation_id IS NOT NULL
+        """,
+        """
+        CREATE INDEX message_bus_archive_conversation
+        ON message_bus_archive (conversation_id, message_id)
+        WHERE conversation_id IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.publish`.
+        """
+        CREATE TABLE message_bus_topic_messages (
+            topic_message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            source_agent TEXT NOT NULL,
+            local_directory TEXT,
+            telegram_chat_id INTEGER NOT NULL,
+            telegram_reply_to_id INTEGER,
+            content TEXT NOT NULL,
+            published_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX message_bus_topic_messages_topic
+        ON message_bus_topic_messages (topic, topic_message_id)
+        """,
+        # See `MessageBus.set_subscriptions`. `topic_message_id` is the last
+        # message delivered to the subscriber.
+        """
+        CREATE TABLE message_bus_subscriptions (
+            agent TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            topic_message_id INTEGER NOT NULL,
+            PRIMARY KEY (agent, topic)
+        )
+        """,
+    ],
+    [
+        # See `MessagePriority`. `enqueued_at` (`time.time()` when the message
+        # was written or published) is used to age priorities and to measure
+        # claim latency; it's NULL for messages written before this migration.
+        """
+        ALTER TABLE message_bus
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 1
+        """,
+        "ALTER TABLE message_bus ADD COLUMN enqueued_at REAL",
+        """
+        ALTER TABLE message_bus_archive
+        ADD COLUMN priority INTEGER NOT NULL DEFAULT 1
+        """,
+        f"""
+        UPDATE message_bus SET priority = 0
+        WHERE source_agent = '{END_USER_AGENT}'
+        """,
+        "ALTER TABLE message_bus_topic_messages ADD COLUMN enqueued_at REAL",
+    ],
+    [
+        # See `_offload_content`.
+        """
+        CREATE TABLE message_bus_blobs (
+            digest TEXT PRIMARY KEY,
+            content TEXT NOT NULL
+        )
+        """,
+        "ALTER TABLE message_bus ADD COLUMN content_digest TEXT",
+        """
+        CREATE INDEX message_bus_content_digest
+        ON message_bus (content_digest)
+        WHERE content_digest IS NOT NULL
+        """,
+    ],
+    [
+        # See `MessageBus.write_telegram_updates`.
+        """
+        CREATE TABLE message_bus_telegram_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+]
+
+# Contents (of messages in `message_bus`) longer than this (in UTF-8 bytes) are
+# stored in `message_bus_blobs` (see `_offload_content`).
+_BLOB_THRESHOLD = 4096
+
+# The columns of `message_bus` read into `Message` fields.
+_MESSAGE_FIELDS = """
+    message_id,
+    source_agent,
+    target_agent,
+    local_directory,
+    conversation_id,
+    telegram_chat_id,
+    telegram_message_id,
+    telegram_reply_to_id,
+    content,
+    queued_at,
+    processed_at,
+    priority
+"""
+# The `content` of a row in `message_bus`, loaded from `message_bus_blobs` if it
+# was offloaded. Only evaluated for the rows a query returns.
+_CONTENT = """COALESCE(
+    (SELECT b.content FROM message_bus_blobs b
+     WHERE b.digest = message_bus.content_digest),
+    message_bus.content)"""
+# Selects `_MESSAGE_FIELDS` (as read by `_message_from_row`) from `message_bus`.
+_MESSAGE_COLUMNS = _MESSAGE_FIELDS.replace("content", f"{_CONTENT} AS content")
+# Like `_MESSAGE_COLUMNS`, for `message_bus_archive`.
+_ARCHIVE_COLUMNS = _MESSAGE_FIELDS.replace(
+    "content", "zlib_decompress(content) AS content")
+
+
+def _apply_migrations(connection: sqlite3.Connection) -> None:
+  """Applies the entries in `_MIGRATIONS` that `connection` lacks.
+
+  Each migration runs in its own `BEGIN IMMEDIATE` transaction (together with
+  the update to `user_version`), so concurrent processes opening the same bus
+  apply each migration exactly once.
+
+  Raises RuntimeError if the database has a version newer than
+  `len(_MIGRATIONS)` (i.e., it was created by a newer version of this code).
+  """
+  # ✨ apply migrations
+  while True:
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+      version = connection.execute("PRAGMA user_version").fetchone()[0]
+      if version > len(_MIGRATIONS):
+        raise RuntimeError(
+            f"Message bus has schema version {version}, newer than the "
+            f"latest known ({len(_MIGRATIONS)}).")
+      if version == len(_MIGRATIONS):
+        connection.execute("COMMIT")
+        return
+      logging.info(f"Migrating message bus to schema version {version + 1}.")
+      for statement in _MIGRATIONS[version]:
+        connection.execute(statement)
+      connection.execute(f"PRAGMA user_version = {version + 1}")
+      connection.execute("COMMIT")
+    except Exception:
+      connection.execute("ROLLBACK")
+      raise
+  # ✨
+
+
+class BusStats(NamedTuple):
+  # Rows in the `message_bus` table.
+  rows: int
+  # Rows neither processed nor sent to Telegram.
+  pending_rows: int
+  # Rows in the `message_bus_archive` table.
+  archived_rows: int
+  # Size of the database file.
+  database_bytes: int
+  # Space in the database file not used by any table (see `compact`).
+  free_bytes: int
+  # Rows in the `message_bus_topic_messages` table.
+  topic_rows: int
+  # Rows in the `message_bus_blobs` table.
+  blob_rows: int
+  # Average and maximum time that messages claimed through this bus object
+  # (not other processes) waited for their first claim, per priority.
+  average_claim_latency: dict[MessagePriority, datetime.timedelta]
+  max_claim_latency: dict[MessagePriority, datetime.timedelta]
+
+
+class ClaimLatency:
+  """Tracks how long messages wait (since written) for their first claim."""
+
+  def __init__(self) -> None:
+    self._claims: dict[MessagePriority, int] = {}
+    self._total_secs: dict[MessagePriority, float] = {}
+    self._max_secs: dict[MessagePriority, float] = {}
+
+  def record(self, priority: MessagePriority, waited_secs: float) -> None:
+    self._claims[priority] = self._claims.get(priority, 0) + 1
+    self._total_secs[priority] = (
+        self._total_secs.get(priority, 0.0) + waited_secs)
+    self._max_secs[priority] = max(
+        self._max_secs.get(priority, 0.0), waited_secs)
+
+  def average(self) -> dict[MessagePriority, datetime.timedelta]:
+    return {
+        priority: datetime.timedelta(seconds=self._total_secs[priority] / count)
+        for priority, count in sorted(
+            self._claims.items(), key=lambda item: item[0].value)
+    }
+
+  def max(self) -> dict[MessagePriority, datetime.timedelta]:
+    return {
+        priority: datetime.timedelta(seconds=self._max_secs[priority])
+        for priority in sorted(self._max_secs, key=lambda p: p.value)
+    }
+
+
+class RetryPolicy(NamedTuple):
+  """How `MessageBus.fail_message` retries messages."""
+  # Attempts (including the first) before a message becomes a dead letter.
+  max_attempts: int
+  # Delay before the first retry; doubles with each retry (up to
+  # `max_backoff`).
+  backoff: datetime.timedelta
+  max_backoff: datetime.timedelta
+
+  def delay(self, attempts: int) -> datetime.timedelta:
+    """Returns how long to wait after `attempts` failed attempts."""
+    return min(self.backoff * 2.0**(attempts - 1), self.max_backoff)
+
+
+class DeadLetter(NamedTuple):
+  """A message that failed `RetryPolicy.max_attempts` times."""
+  message: Message
+  attempts: int
+  # The error (e.g., an exception trace) of the last attempt.
+  error: str
+  failed_at: datetime.datetime
+
+
+@dataclasses.dataclass(frozen=True)
+class TopicMessage:
+  """A message published to a topic (see `MessageBus.publish`).
+
+  Each subscriber receives it as a `Message` with the same fields.
+  """
+  topic_message_id: TopicMessageId
+  topic: Topic
+  source_agent: AgentName
+  local_directory: pathlib.Path | None
+  telegram_chat_id: TelegramChatId
+  telegram_reply_to_id: TelegramMessageId | None
+  content: MessageContent
+  published_at: datetime.datetime
+
+
+class BusSession(NamedTuple):
+  """A session (conversation) started by `MessageBus.start_session`."""
+  conversation_id: ConversationId
+  agent: AgentName
+  telegram_chat_id: TelegramChatId
+  created_at: datetime.datetime
+
+
+def _message_from_row(row: sqlite3.Row) -> Message:
+  """Converts a row with (at least) the `_MESSAGE_COLUMNS`."""
+  # ✨ message from row
+  return Message(
+      message_id=MessageId(row['message_id']),
+      source_agent=AgentName(row['source_agent']),
+      target_agent=AgentName(row['target_agent']),
+      local_directory=pathlib.Path(row['local_directory'])
+      if row['local_directory'] else None,
+      conversation_id=ConversationId(row['conversation_id'])
+      if row['conversation_id'] else None,
+      telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
+      telegram_message_id=TelegramMessageId(row['telegram_message_id'])
+      if row['telegram_message_id'] else None,
+      telegram_reply_to_id=TelegramMessageId(row['telegram_reply_to_id'])
+      if row['telegram_reply_to_id'] else None,
+      content=MessageContent(row['content']),
+      queued_at=datetime.datetime.fromisoformat(row['queued_at']),
+      processed_at=datetime.datetime.fromisoformat(row['processed_at'])
+      if row['processed_at'] else None,
+      priority=MessagePriority(row['priority']),
+  )
+  # ✨
+
+
+def _session_from_row(row: sqlite3.Row) -> BusSession:
+  return BusSession(
+      conversation_id=ConversationId(row['conversation_id']),
+      agent=AgentName(row['agent']),
+      telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
+      created_at=datetime.datetime.fromisoformat(row['created_at']))
+
+
+def _connect(path: pathlib.Path, read_only: bool) -> sqlite3.Connection:
+  """Returns a new connection to the bus in `path`.
+
+  Passes timeout=20.0 and isolation_level=None when connecting. Read-only
+  connections can be used from any thread (but only one at a time).
+
+  Sets `row_factory` to `sqlite3.Row` and registers SQL functions
+  `zlib_compress` and `zlib_decompress` (used for the archive).
+  """
+  # ✨ connect
+  if read_only:
+    connection = sqlite3.connect(
+        path.resolve().as_uri() + "?mode=ro",
+        uri=True,
+        timeout=20.0,
+        isolation_level=None,
+        check_same_thread=False)
+  else:
+    connection = sqlite3.connect(str(path), timeout=20.0, isolation_level=None)
+  connection.row_factory = sqlite3.Row
+  connection.create_function(
+      "zlib_compress",
+      1,
+      lambda text: zlib.compress(text.encode()),
+      deterministic=True)
+  connection.create_function(
+      "zlib_decompress",
+      1,
+      lambda data: zlib.decompress(data).decode(),
+      deterministic=True)
+  return connection
+  # ✨
+
+
+def _offload_content(connection: sqlite3.Connection,
+                     content: MessageContent) -> tuple[str, str | None]:
+  """Returns the values for the `content` and `content_digest` columns.
+
+  Contents longer than `_BLOB_THRESHOLD` are stored in `message_bus_blobs`,
+  keyed by their SHA-256 digest (so messages with the same content share a
+  row), and their `content` column is empty. Must run in the transaction that
+  writes the message.
+  """
+  # ✨ offload content
+  data = content.encode()
+  if len(data) <= _BLOB_THRESHOLD:
+    return content, None
+  digest = hashlib.sha256(data).hexdigest()
+  connection.execute(
+      "INSERT OR IGNORE INTO message_bus_blobs (digest, content) VALUES (?, ?)",
+      (digest, content))
+  return "", digest
+  # ✨
+
+
+class MessageBus(ABC):
+  """Queue of messages between agents (and the end user, through Telegram).
+
+  Messages get increasing ids. Messages to agents are pending until they're
+  marked as processed; messages to `END_USER_AGENT`, until they get a
+  `telegram_message_id`.
+
+  Implementations: `SqliteMessageBus` (shared across processes) and
+  `InMemoryMessageBus` (in message_bus_memory.py; for tests and benchmarks).
+  """
+
+  @abstractmethod
+  async def open(self) -> None:
+    """Connects to the bus (creating it if needed)."""
+    pass
+
+  @abstractmethod
+  async def close(self) -> None:
+    """Disconnects from the bus."""
+    pass
+
+  @abstractmethod
+  async def wait_for_incoming_messages(self,
+                                       agents: list[AgentName],
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+    """Polls until new incoming messages arrive for the agents listed.
+
+    A new incoming message is one without `processed_at` (and not waiting for
+    a retry; see `fail_message`) and with a `message_id` greater than `after`.
+    Returns at most `limit` messages, sorted by `message_id`.
+
+    Consumers should pass as `after` the id of the last message they've already
+    seen (e.g., a cursor obtained from `read_cursor`), so that a backlog is read
+    only once.
+    """
+    pass
+
+  @abstractmethod
+  async def wait_for_outgoing_messages(self,
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+    """Polls until new outgoing messages arrive.
+
+    A new outgoing message is one without `telegram_message_id`, with
+    `target_agent` set to `END_USER_AGENT` and with a `message_id` greater than
+    `after`. Returns at most `limit` messages, sorted by `message_id`.
+    """
+    pass
+
+  @abstractmethod
+  async def read_cursor(self, name: str) -> MessageId:
+    """Returns the value last stored for cursor `name` (or 0).
+
+    Cursors let consumers remember (across restarts) the last message they've
+    consumed; see `wait_for_incoming_messages`.
+    """
+    pass
+
+  @abstractmethod
+  async def save_cursor(self, name: str, message_id: MessageId) -> None:
+    """Stores `message_id` as the value of cursor `name`.
+
+    Cursors only move forward: if the stored value is greater than
+    `message_id`, it is kept.
+    """
+    pass
+
+  @abstractmethod
+  async def claim_incoming_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    """Claims (for `worker_id`) up to `limit` incoming messages for `agents`.
+
+    Only claims messages that aren't claimed by another worker (or whose lease
+    has expired) and aren't waiting for a retry (see `fail_message`). The claim
+    expires after `lease` (unless extended through `extend_leases`), after
+    which the messages can be claimed by others.
+    Claiming is atomic: concurrent callers (even in different processes) never
+    get the same message (unless its lease expires).
+
+    Claims messages in order of `MessagePriority`, promoting each message one
+    level for each `aging` (which must be positive) it has waited since it was
+    written; ties are broken by `message_id`. Returns them in that order. Keeps
+    the time that messages waited for their first claim (see `BusStats`).
+
+    Before claiming, delivers the topic messages (see `publish`) that `agents`
+    haven't received yet: each becomes an incoming message for each subscribed
+    agent (in `agents`), with priority `MessagePriority.LOW`, and the
+    subscription moves past it, atomically.
+
+    Returns immediately, possibly an empty list. The worker is expected to call
+    `mark_as_processed` for each message returned.
+    """
+    pass
+
+  @abstractmethod
+  async def wait_for_claimed_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    """Like `claim_incoming_messages`, but waits until it claims messages."""
+    pass
+
+  @abstractmethod
+  async def extend_leases(self, worker_id: WorkerId,
+                          lease: datetime.timedelta) -> int:
+    """Extends the leases of unprocessed messages claimed by `worker_id`.
+
+    Their leases will expire `lease` from now. Workers should call this
+    periodically while they process claimed messages. Returns the number of
+    messages whose leases were extended.
+    """
+    pass
+
+  @abstractmethod
+  async def release_claims(self, worker_id: WorkerId) -> None:
+    """Releases the unprocessed messages claimed by `worker_id`.
+
+    Other workers can claim them immediately.
+    """
+    pass
+
+  @abstractmethod
+  async def set_subscriptions(self, agent: AgentName,
+                              topics: frozenset[Topic]) -> None:
+    """Subscribes `agent` to `topics` (and unsubscribes it from all others).
+
+    A new subscription starts after the last message already published to its
+    topic; existing subscriptions keep their position.
+    """
+    pass
+
+  @abstractmethod
+  async def publish(self, message: TopicMessage) -> TopicMessage:
+    """Publishes `message` to the agents subscribed to `message.topic`.
+
+    Writes the message once, regardless of the number of subscribers; they
+    receive it when they claim their incoming messages (see
+    `claim_incoming_messages`). The `topic_message_id` will be overwritten (with
+    a new unique id, greater than all previous ones) and the resulting message
+    returned.
+    """
+    pass
+
+  async def set_conversation_id(self, message_id: MessageId,
+                                conversation_id: ConversationId) -> None:
+    await self.set_conversation_ids([(message_id, conversation_id)])
 
-class MessageBus:
+  @abstractmethod
+  async def set_conversation_ids(
+      self, updates: list[tuple[MessageId, ConversationId]]) -> None:
+    """Sets the conversation_id of several messages, atomically.
 
-  def __init__(self, path: pathlib.Path) -> None:
+    It is an error to update a message that already has a conversation_id; if
+    any update fails, none is applied.
+    """
+    pass
+
+  async def write_new_message(self, message: Message) -> Message:
+    """Adds a new message to the bus.
+
+    The MessageId will be overwritten (with a new unique id, greater than all
+    previous ones) and the resulting message returned.
+    """
+    return (await self.write_new_messages([message]))[0]
+
+  @abstractmethod
+  async def write_new_messages(self, messages: list[Message]) -> list[Message]:
+    """Adds several messages to the bus, atomically.
+
+    Returns the messages written (in the same order), with their MessageId.
+    """
+    pass
+
+  @abstractmethod
+  async def write_telegram_updates(
+      self, updates: list[tuple[TelegramUpdateId, Message]]) -> list[Message]:
+    """Like `write_new_messages`, for the messages of Telegram updates.
+
+    Records each update id; messages whose update was already written (e.g.,
+    Telegram retried a webhook delivery) are skipped. Returns the messages
+    written. The records are deleted by `archive_messages`.
+    """
+    pass
+
+  async def mark_as_processed(self, message_id: MessageId) -> None:
+    """Sets processed_at to the current time."""
+    await self.mark_processed_many([message_id])
+
+  @abstractmethod
+  async def mark_processed_many(self, message_ids: list[MessageId]) -> None:
+    """Sets processed_at of several messages, atomically.
+
+    It is an error to mark a message that was already processed; if any update
+    fails, none is applied.
+    """
+    pass
+
+  async def set_telegram_message_id(
+      self, message_id: MessageId,
+      telegram_message_id: TelegramMessageId) -> None:
+    """Updates the telegram_message_id of a given row.
+
+    It is an error to update a message whose telegram_message_id already has a
+    value.
+    """
+    await self.set_telegram_message_ids([(message_id, telegram_message_id)])
+
+  @abstractmethod
+  async def set_telegram_message_ids(
+      self, updates: list[tuple[MessageId, TelegramMessageId]]) -> None:
+    """Like `set_telegram_message_id` for several messages, atomically.
+
+    If any update fails, none is applied.
+    """
+    pass
+
+  @abstractmethod
+  async def read_message(self, message_id: MessageId) -> Message:
+    """Returns a message from the bus or raises ValueError.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def find_message_by_telegram_id(
+      self, telegram_chat_id: TelegramChatId,
+      telegram_message_id: TelegramMessageId) -> Message:
+    """Returns a message from the bus or raises ValueError.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def fail_message(self, message_id: MessageId, error: str,
+                         policy: RetryPolicy) -> bool:
+    """Records a failed attempt at processing an incoming message.
+
+    Releases any claim on the message. If the message has failed fewer than
+    `policy.max_attempts` times, schedules a retry: it becomes incoming again
+    (without `processed_at` and `conversation_id`) after `policy.delay`.
+    Otherwise, it becomes a dead letter (with `error`), marked as processed,
+    until `requeue_dead_letters` is called.
+
+    Returns True if the message will be retried. Raises ValueError if the
+    message doesn't exist.
+    """
+    pass
+
+  @abstractmethod
+  async def list_dead_letters(self) -> list[DeadLetter]:
+    """Returns all dead letters (see `fail_message`), sorted by message id."""
+    pass
+
+  @abstractmethod
+  async def requeue_dead_letters(self,
+                                 message_ids: list[MessageId] | None = None
+                                ) -> list[MessageId]:
+    """Makes dead letters incoming again (as new, with no failed attempts).
+
+    Requeues the messages in `message_ids` (or all dead letters, if None).
+    Raises ValueError (requeueing none) if any of them isn't a dead letter.
+    Returns the messages requeued.
+    """
+    pass
+
+  @abstractmethod
+  async def start_session(self, message_id: MessageId) -> BusSession:
+    """Starts a new session to process an incoming message.
+
+    Assigns a new conversation id (unique across the bus, greater than 0) and
+    records it (with the message's `target_agent` and `telegram_chat_id`) so
+    that `read_session` can find the session after the process that started it
+    is gone. Sets the message's `conversation_id` (atomically).
+
+    Raises ValueError if the message doesn't exist or already has a
+    `conversation_id`.
+    """
+    pass
+
+  @abstractmethod
+  async def read_session(self, conversation_id: ConversationId) -> BusSession:
+    """Returns a session (see `start_session`) or raises ValueError."""
+    pass
+
+  @abstractmethod
+  async def read_conversation(self,
+                              conversation_id: ConversationId) -> list[Message]:
+    """Returns the messages with `conversation_id`, sorted by message id.
+
+    Also looks in the archive (see `archive_messages`).
+    """
+    pass
+
+  @abstractmethod
+  async def archive_messages(self,
+                             older_than: datetime.timedelta,
+                             batch_size: int = 1000) -> int:
+    """Archives old messages that are done; returns how many.
+
+    A message is done if it was processed or, for messages to `END_USER_AGENT`,
+    sent to Telegram. It is old if it was processed (or, for messages without
+    `processed_at`, queued) more than `older_than` ago. Dead letters are never
+    archived. Archived messages are no longer pending anywhere, but
+    `read_message` and `find_message_by_telegram_id` still find them.
+
+    Also deletes topic messages published more than `older_than` ago that were
+    delivered to all their subscribers, and the records of Telegram updates
+    (see `write_telegram_updates`) received more than `older_than` ago.
+    """
+    pass
+
+  @abstractmethod
+  async def compact(self, pages: int = 1000) -> None:
+    """Releases space no longer used (e.g., after `archive_messages`)."""
+    pass
+
+  @abstractmethod
+  async def stats(self) -> BusStats:
+    """Returns statistics about the size of the bus."""
+    pass
+
+
+class SqliteMessageBus(MessageBus):
+  """A `MessageBus` in SQLite, shared by the swarm and the Telegram adapter.
+
+  All writes run in `_executor`, through a single connection. Reads run in
+  `_read_executor`, with a pool of read-only connections (so they don't wait
+  behind writes).
+
+  Consistency: a write is visible to all reads (in any process) that start
+  after the coroutine that issued the write returns; in particular, a task
+  always sees its own writes. Reads that start while a write is in progress
+  (e.g., waiting in the `write_behind` window) may not see it.
+  """
+
+  def __init__(self,
+               path: pathlib.Path,
+               write_behind: datetime.timedelta | None = None,
+               readers: int = 2) -> None:
+    """If `readers` is 0, reads run in `_executor` (with the writer)."""
     self._path = path
+    # If set, writes are delayed by up to this long, to group them into fewer
+    # transactions (see `_write`).
+    self._write_behind = write_behind
+    self._pending_writes: list[tuple[Callable[[], Any],
+                                     asyncio.Future[Any]]] = []
+    # Set while `_pending_writes` waits for the `write_behind` window to end.
+    self._flush_timer: asyncio.TimerHandle | None = None
+    # `_flush_writes` tasks running (see `_start_flush`).
+    self._flushers: set[asyncio.Task[None]] = set()
     self._executor = ThreadPoolExecutor(max_workers=1)
     # _connection is only accessed by threads running in _executor.
     self._connection: sqlite3.Connection | None = None
+    # Wakes up `_poll` when the bus changes (even in other processes).
+    self._notifier = MessageBusNotifier(path.with_name(path.name + ".notify"))
+    self._read_executor = ThreadPoolExecutor(
+        max_workers=readers) if readers else None
+    # Each thread in _read_executor has its own connection (in
+    # `_thread_local.connection`); they're all in `_read_connections`.
+    self._thread_local = threading.local()
+    self._read_connections: list[sqlite3.Connection] = []
+    self._read_connections_lock = threading.Lock()
+    # Updated (in `_executor`) by `_claim_messages_in_thread`.
+    self._claim_latency = ClaimLatency()
 
   async def _run_in_thread(self, func: Callable[P, T], *args: P.args,
                            **kwargs: P.kwargs) -> T:
@@ -62,360 +928,616 @@ class MessageBus:
     return await loop.run_in_executor(self._executor,
                                       lambda: func(*args, **kwargs))
 
-  async def _poll_in_thread(self,
-                            func: Callable[[], list[Message]]) -> list[Message]:
-    """Runs `func` once per second until it returns values."""
-    # ✨ poll in thread
-    _poll_interval_secs = 1.0
+  async def _run_read(self, func: Callable[[sqlite3.Connection], T]) -> T:
+    """Runs `func` in `_read_executor`, with a read-only connection."""
+    # ✨ run read
+    if self._read_executor is None:
+
+      def _run_with_writer() -> T:
+        if self._connection is None:
+          raise ValueError("Database connection is not open.")
+        return func(self._connection)
+
+      return await self._run_in_thread(_run_with_writer)
+
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+
+    def _run_with_reader() -> T:
+      connection: sqlite3.Connection | None = getattr(self._thread_local,
+                                                      "connection", None)
+      if connection is None:
+        connection = _connect(self._path, read_only=True)
+        self._thread_local.connection = connection
+        with self._read_connections_lock:
+          self._read_connections.append(connection)
+      return func(connection)
+
+    return await asyncio.get_running_loop().run_in_executor(
+        self._read_executor, _run_with_reader)
+    # ✨
+
+  async def _poll(
+      self, load: Callable[[], Awaitable[list[Message]]]) -> list[Message]:
+    """Runs `load` until it returns values.
+
+    Runs `load` again whenever `_notifier` signals a change and, as a fallback
+    (in case a notification is lost), every few seconds.
+    """
+    # ✨ poll
+    _poll_interval_secs = 10.0
 
     while True:
-      messages = await self._run_in_thread(func)
+      # Must be obtained before `load` runs, so that changes committed while it
+      # runs aren't missed.
+      changed = self._notifier.changed_event()
+      messages = await load()
       if messages:
         logging.info(f'New messages: {len(messages)}')
         return messages
-      else:
-        await asyncio.sleep(_poll_interval_secs)
+      # Not `asyncio.wait_for`: in Python 3.11 it can swallow a cancellation
+      # that arrives as `changed` is set.
+      waiter = asyncio.create_task(changed.wait())
+      try:
+        await asyncio.wait([waiter], timeout=_poll_interval_secs)
+      finally:
+        waiter.cancel()
     # ✨
 
   async def open(self) -> None:
     """Connects to the bus, potentially initializing it.
 
-    If the database is empty (or does not exist), creates the expected tables
-    (see message_bus.sql for details).
-
-    Passes timeout=20.0 and isolation_level=None when connecting.
+    Applies any pending `_MIGRATIONS` (creating the tables if the database is
+    empty or does not exist; see message_bus.sql for details). New databases
+    are created with `auto_vacuum = INCREMENTAL` (see `compact`).
     """
 
     def _open() -> None:
       # ✨ init db
-      self._connection = sqlite3.connect(
-          str(self._path), timeout=20.0, isolation_level=None)
+      self._connection = _connect(self._path, read_only=False)
       self._connection.execute("PRAGMA journal_mode=WAL;")
-      self._connection.row_factory = sqlite3.Row
-      # Create tables if they don't exist
-      sql_schema = """
-        CREATE TABLE IF NOT EXISTS message_bus (
-            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+      # Only has effect in new databases (before any table is created).
+      self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      _apply_migrations(self._connection)
+      # ✨
 
-            source_agent TEXT NOT NULL,
-            target_agent TEXT NOT NULL,
+    await self._run_in_thread(_open)
+    self._notifier.open()
+
+  async def close(self) -> None:
+    """Runs the pending writes (see `write_behind`) and disconnects."""
+    if self._flush_timer is not None:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+      await self._flush_writes()
+    await asyncio.gather(*self._flushers, return_exceptions=True)
+    self._notifier.close()
+
+    def _close() -> None:
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
+
+    await self._run_in_thread(_close)
+    if self._read_executor is not None:
+      self._read_executor.shutdown()
+      for connection in self._read_connections:
+        connection.close()
+
+  async def wait_for_incoming_messages(self,
+                                       agents: list[AgentName],
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+
+    def _load_messages(connection: sqlite3.Connection) -> list[Message]:
+      """May return empty list."""
+      # ✨ load incoming messages
+      if not agents:
+        return []
+      agent_placeholders = ', '.join(['?' for _ in agents])
+      cursor = connection.execute(
+          f"""
+          SELECT {_MESSAGE_COLUMNS}
+          FROM message_bus
+          WHERE processed_at IS NULL
+              AND target_agent IN ({agent_placeholders})
+              AND message_id > ?
+              AND (retry_at IS NULL OR retry_at <= ?)
+          ORDER BY message_id
+          LIMIT ?
+          """, (*agents, after, time.time(), limit))
+      return [_message_from_row(row) for row in cursor.fetchall()]
+      # ✨
 
-            local_directory TEXT,
+    return await self._poll(lambda: self._run_read(_load_messages))
 
-            conversation_id INTEGER,
+  async def wait_for_outgoing_messages(self,
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
 
-            telegram_chat_id INTEGER NOT NULL,
+    def _load_messages(connection: sqlite3.Connection) -> list[Message]:
+      # ✨ load outgoing messages
+      cursor = connection.execute(
+          f"""
+          SELECT {_MESSAGE_COLUMNS}
+          FROM message_bus
+          WHERE telegram_message_id IS NULL
+              AND target_agent = ?
+              AND message_id > ?
+          ORDER BY message_id
+          LIMIT ?
+          """, (END_USER_AGENT, after, limit))
+      return [_message_from_row(row) for row in cursor.fetchall()]
+      # ✨
 
-            telegram_message_id INTEGER,
-            telegram_reply_to_id INTEGER,
+    return await self._poll(lambda: self._run_read(_load_messages))
 
-            content TEXT NOT NULL,
+  async def read_cursor(self, name: str) -> MessageId:
 
-            queued_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            processed_at DATETIME
-        );
-        """
-      self._connection.executescript(sql_schema)
-      self._connection.commit()
-      # ✨
+    # ✨ read cursor
+    def _read_cursor_db_op(connection: sqlite3.Connection) -> MessageId:
+      row = connection.execute(
+          "SELECT message_id FROM message_bus_cursors WHERE name = ?",
+          (name,)).fetchone()
+      return MessageId(row['message_id'] if row else 0)
 
-    await self._run_in_thread(_open)
+    return await self._run_read(_read_cursor_db_op)
+    # ✨
 
-  async def wait_for_incoming_messages(
-      self, agents: list[AgentName]) -> list[Message]:
-    """Polls until new incoming messages arrive for the agents listed.
+  async def save_cursor(self, name: str, message_id: MessageId) -> None:
+
+    # ✨ save cursor
+    def _save_cursor_db_op() -> None:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      self._connection.execute(
+          """
+          INSERT INTO message_bus_cursors (name, message_id) VALUES (?, ?)
+          ON CONFLICT (name) DO UPDATE
+          SET message_id = max(message_id, excluded.message_id)
+          """, (name, message_id))
+
+    await self._run_in_thread(_save_cursor_db_op)
+    # ✨
 
-    A new incoming message is one with `processed_at` set to NULL.
+  async def claim_incoming_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    return await self._run_in_thread(self._claim_messages_in_thread, agents,
+                                     worker_id, lease, limit, aging)
+
+  async def wait_for_claimed_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    return await self._poll(lambda: self._run_in_thread(
+        self._claim_messages_in_thread, agents, worker_id, lease, limit, aging))
+
+  def _claim_messages_in_thread(self, agents: list[AgentName],
+                                worker_id: WorkerId, lease: datetime.timedelta,
+                                limit: int,
+                                aging: datetime.timedelta) -> list[Message]:
+    """Runs in `_executor`; returns the messages in the order claimed.
+
+    Delivers topic messages through `_deliver_topic_messages_in_thread` and then
+    claims with a single `UPDATE … RETURNING` statement.
     """
+    # ✨ claim messages
+    if not agents:
+      return []
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+    self._deliver_topic_messages_in_thread(agents, limit)
+    now = time.time()
+    agent_placeholders = ', '.join(['?' for _ in agents])
+    # Messages without `enqueued_at` (older than priorities) are fully aged.
+    cursor = self._connection.execute(
+        f"""
+        UPDATE message_bus
+        SET claimed_by = ?, lease_expires_at = ?
+        WHERE message_id IN (
+            SELECT message_id
+            FROM message_bus
+            WHERE processed_at IS NULL
+                AND target_agent IN ({agent_placeholders})
+                AND (claimed_by IS NULL OR lease_expires_at < ?)
+                AND (retry_at IS NULL OR retry_at <= ?)
+            ORDER BY
+                MAX(0, priority - CAST(
+                    (? - COALESCE(enqueued_at, 0)) / ? AS INTEGER)),
+                message_id
+            LIMIT ?)
+        RETURNING {_MESSAGE_COLUMNS}, enqueued_at, retry_at
+        """, (worker_id, now + lease.total_seconds(), *agents, now, now, now,
+              aging.total_seconds(), limit))
+    claimed: list[tuple[int, Message]] = []
+    for row in cursor.fetchall():
+      message = _message_from_row(row)
+      waited_secs = now - (row['enqueued_at'] or 0)
+      # Retried messages already had their first claim.
+      if row['enqueued_at'] is not None and row['retry_at'] is None:
+        self._claim_latency.record(message.priority, waited_secs)
+      claimed.append((message.priority.aged(waited_secs, aging), message))
+    if claimed:
+      logging.info(f"Worker {worker_id} claimed {len(claimed)} messages.")
+    return [
+        message for _, message in sorted(
+            claimed, key=lambda c: (c[0], c[1].message_id))
+    ]
+    # ✨
 
-    def _load_messages() -> list[Message]:
-      """May return empty list."""
-      # ✨ load incoming messages
-      if not agents:
-        return []
+  async def extend_leases(self, worker_id: WorkerId,
+                          lease: datetime.timedelta) -> int:
 
-      agent_placeholders = ', '.join(['?' for _ in agents])
-      query = f"""
-          SELECT
-              message_id,
-              source_agent,
-              target_agent,
-              local_directory,
-              conversation_id,
-              telegram_chat_id,
-              telegram_message_id,
-              telegram_reply_to_id,
-              content,
-              queued_at,
-              processed_at
-          FROM message_bus
-          WHERE processed_at IS NULL AND target_agent IN ({agent_placeholders})
-      """
+    # ✨ extend leases
+    def _extend_leases_db_op() -> int:
       if self._connection is None:
         raise ValueError("Database connection is not open.")
+      cursor = self._connection.execute(
+          """
+          UPDATE message_bus SET lease_expires_at = ?
+          WHERE claimed_by = ? AND processed_at IS NULL
+          """, (time.time() + lease.total_seconds(), worker_id))
+      return cursor.rowcount
 
-      cursor = self._connection.execute(query, tuple(agents))
-      new_messages_rows = cursor.fetchall()
-
-      messages = []
-      for row in new_messages_rows:
-        messages.append(
-            Message(
-                message_id=MessageId(row['message_id']),
-                source_agent=AgentName(row['source_agent']),
-                target_agent=AgentName(row['target_agent']),
-                local_directory=pathlib.Path(row['local_directory'])
-                if row['local_directory'] else None,
-                conversation_id=ConversationId(row['conversation_id'])
-                if row['conversation_id'] else None,
-                telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
-                telegram_message_id=TelegramMessageId(
-                    row['telegram_message_id'])
-                if row['telegram_message_id'] else None,
-                telegram_reply_to_id=TelegramMessageId(
-                    row['telegram_reply_to_id'])
-                if row['telegram_reply_to_id'] else None,
-                content=MessageContent(row['content']),
-                queued_at=datetime.datetime.fromisoformat(row['queued_at']),
-                processed_at=datetime.datetime.fromisoformat(
-                    row['processed_at']) if row['processed_at'] else None,
-            ))
-      return messages
-      # ✨
+    return await self._run_in_thread(_extend_leases_db_op)
+    # ✨
 
-    return await self._poll_in_thread(_load_messages)
+  async def release_claims(self, worker_id: WorkerId) -> None:
 
-  async def wait_for_outgoing_messages(self) -> list[Message]:
-    """Polls until new outgoing messages arrive.
+    # ✨ release claims
+    def _release_claims_db_op() -> None:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      self._connection.execute(
+          """
+          UPDATE message_bus SET claimed_by = NULL, lease_expires_at = NULL
+          WHERE claimed_by = ? AND processed_at IS NULL
+          """, (worker_id,))
 
-    A new outgoing message is one with `telegram_message_id` set to `NULL` and
-    `agent` set to the value in `END_USER_AGENT`.
-    """
+    await self._run_in_thread(_release_claims_db_op)
+    self._notifier.notify()
+    # ✨
 
-    def _load_messages() -> list[Message]:
-      # ✨ load outgoing messages
+  async def set_subscriptions(self, agent: AgentName,
+                              topics: frozenset[Topic]) -> None:
+
+    # ✨ set subscriptions
+    def _set_subscriptions_db_op() -> None:
       if self._connection is None:
         raise ValueError("Database connection is not open.")
+      topic_placeholders = ', '.join(['?' for _ in topics])
+      self._connection.execute(
+          f"""
+          DELETE FROM message_bus_subscriptions
+          WHERE agent = ? AND topic NOT IN ({topic_placeholders})
+          """, (agent, *topics))
+      for topic in topics:
+        self._connection.execute(
+            """
+            INSERT INTO message_bus_subscriptions (agent, topic, topic_message_id)
+            SELECT ?, ?, COALESCE(MAX(topic_message_id), 0)
+            FROM message_bus_topic_messages WHERE topic = ?
+            ON CONFLICT (agent, topic) DO NOTHING
+            """, (agent, topic, topic))
+
+    await self._write(_set_subscriptions_db_op)
+    # ✨
 
-      query = """
-          SELECT
-              message_id,
+  async def publish(self, message: TopicMessage) -> TopicMessage:
+
+    # ✨ publish
+    def _publish_db_op() -> TopicMessage:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      cursor = self._connection.execute(
+          """
+          INSERT INTO message_bus_topic_messages (
+              topic,
               source_agent,
-              target_agent,
               local_directory,
-              conversation_id,
               telegram_chat_id,
-              telegram_message_id,
               telegram_reply_to_id,
               content,
-              queued_at,
-              processed_at
-          FROM message_bus
-          WHERE telegram_message_id IS NULL AND target_agent = ?
-      """
-      cursor = self._connection.execute(query, (END_USER_AGENT,))
-      new_messages_rows = cursor.fetchall()
-
-      messages = []
-      for row in new_messages_rows:
-        messages.append(
-            Message(
-                message_id=MessageId(row['message_id']),
-                source_agent=AgentName(row['source_agent']),
-                target_agent=AgentName(row['target_agent']),
-                local_directory=pathlib.Path(row['local_directory'])
-                if row['local_directory'] else None,
-                conversation_id=ConversationId(row['conversation_id'])
-                if row['conversation_id'] else None,
-                telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
-                telegram_message_id=TelegramMessageId(
-                    row['telegram_message_id'])
-                if row['telegram_message_id'] else None,
-                telegram_reply_to_id=TelegramMessageId(
-                    row['telegram_reply_to_id'])
-                if row['telegram_reply_to_id'] else None,
-                content=MessageContent(row['content']),
-                queued_at=datetime.datetime.fromisoformat(row['queued_at']),
-                processed_at=datetime.datetime.fromisoformat(
-                    row['processed_at']) if row['processed_at'] else None,
-            ))
-      return messages
-      # ✨
-
-    return await self._poll_in_thread(_load_messages)
-
-  async def set_conversation_id(self, message_id: MessageId,
-                                conversation_id: ConversationId) -> None:
-    # ✨ set message conversation
-    def _set_conversation_id_db_op(msg_id: MessageId,
-                                   conv_id: ConversationId) -> None:
-      """Synchronous database operation to set the conversation_id."""
-      if self._connection is None:
-        raise ValueError("Database connection is not open.")
-
-      cursor = self._connection.execute(
-          "UPDATE message_bus SET conversation_id = ? WHERE message_id = ? AND conversation_id IS NULL",
-          (conv_id, msg_id),
-      )
-      self._connection.commit()
-      if cursor.rowcount == 0:
-        # This means either the message_id was not found, or conversation_id was already set.
-        # In either case, we consider this an error as per the requirement.
-        raise ValueError(
-            f"Message with ID {msg_id} not found or conversation_id already set."
-        )
-      elif cursor.rowcount > 1:
-        # This should ideally not happen with a PRIMARY KEY condition.
+              published_at,
+              enqueued_at
+          )
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+          """, (
+              message.topic,
+              message.source_agent,
+              str(message.local_directory) if message.local_directory else None,
+              message.telegram_chat_id,
+              message.telegram_reply_to_id,
+              message.content,
+              message.published_at,
+              time.time(),
+          ))
+      if cursor.lastrowid is None:
         raise RuntimeError(
-            f"Multiple messages with ID {msg_id} updated, which should not happen."
-        )
+            "Failed to retrieve the ID of the newly published message.")
+      logging.info(f"Published message {cursor.lastrowid} to {message.topic}.")
+      return dataclasses.replace(
+          message, topic_message_id=TopicMessageId(cursor.lastrowid))
 
-    await self._run_in_thread(_set_conversation_id_db_op, message_id,
-                              conversation_id)
+    return await self._write(_publish_db_op)
     # ✨
 
-  async def write_new_message(self, message: Message) -> Message:
-    """Adds a new message to the database.
+  def _deliver_topic_messages_in_thread(self, agents: list[AgentName],
+                                        limit: int) -> int:
+    """Runs in `_executor`; see `claim_incoming_messages`.
 
-    The MessageId will be overwritten (based on database state) and the
-    resulting message returned.
+    Delivers up to `limit` topic messages in a single transaction. Checks for
+    pending topic messages first (outside of the transaction), so that it
+    doesn't lock the bus when there are none. Returns the number of messages
+    delivered.
     """
-
-    # ✨ write new message
-    def _insert_message_and_commit(msg: Message) -> Message:
-      """Synchronous database operation to insert a new message."""
-      if self._connection is None:
-        raise ValueError("Database connection is not open.")
-
-      logging.info(
-          'Writing message: source_agent=%s, target_agent=%s, local_directory=%s, conversation_id=%s, telegram_chat_id=%s, telegram_message_id=%s, telegram_reply_to_id=%s, content="%s", queued_at=%s',
-          msg.source_agent,
-          msg.target_agent,
-          msg.local_directory,
-          msg.conversation_id,
-          msg.telegram_chat_id,
-          msg.telegram_message_id,
-          msg.telegram_reply_to_id,
-          msg.content,
-          msg.queued_at,
-      )
-      cursor = self._connection.execute(
-          """
+    # ✨ deliver topic messages
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+    connection = self._connection
+    agent_placeholders = ', '.join(['?' for _ in agents])
+    query = f"""
+        SELECT
+            s.agent,
+            t.topic_message_id,
+            t.topic,
+            t.source_agent,
+            t.local_directory,
+            t.telegram_chat_id,
+            t.telegram_reply_to_id,
+            t.content,
+            t.published_at,
+            t.enqueued_at
+        FROM message_bus_subscriptions s
+        JOIN message_bus_topic_messages t
+            ON t.topic = s.topic AND t.topic_message_id > s.topic_message_id
+        WHERE s.agent IN ({agent_placeholders})
+        ORDER BY t.topic_message_id
+        LIMIT ?
+        """
+    if connection.execute(query, (*agents, limit)).fetchone() is None:
+      return 0
+
+    def _deliver() -> int:
+      rows = connection.execute(query, (*agents, limit)).fetchall()
+      for row in rows:
+        content, content_digest = _offload_content(connection, row['content'])
+        connection.execute(
+            """
             INSERT INTO message_bus (
                 source_agent,
                 target_agent,
                 local_directory,
-                conversation_id,
                 telegram_chat_id,
-                telegram_message_id,
                 telegram_reply_to_id,
                 content,
+                content_digest,
                 queued_at,
-                processed_at
+                priority,
+                enqueued_at
             )
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-          (
-              msg.source_agent,
-              msg.target_agent,
-              str(msg.local_directory) if msg.local_directory else None,
-              msg.conversation_id if msg.conversation_id else None,
-              msg.telegram_chat_id,
-              msg.telegram_message_id if msg.telegram_message_id else None,
-              msg.telegram_reply_to_id if msg.telegram_reply_to_id else None,
-              msg.content,
-              msg.queued_at,
-              None,  # processed_at is NULL for new messages
-          ),
-      )
-      self._connection.commit()
-      new_id = cursor.lastrowid
-      if new_id is None:
-        raise RuntimeError(
-            "Failed to retrieve the ID of the newly inserted message.")
-      logging.info('Wrote message with ID: %s', new_id)
-      return dataclasses.replace(msg, message_id=MessageId(new_id))
-
-    return await self._run_in_thread(
-        _insert_message_and_commit,
-        message,
-    )
+            """, (row['source_agent'], row['agent'], row['local_directory'],
+                  row['telegram_chat_id'], row['telegram_reply_to_id'], content,
+                  content_digest, row['published_at'],
+                  MessagePriority.LOW.value, row['enqueued_at']))
+        connection.execute(
+            """
+            UPDATE message_bus_subscriptions
+            SET topic_message_id = MAX(topic_message_id, ?)
+            WHERE agent = ? AND topic = ?
+            """, (row['topic_message_id'], row['agent'], row['topic']))
+      return len(rows)
+
+    [(delivered, exception)] = self._run_writes_in_thread([_deliver])
+    if exception is not None:
+      raise exception
+    if delivered:
+      logging.info(f"Delivered {delivered} topic messages.")
+    return cast(int, delivered)
     # ✨
 
-  async def mark_as_processed(self, message_id: MessageId) -> None:
-    """Sets processed_at to the current time."""
+  async def set_conversation_ids(
+      self, updates: list[tuple[MessageId, ConversationId]]) -> None:
 
-    # ✨ set processed at
-    def _mark_as_processed_db_op(msg_id: MessageId) -> None:
-      """Synchronous database operation to set the processed_at timestamp."""
+    def _write_all() -> None:
+      for u in updates:
+        self._set_conversation_id_in_thread(*u)
+
+    if updates:
+      await self._write(_write_all)
+
+  async def write_new_messages(self, messages: list[Message]) -> list[Message]:
+    if not messages:
+      return []
+    return await self._write(
+        lambda: [self._insert_message_in_thread(m) for m in messages])
+
+  async def write_telegram_updates(
+      self, updates: list[tuple[TelegramUpdateId, Message]]) -> list[Message]:
+
+    def _write_all() -> list[Message]:
       if self._connection is None:
         raise ValueError("Database connection is not open.")
+      written: list[Message] = []
+      for update_id, message in updates:
+        if self._connection.execute(
+            "INSERT OR IGNORE INTO message_bus_telegram_updates (update_id) "
+            "VALUES (?)", (update_id,)).rowcount:
+          written.append(self._insert_message_in_thread(message))
+      return written
 
-      cursor = self._connection.execute(
-          "UPDATE message_bus SET processed_at = CURRENT_TIMESTAMP WHERE message_id = ? AND processed_at IS NULL",
-          (msg_id,),
-      )
-      self._connection.commit()
-      if cursor.rowcount == 0:
-        raise ValueError(
-            f"Message with ID {msg_id} not found or already processed.")
-      elif cursor.rowcount > 1:
-        raise RuntimeError(
-            f"Multiple messages with ID {msg_id} updated, which should not happen."
-        )
+    if not updates:
+      return []
+    return await self._write(_write_all)
 
-    await self._run_in_thread(_mark_as_processed_db_op, message_id)
-    # ✨
+  async def mark_processed_many(self, message_ids: list[MessageId]) -> None:
 
-  async def set_telegram_message_id(
-      self, message_id: MessageId,
-      telegram_message_id: TelegramMessageId) -> None:
-    """Updates the telegram_message_id of a given row.
+    def _write_all() -> None:
+      for i in message_ids:
+        self._mark_as_processed_in_thread(i)
+
+    if message_ids:
+      await self._write(_write_all)
+
+  async def set_telegram_message_ids(
+      self, updates: list[tuple[MessageId, TelegramMessageId]]) -> None:
+
+    def _write_all() -> None:
+      for u in updates:
+        self._set_telegram_message_id_in_thread(*u)
+
+    if updates:
+      await self._write(_write_all)
+
+  async def _write(self, func: Callable[[], T]) -> T:
+    """Runs `func` (in `_executor`) in a write transaction; returns its result.
 
-    It is an error to try to update a message_id where the telegram_message_id
-    already has a value (we use a conditional update and validate that exactly
-    1 row was updated).
+    Without `write_behind`, runs `func` in its own transaction. Otherwise,
+    queues it in `_pending_writes`, to be run by `_flush_writes` (together with
+    all other writes queued during the `write_behind` window), through
+    `_flush_timer` and `_start_flush`.
+
+    Notifies waiters (through `_notifier`) after the transaction commits.
     """
+    # ✨ write
+    if self._write_behind is not None:
+      future: asyncio.Future[T] = asyncio.get_running_loop().create_future()
+      self._pending_writes.append((func, future))
+      if len(self._pending_writes) == 1:
+        self._flush_timer = asyncio.get_running_loop().call_later(
+            self._write_behind.total_seconds(), self._start_flush)
+      return await future
+
+    results = await self._run_in_thread(self._run_writes_in_thread, [func])
+    self._notifier.notify()
+    result, exception = results[0]
+    if exception is not None:
+      raise exception
+    return cast(T, result)
+    # ✨
 
-    # ✨ set telegram message id
-    def _set_telegram_message_id_db_op(msg_id: MessageId,
-                                       tg_msg_id: TelegramMessageId) -> None:
-      """Synchronous database operation to set the telegram_message_id."""
-      if self._connection is None:
-        raise ValueError("Database connection is not open.")
+  def _start_flush(self) -> None:
+    """Starts `_flush_writes` (at the end of the `write_behind` window)."""
+    self._flush_timer = None
+    task = asyncio.create_task(self._flush_writes())
+    self._flushers.add(task)
+    task.add_done_callback(self._flush_done)
 
-      cursor = self._connection.execute(
-          "UPDATE message_bus SET telegram_message_id = ? WHERE message_id = ? AND telegram_message_id IS NULL",
-          (tg_msg_id, msg_id),
-      )
-      self._connection.commit()
-      if cursor.rowcount == 0:
-        # This means either the message_id was not found, or telegram_message_id was already set.
-        raise ValueError(
-            f"Message with ID {msg_id} not found or telegram_message_id already set."
-        )
-      elif cursor.rowcount > 1:
-        # This should ideally not happen with a PRIMARY KEY condition.
-        raise RuntimeError(
-            f"Multiple messages with ID {msg_id} updated, which should not happen."
-        )
+  def _flush_done(self, task: asyncio.Task[None]) -> None:
+    self._flushers.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      logging.error(
+          "Message bus: flushing writes failed.", exc_info=task.exception())
+
+  async def _flush_writes(self) -> None:
+    """Runs all `_pending_writes` in a single transaction.
 
-    await self._run_in_thread(_set_telegram_message_id_db_op, message_id,
-                              telegram_message_id)
+    Each write runs in its own savepoint: a write that fails (its exception is
+    given to its caller) doesn't affect the others.
+    """
+    # ✨ flush writes
+    writes, self._pending_writes = self._pending_writes, []
+    try:
+      results = await self._run_in_thread(self._run_writes_in_thread,
+                                          [func for func, _ in writes])
+    except Exception as e:
+      for _, future in writes:
+        if not future.done():
+          future.set_exception(e)
+      return
+    self._notifier.notify()
+    for (_, future), (result, exception) in zip(writes, results):
+      if future.done():  # Cancelled.
+        continue
+      if exception is not None:
+        future.set_exception(exception)
+      else:
+        future.set_result(result)
     # ✨
 
-  async def read_message(self, message_id: MessageId) -> Message:
-    """Returns a message from the database or raises ValueError."""
+  def _run_writes_in_thread(
+      self, funcs: list[Callable[[],
+                                 Any]]) -> list[tuple[Any, Exception | None]]:
+    """Runs `funcs` (in `_executor`) in a single transaction.
 
-    # ✨ read message
-    def _read_message_db_op(msg_id: MessageId) -> Message:
-      """Synchronous database operation to read a message by its ID."""
-      if self._connection is None:
-        raise ValueError("Database connection is not open.")
+    Returns the result (or exception) of each function, in order.
+    """
+    # ✨ run writes in thread
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+    results: list[tuple[Any, Exception | None]] = []
+    self._connection.execute("BEGIN IMMEDIATE")
+    try:
+      for func in funcs:
+        self._connection.execute("SAVEPOINT write")
+        try:
+          results.append((func(), None))
+        except Exception as e:
+          self._connection.execute("ROLLBACK TO write")
+          results.append((None, e))
+        self._connection.execute("RELEASE write")
+      self._connection.execute("COMMIT")
+    except Exception:
+      self._connection.execute("ROLLBACK")
+      raise
+    return results
+    # ✨
 
-      query = """
-          SELECT
-              message_id,
+  def _set_conversation_id_in_thread(self, message_id: MessageId,
+                                     conversation_id: ConversationId) -> None:
+    # ✨ set message conversation
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+
+    cursor = self._connection.execute(
+        "UPDATE message_bus SET conversation_id = ? WHERE message_id = ? AND conversation_id IS NULL",
+        (conversation_id, message_id),
+    )
+    if cursor.rowcount == 0:
+      # This means either the message_id was not found, or conversation_id was already set.
+      # In either case, we consider this an error as per the requirement.
+      raise ValueError(
+          f"Message with ID {message_id} not found or conversation_id already set."
+      )
+    elif cursor.rowcount > 1:
+      # This should ideally not happen with a PRIMARY KEY condition.
+      raise RuntimeError(
+          f"Multiple messages with ID {message_id} updated, which should not happen."
+      )
+    # ✨
+
+  def _insert_message_in_thread(self, message: Message) -> Message:
+    # ✨ write new message
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
+
+    msg = message
+    logging.info(
+        'Writing message: source_agent=%s, target_agent=%s, local_directory=%s, conversation_id=%s, telegram_chat_id=%s, telegram_message_id=%s, telegram_reply_to_id=%s, content="%s", queued_at=%s, priority=%s',
+        msg.source_agent,
+        msg.target_agent,
+        msg.local_directory,
+        msg.conversation_id,
+        msg.telegram_chat_id,
+        msg.telegram_message_id,
+        msg.telegram_reply_to_id,
+        msg.content,
+        msg.queued_at,
+        msg.priority.name,
+    )
+    content, content_digest = _offload_content(self._connection, msg.content)
+    cursor = self._connection.execute(
+        """
+          INSERT INTO message_bus (
               source_agent,
               target_agent,
               local_directory,
@@ -424,109 +1546,452 @@ class MessageBus:
               telegram_message_id,
               telegram_reply_to_id,
               content,
+              content_digest,
               queued_at,
-              processed_at
-          FROM message_bus
-          WHERE message_id = ?
-      """
-      logging.info('Reading message with ID: %s', msg_id)
+              processed_at,
+              priority,
+              enqueued_at
+          )
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+          """,
+        (
+            msg.source_agent,
+            msg.target_agent,
+            str(msg.local_directory) if msg.local_directory else None,
+            msg.conversation_id if msg.conversation_id else None,
+            msg.telegram_chat_id,
+            msg.telegram_message_id if msg.telegram_message_id else None,
+            msg.telegram_reply_to_id if msg.telegram_reply_to_id else None,
+            content,
+            content_digest,
+            msg.queued_at,
+            None,  # processed_at is NULL for new messages
+            msg.priority.value,
+            time.time(),
+        ),
+    )
+    new_id = cursor.lastrowid
+    if new_id is None:
+      raise RuntimeError(
+          "Failed to retrieve the ID of the newly inserted message.")
+    logging.info('Wrote message with ID: %s', new_id)
+    return dataclasses.replace(msg, message_id=MessageId(new_id))
+    # ✨
 
-      cursor = self._connection.execute(query, (msg_id,))
-      row = cursor.fetchone()
+  def _mark_as_processed_in_thread(self, message_id: MessageId) -> None:
+    # ✨ set processed at
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
 
-      if row is None:
-        raise ValueError(f"Message with ID {msg_id} not found.")
-
-      message = Message(
-          message_id=MessageId(row['message_id']),
-          source_agent=AgentName(row['source_agent']),
-          target_agent=AgentName(row['target_agent']),
-          local_directory=pathlib.Path(row['local_directory'])
-          if row['local_directory'] else None,
-          conversation_id=ConversationId(row['conversation_id'])
-          if row['conversation_id'] else None,
-          telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
-          telegram_message_id=TelegramMessageId(row['telegram_message_id'])
-          if row['telegram_message_id'] else None,
-          telegram_reply_to_id=TelegramMessageId(row['telegram_reply_to_id'])
-          if row['telegram_reply_to_id'] else None,
-          content=MessageContent(row['content']),
-          queued_at=datetime.datetime.fromisoformat(row['queued_at']),
-          processed_at=datetime.datetime.fromisoformat(row['processed_at'])
-          if row['processed_at'] else None,
+    cursor = self._connection.execute(
+        "UPDATE message_bus SET processed_at = CURRENT_TIMESTAMP WHERE message_id = ? AND processed_at IS NULL",
+        (message_id,),
+    )
+    if cursor.rowcount == 0:
+      raise ValueError(
+          f"Message with ID {message_id} not found or already processed.")
+    elif cursor.rowcount > 1:
+      raise RuntimeError(
+          f"Multiple messages with ID {message_id} updated, which should not happen."
       )
-      logging.info('Read message with ID: %s', msg_id)
-      return message
+    # ✨
+
+  def _set_telegram_message_id_in_thread(
+      self, message_id: MessageId,
+      telegram_message_id: TelegramMessageId) -> None:
+    # ✨ set telegram message id
+    if self._connection is None:
+      raise ValueError("Database connection is not open.")
 
-    return await self._run_in_thread(_read_message_db_op, message_id)
+    cursor = self._connection.execute(
+        "UPDATE message_bus SET telegram_message_id = ? WHERE message_id = ? AND telegram_message_id IS NULL",
+        (telegram_message_id, message_id),
+    )
+    if cursor.rowcount == 0:
+      # This means either the message_id was not found, or telegram_message_id was already set.
+      raise ValueError(
+          f"Message with ID {message_id} not found or telegram_message_id already set."
+      )
+    elif cursor.rowcount > 1:
+      # This should ideally not happen with a PRIMARY KEY condition.
+      raise RuntimeError(
+          f"Multiple messages with ID {message_id} updated, which should not happen."
+      )
+    # ✨
+
+  async def read_message(self, message_id: MessageId) -> Message:
+
+    # ✨ read message
+    def _read_message_db_op(connection: sqlite3.Connection) -> Message:
+      """Synchronous database operation to read a message by its ID."""
+      logging.info('Reading message with ID: %s', message_id)
+      row = connection.execute(
+          f"SELECT {_MESSAGE_COLUMNS} FROM message_bus WHERE message_id = ?",
+          (message_id,)).fetchone()
+      if row is None:
+        row = connection.execute(
+            f"""
+            SELECT {_ARCHIVE_COLUMNS}
+            FROM message_bus_archive
+            WHERE message_id = ?
+            """, (message_id,)).fetchone()
+      if row is None:
+        raise ValueError(f"Message with ID {message_id} not found.")
+      return _message_from_row(row)
+
+    return await self._run_read(_read_message_db_op)
     # ✨
 
   async def find_message_by_telegram_id(
       self, telegram_chat_id: TelegramChatId,
       telegram_message_id: TelegramMessageId) -> Message:
-    """Returns a message from the database or raises ValueError."""
 
     # ✨ find message by telegram id
     def _find_message_by_telegram_id_db_op(
-        telegram_chat_id: TelegramChatId,
-        telegram_message_id: TelegramMessageId) -> Message:
+        connection: sqlite3.Connection) -> Message:
       """Synchronous database operation to find a message by Telegram IDs."""
+      logging.info(
+          'Finding message by telegram_chat_id=%s, telegram_message_id=%s',
+          telegram_chat_id, telegram_message_id)
+      for query in [
+          f"SELECT {_MESSAGE_COLUMNS} FROM message_bus",
+          f"SELECT {_ARCHIVE_COLUMNS} FROM message_bus_archive"
+      ]:
+        row = connection.execute(
+            query + " WHERE telegram_chat_id = ? AND telegram_message_id = ?",
+            (telegram_chat_id, telegram_message_id)).fetchone()
+        if row is not None:
+          message = _message_from_row(row)
+          logging.info('Found message with ID: %s', message.message_id)
+          return message
+      raise ValueError(
+          f"Message with telegram_chat_id={telegram_chat_id} and telegram_message_id={telegram_message_id} not found."
+      )
+
+    return await self._run_read(_find_message_by_telegram_id_db_op)
+    # ✨
+
+  async def fail_message(self, message_id: MessageId, error: str,
+                         policy: RetryPolicy) -> bool:
+    # ✨ fail message
+
+    def _fail() -> bool:
       if self._connection is None:
         raise ValueError("Database connection is not open.")
+      row = self._connection.execute(
+          """
+          UPDATE message_bus
+          SET attempts = attempts + 1, claimed_by = NULL,
+              lease_expires_at = NULL
+          WHERE message_id = ?
+          RETURNING attempts
+          """, (message_id,)).fetchone()
+      if row is None:
+        raise ValueError(f"Message with ID {message_id} not found.")
+      attempts = row['attempts']
+      if attempts < policy.max_attempts:
+        self._connection.execute(
+            """
+            UPDATE message_bus
+            SET processed_at = NULL, conversation_id = NULL, retry_at = ?
+            WHERE message_id = ?
+            """,
+            (time.time() + policy.delay(attempts).total_seconds(), message_id))
+        return True
+      self._connection.execute(
+          """
+          UPDATE message_bus
+          SET processed_at = COALESCE(processed_at, CURRENT_TIMESTAMP)
+          WHERE message_id = ?
+          """, (message_id,))
+      self._connection.execute(
+          """
+          INSERT OR REPLACE INTO message_bus_dead_letters
+              (message_id, attempts, error)
+          VALUES (?, ?, ?)
+          """, (message_id, attempts, error))
+      return False
+
+    retry = await self._write(_fail)
+    if retry:
+      logging.info(f"Message {message_id} failed; will be retried.")
+    else:
+      logging.warning(f"Message {message_id} failed; moved to dead letters.")
+    return retry
+    # ✨
 
-      query = """
+  async def list_dead_letters(self) -> list[DeadLetter]:
+    # ✨ list dead letters
+
+    def _list(connection: sqlite3.Connection) -> list[DeadLetter]:
+      rows = connection.execute(f"""
           SELECT
-              message_id,
-              source_agent,
-              target_agent,
-              local_directory,
-              conversation_id,
-              telegram_chat_id,
-              telegram_message_id,
-              telegram_reply_to_id,
-              content,
-              queued_at,
-              processed_at
+              {_MESSAGE_COLUMNS},
+              d.attempts AS dead_letter_attempts,
+              d.error,
+              d.failed_at
+          FROM message_bus JOIN message_bus_dead_letters d USING (message_id)
+          ORDER BY message_id
+          """).fetchall()
+      return [
+          DeadLetter(
+              message=_message_from_row(row),
+              attempts=row['dead_letter_attempts'],
+              error=row['error'],
+              failed_at=datetime.datetime.fromisoformat(row['failed_at']))
+          for row in rows
+      ]
+
+    return await self._run_read(_list)
+    # ✨
+
+  async def requeue_dead_letters(self,
+                                 message_ids: list[MessageId] | None = None
+                                ) -> list[MessageId]:
+    # ✨ requeue dead letters
+
+    def _requeue() -> list[MessageId]:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      dead_letters = [
+          MessageId(row['message_id']) for row in self._connection.execute(
+              "SELECT message_id FROM message_bus_dead_letters "
+              "ORDER BY message_id")
+      ]
+      if message_ids is None:
+        requeued = dead_letters
+      else:
+        missing = set(message_ids) - set(dead_letters)
+        if missing:
+          raise ValueError(f"Not dead letters: {sorted(missing)}")
+        requeued = sorted(set(message_ids))
+      if not requeued:
+        return []
+      placeholders = ', '.join(['?' for _ in requeued])
+      self._connection.execute(
+          f"""
+          UPDATE message_bus
+          SET processed_at = NULL, conversation_id = NULL, claimed_by = NULL,
+              lease_expires_at = NULL, attempts = 0, retry_at = NULL
+          WHERE message_id IN ({placeholders})
+          """, requeued)
+      self._connection.execute(
+          f"""
+          DELETE FROM message_bus_dead_letters
+          WHERE message_id IN ({placeholders})
+          """, requeued)
+      return requeued
+
+    requeued = await self._write(_requeue)
+    logging.info(f"Requeued dead letters: {requeued}")
+    return requeued
+    # ✨
+
+  async def start_session(self, message_id: MessageId) -> BusSession:
+    # ✨ start session
+
+    def _start() -> BusSession:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      row = self._connection.execute(
+          """
+          INSERT INTO message_bus_sessions (agent, telegram_chat_id)
+          SELECT target_agent, telegram_chat_id
           FROM message_bus
-          WHERE telegram_chat_id = ? AND telegram_message_id = ?
-      """
-      logging.info(
-          'Finding message by telegram_chat_id=%s, telegram_message_id=%s',
-          telegram_chat_id, telegram_message_id)
+          WHERE message_id = ?
+          RETURNING conversation_id, agent, telegram_chat_id, created_at
+          """, (message_id,)).fetchone()
+      if row is None:
+        raise ValueError(f"Message with ID {message_id} not found.")
+      session = _session_from_row(row)
+      self._set_conversation_id_in_thread(message_id, session.conversation_id)
+      return session
+
+    session = await self._write(_start)
+    logging.info(f"Started session {session.conversation_id} for message "
+                 f"{message_id}.")
+    return session
+    # ✨
 
-      cursor = self._connection.execute(query,
-                                        (telegram_chat_id, telegram_message_id))
-      row = cursor.fetchone()
+  async def read_session(self, conversation_id: ConversationId) -> BusSession:
+    # ✨ read session
 
+    def _read(connection: sqlite3.Connection) -> BusSession:
+      row = connection.execute(
+          """
+          SELECT conversation_id, agent, telegram_chat_id, created_at
+          FROM message_bus_sessions
+          WHERE conversation_id = ?
+          """, (conversation_id,)).fetchone()
       if row is None:
-        raise ValueError(
-            f"Message with telegram_chat_id={telegram_chat_id} and telegram_message_id={telegram_message_id} not found."
-        )
+        raise ValueError(f"Session {conversation_id} not found.")
+      return _session_from_row(row)
 
-      message = Message(
-          message_id=MessageId(row['message_id']),
-          source_agent=AgentName(row['source_agent']),
-          target_agent=AgentName(row['target_agent']),
-          local_directory=pathlib.Path(row['local_directory'])
-          if row['local_directory'] else None,
-          conversation_id=ConversationId(row['conversation_id'])
-          if row['conversation_id'] else None,
-          telegram_chat_id=TelegramChatId(row['telegram_chat_id']),
-          telegram_message_id=TelegramMessageId(row['telegram_message_id'])
-          if row['telegram_message_id'] else None,
-          telegram_reply_to_id=TelegramMessageId(row['telegram_reply_to_id'])
-          if row['telegram_reply_to_id'] else None,
-          content=MessageContent(row['content']),
-          queued_at=datetime.datetime.fromisoformat(row['queued_at']),
-          processed_at=datetime.datetime.fromisoformat(row['processed_at'])
-          if row['processed_at'] else None,
-      )
-      logging.info('Found message with ID: %s', message.message_id)
-      return message
+    return await self._run_read(_read)
+    # ✨
 
-    return await self._run_in_thread(
-        _find_message_by_telegram_id_db_op,
-        telegram_chat_id,
-        telegram_message_id,
-    )
+  async def read_conversation(self,
+                              conversation_id: ConversationId) -> list[Message]:
+    # ✨ read conversation
+
+    def _read(connection: sqlite3.Connection) -> list[Message]:
+      rows = connection.execute(
+          f"""
+          SELECT {_MESSAGE_COLUMNS} FROM message_bus
+          WHERE conversation_id = ?
+          UNION ALL
+          SELECT {_ARCHIVE_COLUMNS} FROM message_bus_archive
+          WHERE conversation_id = ?
+          ORDER BY message_id
+          """, (conversation_id, conversation_id)).fetchall()
+      return [_message_from_row(row) for row in rows]
+
+    return await self._run_read(_read)
+    # ✨
+
+  async def archive_messages(self,
+                             older_than: datetime.timedelta,
+                             batch_size: int = 1000) -> int:
+    """Moves old messages that are done to `message_bus_archive`.
+
+    A message is done if it was processed or, for messages to `END_USER_AGENT`,
+    sent to Telegram. It is old if it was processed (or, for messages without
+    `processed_at`, queued) more than `older_than` ago.
+
+    The archive keeps all the columns (with `content` compressed and inline,
+    even if it was offloaded), so `read_message` and
+    `find_message_by_telegram_id` (for replies to old messages) keep working.
+    Afterwards, deletes the blobs no longer referenced by `message_bus`.
+
+    Moves `batch_size` messages per transaction (to avoid blocking writers for
+    long). Returns the number of messages archived.
+    """
+    # ✨ archive messages
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) -
+              older_than).strftime("%Y-%m-%d %H:%M:%S")
+
+    def _archive_batch() -> int:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      ids = [
+          row['message_id'] for row in self._connection.execute(
+              """
+              SELECT message_id FROM message_bus
+              WHERE ((processed_at IS NOT NULL AND processed_at < ?)
+                  OR (processed_at IS NULL AND target_agent = ?
+                      AND telegram_message_id IS NOT NULL AND queued_at < ?))
+                  AND message_id NOT IN (
+                      SELECT message_id FROM message_bus_dead_letters)
+              ORDER BY message_id
+              LIMIT ?
+              """, (cutoff, END_USER_AGENT, cutoff, batch_size))
+      ]
+      if not ids:
+        return 0
+      placeholders = ', '.join(['?' for _ in ids])
+      self._connection.execute(
+          f"""
+          INSERT INTO message_bus_archive ({_MESSAGE_FIELDS})
+          SELECT {_MESSAGE_FIELDS.replace('content', f'zlib_compress({_CONTENT})')}
+          FROM message_bus
+          WHERE message_id IN ({placeholders})
+          """, ids)
+      self._connection.execute(
+          f"DELETE FROM message_bus WHERE message_id IN ({placeholders})", ids)
+      return len(ids)
+
+    total = 0
+    while count := await self._write(_archive_batch):
+      total += count
+    if total:
+      logging.info(f"Archived {total} messages.")
+
+    def _delete_blobs() -> int:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      return self._connection.execute("""
+          DELETE FROM message_bus_blobs
+          WHERE NOT EXISTS (
+              SELECT 1 FROM message_bus
+              WHERE content_digest = message_bus_blobs.digest)
+          """).rowcount
+
+    if deleted_blobs := await self._write(_delete_blobs):
+      logging.info(f"Deleted {deleted_blobs} blobs.")
+
+    def _delete_topic_messages() -> int:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      return self._connection.execute(
+          """
+          DELETE FROM message_bus_topic_messages
+          WHERE published_at < ?
+              AND topic_message_id <= COALESCE(
+                  (SELECT MIN(s.topic_message_id)
+                   FROM message_bus_subscriptions s
+                   WHERE s.topic = message_bus_topic_messages.topic),
+                  topic_message_id)
+          """, (cutoff,)).rowcount
+
+    if deleted := await self._write(_delete_topic_messages):
+      logging.info(f"Deleted {deleted} topic messages.")
+
+    def _delete_telegram_updates() -> int:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      return self._connection.execute(
+          "DELETE FROM message_bus_telegram_updates WHERE received_at < ?",
+          (cutoff,)).rowcount
+
+    if deleted := await self._write(_delete_telegram_updates):
+      logging.info(f"Deleted {deleted} Telegram update records.")
+    return total
+    # ✨
+
+  async def compact(self, pages: int = 1000) -> None:
+    """Returns free pages to the file system and checkpoints the WAL.
+
+    Runs `PRAGMA incremental_vacuum(pages)` and
+    `PRAGMA wal_checkpoint(TRUNCATE)`. Databases created before incremental
+    vacuum was enabled are converted (through a full `VACUUM`) the first time.
+    """
+
+    # ✨ compact
+    def _compact_db_op() -> None:
+      if self._connection is None:
+        raise ValueError("Database connection is not open.")
+      # 2 is INCREMENTAL.
+      if self._connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logging.info("Enabling incremental vacuum (running a full VACUUM).")
+        self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._connection.execute("VACUUM")
+      self._connection.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+      self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    await self._run_in_thread(_compact_db_op)
+    # ✨
+
+  async def stats(self) -> BusStats:
+
+    # ✨ stats
+    def _stats_db_op(connection: sqlite3.Connection) -> BusStats:
+
+      def _value(query: str) -> int:
+        return int(connection.execute(query).fetchone()[0])
+
+      page_size = _value("PRAGMA page_size")
+      return BusStats(
+          rows=_value("SELECT COUNT(*) FROM message_bus"),
+          pending_rows=_value(
+              "SELECT COUNT(*) FROM message_bus WHERE processed_at IS NULL "
+              "AND telegram_message_id IS NULL"),
+          archived_rows=_value("SELECT COUNT(*) FROM message_bus_archive"),
+          database_bytes=_value("PRAGMA page_count") * page_size,
+          free_bytes=_value("PRAGMA freelist_count") * page_size,
+          topic_rows=_value("SELECT COUNT(*) FROM message_bus_topic_messages"),
+          blob_rows=_value("SELECT COUNT(*) FROM message_bus_blobs"),
+          average_claim_latency=self._claim_latency.average(),
+          max_claim_latency=self._claim_latency.max())
+
+    return await self._run_read(_stats_db_op)
     # ✨
@@ -15,9 +15,141 @@ CREATE TABLE message_bus (
     telegram_message_id  BIGINT,
     telegram_reply_to_id BIGINT,
 
-    content TEXT NOT NULL,
+    -- Empty if the content was offloaded to message_bus_blobs (see
+    -- `content_digest`).
+    content        TEXT NOT NULL,
+    content_digest TEXT,
 
     -- State Tracking (Null-based)
     queued_at    TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     processed_at TIMESTAMP WITH TIME ZONE,
+
+    -- Claims by swarm workers (see MessageBus.claim_incoming_messages).
+    claimed_by       TEXT,
+    lease_expires_at REAL,  -- Seconds since the epoch.
+
+    -- Failed attempts at processing (see MessageBus.fail_message). The message
+    -- isn't incoming again until `retry_at` (seconds since the epoch).
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL,
+
+    -- See MessagePriority: 0 (HIGH, end user), 1 (MEDIUM, delegation) or 2
+    -- (LOW, background). Claims are ordered by priority, promoted one level
+    -- for each minute the message has waited since `enqueued_at` (seconds
+    -- since the epoch).
+    priority    INTEGER NOT NULL DEFAULT 1,
+    enqueued_at REAL
+);
+
+-- Incoming messages (per target agent).
+CREATE INDEX message_bus_incoming ON message_bus (target_agent, message_id)
+    WHERE processed_at IS NULL;
+
+-- Outgoing messages (to END_USER_AGENT) not yet sent to Telegram.
+CREATE INDEX message_bus_outgoing ON message_bus (target_agent, message_id)
+    WHERE telegram_message_id IS NULL;
+
+-- Lookups of Telegram replies.
+CREATE INDEX message_bus_telegram
+    ON message_bus (telegram_chat_id, telegram_message_id)
+    WHERE telegram_message_id IS NOT NULL;
+
+-- Positions of consumers (see MessageBus.save_cursor).
+CREATE TABLE message_bus_cursors (
+    name       TEXT PRIMARY KEY,
+    message_id BIGINT NOT NULL
+);
+
+-- Old messages (that were processed or sent), moved here by
+-- MessageBus.archive_messages. Same columns as message_bus (without claims),
+-- with `content` compressed with zlib.
+CREATE TABLE message_bus_archive (
+    message_id           BIGINT PRIMARY KEY,
+    source_agent         TEXT NOT NULL,
+    target_agent         TEXT NOT NULL,
+    local_directory      TEXT,
+    conversation_id      BIGINT,
+    telegram_chat_id     BIGINT NOT NULL,
+    telegram_message_id  BIGINT,
+    telegram_reply_to_id BIGINT,
+    content              BYTEA NOT NULL,
+    queued_at            TIMESTAMP WITH TIME ZONE,
+    processed_at         TIMESTAMP WITH TIME ZONE,
+    priority             INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE INDEX message_bus_archive_telegram
+    ON message_bus_archive (telegram_chat_id, telegram_message_id)
+    WHERE telegram_message_id IS NOT NULL;
+
+-- Messages that failed too many times (see MessageBus.fail_message), until
+-- they're requeued (MessageBus.requeue_dead_letters).
+CREATE TABLE message_bus_dead_letters (
+    message_id BIGINT PRIMARY KEY,
+    attempts   INTEGER NOT NULL,
+    error      TEXT NOT NULL,  -- E.g., the exception trace.
+    failed_at  TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Sessions started by MessageBus.start_session. Assigns conversation ids
+-- (unique across the bus) and keeps what is needed to restart a session whose
+-- process is gone (its messages are found through `conversation_id`).
+CREATE TABLE message_bus_sessions (
+    conversation_id  SERIAL PRIMARY KEY,
+    agent            TEXT NOT NULL,
+    telegram_chat_id BIGINT NOT NULL,
+    created_at       TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX message_bus_conversation
+    ON message_bus (conversation_id, message_id)
+    WHERE conversation_id IS NOT NULL;
+
+CREATE INDEX message_bus_archive_conversation
+    ON message_bus_archive (conversation_id, message_id)
+    WHERE conversation_id IS NOT NULL;
+
+-- Messages published to a topic (MessageBus.publish). Each subscriber gets its
+-- own copy (in message_bus) when it next claims its messages.
+CREATE TABLE message_bus_topic_messages (
+    topic_message_id     SERIAL PRIMARY KEY,
+    topic                TEXT NOT NULL,
+    source_agent         TEXT NOT NULL,
+    local_directory      TEXT,
+    telegram_chat_id     BIGINT NOT NULL,
+    telegram_reply_to_id BIGINT,
+    content              BYTEA NOT NULL,
+    published_at         TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    enqueued_at          REAL  -- Seconds since the epoch.
+);
+
+CREATE INDEX message_bus_topic_messages_topic
+    ON message_bus_topic_messages (topic, topic_message_id);
+
+-- Topics each agent subscribes to (MessageBus.set_subscriptions), with the
+-- last topic message delivered to it.
+CREATE TABLE message_bus_subscriptions (
+    agent            TEXT NOT NULL,
+    topic            TEXT NOT NULL,
+    topic_message_id BIGINT NOT NULL,
+    PRIMARY KEY (agent, topic)
+);
+
+-- Contents longer than 4096 bytes (see `_offload_content` in message_bus.py),
+-- keyed by their SHA-256 digest and shared by all messages with that content.
+-- Deleted (by MessageBus.archive_messages) once no message references them.
+CREATE TABLE message_bus_blobs (
+    digest  TEXT PRIMARY KEY,
+    content TEXT NOT NULL
+);
+
+CREATE INDEX message_bus_content_digest ON message_bus (content_digest)
+    WHERE content_digest IS NOT NULL;
+
+-- Telegram updates already written (MessageBus.write_telegram_updates), so that
+-- updates retried by Telegram's webhook are skipped. Deleted (by
+-- MessageBus.archive_messages) once older than the retention.
+CREATE TABLE message_bus_telegram_updates (
+    update_id   BIGINT PRIMARY KEY,
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
@@ -0,0 +1,503 @@
+import asyncio
+import dataclasses
+import datetime
+import time
+from typing import Any, Callable
+
+from conversation import ConversationId
+from message_bus import BusSession, BusStats, ClaimLatency, DeadLetter, END_USER_AGENT, Message, MessageBus, MessageId, MessagePriority, PRIORITY_AGING, RetryPolicy, TelegramChatId, TelegramMessageId, TelegramUpdateId, TopicMessage, TopicMessageId, WorkerId
+from swarm_types import AgentName, Topic
+
+
+def _utc(value: datetime.datetime) -> datetime.datetime:
+  """Timestamps without time zone (e.g., `processed_at`) are in UTC."""
+  if value.tzinfo is None:
+    return value.replace(tzinfo=datetime.timezone.utc)
+  return value
+
+
+class InMemoryMessageBus(MessageBus):
+  """A `MessageBus` that keeps all messages in memory.
+
+  Has the same semantics as `SqliteMessageBus` (ids, processed and claimed
+  state, cursors, topics, Telegram lookups and the archive) but can't be shared across
+  processes and doesn't survive restarts. Meant for tests and benchmarks.
+
+  Every operation is applied atomically (all in the event loop's thread) and is
+  visible to all reads that start after it.
+  """
+
+  def __init__(self) -> None:
+    self._open = False
+    self._next_id = 1
+    # Sorted by `message_id` (ids are assigned in increasing order).
+    self._messages: dict[MessageId, Message] = {}
+    # Messages without `processed_at` (a dict, to keep them sorted).
+    self._unprocessed: dict[MessageId, None] = {}
+    self._archive: dict[MessageId, Message] = {}
+    self._telegram_ids: dict[tuple[TelegramChatId, TelegramMessageId],
+                             MessageId] = {}
+    # Values are the worker and the time (`time.time()`) its lease expires.
+    self._claims: dict[MessageId, tuple[WorkerId, float]] = {}
+    self._cursors: dict[str, MessageId] = {}
+    # Failed attempts (see `fail_message`) and when to retry (`time.time()`).
+    self._attempts: dict[MessageId, int] = {}
+    self._retry_at: dict[MessageId, float] = {}
+    # When (`time.time()`) each message (or topic message) was written.
+    self._enqueued_at: dict[MessageId, float] = {}
+    self._topic_enqueued_at: dict[TopicMessageId, float] = {}
+    self._claim_latency = ClaimLatency()
+    # When each update (see `write_telegram_updates`) was received.
+    self._telegram_updates: dict[TelegramUpdateId, datetime.datetime] = {}
+    self._dead_letters: dict[MessageId, DeadLetter] = {}
+    self._sessions: dict[ConversationId, BusSession] = {}
+    # Sorted by `topic_message_id`.
+    self._topic_messages: dict[TopicMessageId, TopicMessage] = {}
+    self._next_topic_message_id = 1
+    # The last topic message delivered to each subscription.
+    self._subscriptions: dict[tuple[AgentName, Topic], TopicMessageId] = {}
+    # Set (and replaced) whenever the bus changes.
+    self._changed = asyncio.Event()
+
+  def _check_open(self) -> None:
+    if not self._open:
+      raise ValueError("Message bus is not open.")
+
+  def _notify(self) -> None:
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  async def _wait(self, load: Callable[[], list[Message]]) -> list[Message]:
+    """Runs `load` until it returns values (whenever the bus changes).
+
+    Also runs it when the first claim lease expires (or retry is due).
+    """
+    while True:
+      self._check_open()
+      messages = load()
+      if messages:
+        return messages
+      changed = self._changed
+      now = time.time()
+      deadlines = [
+          deadline for deadline in [
+              *(expires_at for _, expires_at in self._claims.values()),
+              *self._retry_at.values()
+          ] if deadline > now
+      ]
+      timeout = min(deadlines) - now if deadlines else None
+      # Not `asyncio.wait_for` (see `SqliteMessageBus._poll`).
+      waiter = asyncio.create_task(changed.wait())
+      try:
+        await asyncio.wait([waiter], timeout=timeout)
+      finally:
+        waiter.cancel()
+
+  async def open(self) -> None:
+    self._open = True
+
+  async def close(self) -> None:
+    self._open = False
+
+  async def wait_for_incoming_messages(self,
+                                       agents: list[AgentName],
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+
+    def _load() -> list[Message]:
+      now = time.time()
+      return [
+          self._messages[i]
+          for i in self._unprocessed
+          if i > after and self._messages[i].target_agent in agents and
+          self._retry_at.get(i, 0) <= now
+      ][:limit]
+
+    return await self._wait(_load)
+
+  async def wait_for_outgoing_messages(self,
+                                       after: MessageId = MessageId(0),
+                                       limit: int = 100) -> list[Message]:
+
+    def _load() -> list[Message]:
+      return [
+          m for m in self._messages.values()
+          if m.telegram_message_id is None and
+          m.target_agent == END_USER_AGENT and m.message_id > after
+      ][:limit]
+
+    return await self._wait(_load)
+
+  async def read_cursor(self, name: str) -> MessageId:
+    self._check_open()
+    return self._cursors.get(name, MessageId(0))
+
+  async def save_cursor(self, name: str, message_id: MessageId) -> None:
+    self._check_open()
+    self._cursors[name] = max(self._cursors.get(name, MessageId(0)), message_id)
+
+  def _deliver_topic_messages(self, agents: list[AgentName],
+                              limit: int) -> None:
+    deliveries = sorted(
+        ((topic_message, agent)
+         for (agent, topic), last in self._subscriptions.items()
+         if agent in agents for topic_message in self._topic_messages.values()
+         if topic_message.topic == topic and
+         topic_message.topic_message_id > last),
+        key=lambda delivery: delivery[0].topic_message_id)[:limit]
+    for topic_message, agent in deliveries:
+      message = Message(
+          message_id=MessageId(self._next_id),
+          source_agent=topic_message.source_agent,
+          target_agent=agent,
+          local_directory=topic_message.local_directory,
+          conversation_id=None,
+          telegram_chat_id=topic_message.telegram_chat_id,
+          telegram_message_id=None,
+          telegram_reply_to_id=topic_message.telegram_reply_to_id,
+          content=topic_message.content,
+          queued_at=topic_message.published_at,
+          processed_at=None,
+          priority=MessagePriority.LOW)
+      self._next_id += 1
+      self._enqueued_at[message.message_id] = self._topic_enqueued_at[
+          topic_message.topic_message_id]
+      self._messages[message.message_id] = message
+      self._unprocessed[message.message_id] = None
+      self._subscriptions[(agent, topic_message.topic)] = (
+          topic_message.topic_message_id)
+
+  def _claim(self, agents: list[AgentName], worker_id: WorkerId,
+             lease: datetime.timedelta, limit: int,
+             aging: datetime.timedelta) -> list[Message]:
+    self._deliver_topic_messages(agents, limit)
+    now = time.time()
+    candidates: list[tuple[int, Message]] = []
+    for message_id in self._unprocessed:
+      message = self._messages[message_id]
+      if (message.target_agent not in agents or
+          self._retry_at.get(message_id, 0) > now):
+        continue
+      claim = self._claims.get(message.message_id)
+      if claim is not None and claim[1] >= now:
+        continue
+      waited_secs = now - self._enqueued_at[message_id]
+      candidates.append((message.priority.aged(waited_secs, aging), message))
+    # `_unprocessed` is sorted by `message_id` and the sort is stable.
+    candidates.sort(key=lambda candidate: candidate[0])
+    messages = [message for _, message in candidates[:limit]]
+    for message in messages:
+      self._claims[message.message_id] = (worker_id,
+                                          now + lease.total_seconds())
+      if message.message_id not in self._retry_at:
+        self._claim_latency.record(message.priority,
+                                   now - self._enqueued_at[message.message_id])
+    return messages
+
+  async def claim_incoming_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+    self._check_open()
+    return self._claim(agents, worker_id, lease, limit, aging)
+
+  async def wait_for_claimed_messages(
+      self,
+      agents: list[AgentName],
+      worker_id: WorkerId,
+      lease: datetime.timedelta,
+      limit: int = 100,
+      aging: datetime.timedelta = PRIORITY_AGING) -> list[Message]:
+
+    def _load() -> list[Message]:
+      return self._claim(agents, worker_id, lease, limit, aging)
+
+    return await self._wait(_load)
+
+  def _claimed_by(self, worker_id: WorkerId) -> list[MessageId]:
+    """Returns the unprocessed messages claimed by `worker_id`."""
+    return [
+        message_id for message_id, (worker, _) in self._claims.items()
+        if worker == worker_id and message_id in self._messages and
+        self._messages[message_id].processed_at is None
+    ]
+
+  async def extend_leases(self, worker_id: WorkerId,
+                          lease: datetime.timedelta) -> int:
+    self._check_open()
+    message_ids = self._claimed_by(worker_id)
+    for message_id in message_ids:
+      self._claims[message_id] = (worker_id,
+                                  time.time() + lease.total_seconds())
+    return len(message_ids)
+
+  async def release_claims(self, worker_id: WorkerId) -> None:
+    self._check_open()
+    for message_id in self._claimed_by(worker_id):
+      del self._claims[message_id]
+    self._notify()
+
+  async def set_subscriptions(self, agent: AgentName,
+                              topics: frozenset[Topic]) -> None:
+    self._check_open()
+    for key in list(self._subscriptions):
+      if key[0] == agent and key[1] not in topics:
+        del self._subscriptions[key]
+    for topic in topics:
+      self._subscriptions.setdefault(
+          (agent, topic),
+          max((m.topic_message_id
+               for m in self._topic_messages.values()
+               if m.topic == topic),
+              default=TopicMessageId(0)))
+
+  async def publish(self, message: TopicMessage) -> TopicMessage:
+    self._check_open()
+    message = dataclasses.replace(
+        message, topic_message_id=TopicMessageId(self._next_topic_message_id))
+    self._next_topic_message_id += 1
+    self._topic_messages[message.topic_message_id] = message
+    self._topic_enqueued_at[message.topic_message_id] = time.time()
+    self._notify()
+    return message
+
+  def _set_fields(self, field: str, updates: list[tuple[MessageId, Any]],
+                  description: str) -> list[Message]:
+    """Sets `field` (which must be None) of several messages, atomically.
+
+    Raises ValueError (without applying any update) if a message doesn't
+    exist or already has a value; `description` explains the latter.
+    """
+    self._check_open()
+    updated: dict[MessageId, Message] = {}
+    for message_id, value in updates:
+      message = updated.get(message_id) or self._messages.get(message_id)
+      if message is None or getattr(message, field) is not None:
+        raise ValueError(
+            f"Message with ID {message_id} not found or {description}.")
+      updated[message_id] = dataclasses.replace(message, **{field: value})
+    self._messages.update(updated)
+    self._notify()
+    return list(updated.values())
+
+  async def set_conversation_ids(
+      self, updates: list[tuple[MessageId, ConversationId]]) -> None:
+    self._set_fields("conversation_id", list(updates),
+                     "conversation_id already set")
+
+  async def write_new_messages(self, messages: list[Message]) -> list[Message]:
+    self._check_open()
+    written: list[Message] = []
+    for message in messages:
+      message = dataclasses.replace(
+          message, message_id=MessageId(self._next_id), processed_at=None)
+      self._next_id += 1
+      self._messages[message.message_id] = message
+      self._unprocessed[message.message_id] = None
+      self._enqueued_at[message.message_id] = time.time()
+      if message.telegram_message_id is not None:
+        self._telegram_ids.setdefault(
+            (message.telegram_chat_id, message.telegram_message_id),
+            message.message_id)
+      written.append(message)
+    if written:
+      self._notify()
+    return written
+
+  async def write_telegram_updates(
+      self, updates: list[tuple[TelegramUpdateId, Message]]) -> list[Message]:
+    self._check_open()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    new_updates: dict[TelegramUpdateId, Message] = {}
+    for update_id, message in updates:
+      if update_id not in self._telegram_updates:
+        new_updates.setdefault(update_id, message)
+    self._telegram_updates.update((update_id, now) for update_id in new_updates)
+    return await self.write_new_messages(list(new_updates.values()))
+
+  async def mark_processed_many(self, message_ids: list[MessageId]) -> None:
+    # Like SQLite's CURRENT_TIMESTAMP: UTC, in seconds, without time zone.
+    now = datetime.datetime.now(datetime.timezone.utc).replace(
+        microsecond=0, tzinfo=None)
+    self._set_fields("processed_at", [(i, now) for i in message_ids],
+                     "already processed")
+    for message_id in message_ids:
+      del self._unprocessed[message_id]
+
+  async def set_telegram_message_ids(
+      self, updates: list[tuple[MessageId, TelegramMessageId]]) -> None:
+    for message in self._set_fields("telegram_message_id", list(updates),
+                                    "telegram_message_id already set"):
+      assert message.telegram_message_id is not None
+      self._telegram_ids.setdefault(
+          (message.telegram_chat_id, message.telegram_message_id),
+          message.message_id)
+
+  async def read_message(self, message_id: MessageId) -> Message:
+    self._check_open()
+    message = self._messages.get(message_id) or self._archive.get(message_id)
+    if message is None:
+      raise ValueError(f"Message with ID {message_id} not found.")
+    return message
+
+  async def find_message_by_telegram_id(
+      self, telegram_chat_id: TelegramChatId,
+      telegram_message_id: TelegramMessageId) -> Message:
+    self._check_open()
+    message_id = self._telegram_ids.get((telegram_chat_id, telegram_message_id))
+    if message_id is None:
+      raise ValueError(
+          f"Message with telegram_chat_id={telegram_chat_id} and telegram_message_id={telegram_message_id} not found."
+      )
+    return await self.read_message(message_id)
+
+  async def fail_message(self, message_id: MessageId, error: str,
+                         policy: RetryPolicy) -> bool:
+    self._check_open()
+    message = self._messages.get(message_id)
+    if message is None:
+      raise ValueError(f"Message with ID {message_id} not found.")
+    self._claims.pop(message_id, None)
+    attempts = self._attempts.get(message_id, 0) + 1
+    self._attempts[message_id] = attempts
+    if attempts < policy.max_attempts:
+      self._messages[message_id] = dataclasses.replace(
+          message, processed_at=None, conversation_id=None)
+      self._unprocessed[message_id] = None
+      # Keep `_unprocessed` sorted.
+      self._unprocessed = dict(sorted(self._unprocessed.items()))
+      self._retry_at[message_id] = (
+          time.time() + policy.delay(attempts).total_seconds())
+      self._notify()
+      return True
+    if message.processed_at is None:
+      await self.mark_as_processed(message_id)
+    self._dead_letters[message_id] = DeadLetter(
+        message=self._messages[message_id],
+        attempts=attempts,
+        error=error,
+        failed_at=datetime.datetime.now(datetime.timezone.utc).replace(
+            microsecond=0, tzinfo=None))
+    return False
+
+  async def list_dead_letters(self) -> list[DeadLetter]:
+    self._check_open()
+    return [
+        dead_letter._replace(message=self._messages[message_id])
+        for message_id, dead_letter in sorted(self._dead_letters.items())
+    ]
+
+  async def requeue_dead_letters(self,
+                                 message_ids: list[MessageId] | None = None
+                                ) -> list[MessageId]:
+    self._check_open()
+    if message_ids is None:
+      requeued = sorted(self._dead_letters)
+    else:
+      missing = set(message_ids) - set(self._dead_letters)
+      if missing:
+        raise ValueError(f"Not dead letters: {sorted(missing)}")
+      requeued = sorted(set(message_ids))
+    for message_id in requeued:
+      del self._dead_letters[message_id]
+      self._attempts.pop(message_id, None)
+      self._retry_at.pop(message_id, None)
+      self._messages[message_id] = dataclasses.replace(
+          self._messages[message_id], processed_at=None, conversation_id=None)
+      self._unprocessed[message_id] = None
+    self._unprocessed = dict(sorted(self._unprocessed.items()))
+    self._notify()
+    return requeued
+
+  async def start_session(self, message_id: MessageId) -> BusSession:
+    self._check_open()
+    message = self._messages.get(message_id)
+    if message is None:
+      raise ValueError(f"Message with ID {message_id} not found.")
+    session = BusSession(
+        conversation_id=ConversationId(len(self._sessions) + 1),
+        agent=message.target_agent,
+        telegram_chat_id=message.telegram_chat_id,
+        created_at=datetime.datetime.now(datetime.timezone.utc).replace(
+            microsecond=0, tzinfo=None))
+    await self.set_conversation_id(message_id, session.conversation_id)
+    self._sessions[session.conversation_id] = session
+    return session
+
+  async def read_session(self, conversation_id: ConversationId) -> BusSession:
+    self._check_open()
+    session = self._sessions.get(conversation_id)
+    if session is None:
+      raise ValueError(f"Session {conversation_id} not found.")
+    return session
+
+  async def read_conversation(self,
+                              conversation_id: ConversationId) -> list[Message]:
+    self._check_open()
+    return sorted(
+        (m for m in [*self._messages.values(), *self._archive.values()]
+         if m.conversation_id == conversation_id),
+        key=lambda m: m.message_id)
+
+  async def archive_messages(self,
+                             older_than: datetime.timedelta,
+                             batch_size: int = 1000) -> int:
+    """Ignores `batch_size` (archives everything at once)."""
+    self._check_open()
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - older_than
+
+    def _done(message: Message) -> bool:
+      if message.message_id in self._dead_letters:
+        return False
+      if message.processed_at is not None:
+        return _utc(message.processed_at) < cutoff
+      return (message.target_agent == END_USER_AGENT and
+              message.telegram_message_id is not None and
+              _utc(message.queued_at) < cutoff)
+
+    archived = [m for m in self._messages.values() if _done(m)]
+    for message in archived:
+      del self._messages[message.message_id]
+      self._unprocessed.pop(message.message_id, None)
+      self._claims.pop(message.message_id, None)
+      self._attempts.pop(message.message_id, None)
+      self._retry_at.pop(message.message_id, None)
+      self._enqueued_at.pop(message.message_id, None)
+      self._archive[message.message_id] = message
+    if archived:
+      self._notify()
+    for topic_message in list(self._topic_messages.values()):
+      delivered = [
+          last for (_, topic), last in self._subscriptions.items()
+          if topic == topic_message.topic
+      ]
+      if (_utc(topic_message.published_at) < cutoff and
+          topic_message.topic_message_id <= min(
+              delivered, default=topic_message.topic_message_id)):
+        del self._topic_messages[topic_message.topic_message_id]
+        del self._topic_enqueued_at[topic_message.topic_message_id]
+    for update_id, received_at in list(self._telegram_updates.items()):
+      if received_at < cutoff:
+        del self._telegram_updates[update_id]
+    return len(archived)
+
+  async def compact(self, pages: int = 1000) -> None:
+    self._check_open()
+
+  async def stats(self) -> BusStats:
+    self._check_open()
+    return BusStats(
+        rows=len(self._messages),
+        pending_rows=sum(
+            1 for m in self._messages.values()
+            if m.processed_at is None and m.telegram_message_id is None),
+        archived_rows=len(self._archive),
+        database_bytes=0,
+        free_bytes=0,
+        topic_rows=len(self._topic_messages),
+        blob_rows=0,
+        average_claim_latency=self._claim_latency.average(),
+        max_claim_latency=self._claim_latency.max())
@@ -0,0 +1,96 @@
+"""Wakes up processes waiting for changes in a message bus.
+
+Waiters in the same process are woken up directly. To reach other processes
+(e.g., the Telegram adapter and the swarm), every `MessageBusNotifier` binds a
+unix datagram socket in a directory shared by all users of the bus; `notify`
+sends a one-byte datagram to every other socket in that directory.
+
+Notifications are only hints: waiters must re-check the bus when woken up and
+should still poll (slowly) in case a notification is lost.
+"""
+
+import asyncio
+import logging
+import os
+import pathlib
+import socket
+
+
+class MessageBusNotifier:
+
+  def __init__(self, directory: pathlib.Path) -> None:
+    self._directory = directory
+    self._socket: socket.socket | None = None
+    self._socket_path: pathlib.Path | None = None
+    self._changed = asyncio.Event()
+
+  def open(self) -> None:
+    """Starts receiving notifications from other processes.
+
+    Must run in the event loop that waits for changes. If the socket can't be
+    created, logs a warning: only in-process notifications will be received.
+    """
+    path = self._directory / f"{os.getpid()}-{id(self)}.sock"
+    try:
+      self._directory.mkdir(parents=True, exist_ok=True)
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      sock.setblocking(False)
+      sock.bind(str(path))
+    except OSError as e:
+      logging.warning(f"Can't receive message bus notifications at {path} "
+                      f"(falling back to polling): {e}")
+      return
+    self._socket = sock
+    self._socket_path = path
+    asyncio.get_running_loop().add_reader(sock.fileno(), self._on_readable)
+
+  def close(self) -> None:
+    if self._socket is None:
+      return
+    asyncio.get_running_loop().remove_reader(self._socket.fileno())
+    self._socket.close()
+    self._socket = None
+    if self._socket_path:
+      self._socket_path.unlink(missing_ok=True)
+
+  def changed_event(self) -> asyncio.Event:
+    """Returns an event that will be set by the next notification.
+
+    Callers should obtain the event *before* checking the bus for changes (to
+    avoid missing a notification that arrives while they check).
+    """
+    return self._changed
+
+  def notify(self) -> None:
+    """Wakes up all waiters (in this process and in others)."""
+    self._wake_up()
+    self._notify_other_processes()
+
+  def _wake_up(self) -> None:
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  def _on_readable(self) -> None:
+    assert self._socket
+    try:
+      while self._socket.recv(16):
+        pass
+    except BlockingIOError:
+      pass
+    self._wake_up()
+
+  def _notify_other_processes(self) -> None:
+    if self._socket is None:
+      return
+    for path in self._directory.glob("*.sock"):
+      if path == self._socket_path:
+        continue
+      try:
+        self._socket.sendto(b"\0", str(path))
+      except BlockingIOError:
+        pass  # The receiver already has pending notifications.
+      except (ConnectionRefusedError, FileNotFoundError):
+        # The process that created the socket is gone.
+        path.unlink(missing_ok=True)
+      except OSError as e:
+        logging.warning(f"Unable to notify {path}: {e}")
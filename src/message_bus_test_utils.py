@@ -0,0 +1,489 @@
+"""Tests shared by the `MessageBus` implementations (see `MessageBusTests`)."""
+
+import asyncio
+import dataclasses
+import datetime
+import unittest
+from typing import TYPE_CHECKING
+
+from conversation import ConversationId
+from message_bus import END_USER_AGENT, Message, MessageBus, MessageContent, MessageId, MessagePriority, RetryPolicy, TelegramChatId, TelegramMessageId, TelegramUpdateId, TopicMessage, TopicMessageId, WorkerId
+from swarm_types import AgentName, Topic
+
+AGENT = AgentName("researcher")
+REVIEWER = AgentName("reviewer")
+CODER = AgentName("coder")
+TOPIC = Topic("deploys")
+LEASE = datetime.timedelta(minutes=1)
+
+
+def new_message(content: str,
+                target_agent: AgentName = AGENT,
+                priority: MessagePriority = MessagePriority.MEDIUM) -> Message:
+  return Message(
+      message_id=MessageId(0),
+      source_agent=END_USER_AGENT,
+      target_agent=target_agent,
+      local_directory=None,
+      conversation_id=None,
+      telegram_chat_id=TelegramChatId(1),
+      telegram_message_id=None,
+      telegram_reply_to_id=None,
+      content=MessageContent(content),
+      queued_at=datetime.datetime.now(datetime.timezone.utc),
+      processed_at=None,
+      priority=priority)
+
+
+def new_topic_message(
+    content: str,
+    published_at: datetime.datetime | None = None) -> TopicMessage:
+  return TopicMessage(
+      topic_message_id=TopicMessageId(0),
+      topic=TOPIC,
+      source_agent=CODER,
+      local_directory=None,
+      telegram_chat_id=TelegramChatId(1),
+      telegram_reply_to_id=None,
+      content=MessageContent(content),
+      published_at=published_at or datetime.datetime.now(datetime.timezone.utc))
+
+
+if TYPE_CHECKING:
+  _TestCase = unittest.IsolatedAsyncioTestCase
+else:
+  _TestCase = object
+
+
+class MessageBusTests(_TestCase):
+  """Tests of the `MessageBus` semantics, for every implementation.
+
+  Subclasses (which must also extend `unittest.IsolatedAsyncioTestCase`)
+  implement `new_bus` and `make_old`.
+  """
+
+  bus: MessageBus
+
+  def new_bus(self) -> MessageBus:
+    """Returns a new (empty, not yet open) bus."""
+    raise NotImplementedError()
+
+  def make_old(self, message_id: MessageId) -> None:
+    """Makes a message (and its `processed_at`, if set) years old."""
+    raise NotImplementedError()
+
+  async def asyncSetUp(self) -> None:
+    self.bus = self.new_bus()
+    await self.bus.open()
+
+  async def asyncTearDown(self) -> None:
+    await self.bus.close()
+
+  async def test_ids_are_increasing(self) -> None:
+    written = await self.bus.write_new_messages(
+        [new_message(f"message {i}") for i in range(3)])
+    written.append(await self.bus.write_new_message(new_message("last")))
+    self.assertEqual([m.message_id for m in written], [1, 2, 3, 4])
+    read = await self.bus.read_message(MessageId(4))
+    self.assertEqual(read.content, "last")
+    with self.assertRaises(ValueError):
+      await self.bus.read_message(MessageId(5))
+
+  async def test_write_and_read(self) -> None:
+    written = await self.bus.write_new_message(new_message("hello"))
+    read = await self.bus.read_message(written.message_id)
+    self.assertEqual(read.content, "hello")
+    self.assertEqual(read.target_agent, AGENT)
+
+  async def test_write_new_messages(self) -> None:
+    written = await self.bus.write_new_messages(
+        [new_message(f"message {i}") for i in range(3)])
+    self.assertEqual(len({m.message_id for m in written}), 3)
+    for message in written:
+      self.assertEqual((await
+                        self.bus.read_message(message.message_id)).content,
+                       message.content)
+
+  async def test_incoming_messages_wake_up_waiter(self) -> None:
+    waiter = asyncio.create_task(self.bus.wait_for_incoming_messages([AGENT]))
+    await asyncio.sleep(0.1)
+    self.assertFalse(waiter.done())
+    await self.bus.write_new_message(new_message("hello"))
+    # Well below the polling interval.
+    messages = await asyncio.wait_for(waiter, 2)
+    self.assertEqual([m.content for m in messages], ["hello"])
+
+  async def test_processed_messages_are_not_incoming(self) -> None:
+    first = await self.bus.write_new_message(new_message("first"))
+    second = await self.bus.write_new_message(new_message("second"))
+    await self.bus.mark_as_processed(first.message_id)
+    messages = await self.bus.wait_for_incoming_messages([AGENT])
+    self.assertEqual([m.content for m in messages], ["second"])
+    read = await self.bus.read_message(first.message_id)
+    self.assertIsNotNone(read.processed_at)
+    messages = await self.bus.wait_for_incoming_messages([AGENT],
+                                                         after=MessageId(0),
+                                                         limit=1)
+    self.assertEqual([m.message_id for m in messages], [second.message_id])
+
+  async def test_batches_are_atomic(self) -> None:
+    first = await self.bus.write_new_message(new_message("first"))
+    second = await self.bus.write_new_message(new_message("second"))
+    await self.bus.mark_as_processed(second.message_id)
+    with self.assertRaises(ValueError):
+      await self.bus.mark_processed_many([first.message_id, second.message_id])
+    with self.assertRaises(ValueError):
+      await self.bus.set_conversation_ids([
+          (first.message_id, ConversationId(1)),
+          (first.message_id, ConversationId(2))
+      ])
+    read = await self.bus.read_message(first.message_id)
+    self.assertIsNone(read.processed_at)
+    self.assertIsNone(read.conversation_id)
+
+  async def test_incoming_messages_after_cursor(self) -> None:
+    written = [
+        await self.bus.write_new_message(new_message(f"message {i}"))
+        for i in range(5)
+    ]
+    messages = await self.bus.wait_for_incoming_messages(
+        [AGENT], after=written[1].message_id, limit=2)
+    self.assertEqual([m.content for m in messages], ["message 2", "message 3"])
+
+  async def test_outgoing_messages_after_cursor(self) -> None:
+    first = await self.bus.write_new_message(
+        new_message("first", END_USER_AGENT))
+    await self.bus.write_new_message(new_message("second", END_USER_AGENT))
+    messages = await self.bus.wait_for_outgoing_messages(after=first.message_id)
+    self.assertEqual([m.content for m in messages], ["second"])
+
+  async def test_outgoing_messages_and_telegram_ids(self) -> None:
+    reply = await self.bus.write_new_message(
+        new_message("reply", END_USER_AGENT))
+    messages = await self.bus.wait_for_outgoing_messages()
+    self.assertEqual([m.message_id for m in messages], [reply.message_id])
+    await self.bus.set_telegram_message_id(reply.message_id,
+                                           TelegramMessageId(42))
+    with self.assertRaises(ValueError):
+      await self.bus.set_telegram_message_id(reply.message_id,
+                                             TelegramMessageId(43))
+    found = await self.bus.find_message_by_telegram_id(
+        TelegramChatId(1), TelegramMessageId(42))
+    self.assertEqual(found.message_id, reply.message_id)
+    with self.assertRaises(ValueError):
+      await self.bus.find_message_by_telegram_id(
+          TelegramChatId(2), TelegramMessageId(42))
+
+  async def test_claims_are_exclusive(self) -> None:
+    for i in range(10):
+      await self.bus.write_new_message(new_message(f"message {i}"))
+    first = await self.bus.claim_incoming_messages([AGENT],
+                                                   WorkerId("first"),
+                                                   LEASE,
+                                                   limit=6)
+    second = await self.bus.claim_incoming_messages([AGENT], WorkerId("second"),
+                                                    LEASE)
+    self.assertEqual([m.content for m in first],
+                     [f"message {i}" for i in range(6)])
+    self.assertEqual(len(second), 4)
+    self.assertEqual(await self.bus.extend_leases(WorkerId("first"), LEASE), 6)
+    await self.bus.release_claims(WorkerId("second"))
+    third = await self.bus.claim_incoming_messages([AGENT], WorkerId("third"),
+                                                   LEASE)
+    self.assertEqual([m.message_id for m in third],
+                     [m.message_id for m in second])
+
+  async def test_claims_are_sorted_and_limited(self) -> None:
+    for i in range(5):
+      await self.bus.write_new_message(new_message(f"message {i}"))
+    messages = await self.bus.claim_incoming_messages([AGENT],
+                                                      WorkerId("worker"),
+                                                      LEASE,
+                                                      limit=3)
+    self.assertEqual([m.content for m in messages],
+                     ["message 0", "message 1", "message 2"])
+
+  async def test_expired_leases_are_reclaimed(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    short_lease = datetime.timedelta(milliseconds=10)
+    self.assertEqual(
+        len(await self.bus.claim_incoming_messages([AGENT], WorkerId("first"),
+                                                   short_lease)), 1)
+    await asyncio.sleep(0.05)
+    messages = await self.bus.claim_incoming_messages([AGENT],
+                                                      WorkerId("second"), LEASE)
+    self.assertEqual([m.content for m in messages], ["hello"])
+
+  async def test_extended_leases_are_not_reclaimed(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    await self.bus.claim_incoming_messages([AGENT], WorkerId("first"),
+                                           datetime.timedelta(milliseconds=10))
+    self.assertEqual(await self.bus.extend_leases(WorkerId("first"), LEASE), 1)
+    await asyncio.sleep(0.05)
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT], WorkerId("second"),
+                                               LEASE), [])
+
+  async def test_processed_messages_are_not_reclaimed(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    [message] = await self.bus.claim_incoming_messages(
+        [AGENT], WorkerId("first"), datetime.timedelta(milliseconds=10))
+    await self.bus.mark_as_processed(message.message_id)
+    await asyncio.sleep(0.05)
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT], WorkerId("second"),
+                                               LEASE), [])
+
+  async def test_released_claims_wake_up_waiters(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    await self.bus.claim_incoming_messages([AGENT], WorkerId("first"), LEASE)
+    waiter = asyncio.create_task(
+        self.bus.wait_for_claimed_messages([AGENT], WorkerId("second"), LEASE))
+    await asyncio.sleep(0.1)
+    self.assertFalse(waiter.done())
+    await self.bus.release_claims(WorkerId("first"))
+    messages = await asyncio.wait_for(waiter, 2)
+    self.assertEqual([m.content for m in messages], ["hello"])
+
+  async def test_cursors(self) -> None:
+    self.assertEqual(await self.bus.read_cursor("consumer"), 0)
+    await self.bus.save_cursor("consumer", MessageId(5))
+    self.assertEqual(await self.bus.read_cursor("consumer"), 5)
+    await self.bus.save_cursor("consumer", MessageId(3))
+    self.assertEqual(await self.bus.read_cursor("consumer"), 5)
+    self.assertEqual(await self.bus.read_cursor("other"), 0)
+
+  async def test_archive_messages(self) -> None:
+    processed, pending, sent, unsent, recent = await self.bus.write_new_messages(
+        [
+            new_message("processed"),
+            new_message("pending"),
+            new_message("sent", END_USER_AGENT),
+            new_message("unsent", END_USER_AGENT),
+            new_message("recent"),
+        ])
+    await self.bus.mark_processed_many(
+        [processed.message_id, recent.message_id])
+    await self.bus.set_telegram_message_id(sent.message_id,
+                                           TelegramMessageId(77))
+    await self.bus.set_conversation_id(sent.message_id, ConversationId(5))
+    for message in [processed, pending, sent, unsent]:
+      self.make_old(message.message_id)
+
+    self.assertEqual(
+        await self.bus.archive_messages(datetime.timedelta(days=1)), 2)
+
+    stats = await self.bus.stats()
+    self.assertEqual(stats.rows, 3)
+    self.assertEqual(stats.archived_rows, 2)
+    self.assertEqual(stats.pending_rows, 2)
+
+    self.assertEqual((await
+                      self.bus.read_message(processed.message_id)).content,
+                     "processed")
+    reply_to = await self.bus.find_message_by_telegram_id(
+        TelegramChatId(1), TelegramMessageId(77))
+    self.assertEqual(reply_to.message_id, sent.message_id)
+    self.assertEqual(reply_to.conversation_id, 5)
+    self.assertEqual(reply_to.content, "sent")
+
+    self.assertEqual(
+        await self.bus.archive_messages(datetime.timedelta(days=1)), 0)
+
+  async def test_archive_messages_in_batches(self) -> None:
+    written = await self.bus.write_new_messages(
+        [new_message(f"message {i}") for i in range(5)])
+    await self.bus.mark_processed_many([m.message_id for m in written])
+    for message in written:
+      self.make_old(message.message_id)
+    self.assertEqual(
+        await
+        self.bus.archive_messages(datetime.timedelta(days=1), batch_size=2), 5)
+
+  async def test_sessions(self) -> None:
+    request, other = await self.bus.write_new_messages(
+        [new_message("request"), new_message("other")])
+    session = await self.bus.start_session(request.message_id)
+    self.assertEqual((session.agent, session.telegram_chat_id),
+                     (AGENT, TelegramChatId(1)))
+    self.assertEqual(await self.bus.read_session(session.conversation_id),
+                     session)
+    second = await self.bus.start_session(other.message_id)
+    self.assertGreater(second.conversation_id, session.conversation_id)
+    with self.assertRaises(ValueError):
+      await self.bus.start_session(request.message_id)
+    with self.assertRaises(ValueError):
+      await self.bus.start_session(MessageId(100))
+    with self.assertRaises(ValueError):
+      await self.bus.read_session(ConversationId(100))
+
+    reply = await self.bus.write_new_message(
+        dataclasses.replace(
+            new_message("reply", END_USER_AGENT),
+            conversation_id=session.conversation_id))
+    await self.bus.mark_processed_many([request.message_id])
+    self.make_old(request.message_id)
+    await self.bus.archive_messages(datetime.timedelta(days=1))
+    conversation = await self.bus.read_conversation(session.conversation_id)
+    self.assertEqual([m.content for m in conversation], ["request", "reply"])
+    self.assertEqual(conversation[1].message_id, reply.message_id)
+
+  async def test_failed_messages_are_retried(self) -> None:
+    written = await self.bus.write_new_message(new_message("hello"))
+    await self.bus.claim_incoming_messages([AGENT], WorkerId("first"), LEASE)
+    await self.bus.mark_as_processed(written.message_id)
+    await self.bus.set_conversation_id(written.message_id, ConversationId(1))
+    policy = RetryPolicy(
+        max_attempts=3,
+        backoff=datetime.timedelta(milliseconds=100),
+        max_backoff=datetime.timedelta(seconds=1))
+    self.assertTrue(await self.bus.fail_message(written.message_id, "boom",
+                                                policy))
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT], WorkerId("second"),
+                                               LEASE), [])
+    await asyncio.sleep(0.15)
+    [message] = await self.bus.claim_incoming_messages([AGENT],
+                                                       WorkerId("second"),
+                                                       LEASE)
+    self.assertEqual(message.message_id, written.message_id)
+    self.assertIsNone(message.processed_at)
+    self.assertIsNone(message.conversation_id)
+    self.assertEqual(await self.bus.list_dead_letters(), [])
+
+  async def test_dead_letters(self) -> None:
+    written = await self.bus.write_new_message(new_message("hello"))
+    await self.bus.mark_as_processed(written.message_id)
+    policy = RetryPolicy(
+        max_attempts=1,
+        backoff=datetime.timedelta(seconds=1),
+        max_backoff=datetime.timedelta(seconds=1))
+    self.assertFalse(await self.bus.fail_message(written.message_id, "trace",
+                                                 policy))
+    [dead_letter] = await self.bus.list_dead_letters()
+    self.assertEqual(dead_letter.message.message_id, written.message_id)
+    self.assertEqual((dead_letter.attempts, dead_letter.error), (1, "trace"))
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT], WorkerId("worker"),
+                                               LEASE), [])
+
+    self.make_old(written.message_id)
+    self.assertEqual(
+        await self.bus.archive_messages(datetime.timedelta(days=1)), 0)
+
+    with self.assertRaises(ValueError):
+      await self.bus.requeue_dead_letters([MessageId(1234)])
+    self.assertEqual(await self.bus.requeue_dead_letters(),
+                     [written.message_id])
+    self.assertEqual(await self.bus.list_dead_letters(), [])
+    [message] = await self.bus.claim_incoming_messages([AGENT],
+                                                       WorkerId("worker"),
+                                                       LEASE)
+    self.assertEqual(message.message_id, written.message_id)
+
+  async def test_fail_unknown_message(self) -> None:
+    with self.assertRaises(ValueError):
+      await self.bus.fail_message(
+          MessageId(1234), "boom",
+          RetryPolicy(1, datetime.timedelta(seconds=1),
+                      datetime.timedelta(seconds=1)))
+
+  async def test_closed_bus_raises(self) -> None:
+    await self.bus.close()
+    with self.assertRaises(ValueError):
+      await self.bus.write_new_message(new_message("hello"))
+
+  async def test_topics(self) -> None:
+    await self.bus.publish(new_topic_message("before subscribing"))
+    await self.bus.set_subscriptions(AGENT, frozenset([TOPIC]))
+    await self.bus.set_subscriptions(REVIEWER, frozenset([TOPIC]))
+    published = await self.bus.publish(new_topic_message("deploy"))
+    self.assertEqual(published.topic_message_id, 2)
+    self.assertEqual((await self.bus.stats()).topic_rows, 2)
+
+    for agent in [AGENT, REVIEWER]:
+      [message] = await self.bus.claim_incoming_messages([agent], WorkerId("w"),
+                                                         LEASE)
+      self.assertEqual(
+          (message.source_agent, message.target_agent, message.content),
+          (CODER, agent, "deploy"))
+      self.assertEqual(message.priority, MessagePriority.LOW)
+      await self.bus.mark_as_processed(message.message_id)
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT, REVIEWER], WorkerId("w"),
+                                               LEASE), [])
+
+    # Subscribing again keeps the position; unsubscribing stops delivery.
+    await self.bus.set_subscriptions(AGENT, frozenset([TOPIC]))
+    await self.bus.set_subscriptions(REVIEWER, frozenset())
+    await self.bus.publish(new_topic_message("rollback"))
+    messages = await self.bus.claim_incoming_messages([AGENT, REVIEWER],
+                                                      WorkerId("w"), LEASE)
+    self.assertEqual([(m.target_agent, m.content) for m in messages],
+                     [(AGENT, "rollback")])
+
+  async def test_topic_messages_wake_up_claimers(self) -> None:
+    await self.bus.set_subscriptions(AGENT, frozenset([TOPIC]))
+    claim = asyncio.create_task(
+        self.bus.wait_for_claimed_messages([AGENT], WorkerId("w"), LEASE))
+    await asyncio.sleep(0.05)
+    self.assertFalse(claim.done())
+    await self.bus.publish(new_topic_message("deploy"))
+    [message] = await asyncio.wait_for(claim, 5)
+    self.assertEqual(message.content, "deploy")
+
+  async def test_telegram_updates_are_idempotent(self) -> None:
+    written = await self.bus.write_telegram_updates([
+        (TelegramUpdateId(1), new_message("a")),
+        (TelegramUpdateId(2), new_message("b")),
+        (TelegramUpdateId(1), new_message("a again")),
+    ])
+    self.assertEqual([m.content for m in written], ["a", "b"])
+    written = await self.bus.write_telegram_updates([
+        (TelegramUpdateId(2), new_message("b")),
+        (TelegramUpdateId(3), new_message("c")),
+    ])
+    self.assertEqual([m.content for m in written], ["c"])
+    self.assertEqual(
+        (await self.bus.read_message(written[0].message_id)).content, "c")
+
+  async def test_claims_follow_priority(self) -> None:
+    for priority in MessagePriority:
+      await self.bus.write_new_message(
+          new_message(priority.name, priority=priority))
+    first = await self.bus.claim_incoming_messages([AGENT],
+                                                   WorkerId("w"),
+                                                   LEASE,
+                                                   limit=2)
+    self.assertEqual([m.content for m in first], ["HIGH", "MEDIUM"])
+    second = await self.bus.claim_incoming_messages([AGENT], WorkerId("w"),
+                                                    LEASE)
+    self.assertEqual([m.content for m in second], ["LOW"])
+    stats = await self.bus.stats()
+    self.assertEqual(
+        list(stats.average_claim_latency),
+        [MessagePriority.HIGH, MessagePriority.MEDIUM, MessagePriority.LOW])
+    self.assertEqual(list(stats.max_claim_latency), list(MessagePriority))
+
+  async def test_waiting_messages_are_promoted(self) -> None:
+    await self.bus.write_new_message(
+        new_message("background", priority=MessagePriority.LOW))
+    await asyncio.sleep(0.05)
+    await self.bus.write_new_message(
+        new_message("user", priority=MessagePriority.HIGH))
+    messages = await self.bus.claim_incoming_messages(
+        [AGENT],
+        WorkerId("w"),
+        LEASE,
+        aging=datetime.timedelta(milliseconds=20))
+    self.assertEqual([m.content for m in messages], ["background", "user"])
+
+  async def test_archive_topic_messages(self) -> None:
+    await self.bus.set_subscriptions(AGENT, frozenset([TOPIC]))
+    old = datetime.datetime(2000, 1, 1)
+    await self.bus.publish(new_topic_message("delivered", old))
+    await self.bus.claim_incoming_messages([AGENT], WorkerId("w"), LEASE)
+    await self.bus.publish(new_topic_message("pending", old))
+    await self.bus.publish(new_topic_message("recent"))
+    await self.bus.archive_messages(datetime.timedelta(days=1))
+    self.assertEqual((await self.bus.stats()).topic_rows, 2)
@@ -9,6 +9,7 @@ from typing import Any, NamedTuple
 from agent_loop_options import AgentLoopOptions, BaseAgentLoop, BaseAgentLoopFactory
 from agent_command import VariableName, VariableValueInt, VariableValueStr, VariableValue, VariableMap
 from conversation_state import ConversationState
+from message import Message
 
 
 class CacheKey(NamedTuple):
@@ -109,6 +110,9 @@ class CachingDelegatingAgentLoop(BaseAgentLoop):
     self._delegate = delegate
     self._options = options
 
+  def set_next_message(self, message: Message) -> None:
+    self._delegate.set_next_message(message)
+
   async def run(self) -> VariableMap:
     key = CacheKey(self._workflow, self._options.conversation.name())
     cache_output = await self._cache.load(key)
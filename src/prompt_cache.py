@@ -0,0 +1,154 @@
+import dataclasses
+import datetime
+import logging
+import os
+import pathlib
+import time
+from typing import Awaitable, Callable, NamedTuple
+
+# Sources that take longer than this to load are logged as warnings.
+_SLOW_SOURCE = datetime.timedelta(seconds=1)
+
+
+class PromptSourcePolicy(NamedTuple):
+  """When the output of an executable prompt source can be reused.
+
+  Executable sources are only cached if their policy sets `ttl` or
+  `depends_on`; by default, they run every time (their output may depend on
+  anything, e.g. the state of a git repository).
+  """
+  # Reuse the output for this long.
+  ttl: datetime.timedelta | None = None
+  # Reuse the output while the modification times of these paths don't change
+  # (for a directory, that only happens when entries are added or removed).
+  depends_on: tuple[pathlib.Path, ...] = ()
+
+  def caches(self) -> bool:
+    return self.ttl is not None or bool(self.depends_on)
+
+
+class PromptSourceStats(NamedTuple):
+  source: pathlib.Path
+  # Loads served from the cache.
+  hits: int
+  # Loads that read (or executed) the source.
+  misses: int
+  # Total time spent in misses.
+  load_time: datetime.timedelta
+  # Time of the last miss.
+  last_load_time: datetime.timedelta
+
+
+# Modification time (in nanoseconds) and size of a path; None if it is missing.
+_Stamp = tuple[int, int] | None
+
+
+def _stamp(path: pathlib.Path) -> _Stamp:
+  try:
+    stat = path.stat()
+  except FileNotFoundError:
+    return None
+  return (stat.st_mtime_ns, stat.st_size)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Entry:
+  content: str
+  # Stamps of the source and of `PromptSourcePolicy.depends_on`, in order.
+  stamps: tuple[_Stamp, ...]
+  # `time.monotonic()`.
+  loaded_at: float
+
+
+class PromptCache:
+  """Caches the contents of prompt sources (see `AgentIdentityConfig.prompt`).
+
+  Files are reused while their modification time (and size) don't change.
+  Executable sources follow their `PromptSourcePolicy` (and are also reloaded
+  when the executable changes). Outputs of executable sources are cached per
+  `cwd` (the directory they're given).
+
+  `invalidate` drops all entries, including those of `PromptCache` instances
+  in other processes that share the same `invalidation_path`.
+  """
+
+  def __init__(self, invalidation_path: pathlib.Path | None = None) -> None:
+    # Its modification time is updated by `invalidate`.
+    self._invalidation_path = invalidation_path
+    self._invalidation_stamp = self._read_invalidation_stamp()
+    self._entries: dict[tuple[pathlib.Path, pathlib.Path | None], _Entry] = {}
+    self._stats: dict[pathlib.Path, PromptSourceStats] = {}
+
+  def _read_invalidation_stamp(self) -> _Stamp:
+    if self._invalidation_path is None:
+      return None
+    return _stamp(self._invalidation_path)
+
+  async def load(self, source: pathlib.Path, executable: bool,
+                 policy: PromptSourcePolicy, cwd: pathlib.Path,
+                 load: Callable[[], Awaitable[str]]) -> str:
+    """Returns the contents of `source`, calling `load` if it isn't cached."""
+    invalidation_stamp = self._read_invalidation_stamp()
+    if invalidation_stamp != self._invalidation_stamp:
+      logging.info("Prompt cache invalidated.")
+      self._invalidation_stamp = invalidation_stamp
+      self._entries.clear()
+
+    if executable and not policy.caches():
+      return await self._load(source, load)
+    key = (source, cwd if executable else None)
+    stamps = tuple(
+        _stamp(path)
+        for path in ([source, *policy.depends_on] if executable else [source]))
+    entry = self._entries.get(key)
+    if (entry is not None and entry.stamps == stamps and
+        (not executable or policy.ttl is None or
+         time.monotonic() - entry.loaded_at < policy.ttl.total_seconds())):
+      self._count_hit(source)
+      return entry.content
+    content = await self._load(source, load)
+    self._entries[key] = _Entry(content, stamps, time.monotonic())
+    return content
+
+  async def _load(self, source: pathlib.Path,
+                  load: Callable[[], Awaitable[str]]) -> str:
+    start = time.monotonic()
+    content = await load()
+    elapsed = datetime.timedelta(seconds=time.monotonic() - start)
+    stats = self._get_stats(source)
+    self._stats[source] = stats._replace(
+        misses=stats.misses + 1,
+        load_time=stats.load_time + elapsed,
+        last_load_time=elapsed)
+    if elapsed > _SLOW_SOURCE:
+      logging.warning(f"Slow prompt source: {source} ({elapsed})")
+    else:
+      logging.info(f"Loaded prompt source: {source} ({elapsed})")
+    return content
+
+  def _get_stats(self, source: pathlib.Path) -> PromptSourceStats:
+    return self._stats.get(
+        source,
+        PromptSourceStats(source, 0, 0, datetime.timedelta(),
+                          datetime.timedelta()))
+
+  def _count_hit(self, source: pathlib.Path) -> None:
+    stats = self._get_stats(source)
+    self._stats[source] = stats._replace(hits=stats.hits + 1)
+
+  def invalidate(self) -> None:
+    """Drops all entries (here and in caches sharing `invalidation_path`)."""
+    self._entries.clear()
+    if self._invalidation_path is not None:
+      self._invalidation_path.touch()
+      # Bump the modification time even if the last `invalidate` happened
+      # within the file system's timestamp granularity.
+      stat = self._invalidation_path.stat()
+      os.utime(
+          self._invalidation_path,
+          ns=(stat.st_atime_ns, max(stat.st_mtime_ns, time.time_ns()) + 1))
+      self._invalidation_stamp = self._read_invalidation_stamp()
+
+  def stats(self) -> list[PromptSourceStats]:
+    """Returns the statistics of all sources, slowest (in total) first."""
+    return sorted(self._stats.values(), key=lambda s: s.load_time, reverse=True)
@@ -6,15 +6,19 @@ from validation import ValidationManager
 from file_access_policy import FileAccessPolicy
 from select_python import FindPythonDefinition
 from selection_manager import Selection
+from trigram_index import TrigramIndex
 
 
 class ReplacePythonCommand(AgentCommand):
   """Command to replace a Python code element based on an identifier."""
 
-  def __init__(self, file_access_policy: FileAccessPolicy,
-               validation_manager: ValidationManager | None) -> None:
+  def __init__(self,
+               file_access_policy: FileAccessPolicy,
+               validation_manager: ValidationManager | None,
+               trigram_index: TrigramIndex | None = None) -> None:
     self.file_access_policy = file_access_policy
     self.validation_manager = validation_manager
+    self._trigram_index = trigram_index
 
   def Name(self) -> str:
     return self.Syntax().name
@@ -85,6 +89,8 @@ class ReplacePythonCommand(AgentCommand):
 
     if self.validation_manager:
       self.validation_manager.RegisterChange()
+    if self._trigram_index:
+      await self._trigram_index.update([selections[0].path])
 
     return CommandOutput(
         command_name=self.Name(),
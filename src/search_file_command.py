@@ -1,15 +1,17 @@
 # DO NOT EDIT. This file is automatically generated by Duende.
-import aiofiles
 import asyncio
 import logging
 import pathlib
 import os
+import re
 from typing import AsyncIterable, Iterable, Any
 
 from agent_command import AgentCommand, CommandInput, CommandOutput, CommandSyntax, Argument, ArgumentContentType, PATH_VARIABLE_NAME, REASON_VARIABLE, VariableName, VariableMap, VariableValue
 from file_access_policy import FileAccessPolicy
+from file_search import SearchPattern, search_files
 from list_files import list_all_files
 from pathbox import PathBox
+from trigram_index import TrigramIndex
 
 
 def _collect_errors(errors: list[str]) -> str:
@@ -30,9 +32,14 @@ def _collect_errors(errors: list[str]) -> str:
 
 class SearchFileCommand(AgentCommand):
 
-  def __init__(self, cwd: PathBox, file_access_policy: FileAccessPolicy):
+  def __init__(self,
+               cwd: PathBox,
+               file_access_policy: FileAccessPolicy,
+               trigram_index: TrigramIndex | None = None):
     self._cwd = cwd
     self.file_access_policy = file_access_policy
+    # If set, files that can't match are skipped (see `TrigramIndex`).
+    self._trigram_index = trigram_index
 
   def Name(self) -> str:
     return self.Syntax().name
@@ -58,6 +65,11 @@ class SearchFileCommand(AgentCommand):
                 name=VariableName("case_sensitive"),
                 arg_type=ArgumentContentType.BOOL,
                 description="If true, the match must be case sensitive (false by default).",
+                required=False),
+            Argument(
+                name=VariableName("regex"),
+                arg_type=ArgumentContentType.BOOL,
+                description="If true, `content` is a (Python) regular expression matched against each line (false by default).",
                 required=False)
         ])
 
@@ -75,21 +87,14 @@ class SearchFileCommand(AgentCommand):
 
       return _single_file_iterator()
 
-  def _is_match(self, search_term: str, case_sensitive: bool,
-                line: str) -> bool:
-    # ✨ is match
-    if case_sensitive:
-      return search_term in line
-    else:
-      return search_term.lower() in line.lower()
-    # ✨
-
   async def run(self, inputs: VariableMap) -> CommandOutput:
     search_term: str = str(inputs[VariableName("content")]).strip()
     input_path: VariableValue | None = inputs.get(VariableName("path"))
     case_sensitive = inputs.get(VariableName("case_sensitive"), False)
+    regex = inputs.get(VariableName("regex"), False)
     assert isinstance(input_path, pathlib.Path | None)
     assert isinstance(case_sensitive, bool)
+    assert isinstance(regex, bool)
 
     if len(search_term.splitlines()) > 1:
       # ✨ return error pattern crosses lines
@@ -108,37 +113,45 @@ class SearchFileCommand(AgentCommand):
     matches = []
     errors: list[str] = []
 
-    global_file_count = 0
     global_line_count = 0
     global_match_count = 0
 
-    paths_to_search = self._get_paths_to_search(input_path)
+    paths_to_search = [
+        path async for path in self._get_paths_to_search(input_path)
+    ]
+    global_file_count = len(paths_to_search)
 
     files_data: list[str] = []
 
     match_limit = 100
-    async for file_path in paths_to_search:
-      try:
-        global_file_count += 1
-        async with aiofiles.open(file_path, mode='r', encoding='utf-8') as file:
-          lines = await file.readlines()
-          file_line_count: int = len(lines)
-          global_line_count += file_line_count
-
-        file_match_count = 0
-        for i, line in enumerate(lines):
-          if self._is_match(search_term, case_sensitive, line):
-            file_match_count += 1
-            global_match_count += 1
-            if global_match_count < match_limit:
-              matches.append(f"{file_path}:{i + 1}: {line.strip()}")
-
-        if file_match_count > 0:
-          files_data.append(
-              f"{file_path}, {file_match_count}, {file_line_count}")
-
-      except Exception as e:
-        errors.append(f"{file_path}: {str(e)}")
+    pattern = SearchPattern(
+        search_term, case_sensitive=case_sensitive, regex=regex)
+    try:
+      if self._trigram_index is not None:
+        paths_to_search = await self._trigram_index.candidates(
+            paths_to_search, pattern)
+      results = await search_files(
+          paths_to_search, pattern, max_lines=match_limit)
+    except re.error as e:
+      return CommandOutput(
+          output="",
+          errors=f"Invalid regular expression: {e}",
+          summary="Search failed: invalid regular expression.",
+          command_name=self.Syntax().name)
+
+    for result in results:
+      if result.error is not None:
+        errors.append(f"{result.path}: {result.error}")
+        continue
+      global_line_count += result.line_count
+      for line_number, line in result.lines:
+        if global_match_count + 1 < match_limit:
+          matches.append(f"{result.path}:{line_number}: {line}")
+        global_match_count += 1
+      global_match_count += result.match_count - len(result.lines)
+      if result.match_count > 0:
+        files_data.append(
+            f"{result.path}, {result.match_count}, {result.line_count}")
 
     output_lines: list[str] = [
         f"Files searched: {global_file_count}, Lines scanned: {global_line_count}, Matches found: {global_match_count}"
@@ -164,4 +177,4 @@ class SearchFileCommand(AgentCommand):
         output=output_str,
         errors=_collect_errors(errors),
         summary=summary,
-        command_name=self.Syntax().name)
\ No newline at end of file
+        command_name=self.Syntax().name)
@@ -8,6 +8,7 @@ from agent_command import AgentCommand, CommandInput, CommandOutput, CommandSynt
 from validation import ValidationManager
 from file_access_policy import FileAccessPolicy
 from selection_manager import Selection, SelectionManager, StartPatternNotFound, EndPatternNotFound
+from trigram_index import TrigramIndex
 
 
 class SelectCommand(AgentCommand):
@@ -94,10 +95,13 @@ class SelectCommand(AgentCommand):
 
 class SelectOverwriteCommand(AgentCommand):
 
-  def __init__(self, selection_manager: SelectionManager,
-               validation_manager: ValidationManager | None):
+  def __init__(self,
+               selection_manager: SelectionManager,
+               validation_manager: ValidationManager | None,
+               trigram_index: TrigramIndex | None = None):
     self.selection_manager = selection_manager
     self.validation_manager = validation_manager
+    self._trigram_index = trigram_index
 
   def Name(self) -> str:
     return self.Syntax().name
@@ -136,6 +140,8 @@ class SelectOverwriteCommand(AgentCommand):
       await current_selection.Overwrite(content)
       if self.validation_manager:
         self.validation_manager.RegisterChange()
+      if self._trigram_index:
+        await self._trigram_index.update([current_selection.path])
       line_count = len(content.splitlines())
       return CommandOutput(
           output="The selection was successfully overwritten.",
@@ -1,5 +1,6 @@
 import {ConversationData, shownConversationId} from './conversation.js';
 import {renderConversationsTable} from './conversation_table.js';
+import {setUpSearch} from './search.js';
 
 let currentSessionKey = null;
 const conversationsById = {};
@@ -24,25 +25,32 @@ function getMaxConversationId() {
 }
 
 function createOrUpdateConversation(
-    id, name, state, stateEmoji, lastStateChangeTime) {
+    socket, id, name, state, stateEmoji, lastStateChangeTime) {
   if (conversationsById[id])
     conversationsById[id].updateData(
         name, state, stateEmoji, lastStateChangeTime);
   else
     conversationsById[id] = new ConversationData(
-        id, name, state, stateEmoji, lastStateChangeTime, scrollToBottom);
-  return conversationsById[id].updateView();
+        id, name, state, stateEmoji, lastStateChangeTime, scrollToBottom,
+        (conversation, start, count) =>
+            requestMessages(socket, conversation, start, count));
+  return conversationsById[id];
 }
 
 function scrollToBottom() {
   if (shownConversationId[0] !== null &&
       getShownConversation().div.is(':visible'))
-    window.scrollTo(0, document.body.scrollHeight);
+    getShownConversation().scrollToEnd();
 }
 
-function requestMessages(socket, conversation) {
+function renderShownConversation() {
+  if (shownConversationId[0] !== null) getShownConversation().render();
+}
+
+function requestMessages(socket, conversation, start, count) {
   const data = {
-    message_count: conversation.countMessages(),
+    message_count: start,
+    limit: count,
     conversation_id: conversation.id
   };
   console.log(data);
@@ -83,16 +91,6 @@ function maybeAutoConfirm(socket) {
   }
 }
 
-function maybeRequestMessages(socket, serverMessages, conversation) {
-  if (serverMessages > conversation.countMessages()) {
-    console.log(
-        `Client has ${conversation.countMessages()} messages for ` +
-        `${conversation.id}, server has ${serverMessages}. ` +
-        `Requesting update.`);
-    requestMessages(socket, conversation);
-  }
-}
-
 function handleUpdate(socket, data) {
   console.log('Starting update');
   console.log(data);
@@ -108,23 +106,17 @@ function handleUpdate(socket, data) {
   }
 
   const conversation = createOrUpdateConversation(
-      data.conversation_id, data.conversation_name, data.conversation_state,
-      data.conversation_state_emoji,
+      socket, data.conversation_id, data.conversation_name,
+      data.conversation_state, data.conversation_state_emoji,
       new Date(data.last_state_change_time).getTime());
 
-  data.conversation
-      .slice(
-          Math.max(0, conversation.countMessages() - data.first_message_index))
-      .forEach(message => {
-        conversation.addMessage(message);
-      });
-
-  conversation.updateView();
+  conversation.addMessages(data.first_message_index, data.conversation)
+      .setMessageCount(data.message_count)
+      .updateView();
   if (conversation.isShown()) {
     updatePageTitle();
   }
   maybeAutoConfirm(socket);
-  maybeRequestMessages(socket, data.message_count, conversation);
   renderConversationsTable(conversationsById);
 }
 
@@ -139,11 +131,11 @@ function emitListConversations(socket) {
 function handleListConversations(socket, response_data) {
   console.log('Received conversation list:', response_data);
   response_data.conversations.forEach(data => {
-    const conversation = createOrUpdateConversation(
-        data.id, data.name, data.state, data.state_emoji,
-        new Date(data.last_state_change_time).getTime());
-    conversation.updateView();
-    maybeRequestMessages(socket, data.message_count, conversation);
+    createOrUpdateConversation(
+        socket, data.id, data.name, data.state, data.state_emoji,
+        new Date(data.last_state_change_time).getTime())
+        .setMessageCount(data.message_count)
+        .updateView();
   });
 
   if (Object.keys(conversationsById).length === 0 ||
@@ -187,6 +179,16 @@ function showConversationsTableView() {
   renderConversationsTable(conversationsById);
 }
 
+function showSearchHit(hit) {
+  const conversation = conversationsById[hit.conversation_id];
+  if (!conversation) return;
+  $('#content_panes').children().hide();
+  $('#conversation_view').show();
+  conversation.show();
+  updatePageTitle();
+  conversation.scrollToMessage(hit.message_index);
+}
+
 document.addEventListener('DOMContentLoaded', function() {
   const socket = io();
   socket.on('update', (data) => handleUpdate(socket, data));
@@ -206,6 +208,16 @@ document.addEventListener('DOMContentLoaded', function() {
 
   $(confirmationInput).on('input', scrollToBottom);
 
+  let renderScheduled = false;
+  $(window).on('scroll resize', () => {
+    if (renderScheduled) return;
+    renderScheduled = true;
+    window.requestAnimationFrame(() => {
+      renderScheduled = false;
+      renderShownConversation();
+    });
+  });
+
   $(confirmationInput).on('keydown', function(event) {
     if (event.key === 'Enter') {
       if (event.shiftKey) {
@@ -278,6 +290,8 @@ document.addEventListener('DOMContentLoaded', function() {
     renderConversationsTable(conversationsById);
   });
 
+  setUpSearch(socket, showSearchHit);
+
   console.log('Requesting conversation list.');
   emitListConversations(socket);
 });
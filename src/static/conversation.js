@@ -2,9 +2,113 @@ import {createTimestampView} from './timestamps.js';
 
 export let shownConversationId = [null];
 
+// Messages are requested from the server in aligned blocks of this size.
+const MESSAGES_BLOCK_SIZE = 50;
+// Messages this far (in pixels) above or below the viewport are also mounted.
+const OVERSCAN_PX = 1000;
+// Height assumed for messages that have never been mounted.
+const DEFAULT_MESSAGE_HEIGHT_PX = 150;
+// Contents with more lines are collapsed and only rendered once expanded.
+const MAX_EXPANDED_LINES = 20;
+
+// Returns a jQuery object containing the elements for collapsible content
+function createCollapsibleContent(content, summaryContent) {
+  if (content === undefined || content === null || content === '') return null;
+
+  const text = String(content);
+  const lines = text.split('\n');
+  const createContentPre = () =>
+      $('<pre>').addClass('field-content-pre').text(text);
+
+  if (lines.length <= MAX_EXPANDED_LINES) return createContentPre();
+
+  const $details = $('<details>').addClass('collapsible-content-container');
+
+  const summaryText = summaryContent || lines[0] + '...';
+  const $summary = $('<summary>').text(`${lines.length} lines: ${summaryText}`);
+  $details.append($summary);
+  $details.one('toggle', () => $details.append(createContentPre()));
+  return $details;
+}
+
+function renderPropertiesTable(propertiesObject, orderedKeys, title) {
+  const $block =
+      $('<div>').addClass(title.toLowerCase().replace(/ /g, '-') + '-block');
+  $block.append($('<h3>').html(title));
+  const $table = $('<table>').addClass('properties-table');
+
+  orderedKeys.forEach(key => {
+    const value = propertiesObject[key];
+    const displayLabel =
+        key.replace(/_/g, ' ')
+            .split(' ')
+            .map(word => word.charAt(0).toUpperCase() + word.slice(1))
+            .join(' ');
+
+    const $collapsibleContent = createCollapsibleContent(value);
+    if ($collapsibleContent) {
+      const $row = $('<tr>');
+      $row.append(
+          $('<td>').addClass('property-label').text(`${displayLabel}:`));
+      $row.append(
+          $('<td>').addClass('property-value').append($collapsibleContent));
+      $table.append($row);
+    }
+  });
+  $block.append($table);
+  return $block;
+}
+
+function createMessageElement(message, index) {
+  const $messageDiv =
+      $('<div>').addClass('message').attr('data-message-index', index);
+  const $role = $('<p>').addClass('role').text(`${message.role}:`);
+
+  const creationTimestamp = new Date(message.creation_time).getTime();
+  const $timestampView = createTimestampView(creationTimestamp);
+
+  const $messageHeader = $('<div>').addClass('message-header');
+  $messageHeader.append($role, $timestampView);
+
+  const $contentContainer = $('<div>').addClass('content-container');
+  (message.content_sections || []).forEach(section => {
+    const $sectionDiv = $('<div>').addClass('messageSection');
+
+    if (section.command) {
+      const commandKeys = Object.keys(section.command)
+                              .filter(key => key !== 'command_name')
+                              .sort();
+      const orderedCommandKeys = ['command_name', ...commandKeys];
+      const $commandBlock = renderPropertiesTable(
+          section.command, orderedCommandKeys, '&#129302; Command');
+      $sectionDiv.append($commandBlock);
+    } else if (section.command_output) {
+      const outputKeys =
+          ['command_name', 'output', 'errors', 'summary', 'task_done'];
+      const $outputBlock = renderPropertiesTable(
+          section.command_output, outputKeys,
+          '&#9881;&#65039; Command Output');
+      $sectionDiv.append($outputBlock);
+    } else if (section.content && section.content.length > 0) {
+      const $contentElement =
+          createCollapsibleContent(section.content, section.summary);
+      if ($contentElement) {
+        $sectionDiv.append($contentElement);
+      }
+    }
+
+    $contentContainer.append($sectionDiv);
+  });
+
+  return $messageDiv.append($messageHeader, $contentContainer);
+}
+
 export class ConversationData {
+  // `requestMessages(conversation, start, count)` must (asynchronously) lead
+  // to a call to `addMessages` with the messages requested.
   constructor(
-      id, name, state, stateEmoji, lastStateChangeTime, scrollToBottom) {
+      id, name, state, stateEmoji, lastStateChangeTime, scrollToBottom,
+      requestMessages) {
     this.id = id;
     this.name = name;
     this.state = state;
@@ -15,13 +119,32 @@ export class ConversationData {
     // to make sure we don't send multiple confirmations for the same request).
     this.lastConfirmationSentTime = null;
     this.scrollToBottom = scrollToBottom;
+    this.requestMessages = requestMessages;
+
+    // Number of messages in the server.
+    this.messageCount = 0;
+    // Sparse: only messages that have been received from the server.
     this.messages = [];
+    // Sparse: measured heights of messages that have been mounted.
+    this._heights = [];
+    this._measuredHeightsSum = 0;
+    this._measuredHeightsCount = 0;
+    // Index of message to jQuery element, for messages currently mounted.
+    this._mounted = new Map();
+    // Blocks (see MESSAGES_BLOCK_SIZE) requested but not yet received.
+    this._requestedBlocks = new Set();
+    this._highlightedMessageIndex = null;
 
     console.log(`Creating container for conversation ${this.id}`);
     this.div = $('<div>')
                    .addClass('conversation')
                    .attr('id', `conversation-${id}`)
                    .hide();
+    // Only a window of messages is mounted; the spacers stand in for the rest.
+    this.$topSpacer = $('<div>').addClass('conversation-spacer');
+    this.$messagesDiv = $('<div>');
+    this.$bottomSpacer = $('<div>').addClass('conversation-spacer');
+    this.div.append(this.$topSpacer, this.$messagesDiv, this.$bottomSpacer);
     $('#conversation_container').append(this.div);
   }
 
@@ -67,110 +190,161 @@ export class ConversationData {
   }
 
   countMessages() {
-    return this.messages.length;
-  }
-
-  addMessage(message) {
-    this.messages.push(message);
-    const $messageDiv = $('<div>').addClass('message');
-    const $role = $('<p>').addClass('role').text(`${message.role}:`);
-
-    const creationTimestamp = new Date(message.creation_time).getTime();
-    const $timestampView = createTimestampView(creationTimestamp);
-
-    const $messageHeader = $('<div>').addClass('message-header');
-    $messageHeader.append($role, $timestampView);
-
-    const $contentContainer = $('<div>').addClass('content-container');
-    (message.content_sections || []).forEach(section => {
-      const $sectionDiv = $('<div>').addClass('messageSection');
-
-      // Returns a jQuery object containing the elements for collapsible content
-      const createCollapsibleContent = (content, summaryContent) => {
-        if (content === undefined || content === null || content === '')
-          return null;
-
-        const lineCount = String(content).split('\n').length;
-        const $contentPre =
-            $('<pre>').addClass('field-content-pre').text(content);
-
-        if (lineCount <= 20) return $contentPre;
-
-        const $details =
-            $('<details>').addClass('collapsible-content-container');
-
-        const summaryText = summaryContent ||
-            String(content).split('\n').slice(0, 1).join('\n') + '...';
-        const $summary =
-            $('<summary>').text(`${lineCount} lines: ${summaryText}`);
-        $details.append($summary, $contentPre);
-        return $details;
-      };
-
-      const renderPropertiesTable = (propertiesObject, orderedKeys, title) => {
-        const $block = $('<div>').addClass(
-            title.toLowerCase().replace(/ /g, '-') + '-block');
-        $block.append($('<h3>').html(title));
-        const $table = $('<table>').addClass('properties-table');
-
-        orderedKeys.forEach(key => {
-          const value = propertiesObject[key];
-          const displayLabel =
-              key.replace(/_/g, ' ')
-                  .split(' ')
-                  .map(word => word.charAt(0).toUpperCase() + word.slice(1))
-                  .join(' ');
-
-          const $collapsibleContent = createCollapsibleContent(value);
-          if ($collapsibleContent) {
-            const $row = $('<tr>');
-            $row.append(
-                $('<td>').addClass('property-label').text(`${displayLabel}:`));
-            $row.append($('<td>')
-                            .addClass('property-value')
-                            .append($collapsibleContent));
-            $table.append($row);
-          }
-        });
-        $block.append($table);
-        return $block;
-      };
-
-      if (section.command) {
-        const commandKeys = Object.keys(section.command)
-                                .filter(key => key !== 'command_name')
-                                .sort();
-        const orderedCommandKeys = ['command_name', ...commandKeys];
-        const $commandBlock = renderPropertiesTable(
-            section.command, orderedCommandKeys, '&#129302; Command');
-        $sectionDiv.append($commandBlock);
-      } else if (section.command_output) {
-        const outputKeys =
-            ['command_name', 'output', 'errors', 'summary', 'task_done'];
-        const $outputBlock = renderPropertiesTable(
-            section.command_output, outputKeys,
-            '&#9881;&#65039; Command Output');
-        $sectionDiv.append($outputBlock);
-      } else if (section.content && section.content.length > 0) {
-        const $contentElement =
-            createCollapsibleContent(section.content, section.summary);
-        if ($contentElement) {
-          $sectionDiv.append($contentElement);
-        }
-      }
+    return this.messageCount;
+  }
+
+  // Updates the number of messages in the server. Requests the last message
+  // (so that `getLastMessageOverview` works) but nothing else: other messages
+  // are only requested once they are about to become visible.
+  setMessageCount(messageCount) {
+    if (messageCount === this.messageCount) return this;
+    this.messageCount = messageCount;
+    if (messageCount > 0) this._ensureMessageRequested(messageCount - 1);
+    return this;
+  }
 
-      $contentContainer.append($sectionDiv);
+  addMessages(firstMessageIndex, messages) {
+    messages.forEach((message, i) => {
+      const index = firstMessageIndex + i;
+      this.messages[index] = message;
+      this._requestedBlocks.delete(Math.floor(index / MESSAGES_BLOCK_SIZE));
     });
+    this.messageCount =
+        Math.max(this.messageCount, firstMessageIndex + messages.length);
+    this.render();
+    return this;
+  }
+
+  _ensureMessageRequested(index) {
+    const block = Math.floor(index / MESSAGES_BLOCK_SIZE);
+    if (this._requestedBlocks.has(block)) return;
+    let start = block * MESSAGES_BLOCK_SIZE;
+    const end =
+        Math.min(start + MESSAGES_BLOCK_SIZE, this.messageCount);
+    while (start < end && this.messages[start] !== undefined) start++;
+    if (start >= end) return;
+    this._requestedBlocks.add(block);
+    this.requestMessages(this, start, end - start);
+  }
+
+  _estimatedMessageHeight() {
+    if (this._measuredHeightsCount === 0) return DEFAULT_MESSAGE_HEIGHT_PX;
+    return this._measuredHeightsSum / this._measuredHeightsCount;
+  }
+
+  _recordMessageHeight(index, height) {
+    if (this._heights[index] === undefined) {
+      this._measuredHeightsCount++;
+    } else {
+      this._measuredHeightsSum -= this._heights[index];
+    }
+    this._heights[index] = height;
+    this._measuredHeightsSum += height;
+  }
+
+  // Mounts the messages visible in the viewport (plus some margin) and
+  // unmounts all others.
+  render() {
+    if (!this.isShown() || !this.div.is(':visible')) return;
+
+    const estimatedHeight = this._estimatedMessageHeight();
+    const heightOf = index => this._heights[index] === undefined ?
+        estimatedHeight :
+        this._heights[index];
+
+    const windowTop =
+        $(window).scrollTop() - this.div.offset().top - OVERSCAN_PX;
+    const windowBottom = windowTop + window.innerHeight + 2 * OVERSCAN_PX;
+
+    let first = 0;
+    let offset = 0;
+    while (first < this.messageCount && offset + heightOf(first) < windowTop)
+      offset += heightOf(first++);
+    const topSpacerHeight = offset;
+
+    let end = first;
+    while (end < this.messageCount && offset < windowBottom)
+      offset += heightOf(end++);
 
-    this.div.append($messageDiv.append($messageHeader, $contentContainer));
+    let bottomSpacerHeight = 0;
+    for (let index = end; index < this.messageCount; index++)
+      bottomSpacerHeight += heightOf(index);
+
+    for (const [index, $element] of this._mounted) {
+      if (index < first || index >= end) {
+        $element.remove();
+        this._mounted.delete(index);
+      }
+    }
+
+    const created = [];
+    for (let index = first; index < end; index++) {
+      const $mounted = this._mounted.get(index);
+      const message = this.messages[index];
+      if ($mounted !== undefined &&
+          ($mounted.data('placeholder') !== true || message === undefined))
+        continue;
+      if ($mounted !== undefined) $mounted.remove();
+      if (message === undefined) {
+        this._ensureMessageRequested(index);
+        this._mounted.set(
+            index,
+            $('<div>')
+                .addClass('message message-placeholder')
+                .data('placeholder', true)
+                .css('height', `${heightOf(index)}px`));
+      } else {
+        const $element = createMessageElement(message, index);
+        if (index === this._highlightedMessageIndex)
+          $element.addClass('search-hit');
+        this._mounted.set(index, $element);
+        created.push(index);
+      }
+    }
+
+    this.$topSpacer.css('height', `${topSpacerHeight}px`);
+    this.$bottomSpacer.css('height', `${bottomSpacerHeight}px`);
+    for (let index = first; index < end; index++)
+      this.$messagesDiv.append(this._mounted.get(index));
+    created.forEach(
+        index => this._recordMessageHeight(
+            index, this._mounted.get(index).outerHeight(true)));
+  }
+
+  // Scrolls to the bottom of the conversation. Mounting messages near the
+  // bottom replaces estimated heights with real ones, so we repeat this a few
+  // times until the page height converges.
+  scrollToEnd() {
+    for (let i = 0; i < 3; i++) {
+      window.scrollTo(0, document.body.scrollHeight);
+      this.render();
+    }
+  }
+
+  // Scrolls to (and highlights) a message, e.g. from a search result.
+  scrollToMessage(messageIndex) {
+    const estimatedHeight = this._estimatedMessageHeight();
+    let offset = 0;
+    for (let index = 0; index < messageIndex; index++)
+      offset += this._heights[index] === undefined ? estimatedHeight :
+                                                     this._heights[index];
+    this._highlightedMessageIndex = messageIndex;
+    this.div.find('.message.search-hit').removeClass('search-hit');
+    window.scrollTo(0, this.div.offset().top + offset);
+    this.render();
+    const $element = this._mounted.get(messageIndex);
+    if ($element !== undefined) {
+      $element.addClass('search-hit');
+      $element[0].scrollIntoView({block: 'center'});
+    }
   }
 
   getLastMessageOverview() {
-    if (this.messages.length === 0) {
+    if (this.messageCount === 0) {
       return '';
     }
-    const lastMessage = this.messages[this.messages.length - 1];
-    if (lastMessage.content_sections &&
+    const lastMessage = this.messages[this.messageCount - 1];
+    if (lastMessage && lastMessage.content_sections &&
         lastMessage.content_sections.length > 0) {
       const lastSection =
           lastMessage.content_sections[lastMessage.content_sections.length - 1];
@@ -215,6 +389,7 @@ export class ConversationData {
           .append(createTimestampView(this.lastStateChangeTime))
           .show();
     }
+    this.render();
     this.scrollToBottom();
   }
 }
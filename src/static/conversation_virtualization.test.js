@@ -0,0 +1,94 @@
+import {ConversationData} from './conversation.js';
+
+// Simulated latency of the server answering a request for messages.
+const FAKE_SERVER_LATENCY_MS = 20;
+
+function createSyntheticMessage(index) {
+  const lines = index % 10 === 0 ? 500 : 1 + index % 15;
+  const text = Array.from(
+                   {length: lines},
+                   (_, line) => `Message ${index}, line ${line}: lorem ipsum.`)
+                   .join('\n');
+  const sections = [{content: text}];
+  if (index % 2 === 1) {
+    sections.push({
+      content: '',
+      command: {command_name: 'read_file', path: `src/file_${index}.py`}
+    });
+    sections.push({
+      content: '',
+      command_output:
+          {command_name: 'read_file', output: text, errors: '', summary: 'Read.'}
+    });
+  }
+  return {
+    role: index % 2 === 0 ? 'user' : 'assistant',
+    creation_time: new Date().toISOString(),
+    content_sections: sections
+  };
+}
+
+function percentile(sortedValues, p) {
+  const index = Math.min(
+      sortedValues.length - 1, Math.floor(sortedValues.length * p / 100));
+  return sortedValues[index];
+}
+
+function nextFrame() {
+  return new Promise(resolve => window.requestAnimationFrame(resolve));
+}
+
+async function run(messageCount) {
+  $('#conversation_container').empty();
+  const requests = [];
+  const conversation = new ConversationData(
+      0, 'synthetic', 'RUNNING', '🏃', new Date().getTime(), () => {},
+      (conversation, start, count) => {
+        requests.push(count);
+        setTimeout(
+            () => conversation.addMessages(
+                start,
+                Array.from(
+                    {length: count},
+                    (_, i) => createSyntheticMessage(start + i))),
+            FAKE_SERVER_LATENCY_MS);
+      });
+  $(window).on('scroll', () => conversation.render());
+  conversation.setMessageCount(messageCount).show();
+
+  // Scroll through the whole conversation, one step per frame.
+  const frameTimes = [];
+  let maxMountedMessages = 0;
+  let last = performance.now();
+  for (let step = 0; step <= 400; step++) {
+    window.scrollTo(0, document.body.scrollHeight * step / 400);
+    await nextFrame();
+    const now = performance.now();
+    frameTimes.push(now - last);
+    last = now;
+    maxMountedMessages = Math.max(
+        maxMountedMessages, conversation.div.find('.message').length);
+  }
+  $(window).off('scroll');
+
+  frameTimes.sort((a, b) => a - b);
+  const mean = frameTimes.reduce((a, b) => a + b, 0) / frameTimes.length;
+  const results = [
+    `Messages: ${messageCount}`,
+    `Frames: ${frameTimes.length}`,
+    `Frame time (ms): mean=${mean.toFixed(1)} p50=${
+        percentile(frameTimes, 50).toFixed(1)} p95=${
+        percentile(frameTimes, 95).toFixed(1)} p99=${
+        percentile(frameTimes, 99).toFixed(1)} max=${
+        frameTimes[frameTimes.length - 1].toFixed(1)}`,
+    `Max mounted messages: ${maxMountedMessages}`,
+    `Requests: ${requests.length} (${
+        requests.reduce((a, b) => a + b, 0)} messages)`,
+  ].join('\n');
+  console.log(results);
+  $('#results').text(results);
+}
+
+$(document).ready(() => {
+  $('#run_button').on('click', () => run(parseInt($('#message_count').val())));
+});
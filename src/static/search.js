@@ -0,0 +1,45 @@
+// Full-text search across all conversations (see `conversation_search.py`).
+
+function renderSearchResults(data, onSelectHit) {
+  const $table = $('#search_results_table');
+  $table.empty();
+  $('#search_results_summary')
+      .text(`${data.hits.length} results for "${data.query}"`);
+
+  const $headerRow = $('<tr>');
+  ['Conversation', 'Message', 'Role', 'Match'].forEach(
+      text => $headerRow.append($('<th>').text(text)));
+  $table.append($('<thead>').append($headerRow));
+
+  const $tableBody = $('<tbody>');
+  data.hits.forEach(hit => {
+    const $row = $('<tr>');
+    $row.append($('<td>').text(`${hit.conversation_name} (${
+        hit.conversation_id})`));
+    $row.append($('<td>').text(hit.message_index));
+    $row.append($('<td>').text(hit.role));
+    $row.append($('<td>').addClass('search-snippet').text(hit.snippet));
+    $row.on('click', () => onSelectHit(hit));
+    $tableBody.append($row);
+  });
+  $table.append($tableBody);
+}
+
+function showSearchResultsView() {
+  $('#content_panes').children().hide();
+  $('#search_results_view').show();
+}
+
+export function setUpSearch(socket, onSelectHit) {
+  socket.on('search_results', data => {
+    renderSearchResults(data, onSelectHit);
+    showSearchResultsView();
+  });
+
+  $('#search_form').on('submit', function(event) {
+    event.preventDefault();
+    const query = $('#search_input').val().trim();
+    if (query === '') return;
+    socket.emit('search_conversations', {query: query});
+  });
+}
@@ -6,10 +6,10 @@ import pathlib
 from agent_command import AgentCommand, CommandInput, CommandOutput, CommandSyntax, Argument, ArgumentContentType, REASON_VARIABLE, VariableMap, VariableName, VariableValueInt
 from conversation import ConversationId
 from file_access_policy import FileAccessPolicy
-from message_bus import Message as BusMessage, END_USER_AGENT, MessageBus, MessageContent, MessageId, TelegramChatId, TelegramMessageId
+from message_bus import Message as BusMessage, END_USER_AGENT, MessageBus, MessageContent, MessageId, MessagePriority, TelegramChatId, TelegramMessageId, TopicMessage, TopicMessageId
 from message_queue import AgentMessageQueue
 from pathbox import PathBox
-from swarm_types import AgentName
+from swarm_types import AgentName, Topic
 
 _TARGET_AGENT_ARGUMENT = Argument(
     name=VariableName("target_agent"),
@@ -17,6 +17,13 @@ _TARGET_AGENT_ARGUMENT = Argument(
     description="The name of the agent that should consume the message.",
     required=True)
 
+_TOPIC_ARGUMENT = Argument(
+    name=VariableName("topic"),
+    arg_type=ArgumentContentType.STRING,
+    description="The topic of the message (it will be consumed by all agents "
+    "subscribed to it).",
+    required=True)
+
 _CONTENT_ARGUMENT = Argument(
     name=VariableName("content"),
     arg_type=ArgumentContentType.STRING,
@@ -81,6 +88,8 @@ class DisplayInfoCommand(AgentCommand):
 @dataclasses.dataclass(frozen=True)
 class PublishMessageConfig:
   allow_list: frozenset[AgentName]
+  # Topics the agent can publish to (through `PublishTopicMessageCommand`).
+  topics: frozenset[Topic] = frozenset()
 
 
 # publish_message set's the children's agent `local_directory` to the cwd of the
@@ -114,6 +123,7 @@ class PublishMessageCommand(AgentCommand):
     """Call write_new_message with a new message.
 
     {{🦔 The message's target_agent is always set.}}
+    {{🦔 The message's priority is `MessagePriority.LOW` (background).}}
     {{🦔 If self._cwd is not '.', the message's local_directory is set
          accordingly (otherwise is None).}}
     {{🦔 Returns an error `CommandOutput` if the target agent is missing from
@@ -149,6 +159,7 @@ class PublishMessageCommand(AgentCommand):
         content=MessageContent(content),
         queued_at=datetime.datetime.now(),
         processed_at=None,
+        priority=MessagePriority.LOW,
     )
     written_message = await self._message_bus.write_new_message(message)
     return CommandOutput(
@@ -160,6 +171,78 @@ class PublishMessageCommand(AgentCommand):
     # ✨
 
 
+# Like publish_message, but for all the agents subscribed to a topic.
+class PublishTopicMessageCommand(AgentCommand):
+
+  def __init__(self, config: PublishMessageConfig, message_bus: MessageBus,
+               cwd: PathBox, telegram_chat_id: TelegramChatId,
+               telegram_reply_to_id: TelegramMessageId,
+               source_agent: AgentName) -> None:
+    # ✨ publish to topic store fields
+    self._config = config
+    self._message_bus = message_bus
+    self._cwd = cwd
+    self._telegram_chat_id = telegram_chat_id
+    self._telegram_reply_to_id = telegram_reply_to_id
+    self._source_agent = source_agent
+    # ✨
+
+  def Name(self) -> str:
+    return self.Syntax().name
+
+  def Syntax(self) -> CommandSyntax:
+    return CommandSyntax(
+        name="publish_to_topic",
+        description="Publishes a new message to a topic in the message bus. "
+        "The message will be consumed by every agent subscribed to the topic.",
+        arguments=[REASON_VARIABLE, _TOPIC_ARGUMENT, _CONTENT_ARGUMENT])
+
+  async def run(self, inputs: VariableMap) -> CommandOutput:
+    """Call `MessageBus.publish` with a new message.
+
+    {{🦔 The message is published once (regardless of the number of
+         subscribers).}}
+    {{🦔 If self._cwd is not '.', the message's local_directory is set
+         accordingly (otherwise is None).}}
+    {{🦔 Returns an error `CommandOutput` if the topic is missing from
+         `config.topics`.}}
+    """
+    # ✨ publish to topic run
+    content = str(inputs[VariableName("content")])
+    topic = Topic(str(inputs[VariableName("topic")]))
+
+    if topic not in self._config.topics:
+      return CommandOutput(
+          command_name=self.Name(),
+          output="",
+          errors=f"Topic '{topic}' is not in the allowed list for publishing messages.",
+          summary=f"Failed to publish message: topic '{topic}' not allowed.",
+      )
+
+    local_directory = None
+    if self._cwd.path != pathlib.Path("."):
+      local_directory = self._cwd.path
+
+    published = await self._message_bus.publish(
+        TopicMessage(
+            topic_message_id=TopicMessageId(0),  # Overwritten by the bus.
+            topic=topic,
+            source_agent=self._source_agent,
+            local_directory=local_directory,
+            telegram_chat_id=self._telegram_chat_id,
+            telegram_reply_to_id=self._telegram_reply_to_id,
+            content=MessageContent(content),
+            published_at=datetime.datetime.now(datetime.timezone.utc),
+        ))
+    return CommandOutput(
+        command_name=self.Name(),
+        output=f"Message published to topic {topic} with ID: {published.topic_message_id}",
+        errors="",
+        summary=f"Published message to topic {topic}: {content[:50]}...",
+    )
+    # ✨
+
+
 class AskUserCommand(AgentCommand):
 
   def __init__(self, message_bus: MessageBus, queue: AgentMessageQueue,
@@ -1,6 +1,7 @@
 import aiofiles
 import asyncio
 import dataclasses
+import datetime
 import json
 import os
 import pathlib
@@ -8,7 +9,8 @@ from typing import NewType
 
 from command_registry_factory import create_command_registry_config, CommandRegistryConfig
 from message import ContentSection
-from swarm_types import AgentName
+from prompt_cache import PromptCache, PromptSourcePolicy
+from swarm_types import AgentName, Topic
 
 TelegramId = NewType("TelegramId", int)
 
@@ -22,6 +24,23 @@ class AgentIdentityConfig:
 
   prompt_sources: list[pathlib.Path]
 
+  # Most sessions of this agent that can run at once (see
+  # `SwarmConfig.max_concurrent_sessions`). If None, only the global cap
+  # applies.
+  max_concurrent_sessions: int | None = None
+
+  # How to cache the output of executable entries in `prompt_sources` (see
+  # `PromptSourcePolicy`; entries without a policy are never cached).
+  prompt_policies: dict[pathlib.Path, PromptSourcePolicy] = dataclasses.field(
+      default_factory=dict)
+
+  prompt_cache: PromptCache = dataclasses.field(
+      default_factory=PromptCache, compare=False, repr=False)
+
+  # Topics whose messages are delivered to this agent (see
+  # `MessageBus.set_subscriptions`).
+  subscriptions: frozenset[Topic] = frozenset()
+
   async def prompt(self, cwd: pathlib.Path) -> list[ContentSection]:
     """Loads all sections for the initial message.
 
@@ -37,10 +56,25 @@ class AgentIdentityConfig:
     {{🦔 If an execution returns non-zero, we raise a ValueError exception.
          The exception contains details (including the program's error
          output).}}
+    {{🦔 Each entry is loaded through `prompt_cache` (with its policy in
+         `prompt_policies`, if any), so it is only read (or executed) when its
+         cached contents are stale.}}
     """
     raise NotImplementedError()  # {{🍄 generate agent prompt}}
 
 
+@dataclasses.dataclass(frozen=True)
+class TelegramWebhookConfig:
+  # Public (HTTPS) URL, registered with Telegram, that reaches `host`:`port`.
+  url: str
+  # Where the Telegram adapter listens for updates.
+  port: int
+  host: str = "127.0.0.1"
+  # If set, Telegram sends it with each update, and updates without it are
+  # rejected.
+  secret_token: str | None = None
+
+
 @dataclasses.dataclass(frozen=True)
 class SwarmTelegramConfig:
   token: str
@@ -51,6 +85,10 @@ class SwarmTelegramConfig:
 
   authorized_users: list[TelegramId]
 
+  # If set, the adapter receives updates through a webhook (rather than by
+  # polling Telegram).
+  webhook: TelegramWebhookConfig | None = None
+
 
 @dataclasses.dataclass(frozen=True)
 class SwarmConfig:
@@ -60,9 +98,21 @@ class SwarmConfig:
 
   telegram: SwarmTelegramConfig | None
 
+  # Messages in the bus are archived this many days after they are done (see
+  # `MessageBus.archive_messages`). If 0, messages are never archived.
+  message_bus_retention_days: int = 7
+
+  # Most agent sessions that can run at once (across all agents); further
+  # incoming messages wait (see `SessionScheduler`).
+  max_concurrent_sessions: int = 8
+
+  # Shared by all the `agents` (see `AgentIdentityConfig.prompt_cache`).
+  prompt_cache: PromptCache = dataclasses.field(
+      default_factory=PromptCache, compare=False, repr=False)
+
 
 async def _load_agent_identity_config(
-    path: pathlib.Path) -> AgentIdentityConfig:
+    path: pathlib.Path, prompt_cache: PromptCache) -> AgentIdentityConfig:
   """Loads an AgentIdentityConfig for the agent at a given path (directory).
 
   `name` is the path's base-name.
@@ -78,6 +128,18 @@ async def _load_agent_identity_config(
   * Iterate on values under `prompts` (list[str]) in `config.json`. Each value
     given is a path (relative to `path`) and read (asynch).
 
+  `max_concurrent_sessions` is read from `config.json` (optional; if present,
+  it MUST be a positive integer).
+
+  `prompt_policies` is read from `prompt_cache` in `config.json` (optional): a
+  dictionary whose keys are entries in `prompts` and whose values are
+  dictionaries with (optional) `ttl_seconds` (a positive number) and
+  `depends_on` (a list of paths, relative to `path`). The returned config uses
+  `prompt_cache` as its cache.
+
+  `subscriptions` is read from `subscribe` in `config.json` (optional; a list of
+  non-empty strings).
+
   If `config.json` contains unexpected data or something that can't be parsed,
   or if `prompt_content` is empty, raises an exception.
   """
@@ -91,11 +153,20 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
   """Loads the configuration from JSON file in `path`.
 
   If `telegram` is present, `telegram.token` MUST be set.
+
+  `message_bus_retention_days` is optional; if present, it MUST be a
+  non-negative integer.
+
+  `max_concurrent_sessions` is optional; if present, it MUST be a positive
+  integer.
   If `telegram.token` is set:
 
   * `telegram.authorized_users` MUST NOT be empty.
   * `telegram.consumer_agent` MUST be set to a key in `agents`.
   * `telegram.end_user_identity` MUST NOT be a key in `agents`.
+  * `telegram.webhook` is optional; if present, it MUST be a dictionary with
+    `url` (a string) and `port` (an integer), and optionally `host` and
+    `secret_token` (strings).
 
   The file in `path` does not contain the agent identity configuration, only an
   "agents" key with a list[str]. The entries in the list are names of agents
@@ -108,5 +179,8 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
 
   Validates *all* configurations and successfully detects ALL errors in them
   (in the exception raised), rather than simply stopping at the first failure.
+
+  All agents share a `PromptCache` (also in `SwarmConfig.prompt_cache`) whose
+  invalidation path is `prompt_cache.invalidated` in the directory of `path`.
   """
   raise NotImplementedError()  # {{🍄 load config}}
@@ -2,6 +2,7 @@
 import aiofiles
 import asyncio
 import dataclasses
+import datetime
 import json
 import os
 import pathlib
@@ -9,7 +10,8 @@ from typing import NewType
 
 from command_registry_factory import create_command_registry_config, CommandRegistryConfig
 from message import ContentSection
-from swarm_types import AgentName
+from prompt_cache import PromptCache, PromptSourcePolicy
+from swarm_types import AgentName, Topic
 
 TelegramId = NewType("TelegramId", int)
 
@@ -23,6 +25,23 @@ class AgentIdentityConfig:
 
   prompt_sources: list[pathlib.Path]
 
+  # Most sessions of this agent that can run at once (see
+  # `SwarmConfig.max_concurrent_sessions`). If None, only the global cap
+  # applies.
+  max_concurrent_sessions: int | None = None
+
+  # How to cache the output of executable entries in `prompt_sources` (see
+  # `PromptSourcePolicy`; entries without a policy are never cached).
+  prompt_policies: dict[pathlib.Path, PromptSourcePolicy] = dataclasses.field(
+      default_factory=dict)
+
+  prompt_cache: PromptCache = dataclasses.field(
+      default_factory=PromptCache, compare=False, repr=False)
+
+  # Topics whose messages are delivered to this agent (see
+  # `MessageBus.set_subscriptions`).
+  subscriptions: frozenset[Topic] = frozenset()
+
   async def prompt(self, cwd: pathlib.Path) -> list[ContentSection]:
     """Loads all sections for the initial message.
 
@@ -38,13 +57,17 @@ class AgentIdentityConfig:
     {{🦔 If an execution returns non-zero, we raise a ValueError exception.
          The exception contains details (including the program's error
          output).}}
+    {{🦔 Each entry is loaded through `prompt_cache` (with its policy in
+         `prompt_policies`, if any), so it is only read (or executed) when its
+         cached contents are stale.}}
     """
     # ✨ generate agent prompt
-    async def _get_content_from_source(
-        source_path: pathlib.Path, cwd_path: pathlib.Path) -> ContentSection:
+    async def _read_source(source_path: pathlib.Path,
+                           cwd_path: pathlib.Path) -> str:
       if not os.access(source_path, os.X_OK):
         async with aiofiles.open(source_path, mode="r") as f:
-          return ContentSection(content=await f.read())
+          content: str = await f.read()
+          return content
 
       env: dict[str, str] = os.environ.copy()
       env["DUENDE_AGENT_CWD"] = str(cwd_path)
@@ -61,7 +84,14 @@ class AgentIdentityConfig:
         raise ValueError(
             f"Prompt script {source_path} exited with error code {process.returncode}: "
             f"{stderr_bytes.decode().strip()}")
-      return ContentSection(content=stdout_bytes.decode())
+      return stdout_bytes.decode()
+
+    async def _get_content_from_source(
+        source_path: pathlib.Path, cwd_path: pathlib.Path) -> ContentSection:
+      return ContentSection(content=await self.prompt_cache.load(
+          source_path, os.access(source_path, os.X_OK),
+          self.prompt_policies.get(source_path, PromptSourcePolicy()), cwd_path,
+          lambda: _read_source(source_path, cwd_path)))
 
     return await asyncio.gather(*[
         _get_content_from_source(source_path, cwd)
@@ -70,6 +100,18 @@ class AgentIdentityConfig:
     # ✨
 
 
+@dataclasses.dataclass(frozen=True)
+class TelegramWebhookConfig:
+  # Public (HTTPS) URL, registered with Telegram, that reaches `host`:`port`.
+  url: str
+  # Where the Telegram adapter listens for updates.
+  port: int
+  host: str = "127.0.0.1"
+  # If set, Telegram sends it with each update, and updates without it are
+  # rejected.
+  secret_token: str | None = None
+
+
 @dataclasses.dataclass(frozen=True)
 class SwarmTelegramConfig:
   token: str
@@ -80,6 +122,10 @@ class SwarmTelegramConfig:
 
   authorized_users: list[TelegramId]
 
+  # If set, the adapter receives updates through a webhook (rather than by
+  # polling Telegram).
+  webhook: TelegramWebhookConfig | None = None
+
 
 @dataclasses.dataclass(frozen=True)
 class SwarmConfig:
@@ -89,9 +135,21 @@ class SwarmConfig:
 
   telegram: SwarmTelegramConfig | None
 
+  # Messages in the bus are archived this many days after they are done (see
+  # `MessageBus.archive_messages`). If 0, messages are never archived.
+  message_bus_retention_days: int = 7
+
+  # Most agent sessions that can run at once (across all agents); further
+  # incoming messages wait (see `SessionScheduler`).
+  max_concurrent_sessions: int = 8
+
+  # Shared by all the `agents` (see `AgentIdentityConfig.prompt_cache`).
+  prompt_cache: PromptCache = dataclasses.field(
+      default_factory=PromptCache, compare=False, repr=False)
+
 
 async def _load_agent_identity_config(
-    path: pathlib.Path) -> AgentIdentityConfig:
+    path: pathlib.Path, prompt_cache: PromptCache) -> AgentIdentityConfig:
   """Loads an AgentIdentityConfig for the agent at a given path (directory).
 
   `name` is the path's base-name.
@@ -107,6 +165,18 @@ async def _load_agent_identity_config(
   * Iterate on values under `prompts` (list[str]) in `config.json`. Each value
     given is a path (relative to `path`) and read (asynch).
 
+  `max_concurrent_sessions` is read from `config.json` (optional; if present,
+  it MUST be a positive integer).
+
+  `prompt_policies` is read from `prompt_cache` in `config.json` (optional): a
+  dictionary whose keys are entries in `prompts` and whose values are
+  dictionaries with (optional) `ttl_seconds` (a positive number) and
+  `depends_on` (a list of paths, relative to `path`). The returned config uses
+  `prompt_cache` as its cache.
+
+  `subscriptions` is read from `subscribe` in `config.json` (optional; a list of
+  non-empty strings).
+
   If `config.json` contains unexpected data or something that can't be parsed,
   or if `prompt_content` is empty, raises an exception.
   """
@@ -137,7 +207,10 @@ async def _load_agent_identity_config(
           f"Invalid configuration in '{config_json_path}' for agent '{agent_name}': Expected a dictionary, but got {type(raw_agent_config)}."
       )
 
-    allowed_keys = {'command_registry', 'prompts'}
+    allowed_keys = {
+        'command_registry', 'prompts', 'max_concurrent_sessions',
+        'prompt_cache', 'subscribe'
+    }
     for key in raw_agent_config:
       if key not in allowed_keys:
         raise ValueError(
@@ -182,10 +255,66 @@ async def _load_agent_identity_config(
           f"Agent prompt content is empty for agent '{agent_name}'. Please provide content via 'prompt.md' or 'prompts' in 'config.json'."
       )
 
+    max_concurrent_sessions = raw_agent_config.get("max_concurrent_sessions")
+    if max_concurrent_sessions is not None and (
+        not isinstance(max_concurrent_sessions, int) or isinstance(
+            max_concurrent_sessions, bool) or max_concurrent_sessions < 1):
+      raise ValueError(
+          f"Invalid 'max_concurrent_sessions' in '{config_json_path}' for agent '{agent_name}': Expected a positive integer, but got {max_concurrent_sessions!r}."
+      )
+
+    prompt_policies: dict[pathlib.Path, PromptSourcePolicy] = {}
+    raw_prompt_cache = raw_agent_config.get("prompt_cache", {})
+    if not isinstance(raw_prompt_cache, dict):
+      raise ValueError(
+          f"Invalid 'prompt_cache' configuration in '{config_json_path}' for agent '{agent_name}': Expected a dictionary, but got {type(raw_prompt_cache)}."
+      )
+    for prompt_relative_path_str, raw_policy in raw_prompt_cache.items():
+      prompt_abs_path = path / prompt_relative_path_str
+      if prompt_abs_path not in prompt_sources:
+        raise ValueError(
+            f"Unknown prompt '{prompt_relative_path_str}' in 'prompt_cache' in '{config_json_path}' for agent '{agent_name}'."
+        )
+      if not isinstance(raw_policy, dict) or not set(raw_policy) <= {
+          'ttl_seconds', 'depends_on'
+      }:
+        raise ValueError(
+            f"Invalid 'prompt_cache' entry for '{prompt_relative_path_str}' in '{config_json_path}' for agent '{agent_name}': Expected a dictionary with 'ttl_seconds' and/or 'depends_on', but got {raw_policy!r}."
+        )
+      ttl_seconds = raw_policy.get("ttl_seconds")
+      if ttl_seconds is not None and (not isinstance(ttl_seconds,
+                                                     (int, float)) or
+                                      isinstance(ttl_seconds, bool) or
+                                      ttl_seconds <= 0):
+        raise ValueError(
+            f"Invalid 'ttl_seconds' for '{prompt_relative_path_str}' in '{config_json_path}' for agent '{agent_name}': Expected a positive number, but got {ttl_seconds!r}."
+        )
+      depends_on = raw_policy.get("depends_on", [])
+      if not isinstance(depends_on, list) or not all(
+          isinstance(p, str) for p in depends_on):
+        raise ValueError(
+            f"Invalid 'depends_on' for '{prompt_relative_path_str}' in '{config_json_path}' for agent '{agent_name}': Expected a list of strings, but got {depends_on!r}."
+        )
+      prompt_policies[prompt_abs_path] = PromptSourcePolicy(
+          ttl=datetime.timedelta(
+              seconds=ttl_seconds) if ttl_seconds is not None else None,
+          depends_on=tuple(path / p for p in depends_on))
+
+    subscribe = raw_agent_config.get("subscribe", [])
+    if not isinstance(subscribe, list) or not all(
+        isinstance(topic, str) and topic for topic in subscribe):
+      raise ValueError(
+          f"Invalid 'subscribe' in '{config_json_path}' for agent '{agent_name}': Expected a list of non-empty strings, but got {subscribe!r}."
+      )
+
     return AgentIdentityConfig(
         name=agent_name,
         command_registry=command_registry_config,
         prompt_sources=prompt_sources,
+        max_concurrent_sessions=max_concurrent_sessions,
+        prompt_policies=prompt_policies,
+        prompt_cache=prompt_cache,
+        subscriptions=frozenset(Topic(topic) for topic in subscribe),
     )
     # ✨
   except Exception as e:
@@ -196,11 +325,20 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
   """Loads the configuration from JSON file in `path`.
 
   If `telegram` is present, `telegram.token` MUST be set.
+
+  `message_bus_retention_days` is optional; if present, it MUST be a
+  non-negative integer.
+
+  `max_concurrent_sessions` is optional; if present, it MUST be a positive
+  integer.
   If `telegram.token` is set:
 
   * `telegram.authorized_users` MUST NOT be empty.
   * `telegram.consumer_agent` MUST be set to a key in `agents`.
   * `telegram.end_user_identity` MUST NOT be a key in `agents`.
+  * `telegram.webhook` is optional; if present, it MUST be a dictionary with
+    `url` (a string) and `port` (an integer), and optionally `host` and
+    `secret_token` (strings).
 
   The file in `path` does not contain the agent identity configuration, only an
   "agents" key with a list[str]. The entries in the list are names of agents
@@ -213,6 +351,9 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
 
   Validates *all* configurations and successfully detects ALL errors in them
   (in the exception raised), rather than simply stopping at the first failure.
+
+  All agents share a `PromptCache` (also in `SwarmConfig.prompt_cache`) whose
+  invalidation path is `prompt_cache.invalidated` in the directory of `path`.
   """
   # ✨ load config
   errors: list[str] = []
@@ -237,7 +378,10 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
     )
 
   if not errors:
-    allowed_keys = {'agents', 'message_bus_path', 'telegram'}
+    allowed_keys = {
+        'agents', 'message_bus_path', 'telegram', 'message_bus_retention_days',
+        'max_concurrent_sessions'
+    }
     for key in raw_config:
       if key not in allowed_keys:
         errors.append(f"Unknown configuration key '{key}' in '{path}'.")
@@ -254,7 +398,31 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
   else:
     errors.append(f"Missing 'message_bus_path' in '{path}'.")
 
+  message_bus_retention_days = SwarmConfig.message_bus_retention_days
+  if "message_bus_retention_days" in raw_config:
+    raw_retention_days = raw_config["message_bus_retention_days"]
+    if (not isinstance(raw_retention_days, int) or
+        isinstance(raw_retention_days, bool) or raw_retention_days < 0):
+      errors.append(
+          f"Invalid 'message_bus_retention_days' in '{path}': Expected a non-negative integer, but got {raw_retention_days!r}."
+      )
+    else:
+      message_bus_retention_days = raw_retention_days
+
+  max_concurrent_sessions = SwarmConfig.max_concurrent_sessions
+  if "max_concurrent_sessions" in raw_config:
+    raw_max_concurrent_sessions = raw_config["max_concurrent_sessions"]
+    if (not isinstance(raw_max_concurrent_sessions, int) or
+        isinstance(raw_max_concurrent_sessions, bool) or
+        raw_max_concurrent_sessions < 1):
+      errors.append(
+          f"Invalid 'max_concurrent_sessions' in '{path}': Expected a positive integer, but got {raw_max_concurrent_sessions!r}."
+      )
+    else:
+      max_concurrent_sessions = raw_max_concurrent_sessions
+
   agents: dict[AgentName, AgentIdentityConfig] = {}
+  prompt_cache = PromptCache(path.parent / "prompt_cache.invalidated")
 
   if "agents" in raw_config:
     raw_agents: list | None = raw_config["agents"]
@@ -275,7 +443,8 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
         agent_name_str = agent_name_str_raw
         agent_path = config_dir / "agents" / agent_name_str
         agent_loading_awaitables.append(
-            (agent_name_str, _load_agent_identity_config(agent_path)))
+            (agent_name_str,
+             _load_agent_identity_config(agent_path, prompt_cache)))
 
       results = await asyncio.gather(
           *[a[1] for a in agent_loading_awaitables], return_exceptions=True)
@@ -298,7 +467,9 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
             error_message = str(result.__cause__)
           else:
             error_message = str(result)
-          errors.append(f"Error loading agent '{original_agent_name_str}': {error_message}")
+          errors.append(
+              f"Error loading agent '{original_agent_name_str}': {error_message}"
+          )
   else:
     errors.append(f"Missing 'agents' in '{path}'.")
 
@@ -311,7 +482,8 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
       )
     else:
       telegram_allowed_keys = {
-          'token', 'consumer_agent', 'end_user_identity', 'authorized_users'
+          'token', 'consumer_agent', 'end_user_identity', 'authorized_users',
+          'webhook'
       }
       for key in raw_telegram_config:
         if key not in telegram_allowed_keys:
@@ -390,6 +562,42 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
       else:
         errors.append(f"Missing 'telegram.authorized_users' in '{path}'.")
 
+      telegram_webhook: TelegramWebhookConfig | None = None
+      if "webhook" in raw_telegram_config:
+        raw_webhook = raw_telegram_config["webhook"]
+        if not isinstance(raw_webhook, dict):
+          errors.append(
+              f"Invalid 'telegram.webhook' in '{path}': Expected a dictionary, but got {type(raw_webhook)}."
+          )
+        else:
+          webhook_errors: list[str] = []
+          for key in raw_webhook:
+            if key not in {'url', 'port', 'host', 'secret_token'}:
+              webhook_errors.append(
+                  f"Unknown configuration key 'telegram.webhook.{key}' in '{path}'."
+              )
+          for key in ['url', 'host', 'secret_token']:
+            if key in raw_webhook and not isinstance(raw_webhook[key], str):
+              webhook_errors.append(
+                  f"Invalid 'telegram.webhook.{key}' in '{path}': Expected a string, but got {type(raw_webhook[key])}."
+              )
+          if 'url' not in raw_webhook:
+            webhook_errors.append(
+                f"Missing 'telegram.webhook.url' in '{path}'.")
+          raw_port = raw_webhook.get('port')
+          if not isinstance(raw_port, int) or isinstance(raw_port, bool):
+            webhook_errors.append(
+                f"Invalid 'telegram.webhook.port' in '{path}': Expected an integer, but got {type(raw_port)}."
+            )
+          if webhook_errors:
+            errors.extend(webhook_errors)
+          else:
+            telegram_webhook = TelegramWebhookConfig(
+                url=raw_webhook['url'],
+                port=raw_webhook['port'],
+                host=raw_webhook.get('host', "127.0.0.1"),
+                secret_token=raw_webhook.get('secret_token'))
+
       if (telegram_token is not None and
           telegram_consumer_agent_name is not None and
           telegram_end_user_identity_name is not None and
@@ -399,6 +607,7 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
             consumer_agent=telegram_consumer_agent_name,
             end_user_identity=telegram_end_user_identity_name,
             authorized_users=telegram_authorized_users,
+            webhook=telegram_webhook,
         )
 
   if errors:
@@ -418,5 +627,8 @@ async def load_config(path: pathlib.Path) -> SwarmConfig:
       agents=agents,
       message_bus_path=message_bus_path,  # type: ignore
       telegram=telegram_config,
+      message_bus_retention_days=message_bus_retention_days,
+      max_concurrent_sessions=max_concurrent_sessions,
+      prompt_cache=prompt_cache,
   )
   # ✨
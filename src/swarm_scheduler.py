@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+from enum import Enum
+import logging
+import time
+from typing import Awaitable, Callable, NamedTuple
+
+from message_bus import TelegramChatId
+from swarm_types import AgentName
+
+
+class SessionPriority(Enum):
+  # Lower values start first.
+  END_USER = 0
+  AGENT = 1
+
+
+class SchedulerStats(NamedTuple):
+  running: int
+  queued: int
+  queued_by_agent: dict[AgentName, int]
+  # How long the oldest queued session has been waiting (0 if none).
+  oldest_wait: datetime.timedelta
+  # Average time that started sessions waited in the queue.
+  average_wait: datetime.timedelta
+
+
+@dataclasses.dataclass(frozen=True)
+class _Session:
+  chat: TelegramChatId
+  agent: AgentName
+  priority: SessionPriority
+  run: Callable[[], Awaitable[None]]
+  # `time.monotonic()`.
+  queued_at: float
+
+
+class SessionScheduler:
+  """Decides when the sessions submitted (for incoming messages) start.
+
+  At most `max_running` sessions run at once, and at most
+  `agent_limits[agent]` for each agent listed.
+
+  Among the sessions that can start (given the caps), the one with the highest
+  priority starts first; ties are broken fairly across chats (the chat that
+  least recently started a session goes first). Within a chat, sessions start
+  strictly in the order they were submitted: a session doesn't start until all
+  previous sessions in its chat have started (even if it could, given the
+  caps).
+  """
+
+  def __init__(self, max_running: int, agent_limits: dict[AgentName,
+                                                          int]) -> None:
+    self._max_running = max_running
+    self._agent_limits = agent_limits
+    # Sessions waiting to start, per chat (in order). Chats without waiting
+    # sessions are removed.
+    self._queues: dict[TelegramChatId, collections.deque[_Session]] = {}
+    # Number of sessions started when each chat last started a session.
+    self._last_started: dict[TelegramChatId, int] = {}
+    self._running: set[asyncio.Task[None]] = set()
+    self._running_by_agent: collections.Counter[AgentName] = (
+        collections.Counter())
+    self._started = 0
+    self._total_wait_secs = 0.0
+
+  def submit(self, chat: TelegramChatId, agent: AgentName,
+             priority: SessionPriority, run: Callable[[],
+                                                      Awaitable[None]]) -> None:
+    """Queues a session; `run` is called (and awaited) when it starts.
+
+    The session keeps its slot (for the caps) until `run` returns. Exceptions
+    from `run` are logged.
+    """
+    self._queues.setdefault(chat, collections.deque()).append(
+        _Session(chat, agent, priority, run, time.monotonic()))
+    self._start_sessions()
+
+  def stats(self) -> SchedulerStats:
+    queued = [session for queue in self._queues.values() for session in queue]
+    oldest = min((session.queued_at for session in queued), default=None)
+    return SchedulerStats(
+        running=len(self._running),
+        queued=len(queued),
+        queued_by_agent=dict(
+            collections.Counter(session.agent for session in queued)),
+        oldest_wait=datetime.timedelta(seconds=time.monotonic() -
+                                       oldest if oldest is not None else 0),
+        average_wait=datetime.timedelta(seconds=self._total_wait_secs /
+                                        self._started if self._started else 0))
+
+  async def stop(self) -> None:
+    """Drops all queued sessions and cancels those running."""
+    self._queues.clear()
+    for task in list(self._running):
+      task.cancel()
+    await asyncio.gather(*self._running, return_exceptions=True)
+
+  def _can_start(self, session: _Session) -> bool:
+    limit = self._agent_limits.get(session.agent)
+    return limit is None or self._running_by_agent[session.agent] < limit
+
+  def _start_sessions(self) -> None:
+    while len(self._running) < self._max_running:
+      candidates = [
+          queue[0]
+          for queue in self._queues.values()
+          if self._can_start(queue[0])
+      ]
+      if not candidates:
+        return
+      session = min(
+          candidates,
+          key=lambda s:
+          (s.priority.value, self._last_started.get(s.chat, -1), s.queued_at))
+      queue = self._queues[session.chat]
+      queue.popleft()
+      if not queue:
+        del self._queues[session.chat]
+      self._start(session)
+
+  def _start(self, session: _Session) -> None:
+    wait = time.monotonic() - session.queued_at
+    self._last_started[session.chat] = self._started
+    self._started += 1
+    self._total_wait_secs += wait
+    self._running_by_agent[session.agent] += 1
+    task = asyncio.create_task(self._run(session))
+    self._running.add(task)
+    logging.info(
+        f"Starting session for {session.agent} (chat {session.chat}) after "
+        f"waiting {wait:.1f}s; {len(self._running)} running, "
+        f"{sum(len(q) for q in self._queues.values())} queued.")
+
+  async def _run(self, session: _Session) -> None:
+    try:
+      await session.run()
+    except Exception:
+      logging.exception(f"Session for {session.agent} failed.")
+    finally:
+      self._running_by_agent[session.agent] -= 1
+      task = asyncio.current_task()
+      assert task
+      self._running.discard(task)
+      self._start_sessions()
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import datetime
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Generic, NamedTuple, TypeVar
+
+from swarm_types import AgentName
+
+T = TypeVar('T')
+
+
+class SessionPoolStats(NamedTuple):
+  # Calls to `take` served with a pre-built value.
+  hits: int
+  # Calls to `take` that had to build a value.
+  misses: int
+  # Values ready, per agent.
+  ready: dict[AgentName, int]
+  # Values the pool is trying to keep ready, per agent.
+  targets: dict[AgentName, int]
+
+
+class SessionPool(Generic[T]):
+  """Keeps values (e.g., sessions) built ahead of time for each agent.
+
+  The number of values kept for an agent follows its recent demand: enough to
+  serve the calls to `take` expected over the next `horizon` (estimated from
+  those in the last `window`), between 1 and `max_size`. Values are built (by
+  `build`) in the background, one at a time per agent.
+  """
+
+  def __init__(
+      self,
+      build: Callable[[AgentName], Awaitable[T]],
+      agents: list[AgentName],
+      max_size: int = 4,
+      window: datetime.timedelta = datetime.timedelta(minutes=10),
+      horizon: datetime.timedelta = datetime.timedelta(minutes=1)
+  ) -> None:
+    self._build = build
+    self._max_size = max_size
+    self._window = window
+    self._horizon = horizon
+    self._ready: dict[AgentName, collections.deque[T]] = {
+        agent: collections.deque() for agent in agents
+    }
+    # Times (`time.monotonic()`) of the calls to `take` in the last `window`.
+    self._demand: dict[AgentName, collections.deque[float]] = {
+        agent: collections.deque() for agent in agents
+    }
+    self._fills: dict[AgentName, asyncio.Task[None]] = {}
+    self._hits = 0
+    self._misses = 0
+
+  def start(self) -> None:
+    """Starts building values for all agents."""
+    for agent in self._ready:
+      self._schedule_fill(agent)
+
+  async def take(self, agent: AgentName) -> T:
+    """Returns a value for `agent`: a pre-built one if ready."""
+    now = time.monotonic()
+    self._demand[agent].append(now)
+    self._schedule_fill(agent)
+    ready = self._ready[agent]
+    if ready:
+      self._hits += 1
+      return ready.popleft()
+    self._misses += 1
+    logging.info(f"Session pool for {agent} is empty; building a session.")
+    return await self._build(agent)
+
+  def _target(self, agent: AgentName) -> int:
+    demand = self._demand[agent]
+    cutoff = time.monotonic() - self._window.total_seconds()
+    while demand and demand[0] < cutoff:
+      demand.popleft()
+    expected = len(demand) * (self._horizon / self._window)
+    return max(1, min(self._max_size, math.ceil(expected)))
+
+  def _schedule_fill(self, agent: AgentName) -> None:
+    fill = self._fills.get(agent)
+    if fill is None or fill.done():
+      self._fills[agent] = asyncio.create_task(self._fill(agent))
+
+  async def _fill(self, agent: AgentName) -> None:
+    ready = self._ready[agent]
+    while len(ready) < self._target(agent):
+      try:
+        ready.append(await self._build(agent))
+      except Exception:
+        logging.exception(f"Failed to build a session for {agent}.")
+        return
+
+  def stats(self) -> SessionPoolStats:
+    return SessionPoolStats(
+        hits=self._hits,
+        misses=self._misses,
+        ready={
+            agent: len(ready) for agent, ready in self._ready.items()
+        },
+        targets={agent: self._target(agent) for agent in self._ready})
+
+  async def stop(self) -> None:
+    """Stops building values and drops those ready."""
+    for fill in self._fills.values():
+      fill.cancel()
+    await asyncio.gather(*self._fills.values(), return_exceptions=True)
+    for ready in self._ready.values():
+      ready.clear()
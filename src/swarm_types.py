@@ -1,3 +1,7 @@
 from typing import NewType
 
 AgentName = NewType("AgentName", str)
+
+# Agents publish messages to topics; messages are delivered to the agents
+# subscribed to the topic (see `MessageBus.publish`).
+Topic = NewType("Topic", str)
@@ -2,11 +2,15 @@ import aiofiles
 import asyncio
 import dataclasses
 import datetime
+import functools
 import json
 import logging
+import os
 import pathlib
 import sqlite3
-from typing import NewType
+import time
+import traceback
+from typing import Awaitable, Callable, Iterable, NewType
 import uuid
 
 from agent_loop_options import BaseAgentLoop
@@ -16,22 +20,73 @@ from command_registry import CommandRegistry
 from confirmation import ConfirmationManager, ConfirmationState
 from conversation import ConversationId, Conversation
 from done_command import DoneCommand
-from file_access_policy import create_file_access_policy, FileAccessPolicyConfig, CompositeFileAccessPolicy
+from file_access_policy import create_file_access_policy, FileAccessPolicy, FileAccessPolicyConfig, CompositeFileAccessPolicy
 from list_files_command import ListFilesCommand
 from message import ContentSection, Message
 import message_bus
-from message_bus import Message as BusMessage, MessageBus, TelegramChatId, TelegramMessageId
+from message_bus import Message as BusMessage, MessageBus, RetryPolicy, SqliteMessageBus, TelegramChatId, TelegramMessageId, WorkerId
 from message_queue import AgentMessageQueue
 from pathbox import PathBox
 import shell_command_command
-from swarm_commands import AskUserCommand, DelegateRequestConfig, DelegateRequestCommand, DisplayInfoCommand, PublishMessageCommand, PublishMessageConfig
+from swarm_commands import AskUserCommand, DelegateRequestConfig, DelegateRequestCommand, DisplayInfoCommand, PublishMessageCommand, PublishMessageConfig, PublishTopicMessageCommand
 from swarm_config import AgentIdentityConfig, SwarmConfig, load_config
+from swarm_scheduler import SessionPriority, SessionScheduler
+from swarm_session_pool import SessionPool
 from swarm_types import AgentName
 from search_file_command import SearchFileCommand
 from read_file_command import ReadFileCommand
 from working_directory_command import ChangeWorkingDirectoryCommand
+from trigram_index import TrigramIndex, shared_trigram_index
 from write_file_command import WriteFileCommand
 
+# How long other swarm workers sharing the bus must wait before they can take
+# over messages claimed by this one (if it stops extending the leases).
+_CLAIM_LEASE = datetime.timedelta(minutes=1)
+
+# Writes to the bus (e.g., from many agents running concurrently) issued within
+# this window are grouped into a single transaction.
+_WRITE_BEHIND = datetime.timedelta(milliseconds=5)
+
+# How often to archive old messages from the bus and compact it.
+_RETENTION_PERIOD = datetime.timedelta(hours=1)
+
+# Messages whose processing fails (e.g., during a model outage) are retried with
+# this policy before they become dead letters.
+_RETRY_POLICY = RetryPolicy(
+    max_attempts=3,
+    backoff=datetime.timedelta(seconds=30),
+    max_backoff=datetime.timedelta(minutes=10))
+
+# Sessions whose agent loop finished are kept in memory (so that a reply
+# resumes them with their full conversation) for this long. After that, a reply
+# restarts them from their messages in the bus.
+_SESSION_IDLE_TIMEOUT = datetime.timedelta(minutes=30)
+
+# Setting up a session for a message (once its agent's parts are taken from the
+# session pool) should take less than this; slower setups are logged as
+# warnings.
+_SESSION_SETUP_TARGET = datetime.timedelta(milliseconds=100)
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+  """A part of the swarm's agents, run by one of `count` workflow workers."""
+  index: int
+  count: int
+
+
+def shard_agents(agents: Iterable[AgentName],
+                 shard: Shard | None) -> list[AgentName]:
+  """Returns the agents (sorted) that `shard` runs (all if it's None).
+
+  Agents are assigned to shards round-robin, by name. All shards must see the
+  same agents.
+  """
+  output = sorted(agents)
+  if shard is None:
+    return output
+  return output[shard.index::shard.count]
+
 
 class SwarmConfirmationManager(ConfirmationManager):
 
@@ -57,64 +112,201 @@ class AgentSession:
   conversation: Conversation
   loop: BaseAgentLoop
   message_queue: AgentMessageQueue
+  # The incoming message that (re)started `loop` most recently.
+  message: BusMessage
+  # Whether `loop` is running (or scheduled to run).
+  active: bool = True
+  # When `loop` last finished (`time.monotonic()`).
+  idle_since: float = 0.0
+
+
+@dataclasses.dataclass
+class _WarmSession:
+  """The parts of a session that don't depend on its message.
+
+  Built ahead of time (see `SwarmWorkflow._new_warm_session`) and bound to a
+  message by `SwarmWorkflow._new_session`.
+  """
+  cwd: PathBox
+  command_registry: CommandRegistry
+  file_access_policy: FileAccessPolicy
 
 
 class SwarmWorkflow(AgentWorkflow):
 
-  def __init__(self, options: AgentWorkflowOptions) -> None:
+  def __init__(self,
+               options: AgentWorkflowOptions,
+               shard: Shard | None = None) -> None:
     self._options = options
-    self._background_tasks: list[asyncio.Task[None]] = []
+    # If set, only the agents in the shard (see `shard_agents`) are run.
+    self._shard = shard
     self._sessions: dict[ConversationId, AgentSession] = {}
 
   async def run(self) -> None:
     self._config = await load_config(
         self._options.config_path or pathlib.Path('swarm/config.json'))
-    self._message_bus = MessageBus(self._config.message_bus_path)
+    self._agents = shard_agents(self._config.agents, self._shard)
+    if not self._agents:
+      logging.warning(f"No agents in shard {self._shard}.")
+      return
+    logging.info(f"Running agents (shard {self._shard}): {self._agents}")
+    self._message_bus = SqliteMessageBus(
+        self._config.message_bus_path, write_behind=_WRITE_BEHIND)
     await self._message_bus.open()
-    while True:
-      for message in await self._message_bus.wait_for_incoming_messages(
-          list(self._config.agents)):
-        await self._process_message(message)
+    for agent in self._agents:
+      await self._message_bus.set_subscriptions(
+          agent, self._config.agents[agent].subscriptions)
+    # Several swarm workers can share a bus: each message is processed by the
+    # worker that claims it.
+    self._worker_id = WorkerId(f"swarm-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    self._scheduler = SessionScheduler(
+        self._config.max_concurrent_sessions, {
+            name: agent.max_concurrent_sessions
+            for name, agent in self._config.agents.items()
+            if agent.max_concurrent_sessions is not None
+        })
+    self._session_pool = SessionPool(self._new_warm_session, self._agents)
+    self._session_pool.start()
+    heartbeat = asyncio.create_task(self._extend_leases_periodically())
+    retention = asyncio.create_task(self._run_retention_periodically())
+    eviction = asyncio.create_task(self._evict_idle_sessions_periodically())
+    try:
+      while True:
+        # Claimed messages are marked as processed once handed off (see
+        # `_process_message`); until then, we keep extending their leases.
+        messages = await self._message_bus.wait_for_claimed_messages(
+            self._agents, self._worker_id, _CLAIM_LEASE)
+        for message in messages:
+          try:
+            await self._process_message(message)
+          except Exception:
+            logging.exception(
+                f"Failed to process message {message.message_id}.")
+            await self._fail_message(message, traceback.format_exc())
+    finally:
+      heartbeat.cancel()
+      retention.cancel()
+      eviction.cancel()
+      await self._scheduler.stop()
+      await self._session_pool.stop()
+      await self._message_bus.release_claims(self._worker_id)
+
+  async def _extend_leases_periodically(self) -> None:
+    """Extends the leases of our claimed messages (before they expire)."""
+    raise NotImplementedError()  # {{🍄 extend leases periodically}}
+
+  async def _run_retention_periodically(self) -> None:
+    """Archives old messages and compacts the bus every `_RETENTION_PERIOD`.
+
+    Logs the statistics of the bus, the scheduler, the session pool and the
+    prompt sources after each run. If `_shard` is set, only shard 0 archives
+    and compacts the bus (shared by all shards).
+    """
+    raise NotImplementedError()  # {{🍄 run retention periodically}}
+
+  async def _evict_idle_sessions_periodically(self) -> None:
+    """Evicts sessions idle for longer than `_SESSION_IDLE_TIMEOUT`.
+
+    Removes them from `_sessions` and their conversations from the conversation
+    factory. Active sessions are never evicted.
+    """
+    raise NotImplementedError()  # {{🍄 evict idle sessions periodically}}
 
   async def _process_message(self, message: BusMessage) -> None:
-    """Receives a new incoming message.
+    """Receives a new incoming message (claimed, but not yet processed).
 
-    Sets the `process_at` cell to the current time.
+    Marks the message as processed once it has been handed off: when its
+    session starts (see `_schedule_session`) or, if no session is scheduled,
+    before returning. While a session waits in `_scheduler`, its message remains
+    leased (so that, if this worker dies, another one claims it).
 
-    * If `message.source_agent` is NOT the value in END_USER_AGENT: calls
-      `_start_agent_loop`.
+    * If `message.source_agent` is NOT the value in END_USER_AGENT: schedules
+      `_start_agent_loop` (through `_schedule_session`).
 
-    * Otherwise, if the `message.message_reply_to_id is None`: calls
+    * Otherwise, if the `message.message_reply_to_id is None`: schedules
       `_start_agent_loop`.
 
-    * Otherwise, if the replied-to message can be found in the bus and the
-      replied-to message has a `conversation_id` found in `_sessions`: adds the
-      content of the message to the session's `message_queue`.
+    * Otherwise, if the replied-to message can be found in the bus and has a
+      `conversation_id`, sets it as the message's `conversation_id` (if unset)
+      and:
+
+      * If the session is in `_sessions` and active: adds the content of the
+        message to the session's `message_queue`.
+
+      * If the session is in `_sessions` (but idle): marks it active, sets the
+        message as the next message of its loop and schedules `_run_session`.
+
+      * If the session isn't in `_sessions` (e.g., it was evicted) but
+        `_restore_session` finds it in the bus, schedules `_run_session`.
 
     * Otherwise: writes an outgoing message informing the user that the session
       no longer exists.
     """
     raise NotImplementedError()  # {{🍄 process message}}
 
+  async def _fail_message(self, message: BusMessage, error: str) -> None:
+    """Records (in the bus) a failure processing `message`.
+
+    Calls `MessageBus.fail_message` with `_RETRY_POLICY`. If the message became
+    a dead letter, writes an outgoing message (in reply to `message`) telling
+    the user that the request failed and its message id (for `/requeue`).
+    """
+    raise NotImplementedError()  # {{🍄 fail message}}
+
+  def _schedule_session(self, message: BusMessage,
+                        run: Callable[[], Awaitable[None]]) -> None:
+    """Submits `run` (which processes `message`) to `_scheduler`.
+
+    The session is queued in the message's Telegram chat, for its target agent.
+    Messages from END_USER_AGENT have priority `SessionPriority.END_USER`;
+    messages from other agents (delegation), `SessionPriority.AGENT`. When the
+    session starts, marks `message` as processed before calling `run` (if that
+    fails, e.g. because another worker processed it after our lease expired,
+    logs it and doesn't call `run`). If `run` raises, logs the exception and
+    calls `_fail_message`.
+    """
+    raise NotImplementedError()  # {{🍄 schedule session}}
+
   async def _start_agent_loop(self, message: BusMessage) -> None:
-    """Starts a new agent loop.
+    """Runs a new session for `message` (until its agent loop finishes).
 
-    Calls `MessageBus.set_conversation_id` to write the new conversation id.
+    Calls `MessageBus.start_session` to get the conversation id (which also
+    writes it to `message`), `_new_session` and `_run_session`.
+    """
+    raise NotImplementedError()  # {{🍄 start agent loop}}
 
-    {{🦔 The agent loop is run with an exception handler that will *immediately*
-         log any exceptions that it raises.
+  async def _restore_session(self, message: BusMessage,
+                             conversation_id: ConversationId) -> AgentSession:
+    """Restarts a session that is no longer in memory, for a reply.
+
+    Reads the session and its messages (which include `message`) from the bus
+    and calls `_new_session` with a transcript of the messages as the content.
+    The agent, chat and local directory are those of the session. Raises
+    ValueError if the session isn't in the bus.
+    """
+    raise NotImplementedError()  # {{🍄 restore session}}
+
+  async def _new_session(self, message: BusMessage,
+                         conversation_id: ConversationId) -> AgentSession:
+    """Creates a session (with a new agent loop) and adds it to `_sessions`.
+
+    Takes the parts of the session that don't depend on `message` from
+    `_session_pool` and binds them to `message`. Commands in the session write
+    `conversation_id` to the messages they send.
     """
     assert message.target_agent
+    start = time.monotonic()
     telegram_id = message.telegram_message_id or message.telegram_reply_to_id
     assert telegram_id
     agent_message_queue = AgentMessageQueue()
-    cwd = self._options.agent_loop_options.cwd.copy()
+    warm_session = await self._session_pool.take(message.target_agent)
+    cwd = warm_session.cwd
     if message.local_directory:
       cwd.path = cwd / message.local_directory
-    command_registry = CommandRegistry()
+    command_registry = warm_session.command_registry
     conversation = self._options.conversation_factory.New(
         f"{message.target_agent}: {message.content[:50]}", command_registry)
-    self._init_command_registry(conversation.GetId(), telegram_id, message,
+    self._bind_command_registry(conversation_id, telegram_id, message,
                                 self._config.agents[message.target_agent],
                                 agent_message_queue, command_registry, cwd)
     confirmation_manager = SwarmConfirmationManager(
@@ -124,12 +316,27 @@ class SwarmWorkflow(AgentWorkflow):
         conversation=conversation,
         start_message=await self._new_start_message(message, cwd.path),
         command_registry=command_registry,
-        file_access_policy=create_file_access_policy(self._config.agents[
-            message.target_agent].command_registry.file_access_policy or
-                                                     FileAccessPolicyConfig()),
+        file_access_policy=warm_session.file_access_policy,
         confirmation_state=ConfirmationState(confirmation_manager, 30),
         cwd=cwd)
-    raise NotImplementedError()  # {{🍄 create and start agent loop}}
+    setup_time = datetime.timedelta(seconds=time.monotonic() - start)
+    if setup_time > _SESSION_SETUP_TARGET:
+      logging.warning(f"Slow session setup for {conversation_id}: {setup_time}")
+    else:
+      logging.info(f"Session setup for {conversation_id}: {setup_time}")
+    raise NotImplementedError()  # {{🍄 create agent session}}
+
+  async def _run_session(self, conversation_id: ConversationId,
+                         session: AgentSession) -> None:
+    """Runs the session's agent loop; afterwards, the session becomes idle.
+
+    {{🦔 The agent loop is run with an exception handler that will *immediately*
+         log any exceptions that it raises.}}
+    {{🦔 If the agent loop raises, its session is removed from `_sessions` and
+         `_fail_message` is called for `session.message` (with the exception's
+         trace).}}
+    """
+    raise NotImplementedError()  # {{🍄 run session}}
 
   async def _new_start_message(self, message: BusMessage,
                                cwd: pathlib.Path) -> Message:
@@ -152,33 +359,72 @@ class SwarmWorkflow(AgentWorkflow):
     """Adds to the registry an element for each entry in `config.commands`."""
     raise NotImplementedError()  # {{🍄 add shell templates}}
 
-  def _init_command_registry(self, conversation_id: ConversationId,
+  async def _new_warm_session(self, agent: AgentName) -> _WarmSession:
+    """Builds the parts of a session for `agent` that don't need a message."""
+    config = self._config.agents[agent]
+    file_access_policy_config = (
+        config.command_registry.file_access_policy or FileAccessPolicyConfig())
+    warm_session = _WarmSession(
+        cwd=self._options.agent_loop_options.cwd.copy(),
+        command_registry=CommandRegistry(),
+        file_access_policy=create_file_access_policy(file_access_policy_config))
+    # Shared by all agents (and sessions) with the same policy.
+    trigram_index = await shared_trigram_index(
+        pathlib.Path('.'), warm_session.file_access_policy,
+        repr(file_access_policy_config))
+    self._init_command_registry(config, warm_session.file_access_policy,
+                                warm_session.command_registry, warm_session.cwd,
+                                trigram_index)
+    return warm_session
+
+  def _init_command_registry(self,
+                             config: AgentIdentityConfig,
+                             file_access_policy: FileAccessPolicy,
+                             command_registry: CommandRegistry,
+                             cwd: PathBox,
+                             trigram_index: TrigramIndex | None = None) -> None:
+    """Adds to the registry the commands that don't depend on a message.
+
+    `file_access_policy` is the policy at `config.command_registry`.
+
+    {{🦔 The registry contains ReadFileCommand, ListFilesCommand,
+         SearchFileCommand, DoneCommand (with no arguments) and
+         ChangeWorkingDirectoryCommand.}}
+    {{🦔 If `config.command_registry.allow_shell', the registry contains
+         `ShellCommandCommand`.}}
+    {{🦔 If `config.command_registry.writes', the registry contains
+         `WriteFileCommand`.}}
+    {{🦔 If present, `config.command_registry.writes.file_access_policy`
+         merged with `file_access_policy`. The composite policy is given to
+         `WriteFileCommand`.}}
+    {{🦔 Honors `config.shell_templates` (through `_add_shell_templates`).}}
+    {{🦔 All commands use `cwd` (which `_new_session` may still change).}}
+    {{🦔 If given, `trigram_index` is given to `SearchFileCommand` and
+         `WriteFileCommand`.}}
+    """
+    raise NotImplementedError()  # {{🍄 init command registry}}
+
+  def _bind_command_registry(self, conversation_id: ConversationId,
                              telegram_reply_to_id: TelegramMessageId,
                              message: BusMessage, config: AgentIdentityConfig,
                              queue: AgentMessageQueue,
                              command_registry: CommandRegistry,
                              cwd: PathBox) -> None:
-    """Initializes a valid registry for a specific agent identity.
+    """Adds to the registry the commands that depend on `message`.
 
-    {{🦔 The registry contains ReadFileCommand, ListFilesCommand,
-         SearchFileCommand, DoneCommand (with no arguments),
-         ChangeWorkingDirectoryCommand, DisplayInfoCommand and AskUserCommand.}}
-    {{🦔 If `config.command_registry.allow_shell', the registry contains
-         `ShellCommandCommand`.}}
+    The other commands are added by `_init_command_registry`.
+
+    {{🦔 The registry contains DisplayInfoCommand and AskUserCommand.}}
     {{🦔 If `config.command_registry.delegate_request.allow_list' exists and
          is non-empty, the registry contains DelegateRequestCommand.}}
     {{🦔 If `config.command_registry.publish_message.allow_list' exists and
          is non-empty, the registry contains PublishMessageCommand.}}
-    {{🦔 If `config.command_registry.writes', the registry contains
-         `WriteFileCommand`.}}
-    {{🦔 If present, `config.command_registry.writes.file_access_policy`
-         merged with the policy at `config.command_registry`. The composite
-         policy is given to `WriteFileCommand`.}}
-    {{🦔 Ignores `message.local_directory` (which should have been applied by
-         the caller).}}
-    {{🦔 Honors `config.shell_templates` (through `_add_shell_templates`).
+    {{🦔 If `config.command_registry.publish_message.topics' exists and is
+         non-empty, the registry contains PublishTopicMessageCommand.}}
+    {{🦔 Ignores `message.local_directory` (which should have been applied to
+         `cwd` by the caller).}}
     """
-    raise NotImplementedError()  # {{🍄 init command registry}}
+    raise NotImplementedError()  # {{🍄 bind command registry}}
 
 
 class SwarmWorkflowFactory(AgentWorkflowFactory):
@@ -186,6 +432,14 @@ class SwarmWorkflowFactory(AgentWorkflowFactory):
   def name(self) -> str:
     return "swarm"
 
+  def sharded(self) -> bool:
+    return True
+
   async def new(self, agent_workflow_options: AgentWorkflowOptions,
                 args: dict[str, str]) -> AgentWorkflow:
-    return SwarmWorkflow(agent_workflow_options)
+    shard = None
+    if 'shard_index' in args:
+      shard = Shard(int(args['shard_index']), int(args['shard_count']))
+      if not 0 <= shard.index < shard.count:
+        raise ValueError(f"Invalid shard: {shard}")
+    return SwarmWorkflow(agent_workflow_options, shard)
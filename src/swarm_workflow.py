@@ -3,11 +3,15 @@ import aiofiles
 import asyncio
 import dataclasses
 import datetime
+import functools
 import json
 import logging
+import os
 import pathlib
 import sqlite3
-from typing import NewType
+import time
+import traceback
+from typing import Awaitable, Callable, Iterable, NewType
 import uuid
 
 from agent_loop_options import BaseAgentLoop
@@ -17,22 +21,73 @@ from command_registry import CommandRegistry
 from confirmation import ConfirmationManager, ConfirmationState
 from conversation import ConversationId, Conversation
 from done_command import DoneCommand
-from file_access_policy import create_file_access_policy, FileAccessPolicyConfig, CompositeFileAccessPolicy
+from file_access_policy import create_file_access_policy, FileAccessPolicy, FileAccessPolicyConfig, CompositeFileAccessPolicy
 from list_files_command import ListFilesCommand
 from message import ContentSection, Message
 import message_bus
-from message_bus import Message as BusMessage, MessageBus, TelegramChatId, TelegramMessageId
+from message_bus import Message as BusMessage, MessageBus, RetryPolicy, SqliteMessageBus, TelegramChatId, TelegramMessageId, WorkerId
 from message_queue import AgentMessageQueue
 from pathbox import PathBox
 import shell_command_command
-from swarm_commands import AskUserCommand, DelegateRequestConfig, DelegateRequestCommand, DisplayInfoCommand, PublishMessageCommand, PublishMessageConfig
+from swarm_commands import AskUserCommand, DelegateRequestConfig, DelegateRequestCommand, DisplayInfoCommand, PublishMessageCommand, PublishMessageConfig, PublishTopicMessageCommand
 from swarm_config import AgentIdentityConfig, SwarmConfig, load_config
+from swarm_scheduler import SessionPriority, SessionScheduler
+from swarm_session_pool import SessionPool
 from swarm_types import AgentName
 from search_file_command import SearchFileCommand
 from read_file_command import ReadFileCommand
 from working_directory_command import ChangeWorkingDirectoryCommand
+from trigram_index import TrigramIndex, shared_trigram_index
 from write_file_command import WriteFileCommand
 
+# How long other swarm workers sharing the bus must wait before they can take
+# over messages claimed by this one (if it stops extending the leases).
+_CLAIM_LEASE = datetime.timedelta(minutes=1)
+
+# Writes to the bus (e.g., from many agents running concurrently) issued within
+# this window are grouped into a single transaction.
+_WRITE_BEHIND = datetime.timedelta(milliseconds=5)
+
+# How often to archive old messages from the bus and compact it.
+_RETENTION_PERIOD = datetime.timedelta(hours=1)
+
+# Messages whose processing fails (e.g., during a model outage) are retried with
+# this policy before they become dead letters.
+_RETRY_POLICY = RetryPolicy(
+    max_attempts=3,
+    backoff=datetime.timedelta(seconds=30),
+    max_backoff=datetime.timedelta(minutes=10))
+
+# Sessions whose agent loop finished are kept in memory (so that a reply
+# resumes them with their full conversation) for this long. After that, a reply
+# restarts them from their messages in the bus.
+_SESSION_IDLE_TIMEOUT = datetime.timedelta(minutes=30)
+
+# Setting up a session for a message (once its agent's parts are taken from the
+# session pool) should take less than this; slower setups are logged as
+# warnings.
+_SESSION_SETUP_TARGET = datetime.timedelta(milliseconds=100)
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+  """A part of the swarm's agents, run by one of `count` workflow workers."""
+  index: int
+  count: int
+
+
+def shard_agents(agents: Iterable[AgentName],
+                 shard: Shard | None) -> list[AgentName]:
+  """Returns the agents (sorted) that `shard` runs (all if it's None).
+
+  Agents are assigned to shards round-robin, by name. All shards must see the
+  same agents.
+  """
+  output = sorted(agents)
+  if shard is None:
+    return output
+  return output[shard.index::shard.count]
+
 
 class SwarmConfirmationManager(ConfirmationManager):
 
@@ -58,73 +113,263 @@ class AgentSession:
   conversation: Conversation
   loop: BaseAgentLoop
   message_queue: AgentMessageQueue
+  # The incoming message that (re)started `loop` most recently.
+  message: BusMessage
+  # Whether `loop` is running (or scheduled to run).
+  active: bool = True
+  # When `loop` last finished (`time.monotonic()`).
+  idle_since: float = 0.0
+
+
+@dataclasses.dataclass
+class _WarmSession:
+  """The parts of a session that don't depend on its message.
+
+  Built ahead of time (see `SwarmWorkflow._new_warm_session`) and bound to a
+  message by `SwarmWorkflow._new_session`.
+  """
+  cwd: PathBox
+  command_registry: CommandRegistry
+  file_access_policy: FileAccessPolicy
 
 
 class SwarmWorkflow(AgentWorkflow):
 
-  def __init__(self, options: AgentWorkflowOptions) -> None:
+  def __init__(self,
+               options: AgentWorkflowOptions,
+               shard: Shard | None = None) -> None:
     self._options = options
-    self._background_tasks: list[asyncio.Task[None]] = []
+    # If set, only the agents in the shard (see `shard_agents`) are run.
+    self._shard = shard
     self._sessions: dict[ConversationId, AgentSession] = {}
 
   async def run(self) -> None:
     self._config = await load_config(
         self._options.config_path or pathlib.Path('swarm/config.json'))
-    self._message_bus = MessageBus(self._config.message_bus_path)
+    self._agents = shard_agents(self._config.agents, self._shard)
+    if not self._agents:
+      logging.warning(f"No agents in shard {self._shard}.")
+      return
+    logging.info(f"Running agents (shard {self._shard}): {self._agents}")
+    self._message_bus = SqliteMessageBus(
+        self._config.message_bus_path, write_behind=_WRITE_BEHIND)
     await self._message_bus.open()
+    for agent in self._agents:
+      await self._message_bus.set_subscriptions(
+          agent, self._config.agents[agent].subscriptions)
+    # Several swarm workers can share a bus: each message is processed by the
+    # worker that claims it.
+    self._worker_id = WorkerId(f"swarm-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+    self._scheduler = SessionScheduler(
+        self._config.max_concurrent_sessions, {
+            name: agent.max_concurrent_sessions
+            for name, agent in self._config.agents.items()
+            if agent.max_concurrent_sessions is not None
+        })
+    self._session_pool = SessionPool(self._new_warm_session, self._agents)
+    self._session_pool.start()
+    heartbeat = asyncio.create_task(self._extend_leases_periodically())
+    retention = asyncio.create_task(self._run_retention_periodically())
+    eviction = asyncio.create_task(self._evict_idle_sessions_periodically())
+    try:
+      while True:
+        # Claimed messages are marked as processed once handed off (see
+        # `_process_message`); until then, we keep extending their leases.
+        messages = await self._message_bus.wait_for_claimed_messages(
+            self._agents, self._worker_id, _CLAIM_LEASE)
+        for message in messages:
+          try:
+            await self._process_message(message)
+          except Exception:
+            logging.exception(
+                f"Failed to process message {message.message_id}.")
+            await self._fail_message(message, traceback.format_exc())
+    finally:
+      heartbeat.cancel()
+      retention.cancel()
+      eviction.cancel()
+      await self._scheduler.stop()
+      await self._session_pool.stop()
+      await self._message_bus.release_claims(self._worker_id)
+
+  async def _extend_leases_periodically(self) -> None:
+    """Extends the leases of our claimed messages (before they expire)."""
+    # ✨ extend leases periodically
     while True:
-      for message in await self._message_bus.wait_for_incoming_messages(
-          list(self._config.agents)):
-        await self._process_message(message)
+      await asyncio.sleep(_CLAIM_LEASE.total_seconds() / 3)
+      try:
+        await self._message_bus.extend_leases(self._worker_id, _CLAIM_LEASE)
+      except Exception:
+        logging.exception("Failed to extend leases.")
+    # ✨
+
+  async def _run_retention_periodically(self) -> None:
+    """Archives old messages and compacts the bus every `_RETENTION_PERIOD`.
+
+    Logs the statistics of the bus, the scheduler, the session pool and the
+    prompt sources after each run. If `_shard` is set, only shard 0 archives
+    and compacts the bus (shared by all shards).
+    """
+    # ✨ run retention periodically
+    while True:
+      try:
+        if self._shard is None or self._shard.index == 0:
+          if self._config.message_bus_retention_days:
+            await self._message_bus.archive_messages(
+                datetime.timedelta(days=self._config.message_bus_retention_days)
+            )
+          await self._message_bus.compact()
+        logging.info(f"Message bus: {await self._message_bus.stats()}")
+        logging.info(f"Scheduler: {self._scheduler.stats()}")
+        logging.info(f"Session pool: {self._session_pool.stats()}")
+        for prompt_stats in self._config.prompt_cache.stats():
+          logging.info(f"Prompt source: {prompt_stats}")
+      except Exception:
+        logging.exception("Message bus retention failed.")
+      await asyncio.sleep(_RETENTION_PERIOD.total_seconds())
+    # ✨
+
+  async def _evict_idle_sessions_periodically(self) -> None:
+    """Evicts sessions idle for longer than `_SESSION_IDLE_TIMEOUT`.
+
+    Removes them from `_sessions` and their conversations from the conversation
+    factory. Active sessions are never evicted.
+    """
+    # ✨ evict idle sessions periodically
+    while True:
+      await asyncio.sleep(_SESSION_IDLE_TIMEOUT.total_seconds() / 4)
+      cutoff = time.monotonic() - _SESSION_IDLE_TIMEOUT.total_seconds()
+      evicted = [
+          conversation_id
+          for conversation_id, session in self._sessions.items()
+          if not session.active and session.idle_since < cutoff
+      ]
+      for conversation_id in evicted:
+        session = self._sessions.pop(conversation_id)
+        self._options.conversation_factory.Remove(session.conversation.GetId())
+      if evicted:
+        logging.info(f"Evicted {len(evicted)} idle sessions; "
+                     f"{len(self._sessions)} remain.")
+    # ✨
 
   async def _process_message(self, message: BusMessage) -> None:
-    """Receives a new incoming message.
+    """Receives a new incoming message (claimed, but not yet processed).
 
-    Sets the `process_at` cell to the current time.
+    Marks the message as processed once it has been handed off: when its
+    session starts (see `_schedule_session`) or, if no session is scheduled,
+    before returning. While a session waits in `_scheduler`, its message remains
+    leased (so that, if this worker dies, another one claims it).
 
-    * If `message.source_agent` is NOT the value in END_USER_AGENT: calls
-      `_start_agent_loop`.
+    * If `message.source_agent` is NOT the value in END_USER_AGENT: schedules
+      `_start_agent_loop` (through `_schedule_session`).
 
-    * Otherwise, if the `message.message_reply_to_id is None`: calls
+    * Otherwise, if the `message.message_reply_to_id is None`: schedules
       `_start_agent_loop`.
 
-    * Otherwise, if the replied-to message can be found in the bus and the
-      replied-to message has a `conversation_id` found in `_sessions`: adds the
-      content of the message to the session's `message_queue`.
+    * Otherwise, if the replied-to message can be found in the bus and has a
+      `conversation_id`, sets it as the message's `conversation_id` (if unset)
+      and:
+
+      * If the session is in `_sessions` and active: adds the content of the
+        message to the session's `message_queue`.
+
+      * If the session is in `_sessions` (but idle): marks it active, sets the
+        message as the next message of its loop and schedules `_run_session`.
+
+      * If the session isn't in `_sessions` (e.g., it was evicted) but
+        `_restore_session` finds it in the bus, schedules `_run_session`.
 
     * Otherwise: writes an outgoing message informing the user that the session
       no longer exists.
     """
     # ✨ process message
-    await self._message_bus.mark_as_processed(message.message_id)
-
-    if message.source_agent != message_bus.END_USER_AGENT:
-      # If the message is from another agent, always start a new agent loop.
-      await self._start_agent_loop(message)
-    elif message.telegram_reply_to_id is None:
-      # If the message is from the end user and is not a reply, start a new agent loop.
-      await self._start_agent_loop(message)
+    if (message.source_agent != message_bus.END_USER_AGENT or
+        message.telegram_reply_to_id is None):
+      # Messages from other agents and (non-reply) messages from the end user
+      # start new sessions.
+      self._schedule_session(message,
+                             functools.partial(self._start_agent_loop, message))
+      return
+
+    # The message is from the end user and is a reply. Try to find the original
+    # message that the user is replying to (and its session).
+    conversation_id: ConversationId | None = None
+    try:
+      replied_to_bus_message = await self._message_bus.find_message_by_telegram_id(
+          message.telegram_chat_id, message.telegram_reply_to_id)
+      conversation_id = replied_to_bus_message.conversation_id
+    except ValueError:
+      # The replied-to message was not found in the bus.
+      pass
+
+    session: AgentSession | None = None
+    if conversation_id is not None:
+      session = self._sessions.get(conversation_id)
+      if message.conversation_id is None:
+        await self._message_bus.set_conversation_id(message.message_id,
+                                                    conversation_id)
+      if session is None:
+        try:
+          session = await self._restore_session(message, conversation_id)
+        except ValueError:
+          logging.info(f"Session {conversation_id} not found in the bus.")
+        else:
+          self._schedule_session(
+              message,
+              functools.partial(self._run_session, conversation_id, session))
+          return
+
+    if conversation_id is None or session is None:
+      # Inform the user that the session no longer exists.
+      outgoing_message = BusMessage(
+          message_id=message_bus.MessageId(0),
+          source_agent=message.target_agent,
+          target_agent=AgentName(message_bus.END_USER_AGENT),
+          local_directory=None,
+          conversation_id=None,
+          telegram_chat_id=message.telegram_chat_id,
+          telegram_message_id=None,
+          telegram_reply_to_id=message.telegram_message_id,
+          content=message_bus.MessageContent(
+              "This conversation session no longer exists. Please start a new conversation."
+          ),
+          queued_at=datetime.datetime.now(datetime.timezone.utc),
+          processed_at=None,
+      )
+      await self._message_bus.write_new_message(outgoing_message)
+      await self._message_bus.mark_as_processed(message.message_id)
+    elif session.active:
+      await session.message_queue.push(message.content)
+      await self._message_bus.mark_as_processed(message.message_id)
     else:
-      # The message is from the end user and is a reply.
-      # Try to find the original message that the user is replying to.
-      replied_to_bus_message: BusMessage | None = None
-      try:
-        replied_to_bus_message = await self._message_bus.find_message_by_telegram_id(
-            message.telegram_chat_id, message.telegram_reply_to_id)
-      except ValueError:
-        # The replied-to message was not found in the bus.
-        # This implies the session might be gone or never existed in this bus.
-        pass
-
-      if replied_to_bus_message and replied_to_bus_message.conversation_id in self._sessions:
-        # If the replied-to message has a conversation_id and that session exists,
-        # add the new message content to the session's message queue.
-        session = self._sessions[replied_to_bus_message.conversation_id]
-        await session.message_queue.push(message.content)
-      else:
-        # If the session no longer exists or the replied-to message was not found,
-        # inform the user that the session no longer exists.
-        outgoing_message = BusMessage(
+      # The session's loop finished: run it again, continuing its conversation.
+      session.active = True
+      session.message = message
+      session.loop.set_next_message(
+          Message(
+              role='user',
+              content_sections=[
+                  ContentSection(content="<user_reply>" + message.content +
+                                 "</user_reply>")
+              ]))
+      self._schedule_session(
+          message, functools.partial(self._run_session, conversation_id,
+                                     session))
+    # ✨
+
+  async def _fail_message(self, message: BusMessage, error: str) -> None:
+    """Records (in the bus) a failure processing `message`.
+
+    Calls `MessageBus.fail_message` with `_RETRY_POLICY`. If the message became
+    a dead letter, writes an outgoing message (in reply to `message`) telling
+    the user that the request failed and its message id (for `/requeue`).
+    """
+    # ✨ fail message
+    if await self._message_bus.fail_message(message.message_id, error,
+                                            _RETRY_POLICY):
+      return
+    await self._message_bus.write_new_message(
+        BusMessage(
             message_id=message_bus.MessageId(0),
             source_agent=message.target_agent,
             target_agent=AgentName(message_bus.END_USER_AGENT),
@@ -134,33 +379,115 @@ class SwarmWorkflow(AgentWorkflow):
             telegram_message_id=None,
             telegram_reply_to_id=message.telegram_message_id,
             content=message_bus.MessageContent(
-                "This conversation session no longer exists. Please start a new conversation."
-            ),
+                f"This request failed {_RETRY_POLICY.max_attempts} times and "
+                f"was moved to dead letters (message {message.message_id}); "
+                "it can be retried with /requeue."),
             queued_at=datetime.datetime.now(datetime.timezone.utc),
             processed_at=None,
-        )
-        await self._message_bus.write_new_message(outgoing_message)
+        ))
+    # ✨
+
+  def _schedule_session(self, message: BusMessage,
+                        run: Callable[[], Awaitable[None]]) -> None:
+    """Submits `run` (which processes `message`) to `_scheduler`.
+
+    The session is queued in the message's Telegram chat, for its target agent.
+    Messages from END_USER_AGENT have priority `SessionPriority.END_USER`;
+    messages from other agents (delegation), `SessionPriority.AGENT`. When the
+    session starts, marks `message` as processed before calling `run` (if that
+    fails, e.g. because another worker processed it after our lease expired,
+    logs it and doesn't call `run`). If `run` raises, logs the exception and
+    calls `_fail_message`.
+    """
+    # ✨ schedule session
+    assert message.target_agent
+
+    async def run_session() -> None:
+      try:
+        await self._message_bus.mark_as_processed(message.message_id)
+      except ValueError:
+        logging.exception(
+            f"Failed to mark message {message.message_id} as processed.")
+        return
+      try:
+        await run()
+      except Exception:
+        logging.exception(
+            f"Failed to run session for message {message.message_id}.")
+        await self._fail_message(message, traceback.format_exc())
+
+    self._scheduler.submit(
+        message.telegram_chat_id, message.target_agent,
+        SessionPriority.END_USER if message.source_agent
+        == message_bus.END_USER_AGENT else SessionPriority.AGENT, run_session)
     # ✨
 
   async def _start_agent_loop(self, message: BusMessage) -> None:
-    """Starts a new agent loop.
+    """Runs a new session for `message` (until its agent loop finishes).
 
-    Calls `MessageBus.set_conversation_id` to write the new conversation id.
+    Calls `MessageBus.start_session` to get the conversation id (which also
+    writes it to `message`), `_new_session` and `_run_session`.
+    """
+    # ✨ start agent loop
+    bus_session = await self._message_bus.start_session(message.message_id)
+    session = await self._new_session(message, bus_session.conversation_id)
+    await self._run_session(bus_session.conversation_id, session)
+    # ✨
 
-    {{🦔 The agent loop is run with an exception handler that will *immediately*
-         log any exceptions that it raises.
+  async def _restore_session(self, message: BusMessage,
+                             conversation_id: ConversationId) -> AgentSession:
+    """Restarts a session that is no longer in memory, for a reply.
+
+    Reads the session and its messages (which include `message`) from the bus
+    and calls `_new_session` with a transcript of the messages as the content.
+    The agent, chat and local directory are those of the session. Raises
+    ValueError if the session isn't in the bus.
+    """
+    # ✨ restore session
+    bus_session = await self._message_bus.read_session(conversation_id)
+    if bus_session.agent not in self._config.agents:
+      raise ValueError(f"Unknown agent: {bus_session.agent}")
+    history = await self._message_bus.read_conversation(conversation_id)
+    transcript = [
+        "This conversation was interrupted. Its messages follow; continue it "
+        "(the last message is new)."
+    ]
+    for entry in history:
+      author = ("user" if entry.source_agent == message_bus.END_USER_AGENT else
+                entry.source_agent)
+      transcript.append(f'<message from="{author}">{entry.content}</message>')
+    logging.info(f"Restoring session {conversation_id} "
+                 f"({len(history)} messages).")
+    return await self._new_session(
+        dataclasses.replace(
+            message,
+            target_agent=bus_session.agent,
+            local_directory=history[0].local_directory if history else None,
+            content=message_bus.MessageContent("\n".join(transcript))),
+        conversation_id)
+    # ✨
+
+  async def _new_session(self, message: BusMessage,
+                         conversation_id: ConversationId) -> AgentSession:
+    """Creates a session (with a new agent loop) and adds it to `_sessions`.
+
+    Takes the parts of the session that don't depend on `message` from
+    `_session_pool` and binds them to `message`. Commands in the session write
+    `conversation_id` to the messages they send.
     """
     assert message.target_agent
+    start = time.monotonic()
     telegram_id = message.telegram_message_id or message.telegram_reply_to_id
     assert telegram_id
     agent_message_queue = AgentMessageQueue()
-    cwd = self._options.agent_loop_options.cwd.copy()
+    warm_session = await self._session_pool.take(message.target_agent)
+    cwd = warm_session.cwd
     if message.local_directory:
       cwd.path = cwd / message.local_directory
-    command_registry = CommandRegistry()
+    command_registry = warm_session.command_registry
     conversation = self._options.conversation_factory.New(
         f"{message.target_agent}: {message.content[:50]}", command_registry)
-    self._init_command_registry(conversation.GetId(), telegram_id, message,
+    self._bind_command_registry(conversation_id, telegram_id, message,
                                 self._config.agents[message.target_agent],
                                 agent_message_queue, command_registry, cwd)
     confirmation_manager = SwarmConfirmationManager(
@@ -170,31 +497,46 @@ class SwarmWorkflow(AgentWorkflow):
         conversation=conversation,
         start_message=await self._new_start_message(message, cwd.path),
         command_registry=command_registry,
-        file_access_policy=create_file_access_policy(self._config.agents[
-            message.target_agent].command_registry.file_access_policy or
-                                                     FileAccessPolicyConfig()),
+        file_access_policy=warm_session.file_access_policy,
         confirmation_state=ConfirmationState(confirmation_manager, 30),
         cwd=cwd)
-    # ✨ create and start agent loop
-    agent_loop = self._options.agent_loop_factory.new(agent_loop_options)
+    setup_time = datetime.timedelta(seconds=time.monotonic() - start)
+    if setup_time > _SESSION_SETUP_TARGET:
+      logging.warning(f"Slow session setup for {conversation_id}: {setup_time}")
+    else:
+      logging.info(f"Session setup for {conversation_id}: {setup_time}")
+    # ✨ create agent session
     session = AgentSession(
         conversation=conversation,
-        loop=agent_loop,
+        loop=self._options.agent_loop_factory.new(agent_loop_options),
         message_queue=agent_message_queue,
+        message=message,
     )
-    self._sessions[conversation.GetId()] = session
-
-    await self._message_bus.set_conversation_id(message.message_id,
-                                                conversation.GetId())
+    self._sessions[conversation_id] = session
+    return session
+    # ✨
 
-    async def _run_agent_loop_task(loop: BaseAgentLoop) -> None:
-      try:
-        await loop.run()
-      except Exception:
-        logging.exception("Background agent loop failed.")
+  async def _run_session(self, conversation_id: ConversationId,
+                         session: AgentSession) -> None:
+    """Runs the session's agent loop; afterwards, the session becomes idle.
 
-    self._background_tasks.append(
-        asyncio.create_task(_run_agent_loop_task(agent_loop)))
+    {{🦔 The agent loop is run with an exception handler that will *immediately*
+         log any exceptions that it raises.}}
+    {{🦔 If the agent loop raises, its session is removed from `_sessions` and
+         `_fail_message` is called for `session.message` (with the exception's
+         trace).}}
+    """
+    # ✨ run session
+    try:
+      await session.loop.run()
+    except Exception:
+      logging.exception(f"Agent loop for session {conversation_id} failed.")
+      self._sessions.pop(conversation_id, None)
+      self._options.conversation_factory.Remove(session.conversation.GetId())
+      await self._fail_message(session.message, traceback.format_exc())
+    else:
+      session.active = False
+      session.idle_since = time.monotonic()
     # ✨
 
   async def _new_start_message(self, message: BusMessage,
@@ -228,73 +570,61 @@ class SwarmWorkflow(AgentWorkflow):
               cwd, command_config))
     # ✨
 
-  def _init_command_registry(self, conversation_id: ConversationId,
-                             telegram_reply_to_id: TelegramMessageId,
-                             message: BusMessage, config: AgentIdentityConfig,
-                             queue: AgentMessageQueue,
+  async def _new_warm_session(self, agent: AgentName) -> _WarmSession:
+    """Builds the parts of a session for `agent` that don't need a message."""
+    config = self._config.agents[agent]
+    file_access_policy_config = (
+        config.command_registry.file_access_policy or FileAccessPolicyConfig())
+    warm_session = _WarmSession(
+        cwd=self._options.agent_loop_options.cwd.copy(),
+        command_registry=CommandRegistry(),
+        file_access_policy=create_file_access_policy(file_access_policy_config))
+    # Shared by all agents (and sessions) with the same policy.
+    trigram_index = await shared_trigram_index(
+        pathlib.Path('.'), warm_session.file_access_policy,
+        repr(file_access_policy_config))
+    self._init_command_registry(config, warm_session.file_access_policy,
+                                warm_session.command_registry, warm_session.cwd,
+                                trigram_index)
+    return warm_session
+
+  def _init_command_registry(self,
+                             config: AgentIdentityConfig,
+                             file_access_policy: FileAccessPolicy,
                              command_registry: CommandRegistry,
-                             cwd: PathBox) -> None:
-    """Initializes a valid registry for a specific agent identity.
+                             cwd: PathBox,
+                             trigram_index: TrigramIndex | None = None) -> None:
+    """Adds to the registry the commands that don't depend on a message.
+
+    `file_access_policy` is the policy at `config.command_registry`.
 
     {{🦔 The registry contains ReadFileCommand, ListFilesCommand,
-         SearchFileCommand, DoneCommand (with no arguments),
-         ChangeWorkingDirectoryCommand, DisplayInfoCommand and AskUserCommand.}}
+         SearchFileCommand, DoneCommand (with no arguments) and
+         ChangeWorkingDirectoryCommand.}}
     {{🦔 If `config.command_registry.allow_shell', the registry contains
          `ShellCommandCommand`.}}
-    {{🦔 If `config.command_registry.delegate_request.allow_list' exists and
-         is non-empty, the registry contains DelegateRequestCommand.}}
-    {{🦔 If `config.command_registry.publish_message.allow_list' exists and
-         is non-empty, the registry contains PublishMessageCommand.}}
     {{🦔 If `config.command_registry.writes', the registry contains
          `WriteFileCommand`.}}
     {{🦔 If present, `config.command_registry.writes.file_access_policy`
-         merged with the policy at `config.command_registry`. The composite
-         policy is given to `WriteFileCommand`.}}
-    {{🦔 Ignores `message.local_directory` (which should have been applied by
-         the caller).}}
-    {{🦔 Honors `config.shell_templates` (through `_add_shell_templates`).
+         merged with `file_access_policy`. The composite policy is given to
+         `WriteFileCommand`.}}
+    {{🦔 Honors `config.shell_templates` (through `_add_shell_templates`).}}
+    {{🦔 All commands use `cwd` (which `_new_session` may still change).}}
+    {{🦔 If given, `trigram_index` is given to `SearchFileCommand` and
+         `WriteFileCommand`.}}
     """
     # ✨ init command registry
-    agent_current_working_directory = cwd
-
-    # Create file access policy from config
-    file_access_policy_config = config.command_registry.file_access_policy or FileAccessPolicyConfig(
-    )
-    file_access_policy = create_file_access_policy(file_access_policy_config)
-
     # Register basic commands
     command_registry.Register(DoneCommand([]))
-    command_registry.Register(ReadFileCommand(agent_current_working_directory))
+    command_registry.Register(ReadFileCommand(cwd))
+    command_registry.Register(ListFilesCommand(cwd, file_access_policy))
     command_registry.Register(
-        ListFilesCommand(agent_current_working_directory, file_access_policy))
-    command_registry.Register(
-        SearchFileCommand(agent_current_working_directory, file_access_policy))
-    command_registry.Register(
-        ChangeWorkingDirectoryCommand(agent_current_working_directory))
-    command_registry.Register(
-        DisplayInfoCommand(self._message_bus, conversation_id,
-                           message.telegram_chat_id, telegram_reply_to_id,
-                           message.target_agent))
-    command_registry.Register(
-        AskUserCommand(self._message_bus, queue, conversation_id,
-                       message.telegram_chat_id, telegram_reply_to_id,
-                       message.target_agent))
-
-    # Register PublishMessageCommand if configured
-    if (config.command_registry.publish_message and
-        config.command_registry.publish_message.allow_list):
-      command_registry.Register(
-          PublishMessageCommand(config.command_registry.publish_message,
-                                self._message_bus,
-                                agent_current_working_directory,
-                                message.telegram_chat_id, telegram_reply_to_id,
-                                message.target_agent))
+        SearchFileCommand(cwd, file_access_policy, trigram_index))
+    command_registry.Register(ChangeWorkingDirectoryCommand(cwd))
 
     # Register ShellCommandCommand if allowed
     if config.command_registry.allow_shell:
-      command_registry.Register(
-          shell_command_command.ShellCommandCommand(
-              agent_current_working_directory))
+      command_registry.Register(shell_command_command.ShellCommandCommand(cwd))
 
     # Register WriteFileCommand if configured
     if config.command_registry.writes:
@@ -310,14 +640,70 @@ class SwarmWorkflow(AgentWorkflow):
 
       command_registry.Register(
           WriteFileCommand(
-              cwd=agent_current_working_directory,
+              cwd=cwd,
               file_access_policy=composite_write_file_access_policy,
               validation_manager=self._options.agent_loop_options
               .validation_manager,
               selection_manager=self._options.selection_manager,
               hard_coded_path=None,
+              trigram_index=trigram_index,
           ))
 
+    # Register shell templates if configured
+    if config.command_registry.shell_templates:
+      self._add_shell_templates(config.command_registry.shell_templates,
+                                command_registry, cwd)
+    # ✨
+
+  def _bind_command_registry(self, conversation_id: ConversationId,
+                             telegram_reply_to_id: TelegramMessageId,
+                             message: BusMessage, config: AgentIdentityConfig,
+                             queue: AgentMessageQueue,
+                             command_registry: CommandRegistry,
+                             cwd: PathBox) -> None:
+    """Adds to the registry the commands that depend on `message`.
+
+    The other commands are added by `_init_command_registry`.
+
+    {{🦔 The registry contains DisplayInfoCommand and AskUserCommand.}}
+    {{🦔 If `config.command_registry.delegate_request.allow_list' exists and
+         is non-empty, the registry contains DelegateRequestCommand.}}
+    {{🦔 If `config.command_registry.publish_message.allow_list' exists and
+         is non-empty, the registry contains PublishMessageCommand.}}
+    {{🦔 If `config.command_registry.publish_message.topics' exists and is
+         non-empty, the registry contains PublishTopicMessageCommand.}}
+    {{🦔 Ignores `message.local_directory` (which should have been applied to
+         `cwd` by the caller).}}
+    """
+    # ✨ bind command registry
+    command_registry.Register(
+        DisplayInfoCommand(self._message_bus, conversation_id,
+                           message.telegram_chat_id, telegram_reply_to_id,
+                           message.target_agent))
+    command_registry.Register(
+        AskUserCommand(self._message_bus, queue, conversation_id,
+                       message.telegram_chat_id, telegram_reply_to_id,
+                       message.target_agent))
+
+    # Register PublishMessageCommand if configured
+    if (config.command_registry.publish_message and
+        config.command_registry.publish_message.allow_list):
+      command_registry.Register(
+          PublishMessageCommand(config.command_registry.publish_message,
+                                self._message_bus, cwd,
+                                message.telegram_chat_id, telegram_reply_to_id,
+                                message.target_agent))
+
+    # Register PublishTopicMessageCommand if configured
+    if (config.command_registry.publish_message and
+        config.command_registry.publish_message.topics):
+      command_registry.Register(
+          PublishTopicMessageCommand(config.command_registry.publish_message,
+                                     self._message_bus, cwd,
+                                     message.telegram_chat_id,
+                                     telegram_reply_to_id,
+                                     message.target_agent))
+
     # Register DelegateRequestCommand if configured
     if (config.command_registry.delegate_request and
         config.command_registry.delegate_request.allow_list):
@@ -331,12 +717,6 @@ class SwarmWorkflow(AgentWorkflow):
               message.target_agent,
               message.content,
           ))
-
-    # Register shell templates if configured
-    if config.command_registry.shell_templates:
-      self._add_shell_templates(config.command_registry.shell_templates,
-                                command_registry,
-                                agent_current_working_directory)
     # ✨
 
 
@@ -345,6 +725,14 @@ class SwarmWorkflowFactory(AgentWorkflowFactory):
   def name(self) -> str:
     return "swarm"
 
+  def sharded(self) -> bool:
+    return True
+
   async def new(self, agent_workflow_options: AgentWorkflowOptions,
                 args: dict[str, str]) -> AgentWorkflow:
-    return SwarmWorkflow(agent_workflow_options)
+    shard = None
+    if 'shard_index' in args:
+      shard = Shard(int(args['shard_index']), int(args['shard_count']))
+      if not 0 <= shard.index < shard.count:
+        raise ValueError(f"Invalid shard: {shard}")
+    return SwarmWorkflow(agent_workflow_options, shard)
@@ -1,17 +1,336 @@
 import asyncio
+import collections
 import datetime
 import logging
 import pathlib
-from telegram import Update
+import time
+from typing import Awaitable, Callable
+import urllib.parse
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from telegram import Bot, Update
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 import message_bus as mb
-from swarm_config import load_config, SwarmConfig
+from swarm_config import load_config, SwarmConfig, TelegramWebhookConfig
+
+# Bus cursor (see `MessageBus.read_cursor`) with the last outgoing message
+# consumed by the adapter.
+_OUTGOING_CURSOR = "telegram-adapter:outgoing"
+
+# Longest error shown (per dead letter) by `/dead_letters`.
+_DEAD_LETTER_ERROR_CHARS = 300
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO)
 
+# Telegram's limits on sending messages: about one per second in each chat
+# (with short bursts) and 30 per second overall.
+_CHAT_RATE = 1.0
+_CHAT_BURST = 3
+_GLOBAL_RATE = 30.0
+_GLOBAL_BURST = 30
+
+# Consecutive outgoing messages to a chat queued within this window (of the
+# first one) are sent as one Telegram message (see `OutboundDispatcher`).
+_COALESCE_WINDOW = datetime.timedelta(milliseconds=500)
+
+# Acks (`MessageBus.set_telegram_message_ids`) are written in batches, at most
+# this often.
+_ACK_INTERVAL = datetime.timedelta(milliseconds=500)
+
+# Sends a Telegram message (to a chat, optionally in reply to a message);
+# returns its Telegram message id.
+SendFunction = Callable[[mb.TelegramChatId, str, mb.TelegramMessageId | None],
+                        Awaitable[mb.TelegramMessageId]]
+
+
+class TokenBucket:
+  """Allows `rate` events per second on average, in bursts of up to `burst`."""
+
+  def __init__(self,
+               rate: float,
+               burst: int,
+               clock: Callable[[], float] = time.monotonic) -> None:
+    self._rate = rate
+    self._burst = burst
+    self._clock = clock
+    self._tokens = float(burst)
+    self._updated = clock()
+
+  def _refill(self) -> None:
+    now = self._clock()
+    self._tokens = min(self._burst,
+                       self._tokens + (now - self._updated) * self._rate)
+    self._updated = now
+
+  def delay(self) -> float:
+    """Returns how long (in seconds) until a token is available."""
+    self._refill()
+    return max(0.0, (1 - self._tokens) / self._rate)
+
+  def take(self) -> None:
+    """Consumes a token (which should be available; see `delay`)."""
+    self._refill()
+    self._tokens -= 1
+
+
+class OutboundDispatcher:
+  """Sends outgoing bus messages to Telegram, within its rate limits.
+
+  Each chat has its own queue, drained (in order) by its own task. Sending
+  waits for a token from both the chat's `TokenBucket` (`chat_rate`,
+  `chat_burst`) and the global one.
+  Consecutive messages in a chat from the same agent and conversation (and
+  replying to the same message) are joined into a single Telegram message (up
+  to `MessageLimit.MAX_TEXT_LENGTH` characters) if they're queued within
+  `coalesce_window` of the first one; all of them get its Telegram message id.
+
+  Messages are attempted once: failures are logged and dropped, except for
+  Telegram's `RetryAfter` errors (which wait and retry). The Telegram message
+  ids are written to the bus in batches (every `ack_interval`), together with
+  the cursor `cursor_name`: the last message such that all messages up to it
+  have been attempted.
+  """
+
+  def __init__(self,
+               message_bus: mb.MessageBus,
+               send: SendFunction,
+               cursor_name: str,
+               chat_rate: float = _CHAT_RATE,
+               chat_burst: int = _CHAT_BURST,
+               global_rate: float = _GLOBAL_RATE,
+               global_burst: int = _GLOBAL_BURST,
+               coalesce_window: datetime.timedelta = _COALESCE_WINDOW,
+               ack_interval: datetime.timedelta = _ACK_INTERVAL) -> None:
+    self._message_bus = message_bus
+    self._send = send
+    self._cursor_name = cursor_name
+    self._chat_rate = chat_rate
+    self._chat_burst = chat_burst
+    self._global_bucket = TokenBucket(global_rate, global_burst)
+    self._coalesce_window = coalesce_window
+    self._ack_interval = ack_interval
+    # Messages waiting to be sent, per chat, with the time (`time.monotonic()`)
+    # they were submitted. Chats without messages are removed.
+    self._queues: dict[mb.TelegramChatId,
+                       collections.deque[tuple[float, mb.Message]]] = {}
+    self._senders: dict[mb.TelegramChatId, asyncio.Task[None]] = {}
+    self._chat_buckets: dict[mb.TelegramChatId, TokenBucket] = {}
+    # Submitted messages not yet attempted.
+    self._unsent: set[mb.MessageId] = set()
+    self._last_submitted: mb.MessageId | None = None
+    self._acks: list[tuple[mb.MessageId, mb.TelegramMessageId]] = []
+    self._cursor: mb.MessageId | None = None
+    self._acks_ready = asyncio.Event()
+    self._ack_writer: asyncio.Task[None] | None = None
+
+  def submit(self, messages: list[mb.Message]) -> None:
+    """Queues `messages` (sorted by `message_id`) to be sent."""
+    if self._ack_writer is None:
+      self._ack_writer = asyncio.create_task(self._write_acks_periodically())
+    now = time.monotonic()
+    for message in messages:
+      chat = message.telegram_chat_id
+      self._queues.setdefault(chat, collections.deque()).append((now, message))
+      self._unsent.add(message.message_id)
+      self._last_submitted = message.message_id
+      if chat not in self._senders:
+        self._senders[chat] = asyncio.create_task(self._drain(chat))
+
+  async def join(self) -> None:
+    """Waits until all messages submitted are attempted and acked."""
+    while self._senders:
+      await asyncio.gather(*self._senders.values())
+    await self._write_acks()
+
+  async def stop(self) -> None:
+    """Drops the messages queued (without acking them)."""
+    tasks = list(self._senders.values())
+    if self._ack_writer is not None:
+      tasks.append(self._ack_writer)
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  async def _drain(self, chat: mb.TelegramChatId) -> None:
+    queue = self._queues[chat]
+    bucket = self._chat_buckets.get(chat)
+    if bucket is None:
+      bucket = self._chat_buckets[chat] = TokenBucket(self._chat_rate,
+                                                      self._chat_burst)
+    while queue:
+      wait = (
+          queue[0][0] + self._coalesce_window.total_seconds() -
+          time.monotonic())
+      if wait > 0:
+        await asyncio.sleep(wait)
+      while delay := max(bucket.delay(), self._global_bucket.delay()):
+        await asyncio.sleep(delay)
+      bucket.take()
+      self._global_bucket.take()
+      await self._send_batch(*self._take_batch(queue))
+    del self._queues[chat]
+    del self._senders[chat]
+
+  def _take_batch(
+      self, queue: collections.deque[tuple[float, mb.Message]]
+  ) -> tuple[list[mb.Message], str]:
+    """Removes from `queue` the messages to send together; returns the text."""
+    _, first = queue.popleft()
+    batch = [first]
+    text = f"{first.source_agent}: {first.content}"
+    while queue:
+      _, message = queue[0]
+      if ((message.source_agent, message.conversation_id,
+           message.telegram_reply_to_id)
+          != (first.source_agent, first.conversation_id,
+              first.telegram_reply_to_id) or
+          len(text) + 2 + len(message.content) > MessageLimit.MAX_TEXT_LENGTH):
+        break
+      queue.popleft()
+      batch.append(message)
+      text += f"\n\n{message.content}"
+    return batch, text
+
+  async def _send_batch(self, batch: list[mb.Message], text: str) -> None:
+    first = batch[0]
+    ids = [message.message_id for message in batch]
+    logging.info("Sending messages %s to telegram_chat_id=%s, content=\"%s\"",
+                 ids, first.telegram_chat_id, text)
+    telegram_message_id: mb.TelegramMessageId | None = None
+    while True:
+      try:
+        telegram_message_id = await self._send(first.telegram_chat_id, text,
+                                               first.telegram_reply_to_id)
+        break
+      except RetryAfter as e:
+        retry_after = e.retry_after
+        seconds = (
+            retry_after.total_seconds()
+            if isinstance(retry_after, datetime.timedelta) else retry_after)
+        logging.warning(f"Telegram asked to wait {seconds}s; retrying.")
+        await asyncio.sleep(seconds)
+      except Exception:
+        logging.exception(f"Failed to send messages {ids} to Telegram.")
+        break
+    self._unsent.difference_update(ids)
+    if telegram_message_id is not None:
+      self._acks.extend((i, telegram_message_id) for i in ids)
+    self._acks_ready.set()
+
+  async def _write_acks_periodically(self) -> None:
+    while True:
+      await self._acks_ready.wait()
+      await asyncio.sleep(self._ack_interval.total_seconds())
+      try:
+        await self._write_acks()
+      except Exception:
+        logging.exception("Failed to write Telegram message ids to the bus.")
+
+  async def _write_acks(self) -> None:
+    self._acks_ready.clear()
+    # The cursor must be computed before awaiting: messages sent meanwhile
+    # leave `_unsent`, but their acks are only written in the next batch.
+    acks, self._acks = self._acks, []
+    cursor = (
+        mb.MessageId(min(self._unsent) -
+                     1) if self._unsent else self._last_submitted)
+    if acks:
+      await self._message_bus.set_telegram_message_ids(acks)
+    if cursor is not None and cursor != self._cursor:
+      await self._message_bus.save_cursor(self._cursor_name, cursor)
+      self._cursor = cursor
+
+
+# Telegram updates received (through `WebhookReceiver`) within this window are
+# written to the bus together.
+_WEBHOOK_BATCH_WINDOW = datetime.timedelta(milliseconds=20)
+
+
+class WebhookReceiver:
+  """ASGI app (`app`) that receives Telegram updates through a webhook.
+
+  Telegram POSTs each update (as JSON) to `path`. If `secret_token` is set,
+  requests without it (in `X-Telegram-Bot-Api-Secret-Token`) get a 403.
+
+  Updates for which `to_message` returns a bus message are written in batches:
+  those received within `batch_window` of the first one waiting go in a single
+  `MessageBus.write_telegram_updates` call, which skips updates already
+  written (e.g., retried by Telegram). Requests are answered once their
+  update is written (or with a 500 if writing fails, so that Telegram retries
+  them); `on_written` then receives the messages written. Other updates (e.g.,
+  commands) are passed to `other_update`.
+  """
+
+  def __init__(
+      self,
+      message_bus: mb.MessageBus,
+      to_message: Callable[[Update], Awaitable[mb.Message | None]],
+      other_update: Callable[[Update], Awaitable[None]],
+      on_written: Callable[[list[mb.Message]], Awaitable[None]],
+      secret_token: str | None = None,
+      bot: Bot | None = None,
+      path: str = "/telegram",
+      batch_window: datetime.timedelta = _WEBHOOK_BATCH_WINDOW) -> None:
+    self._message_bus = message_bus
+    self._to_message = to_message
+    self._other_update = other_update
+    self._on_written = on_written
+    self._secret_token = secret_token
+    self._bot = bot
+    self._batch_window = batch_window
+    # Updates waiting to be written; the futures receive whether they were.
+    self._pending: list[tuple[mb.TelegramUpdateId, mb.Message,
+                              asyncio.Future[bool]]] = []
+    self._writer: asyncio.Task[None] | None = None
+    self._callbacks: set[asyncio.Future[None]] = set()
+    self.app = FastAPI()
+    self.app.post(path)(self._receive)
+
+  async def _receive(self, request: Request) -> Response:
+    if (self._secret_token is not None and
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+        != self._secret_token):
+      return Response(status_code=403)
+    update = Update.de_json(await request.json(), self._bot)
+    message = await self._to_message(update)
+    if message is None:
+      await self._other_update(update)
+      return Response(status_code=200)
+    written = asyncio.get_running_loop().create_future()
+    self._pending.append(
+        (mb.TelegramUpdateId(update.update_id), message, written))
+    if self._writer is None or self._writer.done():
+      self._writer = asyncio.create_task(self._write_batches())
+    return Response(status_code=200 if await written else 500)
+
+  async def _write_batches(self) -> None:
+    while self._pending:
+      await asyncio.sleep(self._batch_window.total_seconds())
+      batch, self._pending = self._pending, []
+      try:
+        written = await self._message_bus.write_telegram_updates([
+            (update_id, message) for update_id, message, _ in batch
+        ])
+      except Exception:
+        logging.exception(f"Failed to write {len(batch)} Telegram updates.")
+        for _, _, future in batch:
+          future.set_result(False)
+        continue
+      for _, _, future in batch:
+        future.set_result(True)
+      logging.info(
+          f"Wrote {len(written)} messages from {len(batch)} Telegram updates.")
+      if written:
+        callback = asyncio.ensure_future(self._on_written(written))
+        self._callbacks.add(callback)
+        callback.add_done_callback(self._callbacks.discard)
+
 
 class Handler:
 
@@ -19,33 +338,123 @@ class Handler:
     assert config.telegram
     self._config = config
     self._message_bus = message_bus
+    # Messages from the end user (written to the bus).
+    self._user_messages = (
+        filters.TEXT & ~filters.COMMAND
+        & filters.User(config.telegram.authorized_users))
 
   async def start(self, update: Update,
                   context: ContextTypes.DEFAULT_TYPE) -> None:
     assert update.message
     await update.message.reply_text("I'm awake!")
 
-  async def echo(self, update: Update,
-                 context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Receives a message from Telegram and inserts it to the message bus.
+  async def dead_letters(self, update: Update,
+                         context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Replies with the dead letters in the bus (admin command).
+
+    For each dead letter: its message id, target agent, number of attempts,
+    the start of its content and the last line of its error (at most
+    `_DEAD_LETTER_ERROR_CHARS`). Replies "No dead letters." if there are none.
+    """
+    raise NotImplementedError()  # {{🍄 list dead letters}}
+
+  async def requeue(self, update: Update,
+                    context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Requeues dead letters (admin command).
+
+    Usage: `/requeue all` or `/requeue <message_id>...`. Replies with the
+    messages requeued, or with the usage (or the error from
+    `MessageBus.requeue_dead_letters`) if the arguments are invalid.
+    """
+    raise NotImplementedError()  # {{🍄 requeue dead letters}}
+
+  async def invalidate_prompts(self, update: Update,
+                               context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Invalidates the prompt cache of the swarm (admin command).
+
+    Calls `PromptCache.invalidate` on `self._config.prompt_cache` (which also
+    invalidates the caches of swarm processes using the same configuration).
+    """
+    raise NotImplementedError()  # {{🍄 invalidate prompts}}
+
+  async def _bus_message(self, update: Update) -> mb.Message:
+    """Returns the bus message (not yet written) for a message from Telegram.
 
     If the update is a response to a previous message, looks up the previous
     message in the message bus. If the previous message is found, the new row
     will set `target_agent` to `original_message.source_agent` and propagate
     `conversation_id`.
 
-    `source_agent` is set to the value in `END_USER_AGENT`.
+    `source_agent` is set to the value in `END_USER_AGENT` and `priority` to
+    `MessagePriority.HIGH`.
+    """
+    assert update.effective_chat  # for telegram_chat_id.
+    raise NotImplementedError()  # {{🍄 bus message from update}}
 
-    A response is sent to the chat and logged: f"Message received ({id=})"
+  async def echo(self, update: Update,
+                 context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Receives a message from Telegram and inserts it to the message bus.
+
+    Writes the message from `_bus_message`. A response is sent to the chat and
+    logged: f"Message received ({id=})"
     """
     assert update.effective_chat  # for telegram_chat_id.
     raise NotImplementedError()  # {{🍄 write message to bus and respond}}
 
+  async def _webhook_message(self, update: Update) -> mb.Message | None:
+    """Returns the bus message for an update received through the webhook.
+
+    Returns None for updates that `echo` wouldn't receive (e.g., commands).
+    """
+    if not self._user_messages.check_update(update):
+      return None
+    return await self._bus_message(update)
+
+  async def _acknowledge(self, messages: list[mb.Message]) -> None:
+    """Tells the user (like `echo`) that their messages were received."""
+    for message in messages:
+      response_text = f"Message received (id={message.message_id})"
+      try:
+        await self._app.bot.send_message(
+            chat_id=message.telegram_chat_id,
+            text=response_text,
+            reply_to_message_id=message.telegram_message_id)
+      except Exception:
+        logging.exception(f"Failed to acknowledge {message.message_id}.")
+      logging.info(response_text)
+
+  async def _serve_webhook(self, webhook: TelegramWebhookConfig) -> None:
+    """Registers `webhook` with Telegram and serves its `WebhookReceiver`."""
+    receiver = WebhookReceiver(
+        self._message_bus,
+        self._webhook_message,
+        self._app.process_update,
+        self._acknowledge,
+        secret_token=webhook.secret_token,
+        bot=self._app.bot,
+        path=urllib.parse.urlparse(webhook.url).path or "/")
+    await self._app.bot.set_webhook(
+        webhook.url, secret_token=webhook.secret_token)
+    logging.info(f"Receiving updates through {webhook.url}.")
+    await uvicorn.Server(
+        uvicorn.Config(receiver.app, host=webhook.host,
+                       port=webhook.port)).serve()
+
+  async def _send_message(
+      self, chat: mb.TelegramChatId, text: str,
+      reply_to: mb.TelegramMessageId | None) -> mb.TelegramMessageId:
+    sent_message = await self._app.bot.send_message(
+        chat_id=chat, text=text, reply_to_message_id=reply_to)
+    return mb.TelegramMessageId(sent_message.message_id)
+
   async def _send_outgoing_messages(self) -> None:
     """Calls wait_for_outgoing_messages and dispatches messages to the user.
 
-    For each message received, calls `self._app.bot.send_message` and
-    `set_telegram_message_id` (based on resulting outgoing message).
+    Submits the messages received to an `OutboundDispatcher`, which sends them
+    (through `_send_message`) and writes their Telegram message ids.
+
+    Consumes the messages through the `_OUTGOING_CURSOR` cursor (saved by the
+    dispatcher): each message is only attempted once (even across restarts).
 
     {{🦔 The content of the outgoing messages starts with the source agent.}}
     """
@@ -62,15 +471,30 @@ class Handler:
             self.start,
             filters=filters.User(self._config.telegram.authorized_users)))
     self._app.add_handler(
-        MessageHandler(
-            filters.TEXT & ~filters.COMMAND
-            & filters.User(self._config.telegram.authorized_users), self.echo))
+        CommandHandler(
+            "dead_letters",
+            self.dead_letters,
+            filters=filters.User(self._config.telegram.authorized_users)))
+    self._app.add_handler(
+        CommandHandler(
+            "requeue",
+            self.requeue,
+            filters=filters.User(self._config.telegram.authorized_users)))
+    self._app.add_handler(
+        CommandHandler(
+            "invalidate_prompts",
+            self.invalidate_prompts,
+            filters=filters.User(self._config.telegram.authorized_users)))
+    self._app.add_handler(MessageHandler(self._user_messages, self.echo))
 
     asyncio.create_task(self._send_outgoing_messages())
 
     async with self._app:
       await self._app.initialize()
       await self._app.start()
+      if self._config.telegram.webhook is not None:
+        await self._serve_webhook(self._config.telegram.webhook)
+        return
       assert self._app.updater
       await self._app.updater.start_polling()
       print("Bot is polling... Press Ctrl+C to stop.")
@@ -81,7 +505,7 @@ class Handler:
 async def main() -> None:
   config = await load_config(pathlib.Path('swarm/config.json'))
   assert config.telegram
-  await Handler(config, mb.MessageBus(config.message_bus_path)).run()
+  await Handler(config, mb.SqliteMessageBus(config.message_bus_path)).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+import unittest
+
+from agent_command import CommandInput, CommandOutput, VariableMap, VariableName, VariableValueStr
+from command_registry import CommandRegistry
+from conversation import ConversationFactory, ConversationFactoryOptions
+from conversation_search import ConversationSearchIndex
+from message import ContentSection, Message
+
+
+class TestConversationSearchIndex(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self) -> None:
+    self.index = ConversationSearchIndex()
+    self.factory = ConversationFactory(
+        ConversationFactoryOptions(search_index=self.index))
+
+  async def _add(self, conversation_name: str,
+                 sections: list[ContentSection]) -> int:
+    conversation = self.factory.New(conversation_name, CommandRegistry())
+    await conversation.AddMessage(
+        Message(role='user', content_sections=[ContentSection("Start.")]))
+    await conversation.AddMessage(
+        Message(role='assistant', content_sections=sections))
+    return conversation.GetId()
+
+  async def test_search_content(self) -> None:
+    conversation_id = await self._add(
+        "first", [ContentSection("Let's look at the bus implementation.")])
+    await self._add("second", [ContentSection("Nothing to see.")])
+    await self.index.flush()
+
+    hits = await self.index.search("implementation")
+    self.assertEqual(len(hits), 1)
+    self.assertEqual(hits[0].conversation_id, conversation_id)
+    self.assertEqual(hits[0].message_index, 1)
+    self.assertEqual(hits[0].role, 'assistant')
+    self.assertIn("[implementation]", hits[0].snippet)
+
+  async def test_search_command_args_and_outputs(self) -> None:
+    await self._add("reader", [
+        ContentSection(
+            "",
+            command=CommandInput(
+                command_name="read_file",
+                args=VariableMap({
+                    VariableName("path"): VariableValueStr("src/message_bus.py")
+                })))
+    ])
+    await self._add("searcher", [
+        ContentSection(
+            "",
+            command_output=CommandOutput(
+                command_name="search_file",
+                output="src/message_bus.py:12: found",
+                errors="",
+                summary="Searched 3 files."))
+    ])
+    await self.index.flush()
+
+    hits = await self.index.search("message_bus.py")
+    self.assertEqual({h.conversation_id for h in hits}, {0, 1})
+
+  async def test_removed_conversations_are_not_found(self) -> None:
+    removed_id = await self._add("removed",
+                                 [ContentSection("An evicted session.")])
+    kept_id = await self._add("kept", [ContentSection("A session kept.")])
+    self.factory.Remove(removed_id)
+    await self.index.flush()
+
+    hits = await self.index.search("session")
+    self.assertEqual([hit.conversation_id for hit in hits], [kept_id])
+
+  async def test_search_ranks_better_matches_first(self) -> None:
+    await self._add("weak", [ContentSection("cache " + "filler " * 50)])
+    strong_id = await self._add("strong", [ContentSection("cache cache cache")])
+    await self.index.flush()
+
+    hits = await self.index.search("cache")
+    self.assertEqual(hits[0].conversation_id, strong_id)
+
+  async def test_search_requires_all_terms(self) -> None:
+    await self._add("both", [ContentSection("alpha beta")])
+    await self._add("one", [ContentSection("alpha gamma")])
+    await self.index.flush()
+
+    hits = await self.index.search("alpha beta")
+    self.assertEqual([h.conversation_id for h in hits], [0])
+
+  async def test_search_empty_query(self) -> None:
+    await self._add("any", [ContentSection("alpha")])
+    self.assertEqual(await self.index.search("   "), [])
+
+  async def test_search_special_characters(self) -> None:
+    await self._add("quotes", [ContentSection('say "hello" (now)')])
+    await self.index.flush()
+
+    hits = await self.index.search('"hello" (now')
+    self.assertEqual(len(hits), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
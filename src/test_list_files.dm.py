@@ -3,6 +3,7 @@ import asyncio
 import os
 import tempfile
 import shutil
+import time
 import aiofiles
 import pathlib
 import re
@@ -73,6 +74,20 @@ class ListAllFilesTest(unittest.IsolatedAsyncioTestCase):
     """Runs successfully if file access policy doesn't match anything."""
     # {{🍄 file access policy no match}}
 
+  async def testMatchesRglob(self) -> None:
+    """Output matches that of `sorted(rglob("*"))` (keeping only files).
+
+    Adds to the structure a hidden file, a symlink to a file (listed) and a
+    symlink to a directory (not descended into)."""
+    # {{🍄 matches rglob}}
+
+  async def testSeesChanges(self) -> None:
+    """Files added or removed after a listing are reflected in the next one.
+
+    Sets the mtimes of all directories to an hour ago before the first listing
+    (so that its listings are cached)."""
+    # {{🍄 sees changes}}
+
 
 if __name__ == '__main__':
   unittest.main()
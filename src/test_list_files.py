@@ -4,6 +4,7 @@ import asyncio
 import os
 import tempfile
 import shutil
+import time
 import aiofiles
 import pathlib
 import re
@@ -168,6 +169,52 @@ class ListAllFilesTest(unittest.IsolatedAsyncioTestCase):
     self.assertListEqual(file_paths, [])
     # ✨
 
+  async def testMatchesRglob(self) -> None:
+    """Output matches that of `sorted(rglob("*"))` (keeping only files).
+
+    Adds to the structure a hidden file, a symlink to a file (listed) and a
+    symlink to a directory (not descended into)."""
+    # ✨ matches rglob
+    pathlib.Path("fruits/.hidden.md").touch()
+    os.symlink("fruits/banana.md", "banana_link.md")
+    os.symlink("animals", "animals_link")
+    policy = CurrentDirectoryFileAccessPolicy()
+    expected = [
+        p for p in sorted(pathlib.Path(".").rglob("*"))
+        if p.is_file() and policy.allow_access(str(p))
+    ]
+    file_paths = [f async for f in list_all_files(pathlib.Path("."), policy)]
+    self.assertListEqual(file_paths, expected)
+    self.assertIn(pathlib.Path("banana_link.md"), file_paths)
+    self.assertNotIn(pathlib.Path("animals_link/birds/condor.txt"), file_paths)
+    # ✨
+
+  async def testSeesChanges(self) -> None:
+    """Files added or removed after a listing are reflected in the next one.
+
+    Sets the mtimes of all directories to an hour ago before the first listing
+    (so that its listings are cached)."""
+    # ✨ sees changes
+    an_hour_ago = time.time() - 3600
+    for directory in [
+        ".", "animals", "animals/mammals", "animals/birds", "fruits"
+    ]:
+      os.utime(directory, (an_hour_ago, an_hour_ago))
+    policy = CurrentDirectoryFileAccessPolicy()
+    before = [str(f) async for f in list_all_files(pathlib.Path("."), policy)]
+    self.assertIn("animals/mammals/fox.txt", before)
+
+    pathlib.Path("animals/mammals/fox.txt").unlink()
+    pathlib.Path("animals/birds/owl.txt").touch()
+    pathlib.Path("animals/fish").mkdir()
+    pathlib.Path("animals/fish/trout.txt").touch()
+    after = [str(f) async for f in list_all_files(pathlib.Path("."), policy)]
+    self.assertNotIn("animals/mammals/fox.txt", after)
+    self.assertIn("animals/birds/owl.txt", after)
+    self.assertIn("animals/fish/trout.txt", after)
+    self.assertEqual(len(after), len(before) + 1)
+    # ✨
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,5 +1,6 @@
 import unittest
-from conversation import Message, MultilineContent, ContentSection
+from agent_command import CommandInput, CommandOutput, VariableMap, VariableName, VariableValueInt, VariableValueStr
+from message import Message, ContentSection
 from datetime import datetime, timezone
 
 
@@ -48,9 +49,10 @@ class TestMessage(unittest.TestCase):
     self.assertEqual(message.creation_time, now)
     sections = message.GetContentSections()
     self.assertEqual(len(sections), 2)
-    self.assertEqual(sections[0].content, ["New section A"])
+    # Serialized content (lists of lines, in older files) is joined.
+    self.assertEqual(sections[0].content, "New section A")
     self.assertEqual(sections[0].summary, "Summary A")
-    self.assertEqual(sections[1].content, ["New section B"])
+    self.assertEqual(sections[1].content, "New section B")
     self.assertIsNone(sections[1].summary)
 
   def test_serialize(self) -> None:
@@ -95,6 +97,59 @@ class TestMessage(unittest.TestCase):
     message.PushSection(section2)
     self.assertEqual(message.GetContentSections(), [section1, section2])
 
+  def test_from_properties_dict_round_trip(self) -> None:
+    message = Message(
+        role="assistant",
+        content_sections=[
+            ContentSection(content="Reading the file.", summary="Plan"),
+            ContentSection(
+                content="",
+                command=CommandInput(
+                    command_name="read_file",
+                    args=VariableMap(
+                        {VariableName("path"): VariableValueStr("src/a.py")}),
+                    derived_args=VariableMap(
+                        {VariableName("lines"): VariableValueInt(12)}))),
+            ContentSection(
+                content="",
+                command_output=CommandOutput(
+                    command_name="read_file",
+                    output="contents",
+                    errors="",
+                    summary="Read 12 lines.",
+                    task_done=True))
+        ])
+    properties = message.ToPropertiesDict()
+    restored = Message.FromPropertiesDict(properties)
+
+    self.assertEqual(restored.role, "assistant")
+    self.assertEqual(restored.creation_time, message.creation_time)
+    self.assertEqual(restored.ToPropertiesDict(), properties)
+    sections = restored.GetContentSections()
+    self.assertEqual(sections[0].summary, "Plan")
+    assert sections[1].command
+    self.assertEqual(sections[1].command.command_name, "read_file")
+    self.assertEqual(sections[1].command.args[VariableName("path")],
+                     VariableValueStr("src/a.py"))
+    assert sections[2].command_output
+    self.assertEqual(sections[2].command_output.output, "contents")
+    self.assertTrue(sections[2].command_output.task_done)
+
+  def test_from_properties_dict_task_not_done(self) -> None:
+    message = Message(
+        role="user",
+        content_sections=[
+            ContentSection(
+                content="",
+                command_output=CommandOutput(
+                    command_name="shell", output="", errors="boom", summary=""))
+        ])
+    restored = Message.FromPropertiesDict(message.ToPropertiesDict())
+    output = restored.GetContentSections()[0].command_output
+    assert output
+    self.assertFalse(output.task_done)
+    self.assertEqual(output.errors, "boom")
+
 
 if __name__ == '__main__':
   unittest.main()
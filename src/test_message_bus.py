@@ -0,0 +1,294 @@
+import asyncio
+import datetime
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from message_bus import _BLOB_THRESHOLD, _MIGRATIONS, END_USER_AGENT, Message, MessageBus, MessageId, MessagePriority, RetryPolicy, SqliteMessageBus, WorkerId
+from message_bus_test_utils import AGENT, LEASE, REVIEWER, MessageBusTests, new_message
+
+
+class TestSqliteMessageBus(MessageBusTests, unittest.IsolatedAsyncioTestCase):
+
+  bus: SqliteMessageBus
+
+  async def asyncSetUp(self) -> None:
+    self._directory = tempfile.TemporaryDirectory()
+    self.path = pathlib.Path(self._directory.name) / "bus.db"
+    await super().asyncSetUp()
+
+  async def asyncTearDown(self) -> None:
+    await super().asyncTearDown()
+    self._directory.cleanup()
+
+  def new_bus(self) -> MessageBus:
+    return SqliteMessageBus(self.path)
+
+  def make_old(self, message_id: MessageId) -> None:
+    connection = sqlite3.connect(str(self.path))
+    connection.execute(
+        "UPDATE message_bus SET queued_at = '2000-01-01 00:00:00', "
+        "processed_at = iif(processed_at IS NULL, NULL, "
+        "'2000-01-01 00:00:01') WHERE message_id = ?", (message_id,))
+    connection.commit()
+    connection.close()
+
+  async def test_wake_up_from_other_bus_instance(self) -> None:
+    other = SqliteMessageBus(self.path)
+    await other.open()
+    try:
+      waiter = asyncio.create_task(self.bus.wait_for_outgoing_messages())
+      await asyncio.sleep(0.1)
+      await other.write_new_message(new_message("reply", END_USER_AGENT))
+      messages = await asyncio.wait_for(waiter, 2)
+      self.assertEqual([m.content for m in messages], ["reply"])
+    finally:
+      await other.close()
+
+  async def test_migrations_create_indexes(self) -> None:
+    connection = sqlite3.connect(str(self.path))
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    indexes = {
+        row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    connection.close()
+    self.assertEqual(version, len(_MIGRATIONS))
+    self.assertLessEqual(
+        {
+            "message_bus_incoming", "message_bus_outgoing",
+            "message_bus_telegram"
+        }, indexes)
+
+  async def test_migrates_unversioned_database(self) -> None:
+    path = self.path.with_name("old.db")
+    connection = sqlite3.connect(str(path), isolation_level=None)
+    for statement in _MIGRATIONS[0]:
+      connection.execute(statement)
+    connection.execute(
+        "INSERT INTO message_bus (source_agent, target_agent, "
+        "telegram_chat_id, content) VALUES (?, ?, 1, 'old')",
+        (END_USER_AGENT, AGENT))
+    connection.close()
+
+    bus = SqliteMessageBus(path)
+    await bus.open()
+    try:
+      messages = await bus.wait_for_incoming_messages([AGENT])
+      self.assertEqual([(m.content, m.priority) for m in messages],
+                       [("old", MessagePriority.HIGH)])
+    finally:
+      await bus.close()
+    connection = sqlite3.connect(str(path))
+    self.assertEqual(
+        connection.execute("PRAGMA user_version").fetchone()[0],
+        len(_MIGRATIONS))
+    connection.close()
+
+  async def test_rejects_newer_schema(self) -> None:
+    path = self.path.with_name("new.db")
+    connection = sqlite3.connect(str(path))
+    connection.execute(f"PRAGMA user_version = {len(_MIGRATIONS) + 1}")
+    connection.close()
+    bus = SqliteMessageBus(path)
+    with self.assertRaises(RuntimeError):
+      await bus.open()
+
+  async def test_claims_are_exclusive_across_instances(self) -> None:
+    other = SqliteMessageBus(self.path)
+    await other.open()
+    try:
+      for i in range(10):
+        await self.bus.write_new_message(new_message(f"message {i}"))
+      first, second = await asyncio.gather(
+          self.bus.claim_incoming_messages([AGENT],
+                                           WorkerId("first"),
+                                           LEASE,
+                                           limit=6),
+          other.claim_incoming_messages([AGENT],
+                                        WorkerId("second"),
+                                        LEASE,
+                                        limit=6))
+      ids = [m.message_id for m in first + second]
+      self.assertEqual(len(ids), 10)
+      self.assertEqual(len(set(ids)), 10)
+      self.assertEqual(
+          await self.bus.claim_incoming_messages([AGENT], WorkerId("third"),
+                                                 LEASE), [])
+    finally:
+      await other.close()
+
+  async def test_write_behind_groups_writes(self) -> None:
+    bus = SqliteMessageBus(
+        self.path, write_behind=datetime.timedelta(milliseconds=20))
+    await bus.open()
+    try:
+      written = await asyncio.gather(*(
+          bus.write_new_message(new_message(f"message {i}")) for i in range(10))
+                                    )
+      self.assertEqual(len({m.message_id for m in written}), 10)
+      messages = await self.bus.wait_for_incoming_messages([AGENT])
+      self.assertEqual(len(messages), 10)
+    finally:
+      await bus.close()
+
+  async def test_write_behind_isolates_failures(self) -> None:
+    bus = SqliteMessageBus(
+        self.path, write_behind=datetime.timedelta(milliseconds=20))
+    await bus.open()
+    try:
+      results = await asyncio.gather(
+          bus.write_new_message(new_message("hello")),
+          bus.mark_as_processed(MessageId(1234)),
+          return_exceptions=True)
+      self.assertIsInstance(results[0], Message)
+      self.assertIsInstance(results[1], ValueError)
+      messages = await self.bus.wait_for_incoming_messages([AGENT])
+      self.assertEqual([m.content for m in messages], ["hello"])
+    finally:
+      await bus.close()
+
+  async def test_close_runs_pending_writes(self) -> None:
+    bus = SqliteMessageBus(
+        self.path, write_behind=datetime.timedelta(seconds=60))
+    await bus.open()
+    write = asyncio.create_task(bus.write_new_message(new_message("hello")))
+    await asyncio.sleep(0.05)
+    self.assertFalse(write.done())
+    await bus.close()
+    self.assertEqual(write.result().content, "hello")
+    messages = await self.bus.wait_for_incoming_messages([AGENT])
+    self.assertEqual([m.content for m in messages], ["hello"])
+
+  async def test_reads_see_own_writes(self) -> None:
+    bus = SqliteMessageBus(
+        self.path, write_behind=datetime.timedelta(milliseconds=5), readers=4)
+    await bus.open()
+    try:
+
+      async def _write_and_read(i: int) -> None:
+        written = await bus.write_new_message(new_message(f"message {i}"))
+        read = await bus.read_message(written.message_id)
+        self.assertEqual(read.content, f"message {i}")
+        await bus.save_cursor(f"cursor {i}", written.message_id)
+        self.assertEqual(await bus.read_cursor(f"cursor {i}"),
+                         written.message_id)
+
+      await asyncio.gather(*(_write_and_read(i) for i in range(20)))
+    finally:
+      await bus.close()
+
+  async def test_reads_without_readers(self) -> None:
+    bus = SqliteMessageBus(self.path, readers=0)
+    await bus.open()
+    try:
+      written = await bus.write_new_message(new_message("hello"))
+      read = await bus.read_message(written.message_id)
+      self.assertEqual(read.content, "hello")
+      self.assertEqual((await bus.stats()).rows, 1)
+    finally:
+      await bus.close()
+
+  async def test_readers_are_read_only(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    with self.assertRaises(sqlite3.OperationalError):
+      await self.bus._run_read(
+          lambda connection: connection.execute("DELETE FROM message_bus"))
+    self.assertEqual((await self.bus.stats()).rows, 1)
+
+  async def test_large_contents_are_offloaded(self) -> None:
+    report = "x" * (_BLOB_THRESHOLD + 1)
+    small, first, second = await self.bus.write_new_messages([
+        new_message("small"),
+        new_message(report),
+        new_message(report, REVIEWER)
+    ])
+    connection = sqlite3.connect(str(self.path))
+    self.assertEqual(
+        connection.execute("SELECT COUNT(*) FROM message_bus WHERE content = ''"
+                          ).fetchone()[0], 2)
+    connection.close()
+    self.assertEqual((await self.bus.stats()).blob_rows, 1)
+
+    claimed = await self.bus.claim_incoming_messages([AGENT, REVIEWER],
+                                                     WorkerId("w"), LEASE)
+    self.assertEqual([m.content for m in claimed], ["small", report, report])
+    self.assertEqual((await self.bus.read_message(second.message_id)).content,
+                     report)
+
+    await self.bus.mark_processed_many([small.message_id, first.message_id])
+    for message in [small, first]:
+      self.make_old(message.message_id)
+    self.assertEqual(
+        await self.bus.archive_messages(datetime.timedelta(days=1)), 2)
+    self.assertEqual((await self.bus.read_message(first.message_id)).content,
+                     report)
+    self.assertEqual((await self.bus.stats()).blob_rows, 1)
+
+    await self.bus.mark_as_processed(second.message_id)
+    self.make_old(second.message_id)
+    self.assertEqual(
+        await self.bus.archive_messages(datetime.timedelta(days=1)), 1)
+    self.assertEqual((await self.bus.stats()).blob_rows, 0)
+    self.assertEqual((await self.bus.read_message(second.message_id)).content,
+                     report)
+
+  async def test_sessions_skip_old_conversation_ids(self) -> None:
+    path = self.path.with_name("old.db")
+    connection = sqlite3.connect(str(path), isolation_level=None)
+    for statement in _MIGRATIONS[0]:
+      connection.execute(statement)
+    connection.execute(
+        "INSERT INTO message_bus (source_agent, target_agent, conversation_id, "
+        "telegram_chat_id, content) VALUES (?, ?, 7, 1, 'old')",
+        (END_USER_AGENT, AGENT))
+    connection.close()
+
+    bus = SqliteMessageBus(path)
+    await bus.open()
+    try:
+      written = await bus.write_new_message(new_message("new"))
+      session = await bus.start_session(written.message_id)
+      self.assertEqual(session.conversation_id, 8)
+    finally:
+      await bus.close()
+
+  async def test_retry_policy_delay(self) -> None:
+    policy = RetryPolicy(
+        max_attempts=10,
+        backoff=datetime.timedelta(seconds=30),
+        max_backoff=datetime.timedelta(minutes=2))
+    self.assertEqual([policy.delay(i).total_seconds() for i in range(1, 5)],
+                     [30, 60, 120, 120])
+
+  async def test_compact(self) -> None:
+    written = await self.bus.write_new_messages(
+        [new_message("x" * 10000) for i in range(50)])
+    await self.bus.mark_processed_many([m.message_id for m in written])
+    for message in written:
+      self.make_old(message.message_id)
+    await self.bus.archive_messages(datetime.timedelta(days=1))
+    await self.bus.compact(pages=100000)
+    self.assertEqual((await self.bus.stats()).free_bytes, 0)
+
+  async def test_compact_converts_old_databases(self) -> None:
+    path = self.path.with_name("old.db")
+    connection = sqlite3.connect(str(path), isolation_level=None)
+    connection.execute("PRAGMA auto_vacuum = NONE")
+    for statement in _MIGRATIONS[0]:
+      connection.execute(statement)
+    connection.close()
+    bus = SqliteMessageBus(path)
+    await bus.open()
+    try:
+      await bus.compact()
+    finally:
+      await bus.close()
+    connection = sqlite3.connect(str(path))
+    self.assertEqual(connection.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+    connection.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+import asyncio
+import dataclasses
+import datetime
+import unittest
+
+from message_bus import MessageBus, MessageId, RetryPolicy, WorkerId
+from message_bus_memory import InMemoryMessageBus
+from message_bus_test_utils import AGENT, LEASE, MessageBusTests, new_message
+
+
+class TestInMemoryMessageBus(MessageBusTests, unittest.IsolatedAsyncioTestCase):
+
+  bus: InMemoryMessageBus
+
+  def new_bus(self) -> MessageBus:
+    return InMemoryMessageBus()
+
+  def make_old(self, message_id: MessageId) -> None:
+    message = self.bus._messages[message_id]
+    old = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    self.bus._messages[message_id] = dataclasses.replace(
+        message,
+        queued_at=old,
+        processed_at=(None if message.processed_at is None else
+                      (old +
+                       datetime.timedelta(seconds=1)).replace(tzinfo=None)))
+
+  # Unlike `SqliteMessageBus` (which polls), waiters wake up as soon as a lease
+  # expires or a retry is due.
+
+  async def test_expired_leases_wake_up_waiters(self) -> None:
+    await self.bus.write_new_message(new_message("hello"))
+    await self.bus.claim_incoming_messages([AGENT], WorkerId("first"),
+                                           datetime.timedelta(milliseconds=10))
+    messages = await asyncio.wait_for(
+        self.bus.wait_for_claimed_messages([AGENT], WorkerId("second"), LEASE),
+        1)
+    self.assertEqual([m.content for m in messages], ["hello"])
+
+  async def test_retries_and_dead_letters(self) -> None:
+    written = await self.bus.write_new_message(new_message("hello"))
+    await self.bus.mark_as_processed(written.message_id)
+    policy = RetryPolicy(
+        max_attempts=2,
+        backoff=datetime.timedelta(milliseconds=20),
+        max_backoff=datetime.timedelta(seconds=1))
+    self.assertTrue(await self.bus.fail_message(written.message_id, "first",
+                                                policy))
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AGENT], WorkerId("worker"),
+                                               LEASE), [])
+    # Wakes up when the retry is due.
+    [message] = await asyncio.wait_for(
+        self.bus.wait_for_claimed_messages([AGENT], WorkerId("worker"), LEASE),
+        1)
+    self.assertEqual(message.message_id, written.message_id)
+
+    await self.bus.mark_as_processed(written.message_id)
+    self.assertFalse(await self.bus.fail_message(written.message_id, "second",
+                                                 policy))
+    [dead_letter] = await self.bus.list_dead_letters()
+    self.assertEqual((dead_letter.attempts, dead_letter.error), (2, "second"))
+    self.assertIsNotNone(dead_letter.message.processed_at)
+    self.assertEqual(await self.bus.requeue_dead_letters([written.message_id]),
+                     [written.message_id])
+    messages = await self.bus.wait_for_incoming_messages([AGENT])
+    self.assertEqual([m.message_id for m in messages], [written.message_id])
+
+
+if __name__ == '__main__':
+  unittest.main()
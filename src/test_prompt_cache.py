@@ -0,0 +1,93 @@
+import asyncio
+import datetime
+import os
+import pathlib
+import tempfile
+import unittest
+
+from prompt_cache import PromptCache, PromptSourcePolicy
+
+
+class TestPromptCache(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self) -> None:
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = pathlib.Path(self._directory.name)
+    self.source = self.directory / "prompt.md"
+    self.source.write_text("prompt")
+    self.cwd = self.directory / "cwd"
+    self.loads = 0
+
+  def tearDown(self) -> None:
+    self._directory.cleanup()
+
+  async def _load(self) -> str:
+    self.loads += 1
+    return f"load {self.loads}"
+
+  async def load(self,
+                 cache: PromptCache,
+                 executable: bool = False,
+                 policy: PromptSourcePolicy = PromptSourcePolicy(),
+                 cwd: pathlib.Path | None = None) -> str:
+    return await cache.load(self.source, executable, policy, cwd or self.cwd,
+                            self._load)
+
+  def touch(self, path: pathlib.Path) -> None:
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+  async def test_files_are_cached_until_modified(self) -> None:
+    cache = PromptCache()
+    self.assertEqual(await self.load(cache), "load 1")
+    self.assertEqual(await self.load(cache, cwd=self.directory), "load 1")
+    self.touch(self.source)
+    self.assertEqual(await self.load(cache), "load 2")
+    [stats] = cache.stats()
+    self.assertEqual((stats.source, stats.hits, stats.misses),
+                     (self.source, 1, 2))
+
+  async def test_scripts_without_policy_always_run(self) -> None:
+    cache = PromptCache()
+    await self.load(cache, executable=True)
+    self.assertEqual(await self.load(cache, executable=True), "load 2")
+
+  async def test_scripts_with_ttl(self) -> None:
+    cache = PromptCache()
+    policy = PromptSourcePolicy(ttl=datetime.timedelta(milliseconds=50))
+    await self.load(cache, True, policy)
+    self.assertEqual(await self.load(cache, True, policy), "load 1")
+    # Outputs are cached per directory.
+    self.assertEqual(await self.load(cache, True, policy, self.directory),
+                     "load 2")
+    await asyncio.sleep(0.06)
+    self.assertEqual(await self.load(cache, True, policy), "load 3")
+
+  async def test_scripts_with_dependencies(self) -> None:
+    cache = PromptCache()
+    dependency = self.directory / "HEAD"
+    dependency.write_text("main")
+    policy = PromptSourcePolicy(depends_on=(dependency,))
+    await self.load(cache, True, policy)
+    self.assertEqual(await self.load(cache, True, policy), "load 1")
+    self.touch(dependency)
+    self.assertEqual(await self.load(cache, True, policy), "load 2")
+    dependency.unlink()
+    self.assertEqual(await self.load(cache, True, policy), "load 3")
+
+  async def test_invalidate_across_instances(self) -> None:
+    path = self.directory / "prompt_cache.invalidated"
+    cache = PromptCache(path)
+    other = PromptCache(path)
+    await self.load(cache)
+    await self.load(other)
+    other.invalidate()
+    self.assertEqual(await self.load(other), "load 3")
+    self.assertEqual(await self.load(cache), "load 4")
+    self.assertEqual(await self.load(cache), "load 4")
+    cache.invalidate()
+    self.assertEqual(await self.load(cache), "load 5")
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -10,7 +10,7 @@ import re
 
 from search_file_command import SearchFileCommand
 from file_access_policy import CurrentDirectoryFileAccessPolicy, RegexFileAccessPolicy
-from agent_command import CommandOutput, VariableMap, VariableName, VariableValueStr
+from agent_command import CommandOutput, VariableMap, VariableName, VariableValueBool, VariableValueStr
 from pathbox import PathBox
 
 
@@ -273,6 +273,99 @@ class SearchFileCommandTest(unittest.IsolatedAsyncioTestCase):
     self.assertIn("Searched 1 files, found 1 matches.", output.summary)
     self.assertNotIn("Errors:", output.summary)
 
+  async def test_run_regex(self) -> None:
+    """Verify regular expressions are matched against each line."""
+    file_name = pathlib.Path("regex_file.py")
+    async with aiofiles.open(file_name, mode='w') as f:
+      await f.write("def foo():\n  pass\nfoo = 1\ndef bar(x):\n")
+
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({
+            VariableName('content'): VariableValueStr(r"^def \w+\(.*\):$"),
+            VariableName('regex'): VariableValueBool(True),
+        }))
+
+    self.assertIn(f"{file_name}:1: def foo():", output.output)
+    self.assertIn(f"{file_name}:4: def bar(x):", output.output)
+    self.assertNotIn(f"{file_name}:3:", output.output)
+    self.assertIn("Searched 1 files, found 2 matches.", output.summary)
+
+  async def test_run_regex_does_not_cross_lines(self) -> None:
+    """Verify a regular expression doesn't match across a line break."""
+    async with aiofiles.open("lines.txt", mode='w') as f:
+      await f.write("first\nsecond\n")
+
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({
+            VariableName('content'): VariableValueStr(r"first\s+second"),
+            VariableName('regex'): VariableValueBool(True),
+        }))
+
+    self.assertIn("Searched 1 files, found 0 matches.", output.summary)
+
+  async def test_run_invalid_regex(self) -> None:
+    """Verify an invalid regular expression is reported as an error."""
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({
+            VariableName('content'): VariableValueStr("foo("),
+            VariableName('regex'): VariableValueBool(True),
+        }))
+
+    self.assertIn("Invalid regular expression", output.errors)
+
+  async def test_run_skips_binary_files(self) -> None:
+    """Verify binary files are skipped (rather than reported as errors)."""
+    search_term = "needle"
+    pathlib.Path("binary.bin").write_bytes(b"\0\xff" + search_term.encode())
+    async with aiofiles.open("text.txt", mode='w') as f:
+      await f.write(f"A {search_term}.\n")
+
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({VariableName('content'): VariableValueStr(search_term)}))
+
+    self.assertNotIn("binary.bin:", output.output)
+    self.assertEqual(output.errors, "")
+    self.assertIn("Searched 2 files, found 1 matches.", output.summary)
+
+  async def test_run_case_insensitive_non_ascii(self) -> None:
+    """Verify case-insensitive search of non-ASCII terms."""
+    file_name = pathlib.Path("accents.txt")
+    async with aiofiles.open(file_name, mode='w', encoding='utf-8') as f:
+      await f.write("Una CANCIÓN.\nOtra línea.\n")
+
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({VariableName('content'): VariableValueStr("canción")}))
+
+    self.assertIn(f"{file_name}:1: Una CANCIÓN.", output.output)
+    self.assertIn("Searched 1 files, found 1 matches.", output.summary)
+
+  async def test_run_many_matches_across_files(self) -> None:
+    """Verify matches are counted (but not listed) past the limit."""
+    for i in range(5):
+      async with aiofiles.open(f"many_{i}.txt", mode='w') as f:
+        await f.write("hit\n" * 40)
+
+    command = SearchFileCommand(
+        PathBox(), file_access_policy=self.file_access_policy)
+    output: CommandOutput = await command.run(
+        VariableMap({VariableName('content'): VariableValueStr("hit")}))
+
+    self.assertIn("Too many matches to display (200, limit is 100).",
+                  output.output)
+    for i in range(5):
+      self.assertIn(f"many_{i}.txt, 40, 40", output.output)
+    self.assertIn("Searched 5 files, found 200 matches.", output.summary)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,91 @@
+import datetime
+import pathlib
+import unittest
+from unittest import mock
+
+from agent_command import VariableMap, VariableName, VariableValueStr
+from message_bus import TelegramChatId, TelegramMessageId, WorkerId
+from message_bus_memory import InMemoryMessageBus
+from pathbox import PathBox
+from swarm_commands import PublishMessageConfig, PublishTopicMessageCommand
+from swarm_types import AgentName, Topic
+
+_CODER = AgentName("coder")
+_REVIEWER = AgentName("reviewer")
+_RESEARCHER = AgentName("researcher")
+_TOPIC = Topic("deploys")
+_LEASE = datetime.timedelta(minutes=1)
+
+
+def _inputs(topic: str, content: str) -> VariableMap:
+  return VariableMap({
+      VariableName("reason"): VariableValueStr("Tell everyone."),
+      VariableName("topic"): VariableValueStr(topic),
+      VariableName("content"): VariableValueStr(content),
+  })
+
+
+class TestPublishTopicMessageCommand(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.bus = InMemoryMessageBus()
+    await self.bus.open()
+    for agent in [_REVIEWER, _RESEARCHER]:
+      await self.bus.set_subscriptions(agent, frozenset([_TOPIC]))
+
+  async def asyncTearDown(self) -> None:
+    await self.bus.close()
+
+  def new_command(self,
+                  cwd: PathBox | None = None) -> PublishTopicMessageCommand:
+    config = PublishMessageConfig(
+        allow_list=frozenset(), topics=frozenset([_TOPIC]))
+    return PublishTopicMessageCommand(config, self.bus, cwd or PathBox(),
+                                      TelegramChatId(1), TelegramMessageId(2),
+                                      _CODER)
+
+  async def test_delivers_to_subscribers(self) -> None:
+    output = await self.new_command().run(_inputs(_TOPIC, "deployed v2"))
+    self.assertEqual(output.errors, "")
+    self.assertIn("with ID: 1", output.output)
+
+    for agent in [_REVIEWER, _RESEARCHER]:
+      [message] = await self.bus.claim_incoming_messages([agent],
+                                                         WorkerId("worker"),
+                                                         _LEASE)
+      self.assertEqual(message.content, "deployed v2")
+      self.assertEqual(message.source_agent, _CODER)
+      self.assertEqual(message.telegram_chat_id, 1)
+      self.assertEqual(message.telegram_reply_to_id, 2)
+      self.assertIsNone(message.local_directory)
+
+  async def test_publishes_once(self) -> None:
+    with mock.patch.object(
+        self.bus, 'publish', wraps=self.bus.publish) as publish:
+      await self.new_command().run(_inputs(_TOPIC, "deployed v2"))
+    publish.assert_awaited_once()
+    [published] = publish.await_args.args
+    self.assertEqual(published.topic, _TOPIC)
+    self.assertEqual(published.published_at.tzinfo, datetime.timezone.utc)
+
+  async def test_local_directory(self) -> None:
+    command = self.new_command(PathBox(pathlib.Path("src/lib")))
+    await command.run(_inputs(_TOPIC, "deployed v2"))
+    [message] = await self.bus.claim_incoming_messages([_REVIEWER],
+                                                       WorkerId("worker"),
+                                                       _LEASE)
+    self.assertEqual(message.local_directory, pathlib.Path("src/lib"))
+
+  async def test_disallowed_topic(self) -> None:
+    with mock.patch.object(
+        self.bus, 'publish', wraps=self.bus.publish) as publish:
+      output = await self.new_command().run(_inputs("secrets", "leak"))
+    self.assertIn("'secrets' is not in the allowed list", output.errors)
+    publish.assert_not_awaited()
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([_REVIEWER], WorkerId("worker"),
+                                               _LEASE), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,124 @@
+import asyncio
+import unittest
+
+from message_bus import TelegramChatId
+from swarm_scheduler import SessionPriority, SessionScheduler
+from swarm_types import AgentName
+
+_RESEARCHER = AgentName("researcher")
+_CODER = AgentName("coder")
+
+
+class TestSessionScheduler(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.started: list[str] = []
+    self.release: dict[str, asyncio.Event] = {}
+
+  def submit(self,
+             scheduler: SessionScheduler,
+             name: str,
+             chat: int = 1,
+             agent: AgentName = _RESEARCHER,
+             priority: SessionPriority = SessionPriority.END_USER) -> None:
+    self.release[name] = asyncio.Event()
+
+    async def run() -> None:
+      self.started.append(name)
+      await self.release[name].wait()
+
+    scheduler.submit(TelegramChatId(chat), agent, priority, run)
+
+  async def finish(self, name: str) -> None:
+    self.release[name].set()
+    for _ in range(5):
+      await asyncio.sleep(0)
+
+  async def test_global_limit(self) -> None:
+    scheduler = SessionScheduler(2, {})
+    for i in range(3):
+      self.submit(scheduler, f"s{i}", chat=i)
+    await asyncio.sleep(0)
+    self.assertEqual(self.started, ["s0", "s1"])
+    stats = scheduler.stats()
+    self.assertEqual((stats.running, stats.queued), (2, 1))
+    self.assertEqual(stats.queued_by_agent, {_RESEARCHER: 1})
+    await self.finish("s1")
+    self.assertEqual(self.started, ["s0", "s1", "s2"])
+    self.assertEqual(scheduler.stats().queued, 0)
+    await scheduler.stop()
+
+  async def test_agent_limit(self) -> None:
+    scheduler = SessionScheduler(10, {_RESEARCHER: 1})
+    self.submit(scheduler, "r0", chat=1)
+    self.submit(scheduler, "r1", chat=2)
+    self.submit(scheduler, "c0", chat=3, agent=_CODER)
+    await asyncio.sleep(0)
+    self.assertEqual(self.started, ["r0", "c0"])
+    await self.finish("r0")
+    self.assertEqual(self.started, ["r0", "c0", "r1"])
+    await scheduler.stop()
+
+  async def test_order_within_chat(self) -> None:
+    scheduler = SessionScheduler(10, {_RESEARCHER: 1})
+    self.submit(scheduler, "r0")
+    # Could start (its agent is under its cap), but must wait for "r1".
+    self.submit(scheduler, "r1")
+    self.submit(scheduler, "c0", agent=_CODER)
+    await asyncio.sleep(0)
+    self.assertEqual(self.started, ["r0"])
+    await self.finish("r0")
+    self.assertEqual(self.started, ["r0", "r1", "c0"])
+    await scheduler.stop()
+
+  async def test_end_users_before_agents(self) -> None:
+    scheduler = SessionScheduler(1, {})
+    self.submit(scheduler, "first", chat=1)
+    self.submit(scheduler, "agent", chat=2, priority=SessionPriority.AGENT)
+    self.submit(scheduler, "user", chat=3)
+    await asyncio.sleep(0)
+    await self.finish("first")
+    await self.finish("user")
+    self.assertEqual(self.started, ["first", "user", "agent"])
+    await scheduler.stop()
+
+  async def test_fair_across_chats(self) -> None:
+    scheduler = SessionScheduler(1, {})
+    self.submit(scheduler, "a0", chat=1)
+    self.submit(scheduler, "a1", chat=1)
+    self.submit(scheduler, "a2", chat=1)
+    self.submit(scheduler, "b0", chat=2)
+    await asyncio.sleep(0)
+    for name in ["a0", "b0", "a1"]:
+      await self.finish(name)
+    self.assertEqual(self.started, ["a0", "b0", "a1", "a2"])
+    await scheduler.stop()
+
+  async def test_failed_session_releases_slot(self) -> None:
+    scheduler = SessionScheduler(1, {})
+
+    async def fail() -> None:
+      raise RuntimeError("boom")
+
+    with self.assertLogs(level="ERROR"):
+      scheduler.submit(
+          TelegramChatId(1), _RESEARCHER, SessionPriority.END_USER, fail)
+      self.submit(scheduler, "next", chat=2)
+      for _ in range(5):
+        await asyncio.sleep(0)
+    self.assertEqual(self.started, ["next"])
+    await scheduler.stop()
+
+  async def test_stop_cancels_running_sessions(self) -> None:
+    scheduler = SessionScheduler(1, {})
+    self.submit(scheduler, "running")
+    self.submit(scheduler, "queued", chat=2)
+    await asyncio.sleep(0)
+    await scheduler.stop()
+    stats = scheduler.stats()
+    self.assertEqual((stats.running, stats.queued), (0, 0))
+    self.assertEqual(self.started, ["running"])
+
+
+if __name__ == '__main__':
+  unittest.main()
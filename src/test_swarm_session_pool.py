@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+import unittest
+
+from swarm_session_pool import SessionPool
+from swarm_types import AgentName
+
+_RESEARCHER = AgentName("researcher")
+_CODER = AgentName("coder")
+
+
+class TestSessionPool(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.built: list[str] = []
+    self.failing = False
+
+  async def build(self, agent: AgentName) -> str:
+    if self.failing:
+      raise RuntimeError("build failed")
+    value = f"{agent} {len(self.built)}"
+    self.built.append(value)
+    return value
+
+  async def settle(self) -> None:
+    for _ in range(10):
+      await asyncio.sleep(0)
+
+  async def test_start_builds_one_per_agent(self) -> None:
+    pool = SessionPool(self.build, [_RESEARCHER, _CODER])
+    pool.start()
+    await self.settle()
+    self.assertEqual(self.built, ["researcher 0", "coder 1"])
+    self.assertEqual(await pool.take(_CODER), "coder 1")
+    await self.settle()
+    stats = pool.stats()
+    self.assertEqual((stats.hits, stats.misses), (1, 0))
+    self.assertEqual(stats.ready, {_RESEARCHER: 1, _CODER: 1})
+    await pool.stop()
+
+  async def test_take_builds_when_empty(self) -> None:
+    pool = SessionPool(self.build, [_RESEARCHER])
+    self.assertEqual(await pool.take(_RESEARCHER), "researcher 0")
+    await self.settle()
+    self.assertEqual(self.built, ["researcher 0", "researcher 1"])
+    self.assertEqual(pool.stats().misses, 1)
+    await pool.stop()
+
+  async def test_target_follows_demand(self) -> None:
+    pool = SessionPool(
+        self.build, [_RESEARCHER],
+        max_size=3,
+        window=datetime.timedelta(minutes=1),
+        horizon=datetime.timedelta(seconds=30))
+    pool.start()
+    await self.settle()
+    self.assertEqual(pool.stats().targets, {_RESEARCHER: 1})
+    for _ in range(4):
+      await pool.take(_RESEARCHER)
+      await self.settle()
+    self.assertEqual(pool.stats().targets, {_RESEARCHER: 2})
+    self.assertEqual(pool.stats().ready, {_RESEARCHER: 2})
+    for _ in range(10):
+      await pool.take(_RESEARCHER)
+      await self.settle()
+    self.assertEqual(pool.stats().ready, {_RESEARCHER: 3})
+    await pool.stop()
+    self.assertEqual(pool.stats().ready, {_RESEARCHER: 0})
+
+  async def test_build_errors_in_background_are_logged(self) -> None:
+    self.failing = True
+    pool = SessionPool(self.build, [_RESEARCHER])
+    with self.assertLogs(level="ERROR"):
+      pool.start()
+      await self.settle()
+    self.assertEqual(pool.stats().ready, {_RESEARCHER: 0})
+    self.failing = False
+    self.assertEqual(await pool.take(_RESEARCHER), "researcher 0")
+    await pool.stop()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,172 @@
+import asyncio
+import datetime
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from agent_command import VariableMap, VariableName, VariableValueStr
+from command_registry import CommandRegistry
+from command_registry_factory import CommandRegistryConfig, CommandRegistryWriteConfig
+from file_access_policy import CurrentDirectoryFileAccessPolicy
+from message_bus import Message, MessageContent, MessageId, SqliteMessageBus, TelegramChatId, WorkerId
+from pathbox import PathBox
+from selection_manager import SelectionManager
+from shell_command_command import ShellCommandTemplatesConfig
+from swarm_config import AgentIdentityConfig
+from swarm_scheduler import SessionScheduler
+from swarm_types import AgentName
+from swarm_workflow import Shard, SwarmWorkflow, SwarmWorkflowFactory, shard_agents
+from trigram_index import TrigramIndex
+
+_AGENTS = [AgentName(name) for name in ["reviewer", "coder", "researcher"]]
+
+
+class TestShardAgents(unittest.TestCase):
+
+  def test_no_shard_runs_all_agents(self) -> None:
+    self.assertEqual(
+        shard_agents(_AGENTS, None), ["coder", "researcher", "reviewer"])
+
+  def test_shards_partition_agents(self) -> None:
+    shards = [shard_agents(_AGENTS, Shard(i, 2)) for i in range(2)]
+    self.assertEqual(shards, [["coder", "reviewer"], ["researcher"]])
+
+  def test_more_shards_than_agents(self) -> None:
+    self.assertEqual(shard_agents(_AGENTS, Shard(3, 4)), [])
+
+
+class TestSwarmWorkflowFactory(unittest.IsolatedAsyncioTestCase):
+
+  async def test_invalid_shard(self) -> None:
+    factory = SwarmWorkflowFactory()
+    self.assertTrue(factory.sharded())
+    with self.assertRaises(ValueError):
+      await factory.new(mock.MagicMock(), {
+          'shard_index': '2',
+          'shard_count': '2'
+      })
+
+
+class TestSwarmWorkflowHandOff(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self._directory = tempfile.TemporaryDirectory()
+    self.bus = SqliteMessageBus(pathlib.Path(self._directory.name) / "bus.db")
+    await self.bus.open()
+    await self.bus.write_new_message(
+        Message(
+            message_id=MessageId(0),
+            source_agent=AgentName("coder"),
+            target_agent=AgentName("researcher"),
+            local_directory=None,
+            conversation_id=None,
+            telegram_chat_id=TelegramChatId(1),
+            telegram_message_id=None,
+            telegram_reply_to_id=None,
+            content=MessageContent("research this"),
+            queued_at=datetime.datetime.now(datetime.timezone.utc),
+            processed_at=None))
+    [self.message] = await self.bus.claim_incoming_messages(
+        [AgentName("researcher")], WorkerId("first"),
+        datetime.timedelta(milliseconds=10))
+
+  async def asyncTearDown(self) -> None:
+    await self.bus.close()
+    self._directory.cleanup()
+
+  def new_workflow(self, max_running: int) -> SwarmWorkflow:
+    workflow = SwarmWorkflow(mock.MagicMock())
+    workflow._message_bus = self.bus
+    workflow._scheduler = SessionScheduler(max_running, {})
+    return workflow
+
+  async def test_queued_message_is_reclaimed_after_lease(self) -> None:
+    workflow = self.new_workflow(max_running=0)
+    await workflow._process_message(self.message)
+    await asyncio.sleep(0.05)
+    [reclaimed
+    ] = await self.bus.claim_incoming_messages([AgentName("researcher")],
+                                               WorkerId("second"),
+                                               datetime.timedelta(minutes=1))
+    self.assertEqual(reclaimed.message_id, self.message.message_id)
+    await workflow._scheduler.stop()
+
+  async def test_started_message_is_processed(self) -> None:
+    workflow = self.new_workflow(max_running=1)
+    started = asyncio.Event()
+
+    async def start_agent_loop(message: Message) -> None:
+      read = await self.bus.read_message(message.message_id)
+      self.assertIsNotNone(read.processed_at)
+      started.set()
+
+    with mock.patch.object(workflow, '_start_agent_loop', start_agent_loop):
+      await workflow._process_message(self.message)
+      await asyncio.wait_for(started.wait(), 2)
+    await asyncio.sleep(0.05)
+    self.assertEqual(
+        await self.bus.claim_incoming_messages([AgentName("researcher")],
+                                               WorkerId("second"),
+                                               datetime.timedelta(minutes=1)),
+        [])
+    await workflow._scheduler.stop()
+
+
+class TestSwarmWorkflowCommandRegistry(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.original_cwd = os.getcwd()
+    self.temp_dir = pathlib.Path(tempfile.mkdtemp())
+    self.index_dir = pathlib.Path(tempfile.mkdtemp())
+    os.chdir(self.temp_dir)
+    pathlib.Path("notes.txt").write_text("hay\n")
+    self.index = TrigramIndex(
+        pathlib.Path('.'), CurrentDirectoryFileAccessPolicy(),
+        self.index_dir / "index.sqlite")
+    await self.index.open()
+    await self.index.refresh()
+
+  async def asyncTearDown(self) -> None:
+    await self.index.close()
+    os.chdir(self.original_cwd)
+    shutil.rmtree(self.temp_dir)
+    shutil.rmtree(self.index_dir)
+
+  async def test_writes_update_trigram_index(self) -> None:
+    options = mock.MagicMock()
+    options.agent_loop_options.validation_manager = None
+    options.selection_manager = SelectionManager()
+    workflow = SwarmWorkflow(options)
+    config = AgentIdentityConfig(
+        name=AgentName("coder"),
+        command_registry=CommandRegistryConfig(
+            file_access_policy=None,
+            shell_templates=ShellCommandTemplatesConfig(commands={}),
+            writes=CommandRegistryWriteConfig(file_access_policy=None)),
+        prompt_sources=[])
+    registry = CommandRegistry()
+    workflow._init_command_registry(config, CurrentDirectoryFileAccessPolicy(),
+                                    registry, PathBox(), self.index)
+
+    write_file = registry.Get("write_file")
+    assert write_file
+    await write_file.run(
+        VariableMap({
+            VariableName("path"): VariableValueStr("notes.txt"),
+            VariableName("content"): VariableValueStr("a needle"),
+        }))
+    # Already indexed by `write_file`.
+    self.assertEqual(await self.index.refresh(), 0)
+
+    search_file = registry.Get("search_file")
+    assert search_file
+    output = await search_file.run(
+        VariableMap({VariableName("content"): VariableValueStr("needle")}))
+    self.assertIn("notes.txt:1: a needle", output.output)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+import httpx
+from telegram import Update
+from telegram.error import RetryAfter
+
+import message_bus as mb
+from message_bus_memory import InMemoryMessageBus
+from swarm_types import AgentName
+from telegram_adapter import OutboundDispatcher, TokenBucket, WebhookReceiver
+
+_CODER = AgentName("coder")
+_REVIEWER = AgentName("reviewer")
+_CURSOR = "test:outgoing"
+
+
+def _new_message(content: str,
+                 source_agent: AgentName = _CODER,
+                 chat: int = 1) -> mb.Message:
+  return mb.Message(
+      message_id=mb.MessageId(0),
+      source_agent=source_agent,
+      target_agent=mb.END_USER_AGENT,
+      local_directory=None,
+      conversation_id=None,
+      telegram_chat_id=mb.TelegramChatId(chat),
+      telegram_message_id=None,
+      telegram_reply_to_id=None,
+      content=mb.MessageContent(content),
+      queued_at=datetime.datetime.now(datetime.timezone.utc),
+      processed_at=None)
+
+
+class FakeBot:
+  """Records the messages sent (like the Bot API's `send_message`)."""
+
+  def __init__(self) -> None:
+    self.sent: list[tuple[mb.TelegramChatId, str]] = []
+    self.sent_at: list[float] = []
+    self.errors: list[Exception] = []
+
+  async def send_message(
+      self, chat: mb.TelegramChatId, text: str,
+      reply_to: mb.TelegramMessageId | None) -> mb.TelegramMessageId:
+    if self.errors:
+      raise self.errors.pop(0)
+    self.sent.append((chat, text))
+    self.sent_at.append(time.monotonic())
+    return mb.TelegramMessageId(100 + len(self.sent))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+  def test_burst_then_rate(self) -> None:
+    now = 0.0
+    bucket = TokenBucket(rate=2, burst=2, clock=lambda: now)
+    for _ in range(2):
+      self.assertEqual(bucket.delay(), 0)
+      bucket.take()
+    self.assertAlmostEqual(bucket.delay(), 0.5)
+    now = 0.5
+    self.assertEqual(bucket.delay(), 0)
+    now = 10
+    bucket.take()
+    bucket.take()
+    self.assertAlmostEqual(bucket.delay(), 0.5)
+
+
+class TestOutboundDispatcher(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.bus = InMemoryMessageBus()
+    await self.bus.open()
+    self.bot = FakeBot()
+
+  async def asyncTearDown(self) -> None:
+    await self.bus.close()
+
+  def new_dispatcher(
+      self,
+      chat_rate: float = 1000,
+      chat_burst: int = 10,
+      coalesce_window: datetime.timedelta = datetime.timedelta(milliseconds=20)
+  ) -> OutboundDispatcher:
+    dispatcher = OutboundDispatcher(
+        self.bus,
+        self.bot.send_message,
+        _CURSOR,
+        chat_rate=chat_rate,
+        chat_burst=chat_burst,
+        coalesce_window=coalesce_window,
+        ack_interval=datetime.timedelta(milliseconds=1))
+    self.addAsyncCleanup(dispatcher.stop)
+    return dispatcher
+
+  async def test_coalesces_consecutive_messages(self) -> None:
+    messages = await self.bus.write_new_messages([
+        _new_message("first"),
+        _new_message("second"),
+        _new_message("review", _REVIEWER),
+        _new_message("other chat", chat=2),
+    ])
+    dispatcher = self.new_dispatcher()
+    dispatcher.submit(messages)
+    await dispatcher.join()
+    self.assertEqual(
+        sorted(self.bot.sent), [(1, "coder: first\n\nsecond"),
+                                (1, "reviewer: review"),
+                                (2, "coder: other chat")])
+    first, second, review, _ = [
+        await self.bus.read_message(m.message_id) for m in messages
+    ]
+    self.assertEqual(first.telegram_message_id, second.telegram_message_id)
+    self.assertNotEqual(first.telegram_message_id, review.telegram_message_id)
+    self.assertEqual(await self.bus.read_cursor(_CURSOR),
+                     messages[-1].message_id)
+
+  async def test_coalescing_respects_size_limit(self) -> None:
+    messages = await self.bus.write_new_messages(
+        [_new_message("x" * 3000),
+         _new_message("y" * 3000)])
+    dispatcher = self.new_dispatcher()
+    dispatcher.submit(messages)
+    await dispatcher.join()
+    self.assertEqual(len(self.bot.sent), 2)
+
+  async def test_chat_rate_limit(self) -> None:
+    messages = await self.bus.write_new_messages(
+        [_new_message("a", agent) for agent in [_CODER, _REVIEWER, _CODER]])
+    dispatcher = self.new_dispatcher(
+        chat_rate=20, chat_burst=1, coalesce_window=datetime.timedelta(0))
+    dispatcher.submit(messages)
+    await dispatcher.join()
+    self.assertEqual(len(self.bot.sent), 3)
+    self.assertGreaterEqual(self.bot.sent_at[2] - self.bot.sent_at[0], 0.09)
+
+  async def test_retries_after_flood_control(self) -> None:
+    self.bot.errors = [RetryAfter(datetime.timedelta(0))]
+    [message] = await self.bus.write_new_messages([_new_message("hello")])
+    dispatcher = self.new_dispatcher()
+    dispatcher.submit([message])
+    await dispatcher.join()
+    self.assertEqual(self.bot.sent, [(1, "coder: hello")])
+    self.assertIsNotNone(
+        (await self.bus.read_message(message.message_id)).telegram_message_id)
+
+  async def test_failed_messages_are_dropped(self) -> None:
+    self.bot.errors = [RuntimeError("network")]
+    failed, sent = await self.bus.write_new_messages(
+        [_new_message("failed"),
+         _new_message("sent", _REVIEWER)])
+    dispatcher = self.new_dispatcher()
+    with self.assertLogs(level="ERROR"):
+      dispatcher.submit([failed, sent])
+      await dispatcher.join()
+    self.assertEqual(self.bot.sent, [(1, "reviewer: sent")])
+    self.assertIsNone(
+        (await self.bus.read_message(failed.message_id)).telegram_message_id)
+    self.assertEqual(await self.bus.read_cursor(_CURSOR), sent.message_id)
+
+
+def _update(update_id: int, text: str) -> dict[str, object]:
+  """Returns an update (as Telegram POSTs it) with a text message."""
+  return {
+      "update_id": update_id,
+      "message": {
+          "message_id": 10 + update_id,
+          "date": 0,
+          "chat": {
+              "id": 1,
+              "type": "private"
+          },
+          "from": {
+              "id": 7,
+              "is_bot": False,
+              "first_name": "user"
+          },
+          "text": text,
+      },
+  }
+
+
+class TestWebhookReceiver(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.bus = InMemoryMessageBus()
+    await self.bus.open()
+    self.batches: list[int] = []
+    self.other: list[Update] = []
+    self.written = asyncio.Queue[list[mb.Message]]()
+    write_telegram_updates = self.bus.write_telegram_updates
+
+    async def record_batch(
+        updates: list[tuple[mb.TelegramUpdateId,
+                            mb.Message]]) -> list[mb.Message]:
+      self.batches.append(len(updates))
+      return await write_telegram_updates(updates)
+
+    self.bus.write_telegram_updates = record_batch  # type: ignore[method-assign]
+    receiver = WebhookReceiver(
+        self.bus,
+        self.to_message,
+        self.other_update,
+        self.written.put,
+        secret_token="secret")
+    self.client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=receiver.app),
+        base_url="http://telegram.test")
+
+  async def asyncTearDown(self) -> None:
+    await self.client.aclose()
+    await self.bus.close()
+
+  async def to_message(self, update: Update) -> mb.Message | None:
+    assert update.message
+    if update.message.text is None or update.message.text.startswith("/"):
+      return None
+    return _new_message(update.message.text)
+
+  async def other_update(self, update: Update) -> None:
+    self.other.append(update)
+
+  async def post(self,
+                 update: dict[str, object],
+                 secret: str = "secret") -> int:
+    response = await self.client.post(
+        "/telegram",
+        json=update,
+        headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+    return response.status_code
+
+  async def test_concurrent_updates_are_written_together(self) -> None:
+    statuses = await asyncio.gather(
+        *[self.post(_update(i, f"message {i}")) for i in range(5)])
+    self.assertEqual(statuses, [200] * 5)
+    self.assertEqual(self.batches, [5])
+    written = await self.written.get()
+    self.assertEqual(
+        sorted(m.content for m in written), [f"message {i}" for i in range(5)])
+
+  async def test_retried_updates_are_written_once(self) -> None:
+    self.assertEqual(await self.post(_update(1, "hello")), 200)
+    self.assertEqual(await self.post(_update(1, "hello")), 200)
+    self.assertEqual(await self.post(_update(2, "again")), 200)
+    self.assertEqual([m.content for m in await self.written.get()], ["hello"])
+    self.assertEqual([m.content for m in await self.written.get()], ["again"])
+
+  async def test_rejects_wrong_secret(self) -> None:
+    self.assertEqual(await self.post(_update(1, "hello"), secret="wrong"), 403)
+    self.assertEqual(self.batches, [])
+
+  async def test_commands_are_passed_through(self) -> None:
+    self.assertEqual(await self.post(_update(1, "/status")), 200)
+    self.assertEqual([u.update_id for u in self.other], [1])
+    self.assertEqual(self.batches, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
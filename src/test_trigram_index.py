@@ -0,0 +1,102 @@
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+from agent_command import CommandOutput, VariableMap, VariableName, VariableValueStr
+from file_access_policy import CurrentDirectoryFileAccessPolicy
+from file_search import SearchPattern
+from pathbox import PathBox
+from search_file_command import SearchFileCommand
+from trigram_index import TrigramIndex
+
+
+class TestTrigramIndex(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self.original_cwd = os.getcwd()
+    self.temp_dir = pathlib.Path(tempfile.mkdtemp())
+    self.index_dir = pathlib.Path(tempfile.mkdtemp())
+    os.chdir(self.temp_dir)
+    pathlib.Path("needle.txt").write_text("a needle in a haystack\n")
+    pathlib.Path("hay.txt").write_text("just hay\n")
+    self.index = await self.open_index()
+
+  async def asyncTearDown(self) -> None:
+    await self.index.close()
+    os.chdir(self.original_cwd)
+    shutil.rmtree(self.temp_dir)
+    shutil.rmtree(self.index_dir)
+
+  async def open_index(self) -> TrigramIndex:
+    index = TrigramIndex(
+        pathlib.Path('.'), CurrentDirectoryFileAccessPolicy(),
+        self.index_dir / "index.sqlite")
+    await index.open()
+    await index.refresh()
+    return index
+
+  async def candidates(self,
+                       term: str,
+                       case_sensitive: bool = False,
+                       regex: bool = False) -> list[str]:
+    paths = sorted(pathlib.Path('.').glob("*.txt"))
+    return [
+        str(path) for path in await self.index.candidates(
+            paths, SearchPattern(term, case_sensitive, regex))
+    ]
+
+  async def test_candidates(self) -> None:
+    self.assertEqual(await self.candidates("needle"), ["needle.txt"])
+    self.assertEqual(await self.candidates("NEEDLE"), ["needle.txt"])
+    self.assertEqual(await self.candidates("NEEDLE", case_sensitive=True),
+                     ["needle.txt"])
+    self.assertEqual(await self.candidates("missing"), [])
+
+  async def test_unusable_patterns_return_all_files(self) -> None:
+    self.assertEqual(await self.candidates("ne"), ["hay.txt", "needle.txt"])
+    self.assertEqual(await self.candidates("needle", regex=True),
+                     ["hay.txt", "needle.txt"])
+
+  async def test_files_not_indexed_are_candidates(self) -> None:
+    pathlib.Path("new.txt").write_text("nothing here\n")
+    self.assertEqual(await self.candidates("needle"), ["needle.txt", "new.txt"])
+
+  async def test_update(self) -> None:
+    pathlib.Path("hay.txt").write_text("a needle after all\n")
+    await self.index.update([pathlib.Path("hay.txt")])
+    self.assertEqual(await self.candidates("needle"), ["hay.txt", "needle.txt"])
+
+  async def test_changes_without_update_are_candidates(self) -> None:
+    pathlib.Path("hay.txt").write_text("hay and a needle\n")
+    self.assertEqual(await self.candidates("needle"), ["hay.txt", "needle.txt"])
+
+  async def test_refresh_finds_changes(self) -> None:
+    pathlib.Path("needle.txt").unlink()
+    pathlib.Path("hay.txt").write_text("a needle, longer than before\n")
+    self.assertEqual(await self.index.refresh(), 1)
+    self.assertEqual(await self.candidates("needle"), ["hay.txt"])
+
+  async def test_persists(self) -> None:
+    await self.index.close()
+    self.index = await self.open_index()
+    self.assertEqual(await self.index.refresh(), 0)
+    self.assertEqual(await self.candidates("needle"), ["needle.txt"])
+
+  async def test_search_file_command(self) -> None:
+    pathlib.Path("other.txt").write_text("another needle\n")
+    await self.index.update([pathlib.Path("other.txt")])
+    command = SearchFileCommand(PathBox(), CurrentDirectoryFileAccessPolicy(),
+                                self.index)
+    output: CommandOutput = await command.run(
+        VariableMap({VariableName('content'): VariableValueStr("needle")}))
+
+    self.assertIn("needle.txt:1: a needle in a haystack", output.output)
+    self.assertIn("other.txt:1: another needle", output.output)
+    self.assertNotIn("hay.txt", output.output)
+    self.assertIn("Searched 3 files, found 2 matches.", output.summary)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import pathlib
+import tempfile
+import unittest
+from typing import Any, Callable
+from unittest import mock
+
+from agent_workflow import AgentWorkflow, AgentWorkflowFactory, AgentWorkflowFactoryContainer
+from agent_workflow_options import AgentWorkflowOptions
+from command_registry import CommandRegistry
+from confirmation import AsyncConfirmationManager, ConfirmationManager
+from conversation import Conversation, ConversationFactory, ConversationFactoryOptions, ConversationId
+from conversation_state import ConversationState
+from message import ContentSection, Message
+from workflow_workers import WorkflowWorkerPool, _run_worker, _Worker
+
+
+class _GreetingWorkflow(AgentWorkflow):
+  """Says hello, asks for confirmation and (unless `block`) finishes."""
+
+  def __init__(self, options: AgentWorkflowOptions, args: dict[str,
+                                                               str]) -> None:
+    super().__init__(options)
+    self._args = args
+
+  async def run(self) -> None:
+    conversation = self._conversation_factory.New(self._args['name'],
+                                                  CommandRegistry())
+    await conversation.AddMessage(
+        Message('assistant', [ContentSection(content="hello")]))
+    confirmation_manager: ConfirmationManager = (
+        self._options.confirmation_manager)  # type: ignore[attr-defined]
+    confirmation = await confirmation_manager.RequireConfirmation(
+        conversation.GetId(), "continue?")
+    await conversation.AddMessage(
+        Message('assistant',
+                [ContentSection(content=f"confirmed: {confirmation}")]))
+    if 'block' in self._args:
+      await asyncio.Event().wait()
+
+
+class _GreetingWorkflowFactory(AgentWorkflowFactory):
+
+  def name(self) -> str:
+    return "greeting"
+
+  async def new(self, agent_workflow_options: AgentWorkflowOptions,
+                args: dict[str, str]) -> AgentWorkflow:
+    return _GreetingWorkflow(agent_workflow_options, args)
+
+
+class _InProcessWorkerPool(WorkflowWorkerPool):
+  """Runs each worker as a task (rather than a process)."""
+
+  async def _start_process(self, worker: _Worker) -> Any:
+    container = AgentWorkflowFactoryContainer()
+    container.add(_GreetingWorkflowFactory())
+
+    async def create_options(
+        confirmation_manager: ConfirmationManager,
+        conversation_factory: ConversationFactory) -> AgentWorkflowOptions:
+      return mock.MagicMock(
+          conversation_factory=conversation_factory,
+          confirmation_manager=confirmation_manager)
+
+    task = asyncio.create_task(
+        _run_worker(
+            str(self._socket_path), worker.index, container, create_options))
+
+    async def wait() -> int:
+      await asyncio.gather(task, return_exceptions=True)
+      return 1
+
+    return mock.MagicMock(pid=1000 + worker.index, wait=wait)
+
+
+class TestWorkflowWorkerPool(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self) -> None:
+    self._directory = tempfile.TemporaryDirectory()
+    self.conversation_factory = ConversationFactory(
+        ConversationFactoryOptions())
+
+    async def confirm(conversation_id: ConversationId, message: str) -> None:
+      self.confirmation_manager.provide_confirmation(conversation_id, "yes")
+
+    self.confirmation_manager = AsyncConfirmationManager(confirm)
+
+  async def asyncTearDown(self) -> None:
+    self.supervisor.cancel()
+    await asyncio.gather(self.supervisor, return_exceptions=True)
+    self._directory.cleanup()
+
+  async def start_pool(self, worker_count: int) -> WorkflowWorkerPool:
+    pool = _InProcessWorkerPool(
+        pathlib.Path(self._directory.name) / "workers.sock", worker_count, [],
+        self.conversation_factory, self.confirmation_manager)
+    await pool.start()
+    self.supervisor = asyncio.create_task(pool.wait())
+    return pool
+
+  async def wait_until(self, condition: Callable[[], bool]) -> None:
+    async with asyncio.timeout(5):
+      while not condition():
+        await asyncio.sleep(0.01)
+
+  def contents(self, conversation: Conversation) -> list[str]:
+    return [
+        section.content
+        for message in conversation.GetMessagesList()
+        for section in message.GetContentSections()
+    ]
+
+  def conversation(self, name: str) -> Conversation:
+    [conversation
+    ] = [c for c in self.conversation_factory.GetAll() if c.GetName() == name]
+    return conversation
+
+  async def test_streams_events_and_confirmations(self) -> None:
+    pool = await self.start_pool(1)
+    await pool.start_workflow("greeting", {'name': "first"})
+    await self.wait_until(lambda: any(
+        c.GetName() == "first" for c in self.conversation_factory.GetAll()))
+    conversation = self.conversation("first")
+    await self.wait_until(lambda: len(conversation.GetMessagesList()) == 2)
+    self.assertEqual(self.contents(conversation), ["hello", "confirmed: yes"])
+    await self.wait_until(lambda: not pool._workers[0].running)
+
+  async def test_places_workflows_in_least_loaded_worker(self) -> None:
+    pool = await self.start_pool(2)
+    await pool.start_workflow("greeting", {'name': "quick"})
+    await self.wait_until(lambda: not any(w.running for w in pool._workers))
+    for name in ["first", "second"]:
+      await pool.start_workflow("greeting", {'name': name, 'block': ""})
+    self.assertEqual([len(w.running) for w in pool._workers], [1, 1])
+
+  async def test_restart(self) -> None:
+    pool = await self.start_pool(1)
+    await pool.start_workflow(
+        "greeting", {
+            'name': "sharded",
+            'block': ""
+        }, sharded=True)
+    await pool.start_workflow("greeting", {'name': "lost", 'block': ""})
+    await self.wait_until(lambda: len(self.conversation_factory.GetAll()) == 2)
+    lost = self.conversation("lost")
+    await self.wait_until(lambda: len(lost.GetMessagesList()) == 2)
+
+    # Disconnecting the worker makes it exit.
+    worker = pool._workers[0]
+    assert worker.writer
+    worker.writer.close()
+
+    await self.wait_until(
+        lambda: worker.restarts == 1 and worker.connected.is_set())
+    self.assertEqual(lost.GetState(), ConversationState.DONE)
+    self.assertIn("Workflow worker 0 exited; this conversation was lost.",
+                  self.contents(lost))
+    # Only the sharded workflow is started again.
+    self.assertEqual(list(worker.running.values()), [("greeting", True)])
+    await self.wait_until(lambda: len(self.conversation_factory.GetAll()) == 3)
+
+  async def test_start_waits_for_reconnection(self) -> None:
+    pool = await self.start_pool(1)
+    worker = pool._workers[0]
+    await worker.connected.wait()
+
+    # Hold the restart back until the workflow is being started.
+    restart = asyncio.Event()
+    spawn = pool._spawn
+
+    async def delayed_spawn(worker: _Worker) -> None:
+      await restart.wait()
+      await spawn(worker)
+
+    with mock.patch.object(pool, '_spawn', delayed_spawn):
+      assert worker.writer
+      worker.writer.close()
+      await self.wait_until(
+          lambda: worker.restarts == 1 and worker.writer is None)
+      self.assertFalse(worker.connected.is_set())
+
+      start = asyncio.create_task(
+          pool.start_workflow("greeting", {
+              'name': "late",
+              'block': ""
+          }))
+      await asyncio.sleep(0.05)
+      self.assertFalse(start.done())
+      restart.set()
+      await start
+    self.assertEqual(list(worker.running.values()), [("greeting", False)])
+    await self.wait_until(lambda: len(self.conversation_factory.GetAll()) == 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
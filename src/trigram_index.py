@@ -0,0 +1,331 @@
+"""Persistent trigram index of the files visible through a file access policy.
+
+`SearchFileCommand` uses it (through `TrigramIndex.candidates`) to skip files
+that can't contain the search term: those that don't contain all of its
+trigrams. Trigrams are extracted from the (ASCII) lowercased bytes of each
+file, so the same index serves case-sensitive and case-insensitive searches.
+
+The index is kept in SQLite (see `default_index_path`). It is brought up to
+date by `refresh` (which compares the mtime and size of every file against
+the index); `candidates` schedules a refresh in the background whenever the
+last one is older than `refresh_interval`. Commands that write files call
+`update` so that their changes are reflected immediately; files changed
+otherwise (e.g., by git or an editor) are detected by `candidates`, which
+compares their mtime and size against the index.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Iterable
+
+from file_access_policy import FileAccessPolicy
+from file_search import SearchPattern
+from list_files import list_all_files
+
+DEFAULT_DIRECTORY = pathlib.Path.home() / ".duende" / "trigram_index"
+
+# Files larger than this aren't indexed (and are thus always searched).
+_MAX_FILE_BYTES = 1 << 20
+
+_BINARY_PROBE_BYTES = 8192
+
+_REFRESH_INTERVAL = datetime.timedelta(seconds=30)
+
+# Trigrams of the search term looked up (files containing a subset of them are
+# still a superset of those containing the term).
+_MAX_QUERY_TRIGRAMS = 32
+
+# Files indexed per transaction (while refreshing).
+_BATCH_SIZE = 200
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path    TEXT NOT NULL UNIQUE,  -- Absolute.
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL
+);
+-- The trigrams (three bytes, as a big-endian integer) in each file.
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram INTEGER NOT NULL,
+    file_id INTEGER NOT NULL,
+    PRIMARY KEY (trigram, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file_id);
+"""
+
+
+def default_index_path(root: pathlib.Path, policy_key: str) -> pathlib.Path:
+  """Returns the path for the index of `root` under the policy `policy_key`.
+
+  `policy_key` identifies the file access policy (e.g., the `repr` of its
+  `FileAccessPolicyConfig`): each policy gets its own index.
+  """
+  digest = hashlib.sha256(
+      f"{root.resolve()}\n{policy_key}".encode('utf-8')).hexdigest()
+  return DEFAULT_DIRECTORY / f"{digest[:32]}.sqlite"
+
+
+def _trigrams(contents: bytes) -> set[int]:
+  """Returns the trigrams in the lowercased `contents`."""
+  lowered = contents.lower()
+  return {(a << 16) | (b << 8) | c
+          for a, b, c in set(zip(lowered, lowered[1:], lowered[2:]))}
+
+
+class TrigramIndex:
+
+  def __init__(
+      self,
+      root: pathlib.Path,
+      file_access_policy: FileAccessPolicy,
+      path: pathlib.Path,
+      refresh_interval: datetime.timedelta = _REFRESH_INTERVAL) -> None:
+    self._root = root
+    self._file_access_policy = file_access_policy
+    self._path = path
+    self._refresh_interval = refresh_interval
+    self._connection: sqlite3.Connection | None = None
+    # Serializes the use of `_connection` (from worker threads).
+    self._lock = threading.Lock()
+    # Indexed files (by absolute path): file id, mtime (ns) and size.
+    self._files: dict[str, tuple[int, int, int]] = {}
+    # Whether a refresh has completed (before that, nothing is skipped).
+    self._ready = False
+    self._last_refresh: float | None = None  # `time.monotonic()`.
+    self._refresher: asyncio.Task[None] | None = None
+
+  async def open(self) -> None:
+    """Opens (or creates) the index and starts a refresh in the background."""
+    await asyncio.to_thread(self._open_in_thread)
+    self._start_refresh()
+
+  def _open_in_thread(self) -> None:
+    self._path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(
+        str(self._path), isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    self._files = {
+        path: (file_id, mtime_ns, size) for file_id, path, mtime_ns, size in
+        connection.execute("SELECT file_id, path, mtime_ns, size FROM files")
+    }
+    self._connection = connection
+
+  async def close(self) -> None:
+    if self._refresher is not None:
+      self._refresher.cancel()
+      await asyncio.gather(self._refresher, return_exceptions=True)
+    if self._connection is not None:
+      with self._lock:
+        self._connection.close()
+      self._connection = None
+
+  def _start_refresh(self) -> None:
+    if self._refresher is None or self._refresher.done():
+      self._refresher = asyncio.create_task(self._refresh_in_background())
+
+  async def _refresh_in_background(self) -> None:
+    try:
+      await self.refresh()
+    except Exception:
+      logging.exception("Trigram index: refresh failed.")
+
+  async def refresh(self) -> int:
+    """Indexes new and modified files and forgets those no longer visible.
+
+    Returns the number of files (re)indexed.
+    """
+    start = time.monotonic()
+    paths = [
+        os.path.abspath(path)
+        async for path in list_all_files(self._root, self._file_access_policy)
+    ]
+    changed = await asyncio.to_thread(self._changed_files, paths)
+    for i in range(0, len(changed), _BATCH_SIZE):
+      await asyncio.to_thread(self._index_in_thread, changed[i:i + _BATCH_SIZE])
+    removed = await asyncio.to_thread(self._removed_files, paths)
+    if removed:
+      await asyncio.to_thread(self._remove_in_thread, removed)
+    self._ready = True
+    self._last_refresh = start
+    logging.info(f"Trigram index: {len(paths)} files, {len(changed)} indexed, "
+                 f"{len(removed)} removed, "
+                 f"{time.monotonic() - start:.3f}s.")
+    return len(changed)
+
+  def _changed_files(self, paths: list[str]) -> list[str]:
+    changed: list[str] = []
+    for path in paths:
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      indexed = self._files.get(path)
+      if indexed is None or indexed[1:] != (stat.st_mtime_ns, stat.st_size):
+        changed.append(path)
+    return changed
+
+  def _removed_files(self, paths: list[str]) -> list[str]:
+    with self._lock:
+      return list(self._files.keys() - set(paths))
+
+  async def update(self, paths: Iterable[pathlib.Path]) -> None:
+    """Re-indexes `paths` (e.g., after writing them).
+
+    Paths that the file access policy doesn't allow are ignored.
+    """
+    absolute_paths = [
+        os.path.abspath(path)
+        for path in paths
+        if self._file_access_policy.allow_access(str(path))
+    ]
+    if absolute_paths:
+      await asyncio.to_thread(self._index_in_thread, absolute_paths)
+
+  def _index_in_thread(self, paths: list[str]) -> None:
+    """Indexes `paths` (removing those that can't be read) in a transaction."""
+    entries: list[tuple[str, os.stat_result, set[int]]] = []
+    removed: list[str] = []
+    for path in paths:
+      try:
+        stat = os.stat(path)
+        if stat.st_size > _MAX_FILE_BYTES:
+          removed.append(path)  # Files not indexed are always searched.
+          continue
+        with open(path, 'rb') as file:
+          contents = file.read()
+        # Binary files are indexed without trigrams (they're never searched).
+        binary = b'\0' in contents[:_BINARY_PROBE_BYTES]
+        entries.append((path, stat, set() if binary else _trigrams(contents)))
+      except OSError:
+        removed.append(path)
+    if removed:
+      self._remove_in_thread(removed)
+    if not entries:
+      return
+    with self._lock:
+      assert self._connection
+      connection = self._connection
+      connection.execute("BEGIN")
+      try:
+        for path, stat, trigrams in entries:
+          indexed = self._files.get(path)
+          if indexed is not None:
+            connection.execute("DELETE FROM trigrams WHERE file_id = ?",
+                               (indexed[0],))
+          file_id = connection.execute(
+              """
+              INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)
+              ON CONFLICT (path) DO UPDATE
+                  SET mtime_ns = excluded.mtime_ns, size = excluded.size
+              RETURNING file_id
+              """, (path, stat.st_mtime_ns, stat.st_size)).fetchone()[0]
+          connection.executemany(
+              "INSERT INTO trigrams (trigram, file_id) VALUES (?, ?)",
+              [(trigram, file_id) for trigram in trigrams])
+          self._files[path] = (file_id, stat.st_mtime_ns, stat.st_size)
+        connection.execute("COMMIT")
+      except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+
+  def _remove_in_thread(self, paths: list[str]) -> None:
+    file_ids = [(self._files[path][0],) for path in paths if path in self._files
+               ]
+    with self._lock:
+      assert self._connection
+      connection = self._connection
+      connection.execute("BEGIN")
+      try:
+        connection.executemany("DELETE FROM trigrams WHERE file_id = ?",
+                               file_ids)
+        connection.executemany("DELETE FROM files WHERE file_id = ?", file_ids)
+        connection.execute("COMMIT")
+      except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+      for path in paths:
+        self._files.pop(path, None)
+
+  async def candidates(self, paths: list[pathlib.Path],
+                       pattern: SearchPattern) -> list[pathlib.Path]:
+    """Returns the files in `paths` that may contain lines matching `pattern`.
+
+    Files that aren't indexed, or whose mtime or size differ from those
+    indexed, are always included. Returns all of `paths` if the index can't
+    narrow them down: before the first refresh completes, and for regular
+    expressions, terms shorter than three characters and case-insensitive
+    non-ASCII terms.
+    """
+    if (self._last_refresh is not None and time.monotonic() - self._last_refresh
+        > self._refresh_interval.total_seconds()):
+      self._start_refresh()
+    term = pattern.term.encode('utf-8')
+    if (not self._ready or pattern.regex or len(term) < 3 or
+        not (pattern.case_sensitive or pattern.term.isascii())):
+      return paths
+    matching = await asyncio.to_thread(self._matching_files_in_thread,
+                                       _trigrams(term))
+    return await asyncio.to_thread(self._filter_in_thread, paths, matching)
+
+  def _filter_in_thread(self, paths: list[pathlib.Path],
+                        matching: set[int]) -> list[pathlib.Path]:
+    """Returns the files in `paths` not excluded by the index.
+
+    Files not in `matching` are excluded only if they haven't changed since
+    they were indexed.
+    """
+    cwd = os.getcwd()
+    output: list[pathlib.Path] = []
+    for path in paths:
+      indexed = self._files.get(os.path.join(cwd, path))
+      if indexed is None or indexed[0] in matching or self._changed(
+          path, indexed):
+        output.append(path)
+    return output
+
+  def _changed(self, path: pathlib.Path, indexed: tuple[int, int, int]) -> bool:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return False  # Searching it would fail anyway.
+    return indexed[1:] != (stat.st_mtime_ns, stat.st_size)
+
+  def _matching_files_in_thread(self, trigrams: set[int]) -> set[int]:
+    """Returns the ids of the files that contain all of `trigrams`.
+
+    Only looks up (up to) `_MAX_QUERY_TRIGRAMS` of them.
+    """
+    selected = sorted(trigrams)[:_MAX_QUERY_TRIGRAMS]
+    query = " INTERSECT ".join(
+        ["SELECT file_id FROM trigrams WHERE trigram = ?"] * len(selected))
+    with self._lock:
+      assert self._connection
+      return {file_id for file_id, in self._connection.execute(query, selected)}
+
+
+_shared_indexes: dict[pathlib.Path, TrigramIndex] = {}
+
+
+async def shared_trigram_index(root: pathlib.Path,
+                               file_access_policy: FileAccessPolicy,
+                               policy_key: str) -> TrigramIndex:
+  """Returns the index (opened once per process) for `root` and the policy.
+
+  See `default_index_path` for `policy_key`.
+  """
+  path = default_index_path(root, policy_key)
+  index = _shared_indexes.get(path)
+  if index is None:
+    index = _shared_indexes[path] = TrigramIndex(root, file_access_policy, path)
+    await index.open()
+  return index
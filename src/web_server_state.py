@@ -1,6 +1,8 @@
 import asyncio
 import argparse
 import logging
+import pathlib
+import sys
 from pydantic import BaseModel
 from typing import Any
 import socketio
@@ -12,12 +14,14 @@ from agent_workflow import AgentWorkflow
 from agent_workflow_options import AgentWorkflowOptions
 from confirmation import AsyncConfirmationManager
 from conversation import Conversation, ConversationFactory, ConversationId, ConversationFactoryOptions
+from conversation_search import ConversationSearchIndex
 from implement_workflow import ImplementAndReviewWorkflow
 from message import Message
 from principle_review_workflow import PrincipleReviewWorkflow
 from random_key import GenerateRandomKey
 from review_evaluator_test_workflow import ReviewEvaluatorTestWorkflow
 from workflow_registry import StandardWorkflowFactoryContainer
+from workflow_workers import WorkflowWorkerPool
 
 
 class CreateAgentWorkflowData(BaseModel):
@@ -32,10 +36,13 @@ class WebServerState:
     self.session_key = GenerateRandomKey()
     self._background_tasks: list[asyncio.Task[None]] = []
     self._workflow_factory_container = StandardWorkflowFactoryContainer()
+    self._search_index = ConversationSearchIndex()
+    self._worker_pool: WorkflowWorkerPool | None = None
     self._conversation_factory = ConversationFactory(
         ConversationFactoryOptions(
             on_message_added_callback=self._on_conversation_updated,
-            on_state_changed_callback=self._on_conversation_updated))
+            on_state_changed_callback=self._on_conversation_updated,
+            search_index=self._search_index))
 
   async def start(self, args: argparse.Namespace) -> None:
     self.confirmation_manager = AsyncConfirmationManager(
@@ -50,6 +57,14 @@ class WebServerState:
     logging.info(str(self._agent_workflow_options))
     agent_workflow: AgentWorkflow | None = None
 
+    if args.workflow_workers:
+      self._worker_pool = WorkflowWorkerPool(
+          pathlib.Path(args.workflow_workers_socket), args.workflow_workers,
+          sys.argv[1:], self._conversation_factory, self.confirmation_manager)
+      await self._worker_pool.start()
+      self._background_tasks.append(
+          asyncio.create_task(self._worker_pool.wait()))
+
     if args.workflow:
       factory = self._workflow_factory_container.get(args.workflow)
       if not factory:
@@ -57,7 +72,11 @@ class WebServerState:
         raise ValueError(
             f"Unknown workflow: {args.workflow}. "
             f"Valid values: {self._workflow_factory_container.factory_names()}")
-      agent_workflow = await factory.new(self._agent_workflow_options, {})
+      if self._worker_pool:
+        await self._worker_pool.start_workflow(args.workflow, {},
+                                               factory.sharded())
+      else:
+        agent_workflow = await factory.new(self._agent_workflow_options, {})
     elif args.input:
       agent_workflow = PrincipleReviewWorkflow(self._agent_workflow_options)
     elif args.evaluate_evaluators:
@@ -84,9 +103,18 @@ class WebServerState:
                                      conversation_id: ConversationId) -> None:
     await self.send_update(conversation_id, None, confirmation_required=None)
 
-  async def send_update(self, conversation_id: ConversationId,
+  async def send_update(self,
+                        conversation_id: ConversationId,
                         client_message_count: int | None,
-                        confirmation_required: str | None) -> None:
+                        confirmation_required: str | None,
+                        limit: int | None = None,
+                        to: str | None = None) -> None:
+    """Emits an `update` event for a conversation.
+
+    If `client_message_count` is given, includes the messages starting at that
+    index (at most `limit`, if given). If `to` is given, only that client
+    receives the update.
+    """
     try:
       conversation = self._conversation_factory.Get(conversation_id)
     except KeyError:
@@ -97,7 +125,7 @@ class WebServerState:
 
     messages_list = conversation.GetMessagesList()
     if client_message_count is not None:
-      new_messages = messages_list[client_message_count:]
+      new_messages = messages_list[client_message_count:][:limit]
     else:
       new_messages = []
 
@@ -126,7 +154,7 @@ class WebServerState:
         'first_message_index':
             client_message_count or 0
     }
-    await self.socketio.emit('update', data)
+    await self.socketio.emit('update', data, to=to)
 
   async def _confirmation_requested(self, conversation_id: ConversationId,
                                     message: str) -> None:
@@ -168,6 +196,31 @@ class WebServerState:
                 max(c.GetId() for c in all_conversations)
         })
 
+  async def search_conversations(self, sid: str, query: str) -> None:
+    MAX_SEARCH_HITS = 50
+    hits = await self._search_index.search(query, limit=MAX_SEARCH_HITS)
+    # Hits in conversations removed since (e.g., evicted swarm sessions whose
+    # removal from the index is still queued) are skipped.
+    conversations = {c.GetId(): c for c in self._conversation_factory.GetAll()}
+    await self.socketio.emit(
+        'search_results', {
+            'query':
+                query,
+            'hits': [{
+                'conversation_id':
+                    hit.conversation_id,
+                'conversation_name':
+                    conversations[hit.conversation_id].GetName(),
+                'message_index':
+                    hit.message_index,
+                'role':
+                    hit.role,
+                'snippet':
+                    hit.snippet
+            } for hit in hits if hit.conversation_id in conversations]
+        },
+        to=sid)
+
   async def list_workflow_factories(self) -> None:
     await self.socketio.emit(
         'list_workflow_factories',
@@ -179,6 +232,10 @@ class WebServerState:
       logging.info(f"Unknown workflow factory: {data.name}")
       return
     logging.info(f"Create workflow: {data.name}")
+    if self._worker_pool:
+      await self._worker_pool.start_workflow(data.name, data.args,
+                                             factory.sharded())
+      return
     workflow = await factory.new(self._agent_workflow_options, data.args)
     self._background_tasks.append(asyncio.create_task(workflow.run()))
 
@@ -0,0 +1,497 @@
+"""Runs agent workflows in worker processes.
+
+The web server (`agent_server.py`) starts a `WorkflowWorkerPool`, which spawns
+worker processes (this file's `main`) and listens on a unix socket for them to
+connect. Each worker runs its own event loop, with its own conversations.
+Conversation events stream back to the web server, which mirrors them into its
+own `ConversationFactory` (so the web UI and search work unchanged).
+
+The protocol is one JSON object per line. Worker to server:
+
+* `hello`: `worker_index`.
+* `message_added`: `conversation_id`, `conversation_name`, `message` (from
+  `Message.ToPropertiesDict`).
+* `state_changed`: `conversation_id`, `conversation_name`, `state`.
+* `confirmation_requested`: `conversation_id`, `conversation_name`, `message`.
+* `load`: `workflows` (running), `cpu` (fraction of a CPU used since the last
+  `load`), `loop_lag` (the longest delay of the worker's event loop since the
+  last `load`, in seconds).
+* `workflow_finished`: `workflow_id`.
+
+Server to worker:
+
+* `start_workflow`: `workflow_id` (assigned by the server), `name`, `args`.
+* `confirm`: `conversation_id`, `confirmation`.
+
+Conversation ids in the protocol are those of the worker; the server maps them
+to ids in its own `ConversationFactory`.
+
+Sharded workflows (see `AgentWorkflowFactory.sharded`) run in every worker and
+are started again when a worker restarts (e.g., after a crash). Other workflows
+running in a worker that exits are lost: they are logged, and their mirrored
+conversations get a message saying so (and are marked as done).
+"""
+
+import asyncio
+import dataclasses
+import datetime
+import functools
+import json
+import logging
+import pathlib
+import sys
+import time
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from agent_workflow import AgentWorkflow, AgentWorkflowFactoryContainer
+from agent_workflow_options import AgentWorkflowOptions
+from args_common import CreateAgentWorkflowOptions, CreateCommonParser
+from command_registry import CommandRegistry
+from confirmation import AsyncConfirmationManager, ConfirmationManager
+from conversation import Conversation, ConversationFactory, ConversationFactoryOptions, ConversationId
+from conversation_state import ConversationState
+from message import ContentSection, Message
+from workflow_registry import StandardWorkflowFactoryContainer
+
+# Lines can contain full messages (e.g., large command outputs).
+_STREAM_LIMIT = 64 * 1024 * 1024
+
+# How often workers report their load.
+_LOAD_REPORT_PERIOD = datetime.timedelta(minutes=1)
+
+# How often workers measure the delay of their event loop.
+_LOOP_LAG_PROBE_PERIOD = datetime.timedelta(seconds=1)
+
+# Event loop delays longer than this are reported as warnings.
+_SLOW_LOOP_LAG = datetime.timedelta(seconds=1)
+
+
+async def _send(writer: asyncio.StreamWriter, data: dict[str, Any]) -> None:
+  writer.write(json.dumps(data).encode() + b"\n")
+  await writer.drain()
+
+
+async def _receive(reader: asyncio.StreamReader) -> dict[str, Any] | None:
+  """Returns the next object from `reader`, or None at the end of the stream."""
+  line = await reader.readline()
+  if not line:
+    return None
+  data: dict[str, Any] = json.loads(line)
+  return data
+
+
+class WorkerLoad(NamedTuple):
+  worker_index: int
+  pid: int | None
+  # Times the worker was restarted (after exiting).
+  restarts: int
+  # Values from the worker's last `load` event (see the protocol).
+  workflows: int
+  cpu: float
+  loop_lag: datetime.timedelta
+
+
+@dataclasses.dataclass
+class _Worker:
+  index: int
+  process: asyncio.subprocess.Process | None = None
+  writer: asyncio.StreamWriter | None = None
+  connected: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+  # The workflows running in the worker (by workflow id): their name and
+  # whether they are sharded.
+  running: dict[int, tuple[str, bool]] = dataclasses.field(default_factory=dict)
+  restarts: int = 0
+  # The `start_workflow` commands (name, args) of sharded workflows, sent again
+  # whenever the worker (re)connects.
+  sharded_workflows: list[tuple[str, dict[str, str]]] = dataclasses.field(
+      default_factory=list)
+  load: WorkerLoad | None = None
+
+
+class WorkflowWorkerPool:
+  """Web server side: spawns the workers and mirrors their conversations."""
+
+  def __init__(self, socket_path: pathlib.Path, worker_count: int,
+               worker_args: list[str],
+               conversation_factory: ConversationFactory,
+               confirmation_manager: AsyncConfirmationManager) -> None:
+    self._socket_path = socket_path
+    self._worker_args = worker_args
+    self._conversation_factory = conversation_factory
+    self._confirmation_manager = confirmation_manager
+    self._workers = [_Worker(index) for index in range(worker_count)]
+    # (worker index, worker conversation id) to local conversation.
+    self._conversations: dict[tuple[int, ConversationId], Conversation] = {}
+    # Confirmations being forwarded (see `_forward_confirmation`).
+    self._confirmation_tasks: set[asyncio.Task[None]] = set()
+    self._next_workflow_id = 0
+
+  async def start(self) -> None:
+    if self._socket_path.exists():
+      self._socket_path.unlink()
+    self._server = await asyncio.start_unix_server(
+        self._serve_worker, path=str(self._socket_path), limit=_STREAM_LIMIT)
+    for worker in self._workers:
+      await self._spawn(worker)
+
+  async def _spawn(self, worker: _Worker) -> None:
+    worker.connected.clear()
+    worker.writer = None
+    worker.load = None
+    worker.process = await self._start_process(worker)
+    logging.info(f"Started workflow worker {worker.index}: "
+                 f"pid {worker.process.pid}")
+
+  async def _start_process(self, worker: _Worker) -> asyncio.subprocess.Process:
+    return await asyncio.create_subprocess_exec(sys.executable,
+                                                str(pathlib.Path(__file__)),
+                                                '--worker-socket',
+                                                str(self._socket_path),
+                                                '--worker-index',
+                                                str(worker.index),
+                                                *self._worker_args)
+
+  async def wait(self) -> None:
+    """Restarts workers that exit. Never returns."""
+
+    async def _supervise(worker: _Worker) -> None:
+      while True:
+        assert worker.process
+        return_code = await worker.process.wait()
+        logging.error(f"Workflow worker {worker.index} exited "
+                      f"({return_code}); restarting it.")
+        worker.restarts += 1
+        await self._abandon_workflows(worker)
+        await self._spawn(worker)
+
+    await asyncio.gather(*(_supervise(w) for w in self._workers))
+
+  async def _abandon_workflows(self, worker: _Worker) -> None:
+    """Forgets the workflows and conversations of a worker that exited.
+
+    Logs the (non-sharded) workflows lost and tells the user, in each of the
+    worker's conversations that wasn't done, that it was lost.
+    """
+    lost = [name for name, sharded in worker.running.values() if not sharded]
+    if lost:
+      logging.error(f"Workflow worker {worker.index} exited; lost workflows "
+                    f"(not restarted): {lost}")
+    worker.running.clear()
+    for key in [key for key in self._conversations if key[0] == worker.index]:
+      conversation = self._conversations.pop(key)
+      if conversation.GetState() in (ConversationState.DONE,
+                                     ConversationState.DONE_FROM_CACHE):
+        continue
+      await conversation.AddMessage(
+          Message(
+              role='system',
+              content_sections=[
+                  ContentSection(
+                      content=f"Workflow worker {worker.index} exited; this "
+                      "conversation was lost.")
+              ]))
+      await conversation.SetState(ConversationState.DONE)
+
+  async def start_workflow(self,
+                           name: str,
+                           args: dict[str, str],
+                           sharded: bool = False) -> None:
+    """Starts a workflow in the worker running the fewest workflows.
+
+    If `sharded`, starts it in every worker instead, adding `shard_index` and
+    `shard_count` to `args`.
+    """
+    if sharded:
+      for worker in self._workers:
+        shard_args = {
+            **args, 'shard_index': str(worker.index),
+            'shard_count': str(len(self._workers))
+        }
+        worker.sharded_workflows.append((name, shard_args))
+        logging.info(f"Starting workflow {name} in worker {worker.index} "
+                     f"(shard {worker.index} of {len(self._workers)}).")
+        if worker.writer:
+          await self._send_start_workflow(worker, name, shard_args, True)
+      return
+
+    # The worker may disconnect again while we wait; if so, pick again.
+    while True:
+      worker = min(self._workers, key=lambda w: len(w.running))
+      await worker.connected.wait()
+      if worker.writer:
+        break
+    await self._send_start_workflow(worker, name, args, False)
+    logging.info(f"Started workflow {name} in worker {worker.index} "
+                 f"({len(worker.running)} workflows).")
+
+  async def _send_start_workflow(self, worker: _Worker, name: str,
+                                 args: dict[str, str], sharded: bool) -> None:
+    assert worker.writer
+    workflow_id = self._next_workflow_id
+    self._next_workflow_id += 1
+    worker.running[workflow_id] = (name, sharded)
+    await _send(
+        worker.writer, {
+            'type': 'start_workflow',
+            'workflow_id': workflow_id,
+            'name': name,
+            'args': args
+        })
+
+  async def _serve_worker(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+    hello = await _receive(reader)
+    if hello is None or hello.get('type') != 'hello':
+      logging.error(f"Invalid handshake from workflow worker: {hello}")
+      writer.close()
+      return
+    worker = self._workers[hello['worker_index']]
+    worker.writer = writer
+    # Copy: `start_workflow` may add (and send) more while we're sending these.
+    for name, args in list(worker.sharded_workflows):
+      await self._send_start_workflow(worker, name, args, True)
+    worker.connected.set()
+    logging.info(f"Workflow worker {worker.index} connected.")
+    while (event := await _receive(reader)) is not None:
+      try:
+        await self._handle_event(worker, event)
+      except Exception:
+        logging.exception(f"Failed to handle event from worker {worker.index}")
+    logging.error(f"Workflow worker {worker.index} disconnected.")
+    # The worker may have been restarted (and reconnected) already.
+    if worker.writer is writer:
+      worker.writer = None
+      worker.connected.clear()
+
+  def _get_conversation(self, worker: _Worker,
+                        event: dict[str, Any]) -> Conversation:
+    key = (worker.index, ConversationId(event['conversation_id']))
+    if key not in self._conversations:
+      self._conversations[key] = self._conversation_factory.New(
+          event['conversation_name'], CommandRegistry())
+    return self._conversations[key]
+
+  async def _handle_event(self, worker: _Worker, event: dict[str, Any]) -> None:
+    if event['type'] == 'load':
+      self._record_load(worker, event)
+      return
+    if event['type'] == 'workflow_finished':
+      # Absent if the worker exited (see `_abandon_workflows`) since.
+      finished = worker.running.pop(event['workflow_id'], None)
+      if finished is not None:
+        logging.info(f"Workflow {finished[0]} finished in worker "
+                     f"{worker.index} ({len(worker.running)} workflows).")
+      return
+    conversation = self._get_conversation(worker, event)
+    match event['type']:
+      case 'message_added':
+        await conversation.AddMessage(
+            Message.FromPropertiesDict(event['message']))
+      case 'state_changed':
+        await conversation.SetState(ConversationState[event['state']])
+      case 'confirmation_requested':
+        task = asyncio.create_task(
+            self._forward_confirmation(worker, event['conversation_id'],
+                                       conversation, event['message']))
+        self._confirmation_tasks.add(task)
+        task.add_done_callback(self._confirmation_tasks.discard)
+      case _:
+        logging.error(f"Unknown event from worker {worker.index}: {event}")
+
+  def _record_load(self, worker: _Worker, event: dict[str, Any]) -> None:
+    worker.load = WorkerLoad(
+        worker_index=worker.index,
+        pid=worker.process.pid if worker.process else None,
+        restarts=worker.restarts,
+        workflows=event['workflows'],
+        cpu=event['cpu'],
+        loop_lag=datetime.timedelta(seconds=event['loop_lag']))
+    description = (f"Workflow worker {worker.index} load: "
+                   f"{worker.load.workflows} workflows, "
+                   f"{worker.load.cpu:.0%} CPU, "
+                   f"event loop lag {worker.load.loop_lag}, "
+                   f"{worker.restarts} restarts.")
+    if worker.load.loop_lag > _SLOW_LOOP_LAG:
+      logging.warning(description)
+    else:
+      logging.info(description)
+
+  def loads(self) -> list[WorkerLoad]:
+    """Returns the last load reported by each worker (that reported one)."""
+    return [worker.load for worker in self._workers if worker.load]
+
+  async def _forward_confirmation(self, worker: _Worker,
+                                  worker_conversation_id: ConversationId,
+                                  conversation: Conversation,
+                                  message: str) -> None:
+    try:
+      confirmation = await self._confirmation_manager.RequireConfirmation(
+          conversation.GetId(), message)
+      if worker.writer is None:
+        logging.error(f"Worker {worker.index} gone; dropping confirmation.")
+        return
+      await _send(
+          worker.writer, {
+              'type': 'confirm',
+              'conversation_id': worker_conversation_id,
+              'confirmation': confirmation
+          })
+    except Exception:
+      logging.exception(
+          f"Failed to forward confirmation to worker {worker.index}.")
+
+
+class _RemoteConfirmationManager(ConfirmationManager):
+  """Worker side: forwards confirmation requests to the web server."""
+
+  def __init__(self, writer: asyncio.StreamWriter,
+               conversation_factory: ConversationFactory) -> None:
+    self._writer = writer
+    self._conversation_factory = conversation_factory
+    self._pending: dict[ConversationId, asyncio.Future[str]] = {}
+
+  async def RequireConfirmation(self, conversation_id: ConversationId,
+                                message: str) -> str | None:
+    if conversation_id in self._pending:
+      raise RuntimeError(f"Duplicate RequireConfirmation for {conversation_id}")
+    future = asyncio.Future[str]()
+    self._pending[conversation_id] = future
+    await _send(
+        self._writer, {
+            'type':
+                'confirmation_requested',
+            'conversation_id':
+                conversation_id,
+            'conversation_name':
+                self._conversation_factory.Get(conversation_id).GetName(),
+            'message':
+                message
+        })
+    return await future
+
+  def provide_confirmation(self, conversation_id: ConversationId,
+                           confirmation: str) -> None:
+    future = self._pending.pop(conversation_id, None)
+    if future and not future.done():
+      future.set_result(confirmation)
+
+
+async def _report_load_periodically(writer: asyncio.StreamWriter,
+                                    workflows: set[asyncio.Task[None]]) -> None:
+  """Sends a `load` event every `_LOAD_REPORT_PERIOD`."""
+  period_start = time.monotonic()
+  cpu_start = time.process_time()
+  loop_lag = 0.0
+  while True:
+    probe_start = time.monotonic()
+    await asyncio.sleep(_LOOP_LAG_PROBE_PERIOD.total_seconds())
+    now = time.monotonic()
+    loop_lag = max(loop_lag,
+                   now - probe_start - _LOOP_LAG_PROBE_PERIOD.total_seconds())
+    if now - period_start < _LOAD_REPORT_PERIOD.total_seconds():
+      continue
+    cpu = time.process_time()
+    await _send(
+        writer, {
+            'type': 'load',
+            'workflows': len(workflows),
+            'cpu': (cpu - cpu_start) / (now - period_start),
+            'loop_lag': loop_lag
+        })
+    period_start, cpu_start, loop_lag = now, cpu, 0.0
+
+
+async def _run_worker(
+    socket_path: str, worker_index: int,
+    workflow_factory_container: AgentWorkflowFactoryContainer,
+    create_options: Callable[[ConfirmationManager, ConversationFactory],
+                             Awaitable[AgentWorkflowOptions]]
+) -> None:
+  reader, writer = await asyncio.open_unix_connection(
+      socket_path, limit=_STREAM_LIMIT)
+  await _send(writer, {'type': 'hello', 'worker_index': worker_index})
+
+  async def _on_message_added(conversation_id: ConversationId) -> None:
+    conversation = conversation_factory.Get(conversation_id)
+    await _send(
+        writer, {
+            'type': 'message_added',
+            'conversation_id': conversation_id,
+            'conversation_name': conversation.GetName(),
+            'message': conversation.GetMessagesList()[-1].ToPropertiesDict()
+        })
+
+  async def _on_state_changed(conversation_id: ConversationId) -> None:
+    conversation = conversation_factory.Get(conversation_id)
+    await _send(
+        writer, {
+            'type': 'state_changed',
+            'conversation_id': conversation_id,
+            'conversation_name': conversation.GetName(),
+            'state': conversation.GetState().name
+        })
+
+  conversation_factory = ConversationFactory(
+      ConversationFactoryOptions(
+          on_message_added_callback=_on_message_added,
+          on_state_changed_callback=_on_state_changed))
+  confirmation_manager = _RemoteConfirmationManager(writer,
+                                                    conversation_factory)
+  options = await create_options(confirmation_manager, conversation_factory)
+  background_tasks: set[asyncio.Task[None]] = set()
+  load_reporter = asyncio.create_task(
+      _report_load_periodically(writer, background_tasks))
+
+  async def _finish_workflow(workflow_id: int) -> None:
+    await _send(writer, {
+        'type': 'workflow_finished',
+        'workflow_id': workflow_id
+    })
+
+  async def _run_workflow(workflow_id: int, workflow: AgentWorkflow) -> None:
+    try:
+      await workflow.run()
+    except Exception:
+      logging.exception(f"Workflow {workflow_id} failed.")
+    await _finish_workflow(workflow_id)
+
+  while (command := await _receive(reader)) is not None:
+    match command['type']:
+      case 'start_workflow':
+        factory = workflow_factory_container.get(command['name'])
+        if not factory:
+          logging.error(f"Unknown workflow factory: {command['name']}")
+          await _finish_workflow(command['workflow_id'])
+          continue
+        workflow = await factory.new(options, command['args'])
+        task = asyncio.create_task(
+            _run_workflow(command['workflow_id'], workflow))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+      case 'confirm':
+        confirmation_manager.provide_confirmation(
+            ConversationId(command['conversation_id']), command['confirmation'])
+      case _:
+        logging.error(f"Unknown command: {command}")
+  load_reporter.cancel()
+  logging.info("Web server disconnected; exiting.")
+
+
+def main() -> None:
+  parser = CreateCommonParser()
+  parser.add_argument('--worker-socket', type=str, required=True)
+  parser.add_argument('--worker-index', type=int, required=True)
+  # The server passes all its flags; ignore the ones that are only its own.
+  args, _ = parser.parse_known_args()
+  logging.basicConfig(
+      format=f'%(asctime)s - worker {args.worker_index} - %(levelname)s - '
+      '%(message)s',
+      level=logging.INFO)
+  asyncio.run(
+      _run_worker(args.worker_socket, args.worker_index,
+                  StandardWorkflowFactoryContainer(),
+                  functools.partial(CreateAgentWorkflowOptions, args)))
+
+
+if __name__ == '__main__':
+  main()
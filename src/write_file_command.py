@@ -8,24 +8,30 @@ from typing import Any
 
 from agent_command import AgentCommand, CommandInput, CommandOutput, CommandSyntax, Argument, ArgumentContentType, PATH_VARIABLE_NAME, REASON_VARIABLE, VariableName, VariableValue, VariableValueStr, VariableMap
 from file_access_policy import FileAccessPolicy
+from list_files import file_tree
 from pathbox import PathBox
 from validation import ValidationManager
 from selection_manager import SelectionManager
+from trigram_index import TrigramIndex
 
 _content_variable = VariableName("content")
 
 
 class WriteFileCommand(AgentCommand):
 
-  def __init__(self, cwd: PathBox, file_access_policy: FileAccessPolicy,
+  def __init__(self,
+               cwd: PathBox,
+               file_access_policy: FileAccessPolicy,
                validation_manager: ValidationManager | None,
                selection_manager: SelectionManager,
-               hard_coded_path: pathlib.Path | None):
+               hard_coded_path: pathlib.Path | None,
+               trigram_index: TrigramIndex | None = None):
     self._cwd = cwd
     self._file_access_policy = file_access_policy
     self.validation_manager = validation_manager
     self.selection_manager = selection_manager
     self._hard_coded_path = hard_coded_path
+    self._trigram_index = trigram_index
 
   def Name(self) -> str:
     return self.Syntax().name
@@ -130,8 +136,11 @@ class WriteFileCommand(AgentCommand):
 
       async with aiofiles.open(path, mode="w") as f:
         await f.write(new_content)
+      file_tree.invalidate(path)
       if self.validation_manager:
         self.validation_manager.RegisterChange()
+      if self._trigram_index:
+        await self._trigram_index.update([path])
 
       new_content_lines = new_content.splitlines()
       output_messages = [